@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+每日活跃设备位图
+
+“本月 / 本季度有多少台设备被使用过（按校区）”需要跨多天去重，原来只能对会话做 DISTINCT 扫描。
+现在每天保存一个位图：第 i 位表示 devices.id = i 的设备当天有会话开始（与 /api/stats 的
+active_players 口径一致，设备即 (player_id, player_name) 组合）。
+
+- 位图用 Python 整数表示、以小端字节序存为 BLOB（daily_active_devices，每天一行，
+  几千台设备也只有几百字节）；任意日期范围的去重设备数 = 各天位图按位或后的 1 的个数
+- 校区 / 项目筛选是与设备掩码按位与（设备按注册表归入校区 / 项目，规则与排行榜相同）
+- 接入端在创建会话的同一事务中置位；每个进程记住当天已置位的设备，同一设备当天只写一次
+- 删除会话 / 设备时重新计算对应位；位图与按日汇总一样不受会话保留期影响
+- 首次建表时从会话与归档汇总重建；也可以手动执行 `python active_bitmaps.py --rebuild`
+"""
+from datetime import datetime, timedelta, timezone
+
+from device_dimension import device_id_for
+import partitions
+from leaderboard import GROUPS, RegistryPlaces, group_key
+from models import db, Device, GameSession, DailyUsageArchive, DailyActiveDevices
+
+# 本进程当天已置位的 (day, device_id)
+_marked = set()
+_marked_day = None
+
+
+def to_bytes(bitmap):
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+
+def from_bytes(data):
+    return int.from_bytes(data, 'little') if data else 0
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).date() if value.tzinfo else value.date()
+    return value
+
+
+def _save(day, bitmap):
+    DailyActiveDevices.insert(
+        day=day, device_count=bitmap.bit_count(), bitmap=to_bytes(bitmap)
+    ).on_conflict(
+        conflict_target=[DailyActiveDevices.day],
+        preserve=[DailyActiveDevices.device_count, DailyActiveDevices.bitmap]
+    ).execute()
+
+
+def _load(day):
+    row = DailyActiveDevices.get_or_none(DailyActiveDevices.day == day)
+    return from_bytes(bytes(row.bitmap)) if row else 0
+
+
+def mark_active(device_id, start_time):
+    """会话开始时置位（应在创建会话的同一写事务中调用）"""
+    global _marked_day
+    day = _to_date(start_time)
+    if day != _marked_day:
+        _marked.clear()
+        _marked_day = day
+    if (day, device_id) in _marked:
+        return
+    bitmap = _load(day)
+    if not bitmap >> device_id & 1:
+        _save(day, bitmap | (1 << device_id))
+    _marked.add((day, device_id))
+
+
+def refresh_device_day(device_id, day):
+    """删除会话后重新计算某设备某天的位（仍有会话或归档汇总时保留）"""
+    day = _to_date(day)
+    device = Device.get_or_none(Device.id == device_id)
+    day_start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    active = GameSession.select().where(
+        GameSession.device == device_id,
+        GameSession.start_time >= day_start,
+        GameSession.start_time < day_start + timedelta(days=1)
+    ).exists() or partitions.device_has_sessions(device_id, day) or (device is not None and DailyUsageArchive.select().where(
+        DailyUsageArchive.day == day,
+        DailyUsageArchive.player_id == device.device_key,
+        DailyUsageArchive.player_name == device.name
+    ).exists())
+    bitmap = _load(day)
+    updated = bitmap | (1 << device_id) if active else bitmap & ~(1 << device_id)
+    if updated != bitmap:
+        _save(day, updated)
+    forget([device_id], day)
+
+
+def forget(device_ids, day=None):
+    """丢弃本进程的置位标记（day 为 None 时丢弃所有日期），下次会话开始时重新检查位图。
+    其他进程删除设备 / 会话后通过缓存失效通知调用（见 change_notify.py）"""
+    device_ids = set(device_ids)
+    # 通知回调与接入线程并发：先复制再遍历
+    for key in list(_marked):
+        if key[1] in device_ids and (day is None or key[0] == day):
+            _marked.discard(key)
+
+
+def clear_devices(device_ids):
+    """删除设备后清除其在所有日期的位"""
+    forget(device_ids)
+    mask = 0
+    for device_id in device_ids:
+        mask |= 1 << device_id
+    if not mask:
+        return
+    with db.atomic():
+        for day, blob in DailyActiveDevices.select(DailyActiveDevices.day, DailyActiveDevices.bitmap).tuples():
+            bitmap = from_bytes(bytes(blob))
+            if bitmap & mask:
+                _save(day, bitmap & ~mask)
+
+
+def rebuild():
+    """从会话与归档汇总重建全部位图，返回天数"""
+    bitmaps = {}
+
+    def collect(start, end):
+        for device_id, start_time in GameSession.select(GameSession.device, GameSession.start_time).where(
+                *partitions.range_conditions(start, end)).tuples().iterator():
+            day = _to_date(start_time)
+            bitmaps[day] = bitmaps.get(day, 0) | (1 << device_id)
+    partitions.across(None, None, collect)
+    for day, player_id, player_name in DailyUsageArchive.select(
+            DailyUsageArchive.day, DailyUsageArchive.player_id, DailyUsageArchive.player_name).tuples():
+        # 维度表只包含迁移时仍有会话的设备，只存在于归档汇总中的设备在这里补建
+        device_id = device_id_for(player_id, player_name)
+        day = _to_date(day)
+        bitmaps[day] = bitmaps.get(day, 0) | (1 << device_id)
+    with db.atomic():
+        DailyActiveDevices.delete().execute()
+        for day, bitmap in bitmaps.items():
+            _save(day, bitmap)
+    _marked.clear()
+    return len(bitmaps)
+
+
+def ensure_bitmap_table():
+    """创建位图表；首次创建时重建"""
+    exists = DailyActiveDevices.table_exists()
+    db.create_tables([DailyActiveDevices], safe=True)
+    if not exists:
+        rebuild()
+
+
+def _device_masks(group, campus_name=None, project_name=None):
+    """返回 (筛选掩码或 None, {分组 key: 掩码})"""
+    registry = RegistryPlaces()
+    filter_mask = 0 if (campus_name or project_name) else None
+    group_masks = {}
+    for device_id, player_id, player_name, registry_id in Device.select(
+            Device.id, Device.device_key, Device.name, Device.registry_id).tuples():
+        place = registry.place(player_id, player_name, registry_id)
+        if filter_mask is not None and place is not None \
+                and (not campus_name or place[0] == campus_name) \
+                and (not project_name or place[1] == project_name):
+            filter_mask |= 1 << device_id
+        if group:
+            key = group_key(group, player_id, place)
+            if key is not None:
+                group_masks[key] = group_masks.get(key, 0) | (1 << device_id)
+    return filter_mask, group_masks
+
+
+def compute_distinct_devices(start_date, end_date, campus_name=None, project_name=None, group=None):
+    """日期闭区间内去重的活跃设备数（/api/distinct-devices）"""
+    if end_date < start_date:
+        raise ValueError('end_date 不能早于 start_date')
+    if group and group not in GROUPS:
+        raise ValueError(f"group 必须是 {'/'.join(GROUPS)}")
+
+    union = 0
+    daily = []
+    # 直接读游标：日期保持 ISO 字符串，省去逐行解析（范围查询本身只有 天数 行）
+    for day, blob in db.execute_sql(
+            'SELECT day, bitmap FROM daily_active_devices WHERE day BETWEEN ? AND ? ORDER BY day',
+            (start_date.isoformat(), end_date.isoformat())):
+        bitmap = from_bytes(blob)
+        daily.append((day, bitmap))
+        union |= bitmap
+
+    filter_mask = None
+    group_masks = {}
+    if campus_name or project_name or group:
+        filter_mask, group_masks = _device_masks(group, campus_name, project_name)
+    if filter_mask is not None:
+        union &= filter_mask
+
+    result = {
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'filter': {'campus_name': campus_name, 'project_name': project_name},
+        'distinct_devices': union.bit_count(),
+        'daily': [{
+            'date': day,
+            'active_devices': (bitmap & filter_mask if filter_mask is not None else bitmap).bit_count(),
+        } for day, bitmap in daily],
+    }
+    if group:
+        groups = [{'key': key, 'distinct_devices': (union & mask).bit_count()}
+                  for key, mask in group_masks.items()]
+        result['groups'] = sorted([g for g in groups if g['distinct_devices']],
+                                  key=lambda g: (-g['distinct_devices'], str(g['key'])))
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description='每日活跃设备位图')
+    parser.add_argument('--rebuild', action='store_true', help='从会话与归档汇总重建全部位图')
+    args = parser.parse_args()
+
+    init_db()
+    if args.rebuild:
+        print(f"已重建 {rebuild()} 天的位图")
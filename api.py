@@ -1,13 +1,32 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, jsonify, request, send_from_directory, Response
+from flask import Flask, jsonify, request, Response, g, abort
 from flask_cors import CORS
+import functools
 import json
 import time
 import threading
 import queue
+import re
 
 import os
-from models import GameSession, DeviceStatus, DeviceRegistry, normalize_ble_id, db
+import metrics
+import minute_activity
+import device_jobs
+import active_bitmaps
+import interval_index
+import leaderboard
+import partitions
+import quantile_sketch
+import registry_io
+import registry_search
+import retention
+import sql_profiler
+from data_cache import DataVersion, VersionedCache
+from http_cache import CachedBody, StaticAssets, compress_response
+from change_notify import ChangeListener, forget_devices
+from log_utils import setup_logging, ingest_log
+from models import Device, GameSession, DeviceStatus, DeviceRegistry, DailyUsageArchive, normalize_ble_id, db
+from peewee import fn
 from datetime import datetime, timedelta, timezone
 import logging
 
@@ -46,15 +65,17 @@ def to_utc_datetime(value):
         return dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(timezone.utc)
 
-app = Flask(__name__)
+# 静态文件由 static_files 路由提供（预压缩 + 内容哈希 ETag），不注册 Flask 内置的 static 端点
+app = Flask(__name__, static_folder=None)
 CORS(app, origins=["*"])
 
 # 用于实时更新的队列
 update_queue = queue.Queue()
 clients = []
+metrics.UPDATE_QUEUE_DEPTH.set_function(update_queue.qsize)
 
 # 配置日志
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # 离线阈值（秒），默认 300
@@ -63,19 +84,83 @@ try:
 except Exception:
     OFFLINE_WINDOW_SECONDS = 300
 
+# 响应缓存：数据版本不变时直接复用已序列化（及已压缩）的响应体；
+# 依赖当前时间的状态（在线/离线）最多滞后 DASHBOARD_CACHE_SECONDS 秒
+try:
+    DASHBOARD_CACHE_SECONDS = int(os.environ.get('DASHBOARD_CACHE_SECONDS', '10'))
+except Exception:
+    DASHBOARD_CACHE_SECONDS = 10
+data_version = DataVersion(db.database)
+response_cache = VersionedCache(data_version, max_entries=256)
+# 按时间点查询设备状态的会话区间索引（按月惰性建立）
+as_of_index = interval_index.AsOfIndex(data_version)
+static_assets = StaticAssets(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+
+class _UncacheableResponse(Exception):
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+def cached_json(time_sensitive=False):
+    """按数据版本缓存 GET 接口的 JSON 响应（仅缓存 200 响应）
+
+    - 缓存 key 包含路径、查询参数和当天日期；time_sensitive 时再按 DASHBOARD_CACHE_SECONDS 分桶
+    - 缓存条目同时保存 gzip 版本与 ETag，命中时无需重新序列化和压缩
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = [request.path, tuple(sorted(request.args.items(multi=True))),
+                   datetime.now(timezone.utc).date()]
+            if time_sensitive:
+                key.append(int(time.time() // DASHBOARD_CACHE_SECONDS) if DASHBOARD_CACHE_SECONDS > 0 else time.time())
+
+            def compute():
+                result = view(*args, **kwargs)
+                if isinstance(result, tuple) or result.status_code != 200:
+                    raise _UncacheableResponse(result)
+                return CachedBody(result.get_data(), result.mimetype)
+
+            try:
+                body, _ = response_cache.get_or_compute(tuple(key), compute)
+            except _UncacheableResponse as e:
+                return e.response
+            return body.to_response(request)
+        return wrapper
+    return decorator
+
 @app.before_request
 def before_request():
-    """每次请求前连接数据库"""
+    """每次请求前连接数据库（GET / HEAD 使用只读连接，不与接入争用写锁）"""
+    g.request_start = time.perf_counter()
+    sql_profiler.begin(f'{request.method} {request.endpoint or "unmatched"}')
     if db.is_closed():
-        db.connect()
+        if request.method in ('GET', 'HEAD'):
+            db.connect_reader()
+        else:
+            db.connect()
 
 @app.after_request
 def after_request(response):
     """每次请求后关闭数据库连接"""
     if not db.is_closed():
         db.close()
+    profile = sql_profiler.end()
+    if profile is not None and sql_profiler.header_enabled(app.debug):
+        response.headers['X-SQL-Profile'] = profile.header()
+    response = compress_response(request, response)
+    start = g.get('request_start')
+    if start is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            request.endpoint or 'unmatched', request.method, response.status_code)
     return response
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 指标"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/sessions', methods=['GET'])
 def get_sessions():
     """获取游戏会话列表"""
@@ -84,23 +169,31 @@ def get_sessions():
         per_page = int(request.args.get('per_page', 20))
         player_id = request.args.get('player_id')
         
-        query = GameSession.select().order_by(GameSession.created_at.desc())
+        query = GameSession.select(GameSession, Device.id, Device.device_key, Device.name).join(Device).order_by(
+            GameSession.created_at.desc())
         
         if player_id:
-            query = query.where(GameSession.player_id == player_id)
+            query = query.where(Device.device_key == player_id)
         
         # 分页
         sessions = query.paginate(page, per_page)
         
+        sessions = list(sessions)
+        # 会话期间实际收到心跳的分钟数（见 minute_activity.py）
+        active_minutes = minute_activity.session_minutes([
+            (session.id, session.device_id, to_utc_datetime(session.start_time), to_utc_datetime(session.end_time))
+            for session in sessions])
+
         result = []
         for session in sessions:
             result.append({
                 'id': session.id,
-                'player_id': session.player_id,
-                'player_name': session.player_name,
+                'player_id': session.device.device_key,
+                'player_name': session.device.name,
                 'start_time': format_datetime_for_frontend(session.start_time),
                 'end_time': format_datetime_for_frontend(session.end_time),
                 'duration_seconds': session.duration_seconds,
+                'active_minutes': active_minutes[session.id],
                 'created_at': format_datetime_for_frontend(session.created_at)
             })
         
@@ -117,20 +210,17 @@ def get_sessions():
 
 @app.route('/api/device-registry', methods=['GET'])
 def list_device_registry():
+    """查询注册表：q 走全文索引，cursor 为 keyset 分页游标（兼容 page 参数）"""
     try:
         page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 20))
+        per_page = min(max(int(request.args.get('per_page', 20)), 1), 500)
         query_kw = request.args.get('q')
         status = request.args.get('status')
+        cursor = request.args.get('cursor')
 
-        q = DeviceRegistry.select().order_by(DeviceRegistry.updated_at.desc())
-        if query_kw:
-            kw = f"%{query_kw}%"
-            q = q.where((DeviceRegistry.ble_id.contains(query_kw)) | (DeviceRegistry.campus_name.contains(query_kw)) | (DeviceRegistry.project_name.contains(query_kw)))
-        if status:
-            q = q.where(DeviceRegistry.status == status)
-
-        items = q.paginate(page, per_page)
+        items, total, next_cursor = registry_search.search_registry(
+            query_kw, status=status, cursor=cursor, per_page=per_page,
+            page=None if cursor else page)
         data = [{
             'ble_id': item.ble_id,
             'campus_name': item.campus_name,
@@ -141,7 +231,10 @@ def list_device_registry():
             'updated_at': format_datetime_for_frontend(item.updated_at)
         } for item in items]
 
-        return jsonify({'success': True, 'data': data, 'page': page, 'per_page': per_page})
+        return jsonify({'success': True, 'data': data, 'page': page, 'per_page': per_page,
+                        'total': total, 'next_cursor': next_cursor})
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'参数错误: {e}'}), 400
     except Exception as e:
         logger.error(f"查询设备注册表失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -181,6 +274,49 @@ def create_device_registry():
         logger.error(f"创建设备注册记录失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _flag(name):
+    return (request.args.get(name) or '').lower() in ('1', 'true', 'yes')
+
+@app.route('/api/device-registry/import', methods=['POST'])
+def import_device_registry():
+    """批量导入注册表：上传文件（file 字段）、text/csv 请求体或 JSON 列表；单事务 upsert，逐行报告错误"""
+    try:
+        upload = request.files.get('file')
+        if upload is not None:
+            content = upload.read().decode('utf-8-sig')
+            if (upload.filename or '').lower().endswith('.json'):
+                rows = registry_io.parse_records(json.loads(content))
+            else:
+                rows = registry_io.parse_csv(content)
+        elif request.mimetype in ('text/csv', 'text/plain'):
+            rows = registry_io.parse_csv(request.get_data(as_text=True))
+        else:
+            rows = registry_io.parse_records(request.get_json(force=True))
+
+        report = registry_io.import_registry(
+            rows, dry_run=_flag('dry_run'), all_or_nothing=_flag('all_or_nothing'))
+        logger.info(f"批量导入注册表: 共 {report['total']} 行，新增 {report['inserted']}，"
+                    f"更新 {report['updated']}，失败 {report['failed']}，已提交 {report['committed']}")
+        return jsonify({'success': True, 'data': report})
+    except (registry_io.RegistryImportError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'无法解析导入数据: {e}'}), 400
+    except Exception as e:
+        logger.error(f"批量导入注册表失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/device-registry/export', methods=['GET'])
+def export_device_registry():
+    """流式导出注册表（format=csv|json），导出文件可直接用于批量导入"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'json'):
+        return jsonify({'success': False, 'error': 'format 必须是 csv 或 json'}), 400
+    filename = f"device_registry_{datetime.now(timezone.utc).strftime('%Y%m%d')}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/json'
+    return Response(registry_io.iter_export(fmt), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Cache-Control': 'no-store'
+    })
+
 @app.route('/api/device-registry/<ble_id>', methods=['PUT'])
 def update_device_registry(ble_id):
     try:
@@ -234,410 +370,726 @@ def delete_device_registry(ble_id):
         logger.error(f"获取会话列表时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+class SessionRow:
+    """查询结果中的会话（时间已规范为 UTC datetime）"""
+    __slots__ = ('id', 'device_id', 'player_id', 'player_name', 'start_time', 'end_time', 'duration_seconds')
+
+    def __init__(self, id, device_id, player_id, player_name, start_time, end_time, duration_seconds):
+        self.id = id
+        self.device_id = device_id
+        self.player_id = player_id
+        self.player_name = player_name
+        self.start_time = to_utc_datetime(start_time)
+        self.end_time = to_utc_datetime(end_time)
+        self.duration_seconds = duration_seconds
+
+    @property
+    def last_activity(self):
+        """最后活动时间（开始时间或结束时间中较晚的）"""
+        if self.end_time:
+            return max(self.start_time, self.end_time)
+        return self.start_time
+
+def _session_rows(query):
+    return [SessionRow(*row) for row in query.tuples()]
+
+def _select_sessions():
+    """会话连同设备标识（devices 维度表）"""
+    return GameSession.select(
+        GameSession.id, GameSession.device, Device.device_key, Device.name,
+        GameSession.start_time, GameSession.end_time, GameSession.duration_seconds
+    ).join(Device)
+
+class DashboardContext:
+    """一次请求内共享的中间结果：各面板需要的查询只执行一次（惰性计算）"""
+
+    def __init__(self, now=None):
+        self.now = now or datetime.now(timezone.utc)
+        self.today = self.now.date()
+        self._memo = {}
+        self._window = None  # (start, end, 按开始时间倒序的会话列表)
+
+    def _cached(self, key, compute):
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def sessions_between(self, start, end):
+        """开始时间在 [start, end) 内的会话（倒序）。多次调用时合并为一次范围查询"""
+        if self._window is None or start < self._window[0] or end > self._window[1]:
+            if self._window is not None:
+                start_q, end_q = min(start, self._window[0]), max(end, self._window[1])
+            else:
+                start_q, end_q = start, end
+            # 已封存的月份按分区分段查询，段内倒序、段间按时间从晚到早拼接
+            chunks = partitions.across(start_q, end_q, lambda ws, we: _session_rows(
+                _select_sessions().where(*partitions.range_conditions(ws, we))
+                .order_by(GameSession.start_time.desc())))
+            rows = [row for chunk in reversed(chunks) for row in chunk]
+            self._window = (start_q, end_q, rows)
+        return [s for s in self._window[2] if start <= s.start_time < end]
+
+    def device_pairs(self):
+        """历史会话中出现过的 (player_id, player_name) 组合"""
+        def compute():
+            def run(start, end):
+                has_sessions = fn.EXISTS(GameSession.select(GameSession.id).where(
+                    GameSession.device == Device.id, *partitions.range_conditions(start, end)))
+                return list(Device.select(Device.id, Device.device_key, Device.name).where(has_sessions).tuples())
+            found = {row[0]: row[1:] for chunk in partitions.across(None, None, run) for row in chunk}
+            return [found[device_id] for device_id in sorted(found)]
+        return self._cached('device_pairs', compute)
+
+    def devices(self):
+        """设备维度表 [(id, player_id, player_name, registry_id)]"""
+        return self._cached('devices', lambda: list(Device.select(
+            Device.id, Device.device_key, Device.name, Device.registry_id).tuples()))
+
+    def latest_sessions(self):
+        """每个设备开始时间最晚的会话 {player_id: SessionRow}"""
+        def compute():
+            # SQLite 中 MAX() 聚合时裸列取自最大值所在行
+            def run(start, end):
+                return _session_rows(GameSession.select(
+                    GameSession.id, GameSession.device, Device.device_key, Device.name,
+                    fn.MAX(GameSession.start_time), GameSession.end_time, GameSession.duration_seconds
+                ).join(Device).where(*partitions.range_conditions(start, end)).group_by(Device.device_key))
+            latest = {}
+            for chunk in partitions.across(None, None, run):
+                for row in chunk:
+                    if row.player_id not in latest or row.start_time > latest[row.player_id].start_time:
+                        latest[row.player_id] = row
+            return latest
+        return self._cached('latest_sessions', compute)
+
+    def player_totals(self):
+        """每个设备已完成会话的 {player_id: (总时长, 次数)}"""
+        def compute():
+            totals = {}
+            for chunk in partitions.across(None, None, lambda start, end: list(GameSession.select(
+                    Device.device_key,
+                    fn.SUM(GameSession.duration_seconds),
+                    fn.COUNT(GameSession.duration_seconds)
+            ).join(Device).where(
+                GameSession.duration_seconds.is_null(False), *partitions.range_conditions(start, end)
+            ).group_by(Device.device_key).tuples())):
+                for player_id, total, count in chunk:
+                    previous = totals.get(player_id, (0, 0))
+                    totals[player_id] = (previous[0] + (total or 0), previous[1] + count)
+            return totals
+        return self._cached('player_totals', compute)
+
+    def device_statuses(self):
+        return self._cached('device_statuses', lambda: list(DeviceStatus.select()))
+
+    def sessions_by_id(self, ids):
+        ids = [i for i in ids if i]
+        if not ids:
+            return {}
+        return {row.id: row for row in _session_rows(
+            _select_sessions().where(GameSession.id.in_(ids)))}
+
+    def active_registries(self):
+        return self._cached('active_registries', lambda: list(
+            DeviceRegistry.select().where(DeviceRegistry.status == 'active')))
+
+    def archived_days(self, start_date, end_date):
+        """已清理会话的按日汇总 {date: [DailyUsageArchive]}（日期闭区间，见 retention.py）"""
+        def compute():
+            by_day = {}
+            for row in DailyUsageArchive.select().where(
+                    DailyUsageArchive.day.between(start_date, end_date)):
+                by_day.setdefault(_to_date(row.day), []).append(row)
+            return by_day
+        return self._cached(('archived_days', start_date, end_date), compute)
+
+    def minute_activity(self, start_date, end_date):
+        """日期闭区间内各设备每天的活跃分钟数 {(date, player_id): 分钟数}（见 minute_activity.py）"""
+        return self._cached(('minute_activity', start_date, end_date),
+                            lambda: minute_activity.daily_minutes(start_date, end_date))
+
+    def archive_totals(self):
+        """归档汇总中每个设备的 {player_id: (总时长, 完成次数, 最后活动时间)}"""
+        return self._cached('archive_totals', lambda: {
+            player_id: (total or 0, completed or 0, to_utc_datetime(last_activity))
+            for player_id, total, completed, last_activity in DailyUsageArchive.select(
+                DailyUsageArchive.player_id,
+                fn.SUM(DailyUsageArchive.total_seconds),
+                fn.SUM(DailyUsageArchive.completed_sessions),
+                fn.MAX(DailyUsageArchive.last_activity)
+            ).group_by(DailyUsageArchive.player_id).tuples()
+        })
+
+    def archive_pairs(self):
+        """归档汇总中出现过的 (player_id, player_name) 组合"""
+        return self._cached('archive_pairs', lambda: list(DailyUsageArchive.select(
+            DailyUsageArchive.player_id, DailyUsageArchive.player_name
+        ).distinct().tuples()))
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value
+
+def _day_range(day):
+    day_start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    return day_start, day_start + timedelta(days=1)
+
+def compute_stats(ctx, target_date):
+    """使用统计（/api/stats）"""
+    day_start, day_end = _day_range(target_date)
+    week_start_date = target_date - timedelta(days=target_date.weekday())
+    week_start, _ = _day_range(week_start_date)
+    week_end = week_start + timedelta(days=7)
+
+    # 指定日期所在周的会话（包含指定日期）
+    week_sessions = ctx.sessions_between(week_start, week_end)
+    week_completed = [s for s in week_sessions if s.duration_seconds is not None]
+    day_sessions = [s for s in week_sessions if day_start <= s.start_time < day_end]
+    day_completed = [s for s in day_sessions if s.duration_seconds is not None]
+
+    # 活跃玩家统计
+    active_players = {(s.player_id, s.player_name) for s in day_sessions}
+
+    # 合并已归档（原始会话已清理）的日期
+    archived = ctx.archived_days(week_start_date, week_start_date + timedelta(days=6))
+    week_archived = [row for rows in archived.values() for row in rows]
+    day_archived = archived.get(target_date, [])
+    active_players.update((row.player_id, row.player_name) for row in day_archived)
+
+    # 在线设备统计（最近5分钟内有活动的设备）
+    five_minutes_ago = ctx.now - timedelta(minutes=5)
+    online_devices = GameSession.select(
+        Device.device_key,
+        Device.name
+    ).join(Device).where(
+        (GameSession.end_time.is_null()) |
+        (GameSession.start_time >= five_minutes_ago)
+    ).distinct()
+
+    return {
+        'selected_date': target_date.isoformat(),
+        'day': {
+            'total_time_seconds': sum(s.duration_seconds for s in day_completed)
+                                  + sum(row.total_seconds for row in day_archived),
+            'session_count': len(day_completed) + sum(row.completed_sessions for row in day_archived),
+            'active_players': len(active_players)
+        },
+        'week': {
+            'total_time_seconds': sum(s.duration_seconds for s in week_completed)
+                                  + sum(row.total_seconds for row in week_archived),
+            'session_count': len(week_completed) + sum(row.completed_sessions for row in week_archived)
+        },
+        'online_devices': online_devices.count()
+    }
+
+def compute_players(ctx):
+    """玩家列表及其使用统计（/api/players），按总使用时长排序"""
+    totals = ctx.player_totals()
+    latest = ctx.latest_sessions()
+    archive_totals = ctx.archive_totals()
+    # 原始会话已全部清理的设备仍保留在排行榜中
+    pairs = ctx.device_pairs()
+    seen = set(pairs)
+    pairs = pairs + [pair for pair in ctx.archive_pairs() if pair not in seen]
+    result = []
+    for player_id, player_name in pairs:
+        total_time, session_count = totals.get(player_id, (0, 0))
+        # 最后一次游戏时间 - 使用最新的活动时间
+        last_session = latest.get(player_id)
+        last_played = last_session.last_activity if last_session else None
+        archived = archive_totals.get(player_id)
+        if archived:
+            total_time += archived[0]
+            session_count += archived[1]
+            if last_played is None:
+                last_played = archived[2]
+        result.append({
+            'player_id': player_id,
+            'player_name': player_name,
+            'total_time_seconds': total_time,
+            'session_count': session_count,
+            'last_played': format_datetime_for_frontend(last_played)
+        })
+    result.sort(key=lambda x: x['total_time_seconds'], reverse=True)
+    return result
+
+def compute_device_status(ctx):
+    """设备实时状态（/api/device-status）"""
+    now_utc = ctx.now
+    devices_map = {}
+
+    # 先用 DeviceStatus 构建设备视图
+    statuses = ctx.device_statuses()
+    current_sessions = ctx.sessions_by_id([d.current_session_id for d in statuses])
+    for d in statuses:
+        last_seen = to_utc_datetime(d.last_seen)
+        latest_session = current_sessions.get(d.current_session_id) if d.current_session_id else None
+
+        status = "offline"
+        if latest_session is not None and latest_session.end_time is None and last_seen and (now_utc - last_seen).total_seconds() <= OFFLINE_WINDOW_SECONDS:
+            status = "playing"
+        elif last_seen and (now_utc - last_seen).total_seconds() <= OFFLINE_WINDOW_SECONDS:
+            status = "online"
+
+        devices_map[d.player_id] = {
+            'player_id': d.player_id,
+            'player_name': d.player_name,
+            'status': status,
+            'current_session_id': d.current_session_id,
+            'last_activity': format_datetime_for_frontend(last_seen)
+        }
+
+    # 用历史会话补全未入 DeviceStatus 的设备
+    latest = ctx.latest_sessions()
+    for player_id, player_name in ctx.device_pairs():
+        if player_id in devices_map:
+            continue
+        latest_session = latest.get(player_id)
+
+        last_activity = None
+        status = "offline"
+        current_session_id = None
+        if latest_session:
+            last_activity = latest_session.last_activity
+            if latest_session.end_time is None:
+                status = "playing"
+                current_session_id = latest_session.id
+            elif (now_utc - last_activity).total_seconds() <= OFFLINE_WINDOW_SECONDS:
+                status = "online"
+
+        devices_map[player_id] = {
+            'player_id': player_id,
+            'player_name': player_name,
+            'status': status,
+            'current_session_id': current_session_id,
+            'last_activity': format_datetime_for_frontend(last_activity)
+        }
+
+    devices = list(devices_map.values())
+
+    # 统计各状态数量
+    status_count = {
+        'online': len([d for d in devices if d['status'] == 'online']),
+        'playing': len([d for d in devices if d['status'] == 'playing']),
+        'offline': len([d for d in devices if d['status'] == 'offline'])
+    }
+    return {
+        'devices': devices,
+        'status_count': status_count,
+        'total_devices': len(devices)
+    }
+
+def compute_campus_projects(ctx):
+    """所有校区和项目列表（/api/campus-projects）"""
+    campuses = set()
+    projects = set()
+    campus_projects = {}  # {校区: [项目列表]}
+    for reg in ctx.active_registries():
+        campuses.add(reg.campus_name)
+        projects.add(reg.project_name)
+        if reg.campus_name not in campus_projects:
+            campus_projects[reg.campus_name] = []
+        if reg.project_name not in campus_projects[reg.campus_name]:
+            campus_projects[reg.campus_name].append(reg.project_name)
+    return {
+        'campuses': sorted(list(campuses)),
+        'projects': sorted(list(projects)),
+        'campus_projects': {k: sorted(v) for k, v in campus_projects.items()}
+    }
+
+def resolve_chart_range(args, today):
+    """解析图表日期范围参数，返回 (start_date, end_date, days)"""
+    days = int(args.get('days', 7))  # 默认7天
+    start_date_str = args.get('start_date')
+    end_date_str = args.get('end_date')
+    # 如果提供了具体的开始和结束日期
+    if start_date_str and end_date_str:
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+        days = (end_date - start_date).days + 1
+    else:
+        # 使用默认的天数范围
+        end_date = today
+        start_date = end_date - timedelta(days=days-1)
+    return start_date, end_date, days
+
+def compute_daily_chart(ctx, start_date, end_date, days, campus_name=None, project_name=None):
+    """每日使用时长图表数据（/api/daily-chart）"""
+    # 如果指定了校区或项目，需要找到匹配的设备标识列表
+    filter_player_ids = None
+    filter_player_names = None
+    filter_device_ids = None
+    if campus_name or project_name:
+        # 获取匹配的 ble_id 列表和对应的显示名称（校区-项目）
+        filter_player_ids = set()
+        filter_player_names = set()
+        filter_registry_ids = set()
+        for reg in ctx.active_registries():
+            if campus_name and reg.campus_name != campus_name:
+                continue
+            if project_name and reg.project_name != project_name:
+                continue
+            filter_player_ids.add(reg.ble_id)
+            filter_player_names.add(f"{reg.campus_name}-{reg.project_name}")
+            filter_registry_ids.add(reg.id)
+        # 会话按整数 device_id 筛选：设备关联到匹配的注册记录，或显示名称为 "校区-项目"
+        filter_device_ids = {
+            device_id for device_id, _, name, registry_id in ctx.devices()
+            if registry_id in filter_registry_ids or name in filter_player_names
+        }
+
+    range_start, _ = _day_range(start_date)
+    range_end = range_start + timedelta(days=max(days, 0))
+    by_day = {}
+    for session in ctx.sessions_between(range_start, range_end):
+        if session.duration_seconds is None:
+            continue
+        if filter_device_ids is not None and session.device_id not in filter_device_ids:
+            continue
+        by_day.setdefault(session.start_time.date(), []).append(session)
+
+    archived = ctx.archived_days(start_date, start_date + timedelta(days=max(days, 1) - 1))
+
+    chart_data = []
+    total_period_time = 0
+    total_period_sessions = 0
+    for i in range(days):
+        current_date = start_date + timedelta(days=i)
+        day_sessions = by_day.get(current_date, [])
+        total_time = sum(session.duration_seconds for session in day_sessions)
+        session_count = len(day_sessions)
+        for row in archived.get(current_date, []):
+            # 归档汇总按 player_id（ble_id）/ player_name（"校区-项目"）匹配
+            if filter_player_ids is not None and row.player_id not in filter_player_ids \
+                    and row.player_name not in filter_player_names:
+                continue
+            total_time += row.total_seconds
+            session_count += row.completed_sessions
+
+        total_period_time += total_time
+        total_period_sessions += session_count
+
+        chart_data.append({
+            'date': current_date.isoformat(),
+            'total_time_minutes': round(total_time / 60, 1),
+            'total_time_hours': round(total_time / 3600, 2),
+            'session_count': session_count
+        })
+
+    return {
+        'daily_data': chart_data,
+        'period_summary': {
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
+            'total_days': days,
+            'total_time_minutes': round(total_period_time / 60, 1),
+            'total_time_hours': round(total_period_time / 3600, 2),
+            'total_sessions': total_period_sessions,
+            'avg_daily_minutes': round(total_period_time / 60 / days, 1) if days > 0 else 0
+        },
+        'filter': {
+            'campus_name': campus_name,
+            'project_name': project_name
+        }
+    }
+
+def compute_daily_summary(ctx, days):
+    """按日期汇总的使用记录（/api/daily-summary），最新日期在前"""
+    end_date = ctx.today
+    start_date = end_date - timedelta(days=days-1)
+    range_start, _ = _day_range(start_date)
+    _, range_end = _day_range(end_date)
+
+    by_day = {}
+    for session in ctx.sessions_between(range_start, range_end):
+        by_day.setdefault(session.start_time.date(), []).append(session)
+    archived = ctx.archived_days(start_date, end_date)
+    minutes = ctx.minute_activity(start_date, end_date)
+
+    daily_summary = []
+    for i in range(days):
+        current_date = start_date + timedelta(days=i)
+        day_sessions = by_day.get(current_date, [])
+
+        # 统计当天数据
+        completed_sessions = [s for s in day_sessions if s.duration_seconds is not None]
+        active_sessions = [s for s in day_sessions if s.duration_seconds is None]
+        total_time = sum(session.duration_seconds for session in completed_sessions)
+
+        # 获取当天活跃的设备
+        active_devices = {}
+        for session in day_sessions:
+            device = active_devices.get(session.player_id)
+            if device is None:
+                device = active_devices[session.player_id] = {
+                    'player_name': session.player_name,
+                    'sessions': 0,
+                    'total_time': 0,
+                    'last_activity': session.last_activity
+                }
+            device['sessions'] += 1
+            if session.duration_seconds:
+                device['total_time'] += session.duration_seconds
+            # 更新最后活动时间（考虑开始时间和结束时间）
+            if session.last_activity > device['last_activity']:
+                device['last_activity'] = session.last_activity
+
+        # 合并已归档的会话汇总
+        archived_rows = archived.get(current_date, [])
+        archived_completed = sum(row.completed_sessions for row in archived_rows)
+        archived_sessions = sum(row.session_count for row in archived_rows)
+        total_time += sum(row.total_seconds for row in archived_rows)
+        for row in archived_rows:
+            last_activity = to_utc_datetime(row.last_activity)
+            device = active_devices.get(row.player_id)
+            if device is None:
+                device = active_devices[row.player_id] = {
+                    'player_name': row.player_name,
+                    'sessions': 0,
+                    'total_time': 0,
+                    'last_activity': last_activity
+                }
+            device['sessions'] += row.session_count
+            device['total_time'] += row.total_seconds
+            if last_activity and (device['last_activity'] is None or last_activity > device['last_activity']):
+                device['last_activity'] = last_activity
+
+        # 格式化设备数据中的时间，附上当天实际收到心跳的分钟数
+        formatted_devices = []
+        for player_id, device_data in active_devices.items():
+            formatted_device = device_data.copy()
+            formatted_device['last_activity'] = format_datetime_for_frontend(device_data['last_activity'])
+            formatted_device['active_minutes'] = minutes.get((current_date, player_id), 0)
+            formatted_devices.append(formatted_device)
+
+        daily_summary.append({
+            'date': current_date.isoformat(),
+            'total_time_seconds': total_time,
+            'total_time_minutes': round(total_time / 60, 1),
+            'completed_sessions': len(completed_sessions) + archived_completed,
+            'active_sessions': len(active_sessions) + archived_sessions - archived_completed,
+            'total_sessions': len(day_sessions) + archived_sessions,
+            'active_devices_count': len(active_devices),
+            'active_minutes': sum(device['active_minutes'] for device in formatted_devices),
+            'devices': formatted_devices
+        })
+
+    # 按日期倒序排列（最新的在前面）
+    daily_summary.reverse()
+    return daily_summary
+
 @app.route('/api/stats', methods=['GET'])
+@cached_json(time_sensitive=True)
 def get_stats():
     """获取使用统计"""
     try:
+        ctx = DashboardContext()
         date_str = request.args.get('date')
         if date_str:
             target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         else:
-            target_date = datetime.now(timezone.utc).date()
-        
-        # 指定日期统计
-        day_start = datetime.combine(target_date, datetime.min.time(), tzinfo=timezone.utc)
-        day_end = day_start + timedelta(days=1)
-        day_sessions = GameSession.select().where(
-            GameSession.start_time >= day_start,
-            GameSession.start_time < day_end,
-            GameSession.duration_seconds.is_null(False)
-        )
-        
-        day_total_time = sum(session.duration_seconds for session in day_sessions)
-        day_session_count = day_sessions.count()
-        
-        # 本周统计
-        week_start_date = target_date - timedelta(days=target_date.weekday())
-        week_start = datetime.combine(week_start_date, datetime.min.time(), tzinfo=timezone.utc)
-        week_end = week_start + timedelta(days=7)
-        week_sessions = GameSession.select().where(
-            GameSession.start_time >= week_start,
-            GameSession.start_time < week_end,
-            GameSession.duration_seconds.is_null(False)
-        )
-        
-        week_total_time = sum(session.duration_seconds for session in week_sessions)
-        week_session_count = week_sessions.count()
-        
-        # 活跃玩家统计
-        active_players = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).where(
-            GameSession.start_time >= target_date,
-            GameSession.start_time < target_date + timedelta(days=1)
-        ).distinct()
-        
-        # 在线设备统计（最近5分钟内有活动的设备）
-        five_minutes_ago = datetime.now(timezone.utc) - timedelta(minutes=5)
-        online_devices = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).where(
-            (GameSession.end_time.is_null()) |
-            (GameSession.start_time >= five_minutes_ago)
-        ).distinct()
-        
-        return jsonify({
-            'success': True,
-            'data': {
-                'selected_date': target_date.isoformat(),
-                'day': {
-                    'total_time_seconds': day_total_time,
-                    'session_count': day_session_count,
-                    'active_players': active_players.count()
-                },
-                'week': {
-                    'total_time_seconds': week_total_time,
-                    'session_count': week_session_count
-                },
-                'online_devices': online_devices.count()
-            }
-        })
+            target_date = ctx.today
+        return jsonify({'success': True, 'data': compute_stats(ctx, target_date)})
         
     except Exception as e:
         logger.error(f"获取统计数据时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/players', methods=['GET'])
+@cached_json()
 def get_players():
     """获取玩家列表及其使用统计"""
     try:
-        # 获取所有玩家的统计信息
-        players_query = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name,
-        ).distinct()
-        
-        result = []
-        for player in players_query:
-            # 计算该玩家的总使用时长
-            player_sessions = GameSession.select().where(
-                GameSession.player_id == player.player_id,
-                GameSession.duration_seconds.is_null(False)
-            )
-            
-            total_time = sum(session.duration_seconds for session in player_sessions)
-            session_count = player_sessions.count()
-            
-            # 最后一次游戏时间 - 使用最新的活动时间
-            last_session = GameSession.select().where(
-                GameSession.player_id == player.player_id
-            ).order_by(GameSession.start_time.desc()).first()
-            
-            last_played = None
-            if last_session:
-                # 使用最新的活动时间（开始时间或结束时间中较晚的）
-                if last_session.end_time:
-                    last_played = max(to_utc_datetime(last_session.start_time), to_utc_datetime(last_session.end_time))
-                else:
-                    last_played = to_utc_datetime(last_session.start_time)
-            
-            result.append({
-                'player_id': player.player_id,
-                'player_name': player.player_name,
-                'total_time_seconds': total_time,
-                'session_count': session_count,
-                'last_played': format_datetime_for_frontend(last_played)
-            })
-        
-        # 按总使用时长排序
-        result.sort(key=lambda x: x['total_time_seconds'], reverse=True)
-        
-        return jsonify({
-            'success': True,
-            'data': result
-        })
+        return jsonify({'success': True, 'data': compute_players(DashboardContext())})
         
     except Exception as e:
         logger.error(f"获取玩家列表时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/device-status', methods=['GET'])
+@cached_json(time_sensitive=True)
 def get_device_status():
     """获取设备实时状态"""
     try:
-        now_utc = datetime.now(timezone.utc)
-        devices_map = {}
-
-        # 先用 DeviceStatus 构建设备视图
-        for d in DeviceStatus.select():
-            last_seen = to_utc_datetime(d.last_seen)
-            latest_session = None
-            if d.current_session_id:
-                try:
-                    latest_session = GameSession.get_by_id(d.current_session_id)
-                except Exception:
-                    latest_session = None
-
-            status = "offline"
-            if latest_session is not None and latest_session.end_time is None and last_seen and (now_utc - last_seen).total_seconds() <= OFFLINE_WINDOW_SECONDS:
-                status = "playing"
-            elif last_seen and (now_utc - last_seen).total_seconds() <= OFFLINE_WINDOW_SECONDS:
-                status = "online"
-
-            devices_map[d.player_id] = {
-                'player_id': d.player_id,
-                'player_name': d.player_name,
-                'status': status,
-                'current_session_id': d.current_session_id,
-                'last_activity': format_datetime_for_frontend(last_seen)
-            }
-
-        # 用历史会话补全未入 DeviceStatus 的设备
-        all_session_devices = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).distinct()
-        for sdev in all_session_devices:
-            if sdev.player_id in devices_map:
-                continue
-            latest_session = GameSession.select().where(
-                GameSession.player_id == sdev.player_id
-            ).order_by(GameSession.start_time.desc()).first()
-
-            last_activity = None
-            status = "offline"
-            current_session_id = None
-            if latest_session:
-                if latest_session.end_time:
-                    last_activity = max(to_utc_datetime(latest_session.start_time), to_utc_datetime(latest_session.end_time))
-                else:
-                    last_activity = to_utc_datetime(latest_session.start_time)
-                if latest_session.end_time is None:
-                    status = "playing"
-                    current_session_id = latest_session.id
-                else:
-                    if last_activity and (now_utc - last_activity).total_seconds() <= OFFLINE_WINDOW_SECONDS:
-                        status = "online"
-
-            devices_map[sdev.player_id] = {
-                'player_id': sdev.player_id,
-                'player_name': sdev.player_name,
-                'status': status,
-                'current_session_id': current_session_id,
-                'last_activity': format_datetime_for_frontend(last_activity)
-            }
-
-        devices = list(devices_map.values())
-        
-        # 统计各状态数量
-        status_count = {
-            'online': len([d for d in devices if d['status'] == 'online']),
-            'playing': len([d for d in devices if d['status'] == 'playing']),
-            'offline': len([d for d in devices if d['status'] == 'offline'])
-        }
-        
-        return jsonify({
-            'success': True,
-            'data': {
-                'devices': devices,
-                'status_count': status_count,
-                'total_devices': len(devices)
-            }
-        })
+        return jsonify({'success': True, 'data': compute_device_status(DashboardContext())})
         
     except Exception as e:
         logger.error(f"获取设备状态时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/campus-projects', methods=['GET'])
+@cached_json()
 def get_campus_projects():
     """获取所有校区和项目列表（用于筛选）"""
     try:
-        # 获取所有活跃的注册表记录
-        registries = DeviceRegistry.select().where(DeviceRegistry.status == 'active')
-        
-        # 收集所有校区和项目
-        campuses = set()
-        projects = set()
-        campus_projects = {}  # {校区: [项目列表]}
-        
-        for reg in registries:
-            campuses.add(reg.campus_name)
-            projects.add(reg.project_name)
-            if reg.campus_name not in campus_projects:
-                campus_projects[reg.campus_name] = []
-            if reg.project_name not in campus_projects[reg.campus_name]:
-                campus_projects[reg.campus_name].append(reg.project_name)
-        
-        return jsonify({
-            'success': True,
-            'data': {
-                'campuses': sorted(list(campuses)),
-                'projects': sorted(list(projects)),
-                'campus_projects': {k: sorted(v) for k, v in campus_projects.items()}
-            }
-        })
+        return jsonify({'success': True, 'data': compute_campus_projects(DashboardContext())})
     except Exception as e:
         logger.error(f"获取校区和项目列表失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/daily-chart', methods=['GET'])
+@cached_json()
 def get_daily_chart():
     """获取每日使用时长图表数据"""
     try:
-        days = int(request.args.get('days', 7))  # 默认7天
-        start_date_str = request.args.get('start_date')
-        end_date_str = request.args.get('end_date')
-        campus_name = request.args.get('campus_name')
-        project_name = request.args.get('project_name')
-        
-        # 如果提供了具体的开始和结束日期
-        if start_date_str and end_date_str:
-            start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-            days = (end_date - start_date).days + 1
-        else:
-            # 使用默认的天数范围
-            end_date = datetime.now(timezone.utc).date()
-            start_date = end_date - timedelta(days=days-1)
-        
-        # 如果指定了校区或项目，需要找到匹配的设备标识列表
-        filter_player_ids = None
-        filter_player_names = None
-        if campus_name or project_name:
-            query = DeviceRegistry.select(DeviceRegistry.ble_id, DeviceRegistry.campus_name, DeviceRegistry.project_name).where(DeviceRegistry.status == 'active')
-            if campus_name:
-                query = query.where(DeviceRegistry.campus_name == campus_name)
-            if project_name:
-                query = query.where(DeviceRegistry.project_name == project_name)
-            
-            # 获取匹配的 ble_id 列表和对应的显示名称
-            matched_ble_ids = set()
-            matched_display_names = set()
-            for reg in query:
-                matched_ble_ids.add(reg.ble_id)
-                # 显示名称格式：校区-项目
-                matched_display_names.add(f"{reg.campus_name}-{reg.project_name}")
-            
-            if matched_ble_ids or matched_display_names:
-                filter_player_ids = matched_ble_ids
-                filter_player_names = matched_display_names
-            else:
-                # 如果没有找到匹配的注册表，但指定了筛选条件，返回空数据
-                filter_player_ids = set()
-                filter_player_names = set()
-        
-        chart_data = []
-        total_period_time = 0
-        total_period_sessions = 0
-        
-        for i in range(days):
-            current_date = start_date + timedelta(days=i)
-            
-            # 查询当天的会话数据
-            day_start = datetime.combine(current_date, datetime.min.time(), tzinfo=timezone.utc)
-            day_end = day_start + timedelta(days=1)
-            day_sessions = GameSession.select().where(
-                GameSession.start_time >= day_start,
-                GameSession.start_time < day_end,
-                GameSession.duration_seconds.is_null(False)
-            )
-            
-            # 如果指定了筛选条件，过滤会话
-            if filter_player_ids is not None:
-                filtered_sessions = []
-                for session in day_sessions:
-                    # 匹配 player_id（可能是 ble_id）
-                    if session.player_id in filter_player_ids:
-                        filtered_sessions.append(session)
-                    # 或者匹配 player_name（可能是 "校区-项目" 格式）
-                    elif filter_player_names and session.player_name in filter_player_names:
-                        filtered_sessions.append(session)
-                day_sessions = filtered_sessions
-            
-            total_time = sum(session.duration_seconds for session in day_sessions)
-            session_count = len(day_sessions)
-            
-            total_period_time += total_time
-            total_period_sessions += session_count
-            
-            chart_data.append({
-                'date': current_date.isoformat(),
-                'total_time_minutes': round(total_time / 60, 1),
-                'total_time_hours': round(total_time / 3600, 2),
-                'session_count': session_count
-            })
-        
-        return jsonify({
-            'success': True,
-            'data': {
-                'daily_data': chart_data,
-                'period_summary': {
-                    'start_date': start_date.isoformat(),
-                    'end_date': end_date.isoformat(),
-                    'total_days': days,
-                    'total_time_minutes': round(total_period_time / 60, 1),
-                    'total_time_hours': round(total_period_time / 3600, 2),
-                    'total_sessions': total_period_sessions,
-                    'avg_daily_minutes': round(total_period_time / 60 / days, 1) if days > 0 else 0
-                },
-                'filter': {
-                    'campus_name': campus_name,
-                    'project_name': project_name
-                }
-            }
-        })
+        ctx = DashboardContext()
+        start_date, end_date, days = resolve_chart_range(request.args, ctx.today)
+        data = compute_daily_chart(ctx, start_date, end_date, days,
+                                   request.args.get('campus_name'), request.args.get('project_name'))
+        return jsonify({'success': True, 'data': data})
         
     except Exception as e:
         logger.error(f"获取图表数据时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/leaderboard', methods=['GET'])
+@cached_json()
+def get_leaderboard():
+    """排行榜：group=device|project|campus，metric=time|sessions，limit 默认 10；
+    日期范围参数与 /api/daily-chart 相同（days 或 start_date + end_date）"""
+    try:
+        start_date, end_date, _ = resolve_chart_range(request.args, datetime.now(timezone.utc).date())
+        data = leaderboard.compute_leaderboard(
+            request.args.get('group', 'device'), request.args.get('metric', 'time'),
+            start_date, end_date, request.args.get('limit', 10))
+        return jsonify({'success': True, 'data': data})
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'参数错误: {e}'}), 400
+    except Exception as e:
+        logger.error(f"获取排行榜失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/percentiles', methods=['GET'])
+@cached_json()
+def get_percentiles():
+    """会话时长分位数：group=device|project|campus，q=0.5,0.9,0.99，key 只返回指定实体；
+    日期范围参数与 /api/daily-chart 相同"""
+    try:
+        start_date, end_date, _ = resolve_chart_range(request.args, datetime.now(timezone.utc).date())
+        q = request.args.get('q')
+        quantiles = [float(v) for v in q.split(',') if v.strip()][:10] if q else quantile_sketch.DEFAULT_QUANTILES
+        data = quantile_sketch.compute_percentiles(
+            request.args.get('group', 'device'), start_date, end_date, quantiles, request.args.get('key'))
+        return jsonify({'success': True, 'data': data})
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'参数错误: {e}'}), 400
+    except Exception as e:
+        logger.error(f"获取会话时长分位数失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/distinct-devices', methods=['GET'])
+@cached_json()
+def get_distinct_devices():
+    """日期范围内去重的活跃设备数（每日位图按位或）：可按 campus_name / project_name 筛选，
+    group=device|project|campus 返回分组计数；日期范围参数与 /api/daily-chart 相同"""
+    try:
+        start_date, end_date, _ = resolve_chart_range(request.args, datetime.now(timezone.utc).date())
+        data = active_bitmaps.compute_distinct_devices(
+            start_date, end_date, request.args.get('campus_name'), request.args.get('project_name'),
+            request.args.get('group'))
+        return jsonify({'success': True, 'data': data})
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'参数错误: {e}'}), 400
+    except Exception as e:
+        logger.error(f"获取去重设备数失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+_UNENCODED_OFFSET = re.compile(r' (\d{2}:?\d{2})$')
+
+def parse_as_of(value):
+    """解析时间点参数：ISO8601，可带时区（如 +08:00 或 Z），不带时区视为 UTC"""
+    if not value:
+        raise ValueError('缺少参数 at')
+    value = value.strip()
+    # 日期与时间之间允许用空格分隔
+    if len(value) > 10 and value[10] == ' ':
+        value = value[:10] + 'T' + value[11:]
+    # 查询串中未编码的 + 会变成空格：末尾的“ HH:MM”还原为“+HH:MM”
+    value = _UNENCODED_OFFSET.sub(r'+\1', value)
+    moment = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+@app.route('/api/as-of', methods=['GET'])
+@cached_json(time_sensitive=True)
+def get_as_of():
+    """某一时刻各设备的状态：at=2026-10-18T14:05:00+08:00（必填），
+    player_id 只返回指定设备，playing_only=1 只返回在玩的设备"""
+    try:
+        moment = parse_as_of(request.args.get('at'))
+        data = as_of_index.state_at(
+            moment, OFFLINE_WINDOW_SECONDS, player_id=request.args.get('player_id'),
+            playing_only=request.args.get('playing_only') in ('1', 'true'))
+        return jsonify({'success': True, 'data': data})
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'参数错误: {e}'}), 400
+    except Exception as e:
+        logger.error(f"按时间点查询设备状态失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/device/<player_id>', methods=['DELETE'])
 def delete_device(player_id):
-    """删除设备及其所有相关数据"""
+    """删除设备及其所有相关数据（后台分批执行，返回任务 ID）"""
     try:
-        # 删除该设备的所有游戏会话记录
-        deleted_sessions = GameSession.delete().where(
-            GameSession.player_id == player_id
-        ).execute()
-        
-        # 删除设备状态记录
-        deleted_status = DeviceStatus.delete().where(
-            DeviceStatus.player_id == player_id
-        ).execute()
-        
-        # 尝试删除设备注册表记录（如果存在，基于规范化后的 BLE ID）
-        # 注意：player_id 可能是规范化后的 BLE ID，也可能是原始 player_id
-        deleted_registry = 0
-        try:
-            # 如果 player_id 是 BLE ID 格式，尝试删除注册表
-            if player_id.startswith('MICROBLOCKS'):
-                deleted_registry = DeviceRegistry.delete().where(
-                    DeviceRegistry.ble_id == player_id
-                ).execute()
-        except Exception:
-            pass  # 如果删除注册表失败，不影响整体删除
-        
-        logger.info(f"删除设备 {player_id}: {deleted_sessions} 条会话, {deleted_status} 条状态, {deleted_registry} 条注册表")
-        
+        job = device_jobs.submit_deletion([player_id])
         return jsonify({
             'success': True,
-            'message': f'成功删除设备 {player_id}：{deleted_sessions} 条会话记录，{deleted_status} 条状态记录，{deleted_registry} 条注册表记录'
-        })
-        
+            'job_id': job.id,
+            'message': f'已开始删除设备 {player_id}，进度见 /api/jobs/{job.id}'
+        }), 202
     except Exception as e:
-        logger.error(f"删除设备时出错: {e}")
+        logger.error(f"提交设备删除任务时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/device-deletions', methods=['POST'])
+def delete_devices():
+    """批量删除设备：{"player_ids": [...]}，一个任务内依次删除"""
+    try:
+        body = request.get_json(force=True) or {}
+        player_ids = body.get('player_ids')
+        if not isinstance(player_ids, list) or not player_ids:
+            return jsonify({'success': False, 'error': 'player_ids 必须是非空列表'}), 400
+        job = device_jobs.submit_deletion([str(p) for p in player_ids])
+        return jsonify({'success': True, 'job_id': job.id, 'data': job.to_dict()}), 202
+    except Exception as e:
+        logger.error(f"提交批量删除任务时出错: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """最近的后台任务"""
+    return jsonify({'success': True, 'data': [job.to_dict() for job in reversed(device_jobs.list_jobs())]})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """后台任务状态与进度"""
+    job = device_jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    return jsonify({'success': True, 'data': job.to_dict()})
+
 @app.route('/api/session/<int:session_id>', methods=['DELETE'])
 def delete_session(session_id):
     """删除单个游戏会话记录"""
     try:
-        # 查找并删除指定的会话记录
-        session = GameSession.get_by_id(session_id)
-        session.delete_instance()
+        # 查找并删除指定的会话记录（不在主库时查找已封存的分区）
+        with db.atomic():
+            session = GameSession.get_or_none(GameSession.id == session_id)
+            if session is not None:
+                session.delete_instance()
+                device_id, start_time, duration = session.device_id, session.start_time, session.duration_seconds
+            else:
+                removed = partitions.delete_session(session_id)
+                if removed is None:
+                    raise GameSession.DoesNotExist()
+                device_id, start_time, duration = removed[0], to_utc_datetime(removed[1]), removed[2]
+            if duration is not None:
+                quantile_sketch.remove_duration(device_id, start_time, duration)
+            active_bitmaps.refresh_device_day(device_id, start_time)
+        # 接入进程可能已缓存该设备当天的置位标记
+        forget_devices([device_id], to_utc_datetime(start_time).date())
         
         logger.info(f"删除会话记录 {session_id}")
         
@@ -653,145 +1105,140 @@ def delete_session(session_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/daily-summary', methods=['GET'])
+@cached_json()
 def get_daily_summary():
     """获取按日期汇总的使用记录"""
     try:
         days = int(request.args.get('days', 7))  # 默认显示最近7天
-        end_date = datetime.now(timezone.utc).date()
-        start_date = end_date - timedelta(days=days-1)
-        
-        daily_summary = []
-        
-        for i in range(days):
-            current_date = start_date + timedelta(days=i)
-            
-            # 查询当天的会话数据
-            day_start = datetime.combine(current_date, datetime.min.time(), tzinfo=timezone.utc)
-            day_end = day_start + timedelta(days=1)
-            day_sessions = GameSession.select().where(
-                GameSession.start_time >= day_start,
-                GameSession.start_time < day_end
-            ).order_by(GameSession.start_time.desc())
-            
-            # 统计当天数据
-            completed_sessions = [s for s in day_sessions if s.duration_seconds is not None]
-            active_sessions = [s for s in day_sessions if s.duration_seconds is None]
-            
-            total_time = sum(session.duration_seconds for session in completed_sessions)
-            
-            # 获取当天活跃的设备
-            active_devices = {}
-            for session in day_sessions:
-                device_id = session.player_id
-                if device_id not in active_devices:
-                    # 计算初始的最后活动时间
-                    initial_last_activity = to_utc_datetime(session.start_time)
-                    if session.end_time:
-                        initial_last_activity = max(to_utc_datetime(session.start_time), to_utc_datetime(session.end_time))
-                    
-                    active_devices[device_id] = {
-                        'player_name': session.player_name,
-                        'sessions': 0,
-                        'total_time': 0,
-                        'last_activity': initial_last_activity
-                    }
-                
-                active_devices[device_id]['sessions'] += 1
-                if session.duration_seconds:
-                    active_devices[device_id]['total_time'] += session.duration_seconds
-                
-                # 更新最后活动时间（考虑开始时间和结束时间）
-                session_last_activity = to_utc_datetime(session.start_time)
-                if session.end_time:
-                    session_last_activity = max(to_utc_datetime(session.start_time), to_utc_datetime(session.end_time))
-                
-                if session_last_activity > active_devices[device_id]['last_activity']:
-                    active_devices[device_id]['last_activity'] = session_last_activity
-            
-            # 格式化设备数据中的时间
-            formatted_devices = []
-            for device_data in active_devices.values():
-                formatted_device = device_data.copy()
-                formatted_device['last_activity'] = format_datetime_for_frontend(device_data['last_activity'])
-                formatted_devices.append(formatted_device)
-            
-            daily_summary.append({
-                'date': current_date.isoformat(),
-                'total_time_seconds': total_time,
-                'total_time_minutes': round(total_time / 60, 1),
-                'completed_sessions': len(completed_sessions),
-                'active_sessions': len(active_sessions),
-                'total_sessions': len(day_sessions),
-                'active_devices_count': len(active_devices),
-                'devices': formatted_devices
-            })
-        
-        # 按日期倒序排列（最新的在前面）
-        daily_summary.reverse()
-        
-        return jsonify({
-            'success': True,
-            'data': daily_summary
-        })
+        return jsonify({'success': True, 'data': compute_daily_summary(DashboardContext(), days)})
         
     except Exception as e:
         logger.error(f"获取每日汇总数据时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# 合并接口可包含的面板
+DASHBOARD_PANELS = ('stats', 'device_status', 'campus_projects', 'daily_chart', 'players', 'daily_summary')
+
+def compute_dashboard(args, include):
+    """按 include 计算各面板；同一请求内的共享查询只执行一次"""
+    ctx = DashboardContext()
+    data = {}
+    if 'stats' in include:
+        date_str = args.get('date')
+        target_date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else ctx.today
+        data['stats'] = compute_stats(ctx, target_date)
+    if 'device_status' in include:
+        data['device_status'] = compute_device_status(ctx)
+    if 'campus_projects' in include:
+        data['campus_projects'] = compute_campus_projects(ctx)
+    if 'daily_chart' in include:
+        start_date, end_date, days = resolve_chart_range(args, ctx.today)
+        data['daily_chart'] = compute_daily_chart(ctx, start_date, end_date, days,
+                                                  args.get('campus_name'), args.get('project_name'))
+    if 'players' in include:
+        data['players'] = compute_players(ctx)
+    if 'daily_summary' in include:
+        data['daily_summary'] = compute_daily_summary(ctx, int(args.get('summary_days', 7)))
+    return data
+
+@app.route('/api/dashboard', methods=['GET'])
+@cached_json(time_sensitive=True)
+def get_dashboard():
+    """仪表盘合并接口：一次请求返回多个面板的数据
+
+    参数：
+    - include: 逗号分隔的面板列表（默认全部）：stats,device_status,campus_projects,daily_chart,players,daily_summary
+    - date: stats 的日期；days/start_date/end_date/campus_name/project_name: daily_chart 的参数
+    - summary_days: daily_summary 的天数（默认7）
+    """
+    try:
+        include_arg = request.args.get('include')
+        if include_arg:
+            include = tuple(p for p in DASHBOARD_PANELS if p in {x.strip() for x in include_arg.split(',')})
+        else:
+            include = DASHBOARD_PANELS
+        if not include:
+            return jsonify({'success': False, 'error': f'include 可选值: {",".join(DASHBOARD_PANELS)}'}), 400
+
+        version = data_version.current()
+        return jsonify({'success': True, 'data': compute_dashboard(request.args, include), 'data_version': version})
+
+    except Exception as e:
+        logger.error(f"获取仪表盘数据时出错: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/')
 def index():
     """重定向到主页"""
-    return send_from_directory('static', 'index.html')
+    return static_files('index.html')
 
 @app.route('/static/<path:filename>')
 def static_files(filename):
-    """提供静态文件"""
-    return send_from_directory('static', filename)
+    """提供静态文件（预压缩 + 强 ETag）"""
+    response = static_assets.response(request, filename)
+    if response is None:
+        abort(404)
+    return response
+
+# SSE 响应头（开发服务器与 server.py 的异步 SSE 共用）
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Cache-Control'
+}
+SSE_HEARTBEAT_SECONDS = 10
+
+def format_sse(message):
+    """格式化为一条 SSE 消息"""
+    return f"data: {json.dumps(message)}\n\n"
+
+def build_sse_messages(data):
+    """将一条 update_queue 信号转换为要推送给客户端的消息列表"""
+    # 如果是 MQTT 更新信号，立即获取最新设备状态和统计数据
+    if data.get('type') == 'mqtt_update':
+        logger.debug("🔄 收到 MQTT 更新信号，推送最新数据")
+        # 在请求之外执行（SSE 线程 / 线程池），同样使用只读连接并在用完后关闭
+        opened = db.connect_reader(reuse_if_open=True)
+        try:
+            return [
+                {'type': 'device_update', 'data': get_latest_device_status()},
+                {'type': 'stats_update', 'data': get_latest_stats()}
+            ]
+        finally:
+            if opened:
+                db.close()
+    # 其他类型的更新原样推送
+    return [data]
 
 @app.route('/api/events')
 def events():
     """Server-Sent Events 端点"""
     def event_stream():
+        metrics.SSE_SUBSCRIBERS.inc()
+        try:
+            yield from _event_stream_loop()
+        finally:
+            metrics.SSE_SUBSCRIBERS.dec()
+
+    def _event_stream_loop():
         while True:
             try:
                 # 等待更新事件，超时时间缩短到10秒
-                data = update_queue.get(timeout=10)
-                
-                # 如果是 MQTT 更新信号，立即获取最新数据并推送
-                if data.get('type') == 'mqtt_update':
-                    logger.info("🔄 收到 MQTT 更新信号，推送最新数据")
-                    
-                    # 获取最新设备状态
-                    device_data = get_latest_device_status()
-                    yield f"data: {json.dumps({'type': 'device_update', 'data': device_data})}\n\n"
-                    
-                    # 获取最新统计数据
-                    stats_data = get_latest_stats()
-                    yield f"data: {json.dumps({'type': 'stats_update', 'data': stats_data})}\n\n"
-                else:
-                    # 其他类型的更新
-                    yield f"data: {json.dumps(data)}\n\n"
-                    
+                data = update_queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+                for message in build_sse_messages(data):
+                    yield format_sse(message)
             except queue.Empty:
                 # 发送心跳
-                yield f"data: {json.dumps({'type': 'heartbeat'})}\n\n"
+                yield format_sse({'type': 'heartbeat'})
     
-    return Response(event_stream(), mimetype="text/event-stream",
-                   headers={
-                       'Cache-Control': 'no-cache',
-                       'Connection': 'keep-alive',
-                       'Access-Control-Allow-Origin': '*',
-                       'Access-Control-Allow-Headers': 'Cache-Control'
-                   })
+    return Response(event_stream(), mimetype="text/event-stream", headers=SSE_HEADERS)
 
 def get_latest_device_status():
     """获取最新设备状态"""
     try:
-        # 复用 get_device_status 的逻辑
-        with app.test_request_context():
-            resp = get_device_status()
-            data = resp.get_json()
-            return {'devices': data['data']['devices']} if data and data.get('success') else {'devices': []}
+        # 复用 /api/device-status 的计算逻辑
+        return {'devices': compute_device_status(DashboardContext())['devices']}
     except Exception as e:
         logger.error(f"获取设备状态失败: {e}")
         return {'devices': []}
@@ -817,6 +1264,14 @@ def get_latest_stats():
         logger.error(f"获取统计数据失败: {e}")
         return {'total_time_seconds': 0, 'session_count': 0}
 
+def start_change_listener():
+    """监听独立运行的接入进程发来的变更通知，转入 update_queue"""
+    try:
+        return ChangeListener(update_queue.put).start()
+    except OSError as e:
+        logger.warning(f"变更通知监听启动失败（将只接收进程内更新）: {e}")
+        return None
+
 def broadcast_update(update_type, data):
     """广播更新到所有客户端"""
     try:
@@ -826,7 +1281,7 @@ def broadcast_update(update_type, data):
             'timestamp': time.time()
         }
         update_queue.put(update_data)
-        logger.info(f"广播更新: {update_type}")
+        logger.debug(f"广播更新: {update_type}")
     except Exception as e:
         logger.error(f"广播更新失败: {e}")
 
@@ -837,12 +1292,12 @@ def debug_time():
         from datetime import datetime, timezone
         
         # 获取一些示例数据
-        sessions = GameSession.select().limit(5)
+        sessions = GameSession.select(GameSession, Device.name).join(Device).limit(5)
         debug_data = []
         
         for session in sessions:
             debug_data.append({
-                'player_name': session.player_name,
+                'player_name': session.device.name,
                 'start_time_raw': str(session.start_time),
                 'start_time_iso': session.start_time.isoformat() if session.start_time else None,
                 'end_time_raw': str(session.end_time) if session.end_time else None,
@@ -860,6 +1315,58 @@ def debug_time():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/debug/sql-profile', methods=['GET'])
+def get_sql_profile():
+    """最近的慢查询（含查询计划）与疑似 N+1 查询（SQL_PROFILE 启用时记录）"""
+    return jsonify({'success': True, 'data': sql_profiler.snapshot()})
+
+@app.route('/api/debug/trace', methods=['GET'])
+def list_traced_devices():
+    """列出开启了逐条日志追踪的设备"""
+    return jsonify({'success': True, 'data': ingest_log.traced_devices()})
+
+@app.route('/api/debug/trace', methods=['POST'])
+def set_device_trace():
+    """运行时开关某设备的逐条日志追踪：{"device": "...", "enabled": true}"""
+    try:
+        body = request.get_json(force=True) or {}
+        device = (body.get('device') or '').strip()
+        if not device:
+            return jsonify({'success': False, 'error': 'device 不能为空'}), 400
+        # BLE ID 追踪使用规范化后的 key（与 device_key 一致）
+        if device.lower().startswith('microblocks'):
+            device = normalize_ble_id(device)
+        if body.get('enabled', True):
+            ingest_log.enable_trace(device)
+        else:
+            ingest_log.disable_trace(device)
+        return jsonify({'success': True, 'data': ingest_log.traced_devices()})
+    except Exception as e:
+        logger.error(f"设置设备追踪失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/retention', methods=['GET'])
+def get_retention():
+    """数据保留策略与最近一次执行报告"""
+    return jsonify({'success': True, 'data': {
+        'policy': retention.current_policy(),
+        'running': retention.is_running(),
+        'last_report': retention.last_report,
+        'partitions': partitions.describe() if partitions.enabled() else None
+    }})
+
+@app.route('/api/retention/run', methods=['POST'])
+def run_retention_now():
+    """立即在后台执行一次数据保留任务"""
+    try:
+        if retention.is_running():
+            return jsonify({'success': False, 'error': '数据保留任务正在执行'}), 409
+        threading.Thread(target=retention.run_retention, name='retention-manual', daemon=True).start()
+        return jsonify({'success': True, 'message': '数据保留任务已开始，完成后通过 GET /api/retention 查看报告'}), 202
+    except Exception as e:
+        logger.error(f"启动数据保留任务失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/trigger-update', methods=['POST'])
 def trigger_update():
     """触发前端实时更新"""
@@ -868,10 +1375,7 @@ def trigger_update():
         from datetime import datetime, timedelta, timezone
         
         # 获取设备状态（与 /api/device-status 一致）
-        with app.test_request_context():
-            device_resp = get_device_status()
-            device_json = device_resp.get_json()
-            devices = device_json['data']['devices'] if device_json and device_json.get('success') else []
+        devices = compute_device_status(DashboardContext())['devices']
         
         # 广播设备状态更新
         broadcast_update('device_update', {'devices': devices})
@@ -902,5 +1406,7 @@ if __name__ == '__main__':
     # 初始化数据库
     from models import init_db
     init_db()
+    start_change_listener()
+    static_assets.preload()
     
     app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+读写并发基准：统计接口持续满负荷读取时，接入写库的延迟是否仍然有界
+
+在临时目录中生成合成数据（--devices 台设备、--days 天、每台每天 --per-day 个会话），然后：
+
+1. 只运行接入：写线程以 --rate 条/秒的速度处理心跳 / 开始 / 结束消息，记录每条消息的处理耗时
+2. 接入 + 读取：同时启动 --readers 个读线程，循环请求 /api/daily-summary?days=90 与 /api/players
+   （关闭响应缓存，每次都查询数据库）
+
+分别输出两阶段接入延迟的 p50 / p99 / 最大值，以及读取阶段完成的请求数：
+
+    python bench_read_write.py [--readers 4] [--seconds 10]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DEDUP_WINDOW_SECONDS', '0')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+READ_PATHS = ['/api/daily-summary?days=90', '/api/players']
+# 消息序号跨阶段递增（相同序号会被去重丢弃）
+_seq = itertools.count(1)
+
+
+def populate(devices, days, per_day):
+    """生成合成会话（直接批量插入）"""
+    from models import db, Device, GameSession
+    now = datetime.now(timezone.utc)
+    rnd = random.Random(7)
+    with db.atomic():
+        Device.insert_many([{'device_key': f'bench-{i}', 'name': f'基准设备{i}'} for i in range(devices)]).execute()
+        ids = [d.id for d in Device.select(Device.id)]
+        rows = []
+        for day in range(days):
+            day_start = now - timedelta(days=day + 1)
+            for device_id in ids:
+                for _ in range(per_day):
+                    start = day_start + timedelta(seconds=rnd.randrange(86400))
+                    duration = rnd.randrange(60, 1800)
+                    rows.append({'device': device_id, 'start_time': start,
+                                 'end_time': start + timedelta(seconds=duration), 'duration_seconds': duration})
+            if len(rows) >= 5000:
+                GameSession.insert_many(rows).execute()
+                rows = []
+        if rows:
+            GameSession.insert_many(rows).execute()
+    db.close()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def run_phase(tracker, seconds, rate, readers, devices):
+    """返回 (接入延迟列表, 读取请求数)"""
+    import api
+    stop = threading.Event()
+    latencies = []
+    reads = [0]
+
+    def writer():
+        rnd = random.Random(11)
+        interval = 1.0 / rate
+        next_at = time.perf_counter()
+        while not stop.is_set():
+            device = rnd.randrange(devices)
+            event = rnd.choice(['heartbeat', 'heartbeat', 'game_start', 'game_end'])
+            payload = json.dumps({'event': event, 'playerId': f'live-{device}',
+                                  'playerName': f'在线设备{device}', 'seq': next(_seq)}).encode()
+            started = time.perf_counter()
+            tracker.handle_payload(payload)
+            latencies.append(time.perf_counter() - started)
+            next_at += interval
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+
+    def reader(index):
+        client = api.app.test_client()
+        i = index
+        while not stop.is_set():
+            response = client.get(READ_PATHS[i % len(READ_PATHS)])
+            if response.status_code != 200:
+                raise RuntimeError(f'{READ_PATHS[i % len(READ_PATHS)]} 返回 {response.status_code}')
+            reads[0] += 1
+            i += 1
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, reads[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='读写并发基准')
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--per-day', type=int, default=3)
+    parser.add_argument('--rate', type=float, default=50, help='接入消息速率（条/秒）')
+    parser.add_argument('--readers', type=int, default=4, help='读线程数')
+    parser.add_argument('--seconds', type=float, default=10, help='每阶段时长')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-rw-')
+    os.chdir(workdir)
+    from models import init_db, db
+    init_db()
+    db.close()
+    populate(args.devices, args.days, args.per_day)
+
+    import api
+    from mqtt_client import GameUsageTracker
+    api.response_cache.max_entries = 0
+    tracker = GameUsageTracker()
+
+    print(f"数据：{args.devices} 台设备 × {args.days} 天 × {args.per_day} 个会话，"
+          f"接入 {args.rate:.0f} 条/秒，读线程 {args.readers}（目录 {workdir}）")
+    print(f"{'阶段':<12}{'消息数':>8}{'p50 ms':>10}{'p99 ms':>10}{'最大 ms':>10}{'读请求数':>10}")
+    for name, readers in (('只有接入', 0), ('接入 + 读取', args.readers)):
+        latencies, reads = run_phase(tracker, args.seconds, args.rate, readers, args.devices)
+        print(f"{name:<12}{len(latencies):>8}{percentile(latencies, 0.5) * 1000:>10.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.1f}{max(latencies) * 1000:>10.1f}{reads:>10}")
+
+
+if __name__ == "__main__":
+    main()
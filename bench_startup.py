@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动耗时基准：普通启动、快速启动、快速启动 + 启动快照
+
+每种方式在临时目录中以生产模式启动 run.py（数据库为 --db 的副本，MQTT 指向本机未监听的端口，
+保留任务关闭），进程启动后立即发出第一个请求，记录：
+
+- 端口可连接、/readyz 返回 200 的时间
+- 第一个 /api/players 请求完成的时间（请求在启动期间发出，快速启动时排队等待就绪）
+- 就绪后依次请求常用统计接口的总耗时（冷缓存需要重新计算，快照载入后直接命中）
+
+“快速启动 + 快照”先完整运行一次并以 SIGTERM 优雅关闭以生成快照，再测量第二次启动：
+
+    python bench_startup.py --db game_usage.db [--runs 3]
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+RUN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+# 就绪后请求的统计接口（按数据版本缓存、可保存到快照的接口）
+WARM_PATHS = [
+    '/api/daily-chart?days=30',
+    '/api/daily-summary?days=30',
+    '/api/leaderboard?group=device&days=30',
+    '/api/percentiles?group=project&days=30',
+    '/api/distinct-devices?days=30',
+    '/api/campus-projects',
+]
+MODES = {
+    'standard': {'FAST_START': '0', 'WARM_SNAPSHOT_PATH': ''},
+    'fast': {'FAST_START': '1', 'WARM_SNAPSHOT_PATH': ''},
+    'fast+snapshot': {'FAST_START': '1'},
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _get(port, path, timeout=60):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=timeout) as response:
+        return response.status, response.read()
+
+
+def _wait_port(port, deadline):
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.002)
+    return False
+
+
+def _start(workdir, port, overrides):
+    env = dict(os.environ)
+    env.update({
+        'SERVER_MODE': 'production',
+        'PORT': str(port),
+        'MQTT_HOST': '127.0.0.1',
+        'MQTT_PORT': str(_free_port()),
+        'RETENTION_INTERVAL_SECONDS': '0',
+        'CHANGE_NOTIFY_SOCKET': os.path.join(workdir, 'notify.sock'),
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    env.update(overrides)
+    return subprocess.Popen([sys.executable, RUN_PY], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _stop(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def measure(workdir, overrides):
+    """启动一次并返回各时间点（秒）"""
+    port = _free_port()
+    started = time.monotonic()
+    process = _start(workdir, port, overrides)
+    try:
+        if not _wait_port(port, started + 60):
+            raise RuntimeError('服务器未能在 60 秒内开始监听')
+        result = {'listen': time.monotonic() - started}
+        status, _ = _get(port, '/api/players')
+        if status != 200:
+            raise RuntimeError(f'/api/players 返回 {status}')
+        result['first_response'] = time.monotonic() - started
+        status, body = _get(port, '/readyz')
+        phases = json.loads(body)['phases']
+        # 阶段时间从构造服务器时算起，换算为从进程启动算起
+        result['ready'] = result['listen'] + phases['ready'] - phases['listening']
+        t = time.perf_counter()
+        for path in WARM_PATHS:
+            _get(port, path)
+        result['stats_requests'] = time.perf_counter() - t
+        return result
+    finally:
+        _stop(process)
+
+
+def run_mode(name, db_path, runs):
+    overrides = MODES[name]
+    samples = []
+    for _ in range(runs):
+        workdir = tempfile.mkdtemp(prefix='bench-startup-')
+        try:
+            if db_path:
+                shutil.copy(db_path, os.path.join(workdir, 'game_usage.db'))
+            # 先启动一次（首次建表 / 重建不计入测量；快照方式在关闭时保存快照），再测量第二次启动
+            measure(workdir, overrides)
+            if name == 'fast+snapshot' and not os.path.exists(os.path.join(workdir, 'warm_snapshot.pkl')):
+                raise RuntimeError('优雅关闭后没有生成启动快照')
+            samples.append(measure(workdir, overrides))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='启动耗时基准')
+    parser.add_argument('--db', help='测试用数据库（复制到临时目录），默认空数据库')
+    parser.add_argument('--runs', type=int, default=3, help='每种方式的测量次数（取中位数）')
+    parser.add_argument('--modes', default=','.join(MODES), help='逗号分隔的启动方式')
+    args = parser.parse_args()
+
+    print(f"{'启动方式':<16}{'监听 ms':>10}{'就绪 ms':>10}{'首个响应 ms':>14}{'统计接口 ms':>14}")
+    for name in args.modes.split(','):
+        samples = run_mode(name, args.db, args.runs)
+
+        def median(field):
+            values = [s[field] for s in samples if s.get(field) is not None]
+            return f"{statistics.median(values) * 1000:.0f}" if values else '-'
+
+        print(f"{name:<16}{median('listen'):>10}{median('ready'):>10}"
+              f"{median('first_response'):>14}{median('stats_requests'):>14}")
+
+
+if __name__ == "__main__":
+    main()
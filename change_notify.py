@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+跨进程数据变更通知（本机数据报套接字）
+
+接入进程（mqtt_client.py / ingest_workers.py 单独运行时）每次写库后调用
+ChangeNotifier.notify()，向本机的数据报套接字发送一个很小的消息；
+API 进程中的 ChangeListener 收到后合并为一次 update_queue 信号，推送给 SSE 客户端。
+
+- 优先使用 Unix 域数据报套接字（CHANGE_NOTIFY_SOCKET，默认 /tmp/usage-stats-notify.sock）
+- 不支持 AF_UNIX 的平台回退到 127.0.0.1 的 UDP 端口（CHANGE_NOTIFY_PORT，默认 5002）
+- 发送端非阻塞、无连接：监听方不存在或缓冲区满时直接丢弃，不影响接入
+- 本机任何进程都能向套接字发送数据报，接收端只转发 UPDATE_TYPES 中、字段与长度都符合的通知，
+  其余直接丢弃（不会原样推送给 SSE 客户端）
+
+反方向（API 进程 → 接入进程）用于进程内缓存失效：删除设备 / 会话后，接入进程中已置位的
+活跃设备标记（active_bitmaps）与尚未写库的分钟位（minute_activity）需要丢弃。
+每个接入进程在 CACHE_INVALIDATE_DIR（默认 /tmp/usage-stats-invalidate）下绑定 <pid>.sock，
+broadcast_invalidation() 逐个发送；只支持 Unix 域套接字，且接入进程须与 API 进程在同一台机器上。
+"""
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_SOCKET_PATH = os.environ.get('CHANGE_NOTIFY_SOCKET', '/tmp/usage-stats-notify.sock')
+try:
+    NOTIFY_PORT = int(os.environ.get('CHANGE_NOTIFY_PORT', '5002'))
+except Exception:
+    NOTIFY_PORT = 5002
+
+# 接入进程发来的通知类型（见 GameUsageTracker.trigger_realtime_update）
+UPDATE_TYPES = ('mqtt_update',)
+_UPDATE_FIELDS = {'type', 'timestamp'}
+_MAX_TIMESTAMP_LENGTH = 40
+
+CACHE_INVALIDATE_DIR = os.environ.get('CACHE_INVALIDATE_DIR', '/tmp/usage-stats-invalidate')
+
+_USE_UNIX = hasattr(socket, 'AF_UNIX')
+
+
+def _notify_address():
+    if _USE_UNIX:
+        return socket.AF_UNIX, NOTIFY_SOCKET_PATH
+    return socket.AF_INET, ('127.0.0.1', NOTIFY_PORT)
+
+
+class ChangeNotifier:
+    """发送端：每次调用只是一次非阻塞 sendto"""
+
+    def __init__(self):
+        self.family, self.address = _notify_address()
+        self._sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._lock = threading.Lock()
+
+    def notify(self, data: dict) -> bool:
+        """发送变更通知，返回是否成功投递（无监听方时返回 False）"""
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        try:
+            with self._lock:
+                self._sock.sendto(payload, self.address)
+            return True
+        except (FileNotFoundError, ConnectionRefusedError, BlockingIOError, InterruptedError):
+            # 监听方未启动或接收缓冲区已满：信号可合并，丢弃即可
+            return False
+        except OSError as e:
+            logger.debug(f"发送变更通知失败: {e}")
+            return False
+
+    def close(self):
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+
+def broadcast_invalidation(data: dict) -> int:
+    """向其他进程的接入缓存发送失效通知，返回送达的进程数。已退出进程遗留的套接字文件顺带删除"""
+    if not _USE_UNIX:
+        return 0
+    own = _invalidate_address()
+    payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    delivered = 0
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        for path in glob.glob(os.path.join(CACHE_INVALIDATE_DIR, '*.sock')):
+            if path == own:
+                continue
+            try:
+                sock.sendto(payload, path)
+                delivered += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                logger.warning(f"发送缓存失效通知到 {path} 失败: {e}")
+    finally:
+        sock.close()
+    return delivered
+
+
+def forget_devices(device_ids, day=None) -> int:
+    """通知接入进程丢弃这些设备的进程内缓存（day 为 date 时只丢弃该日的活跃设备标记）"""
+    return broadcast_invalidation({'type': 'forget_devices', 'device_ids': [int(i) for i in device_ids],
+                                   'day': day.isoformat() if day is not None else None})
+
+
+def _invalidate_address():
+    return os.path.join(CACHE_INVALIDATE_DIR, f'{os.getpid()}.sock')
+
+
+class ChangeListener:
+    """接收端：后台线程接收通知，合并后回调 callback(data)"""
+
+    # 一批已到达的通知只回调最后一条
+    coalesce = True
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.family, self.address = _notify_address()
+        self._sock = None
+        self._thread = None
+
+    def accept(self, data) -> bool:
+        """是否转发这条通知（data 为解析后的 JSON，无法解析时为 None）：
+        只接受 {"type": UPDATE_TYPES 之一, "timestamp": 字符串（可选）}"""
+        if not isinstance(data, dict) or data.get('type') not in UPDATE_TYPES or not set(data) <= _UPDATE_FIELDS:
+            return False
+        timestamp = data.get('timestamp')
+        return timestamp is None or (isinstance(timestamp, str) and len(timestamp) <= _MAX_TIMESTAMP_LENGTH)
+
+    def start(self):
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        if self.family == socket.AF_UNIX:
+            # 清理上次异常退出遗留的套接字文件
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+        sock.bind(self.address)
+        self._sock = sock
+        self._thread = threading.Thread(target=self._run, name='change-listener', daemon=True)
+        self._thread.start()
+        logger.info(f"变更通知监听已启动: {self.address}")
+        return self
+
+    def _run(self):
+        sock = self._sock
+        while True:
+            try:
+                sock.setblocking(True)
+                payloads = [sock.recv(4096)]
+                # 取出已到达的通知，合并时一批只回调一次
+                sock.setblocking(False)
+                try:
+                    while True:
+                        payloads.append(sock.recv(4096))
+                except (BlockingIOError, InterruptedError):
+                    pass
+            except OSError:
+                # 套接字已关闭
+                return
+            accepted = []
+            for payload in payloads:
+                try:
+                    data = json.loads(payload.decode('utf-8'))
+                except ValueError:
+                    data = None
+                if self.accept(data):
+                    accepted.append(data)
+                else:
+                    logger.warning(f"忽略格式不正确的通知: {payload[:200]!r}")
+            for data in accepted[-1:] if self.coalesce else accepted:
+                try:
+                    self.callback(data)
+                except Exception as e:
+                    logger.warning(f"处理变更通知失败: {e}")
+
+    def stop(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            if self.family == socket.AF_UNIX:
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
+
+
+class CacheInvalidationListener(ChangeListener):
+    """接入进程中的缓存失效通知接收端：每条通知都回调（不合并）。不支持 Unix 域套接字时不启动"""
+
+    coalesce = False
+
+    def __init__(self, callback):
+        super().__init__(callback)
+        self.family = socket.AF_UNIX if _USE_UNIX else None
+        self.address = _invalidate_address()
+
+    def accept(self, data) -> bool:
+        return (isinstance(data, dict) and data.get('type') == 'forget_devices'
+                and isinstance(data.get('device_ids'), list)
+                and all(isinstance(device_id, int) for device_id in data['device_ids'])
+                and (data.get('day') is None or isinstance(data['day'], str)))
+
+    def start(self):
+        if not _USE_UNIX:
+            logger.info("当前平台不支持 Unix 域套接字，接入进程不接收缓存失效通知")
+            return self
+        os.makedirs(CACHE_INVALIDATE_DIR, exist_ok=True)
+        return super().start()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共夹具：每个测试使用临时目录中的独立数据库
+"""
+import queue
+import types
+from datetime import timedelta
+
+import pytest
+
+import active_bitmaps
+import device_dimension
+import minute_activity
+from models import db, init_db, DB_BUSY_TIMEOUT
+
+
+def _use_database(path):
+    if not db.is_closed():
+        db.close()
+    db.init(path, timeout=DB_BUSY_TIMEOUT, pragmas=[('journal_mode', 'wal')])
+
+
+def _clear_process_caches():
+    device_dimension._device_ids.clear()
+    active_bitmaps._marked.clear()
+    active_bitmaps._marked_day = None
+    minute_activity._pending.clear()
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """在临时目录中初始化数据库，测试结束后恢复默认的 game_usage.db"""
+    monkeypatch.chdir(tmp_path)
+    _use_database(str(tmp_path / 'game_usage.db'))
+    _clear_process_caches()
+    init_db()
+    yield db
+    _use_database('game_usage.db')
+    _clear_process_caches()
+
+
+@pytest.fixture
+def tracker(temp_db):
+    """使用临时数据库、进程内更新队列的接入处理器（不连接 Broker）"""
+    from mqtt_client import GameUsageTracker
+    return GameUsageTracker(update_queue=queue.Queue())
+
+
+def deliver(tracker, payload, topic='game'):
+    """模拟收到一条 MQTT 消息（payload 为 bytes 或 dict）"""
+    if isinstance(payload, dict):
+        import json
+        payload = json.dumps(payload).encode('utf-8')
+    tracker.on_message(None, None, types.SimpleNamespace(topic=topic, payload=payload))
+
+
+def play(tracker, player_id, player_name, start, minutes):
+    """在 start 开始一局游戏，minutes 分钟后结束"""
+    tracker.handle_game_start(player_id, player_name, now=start)
+    tracker.handle_game_end(player_id, player_name, now=start + timedelta(minutes=minutes))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+按数据版本失效的结果缓存
+
+- DataVersion: 用一个只读的常驻 SQLite 连接读取 PRAGMA data_version。
+  任何其他连接（包括其他进程）提交写入后该值都会变化，读取成本为微秒级。
+- VersionedCache: 缓存条目记录计算时的数据版本，版本变化后自动失效；LRU 限制条目数。
+  export_current() / import_entries() 供启动快照使用（见 warm_snapshot.py）
+"""
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class DataVersion:
+    """数据库数据版本号（跨进程有效）"""
+
+    def __init__(self, database):
+        self.database = database
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def current(self) -> int:
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.database, check_same_thread=False)
+            return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def checkpoint(self) -> bool:
+        """在本连接上执行 TRUNCATE checkpoint（本连接执行的 checkpoint 不改变它读到的数据版本）。
+        WAL 全部合并并清空返回 True，有读写者占用时返回 False
+        """
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.database, check_same_thread=False)
+            busy, _, _ = self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            return busy == 0
+
+
+class VersionedCache:
+    """以 (key, 数据版本) 为条件的 LRU 缓存"""
+
+    def __init__(self, version_source, max_entries=128):
+        self.version_source = version_source
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        """返回 (value, version)。同一数据版本下相同 key 只计算一次"""
+        version = self.version_source.current()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], version
+        self.misses += 1
+        value = compute()
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value, version
+
+    def export_current(self, version, predicate=None):
+        """导出数据版本为 version 的条目 [(key, value)]，按 LRU 顺序（最近使用的在后）"""
+        with self._lock:
+            return [(key, value) for key, (entry_version, value) in self._entries.items()
+                    if entry_version == version and (predicate is None or predicate(key))]
+
+    def import_entries(self, entries, version):
+        """以数据版本 version 导入条目（调用方保证这些值与该版本的数据一致），返回导入条数"""
+        with self._lock:
+            for key, value in entries:
+                self._entries[key] = (version, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return len(entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
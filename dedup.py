@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+接入端重复消息过滤
+
+MQTT 重连、QoS 重投以及 BLE 链路不稳定时设备的重试，都会产生重复的
+game_start / game_end。handle_game_start 会强制结束已有会话，重复的开始事件
+因此变成一条很短的假会话并带来多余的写库。
+
+DedupWindow 是固定容量、按时间过期的“最近见过的 key”集合：
+- key 只保存 64 位哈希（同进程内有效），每条约 170 字节，容量 max_entries 即内存上限
+  （默认 10000 条，每个窗口约 1.7 MB）
+- 所有条目使用同一个窗口长度，插入顺序即过期顺序，过期清理只需从队头弹出
+- 超出容量时淘汰最旧的条目（宁可漏判重复，也不无限增长）
+
+多进程接入时同一设备总是分到同一个工作进程（见 ingest_workers.py），
+每个进程各自过滤即可。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from models import env_number
+
+
+# 消息带有 seq / timestamp 时按 (设备, 事件, 序号) 精确去重，窗口可以较长以覆盖重连后的重投
+DEDUP_ID_WINDOW_SECONDS = env_number('DEDUP_ID_WINDOW_SECONDS', 600, float)
+# 没有序号时，同一设备同一事件在短窗口内重复出现视为重复（不适用于心跳）
+DEDUP_WINDOW_SECONDS = env_number('DEDUP_WINDOW_SECONDS', 5, float)
+DEDUP_MAX_ENTRIES = max(1, env_number('DEDUP_MAX_ENTRIES', 10000))
+
+# 消息中可作为设备端序号的字段（按优先级）
+SEQUENCE_FIELDS = ('seq', 'msgId', 'timestamp', 'ts')
+# 只按时间窗口去重的事件：重复会产生假会话
+TIME_DEDUP_EVENTS = ('game_start', 'game_end')
+# 对方事件到达时清除本事件的时间窗口，只有紧挨着的重复才被丢弃
+OPPOSITE_EVENTS = {'game_start': 'game_end', 'game_end': 'game_start'}
+
+
+class DedupWindow:
+    """固定容量的时间窗口去重集合"""
+
+    def __init__(self, window_seconds, max_entries, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()  # key 哈希 -> 过期时间
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.evictions = 0
+
+    def seen(self, key) -> bool:
+        """key 在窗口内出现过返回 True（重复）；否则记录并返回 False"""
+        if self.window_seconds <= 0:
+            return False
+        now = self._clock()
+        digest = hash(key)
+        with self._lock:
+            entries = self._entries
+            # 从队头清理过期条目
+            while entries:
+                if next(iter(entries.values())) > now:
+                    break
+                entries.popitem(last=False)
+            if digest in entries:
+                self.hits += 1
+                return True
+            if len(entries) >= self.max_entries:
+                entries.popitem(last=False)
+                self.evictions += 1
+            entries[digest] = now + self.window_seconds
+            return False
+
+    def forget(self, key):
+        """从窗口中移除 key（之后再出现不算重复）"""
+        with self._lock:
+            self._entries.pop(hash(key), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def message_sequence(message):
+    """取消息中的设备端序号，没有返回 None"""
+    for field in SEQUENCE_FIELDS:
+        value = message.get(field)
+        if value is not None and value != '':
+            return value
+    return None
+
+
+class IngestDeduplicator:
+    """按 (device_key, playerName, event, 序号) 过滤重复消息。
+    与其他地方一样以 (设备 key, 名称) 区分设备：同一块板子快速切换程序时，新程序的开始事件不是重复
+    """
+
+    def __init__(self, id_window_seconds=None, window_seconds=None, max_entries=None):
+        max_entries = max_entries or DEDUP_MAX_ENTRIES
+        self.by_sequence = DedupWindow(
+            DEDUP_ID_WINDOW_SECONDS if id_window_seconds is None else id_window_seconds, max_entries)
+        self.by_event = DedupWindow(
+            DEDUP_WINDOW_SECONDS if window_seconds is None else window_seconds, max_entries)
+
+    def is_duplicate(self, device_key, event, message) -> bool:
+        player_name = message.get('playerName')
+        sequence = message_sequence(message)
+        if sequence is not None:
+            return self.by_sequence.seen((device_key, player_name, event, str(sequence)))
+        if event in TIME_DEDUP_EVENTS:
+            # 开始 → 结束 → 开始 在窗口内是两个真实会话：结束事件清除开始事件的窗口，反之亦然
+            self.by_event.forget((device_key, player_name, OPPOSITE_EVENTS[event]))
+            return self.by_event.seen((device_key, player_name, event))
+        return False
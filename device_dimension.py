@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+设备维度表（devices）与旧版会话表迁移
+
+旧版 game_sessions 每行都保存字符串 player_id / player_name，按设备查找会话只能全表扫描。
+现在设备标识集中到 devices 表，每个 (player_id, player_name) 组合一行（保留历史显示名称，
+统计接口的输出不变），会话只保存整数 device_id：
+
+- 会话行与索引更小，按设备查找走 (device_id, start_time) 索引
+- devices.registry_id 指向 device_registry.id，由触发器维护（注册表的 ORM 写入、批量导入、
+  其他进程的写入都会覆盖到），校区 / 项目筛选变成整数比较
+- 维度行只增不删（删除设备时只删会话），接入进程按 (player_id, player_name) 缓存 device_id
+
+迁移：init_db() 检测到旧表时自动执行；也可以手动执行（建议停止接入进程后进行）：
+
+    python device_dimension.py --migrate
+
+旧表先改名为 game_sessions_legacy，再按主键分批复制到新表（每批一个事务，中断后重新执行
+会从已复制的位置继续），最后删除旧表。释放的空间由保留任务的增量 VACUUM 归还（见 retention.py）。
+"""
+import logging
+import time
+
+from models import db, env_number, Device, GameSession, DeviceRegistry
+
+logger = logging.getLogger(__name__)
+
+
+MIGRATE_BATCH_SIZE = max(1, env_number('DEVICE_MIGRATE_BATCH_SIZE', 5000))
+
+LEGACY_TABLE = 'game_sessions_legacy'
+
+_LINK_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS devices_registry_link AFTER INSERT ON devices BEGIN
+        UPDATE devices SET registry_id = (SELECT id FROM device_registry WHERE ble_id = new.device_key)
+        WHERE id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS device_registry_link_ai AFTER INSERT ON device_registry BEGIN
+        UPDATE devices SET registry_id = new.id WHERE device_key = new.ble_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS device_registry_link_au AFTER UPDATE OF ble_id ON device_registry BEGIN
+        UPDATE devices SET registry_id = NULL WHERE registry_id = old.id;
+        UPDATE devices SET registry_id = new.id WHERE device_key = new.ble_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS device_registry_link_ad AFTER DELETE ON device_registry BEGIN
+        UPDATE devices SET registry_id = NULL WHERE registry_id = old.id;
+    END""",
+]
+
+# (player_id, player_name) -> devices.id；维度行不会删除，缓存无需失效
+_device_ids = {}
+
+
+def _columns(table):
+    return {row[1] for row in db.execute_sql(f'PRAGMA table_info({table})').fetchall()}
+
+
+def _table_exists(table):
+    return db.execute_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def needs_migration():
+    """game_sessions 仍是旧结构，或上次迁移未完成"""
+    return 'player_id' in _columns('game_sessions') or _table_exists(LEGACY_TABLE)
+
+
+def migrate_legacy_sessions(batch_size=None):
+    """把旧版会话表迁移到 devices + device_id，返回迁移报告；无需迁移时返回 None"""
+    if not needs_migration():
+        return None
+    batch_size = batch_size or MIGRATE_BATCH_SIZE
+    started = time.perf_counter()
+    report = {'devices': 0, 'sessions_migrated': 0, 'chunks': 0}
+
+    db.create_tables([Device, DeviceRegistry], safe=True)
+    with db.atomic():
+        if 'player_id' in _columns('game_sessions'):
+            db.execute_sql(f'ALTER TABLE game_sessions RENAME TO {LEGACY_TABLE}')
+        db.create_tables([GameSession], safe=True)
+        # 按首次出现的顺序分配 id，设备列表的顺序与迁移前一致
+        db.execute_sql(f"""INSERT OR IGNORE INTO devices (device_key, name)
+            SELECT player_id, player_name FROM {LEGACY_TABLE}
+            GROUP BY player_id, player_name ORDER BY MIN(id)""")
+    report['devices'] = Device.select().count()
+
+    # 保留原会话 id（设备状态表的 current_session_id 仍然有效）；从新表已有的最大 id 继续
+    last_id = db.execute_sql('SELECT COALESCE(MAX(id), 0) FROM game_sessions').fetchone()[0]
+    while True:
+        with db.atomic():
+            copied = db.execute_sql(f"""INSERT INTO game_sessions
+                    (id, device_id, start_time, end_time, duration_seconds, created_at)
+                SELECT s.id, d.id, s.start_time, s.end_time, s.duration_seconds, s.created_at
+                FROM {LEGACY_TABLE} s
+                JOIN devices d ON d.device_key = s.player_id AND d.name = s.player_name
+                WHERE s.id > ? ORDER BY s.id LIMIT ?""", (last_id, batch_size)).rowcount
+            if copied <= 0:
+                break
+            last_id = db.execute_sql('SELECT MAX(id) FROM game_sessions').fetchone()[0]
+        report['sessions_migrated'] += copied
+        report['chunks'] += 1
+        logger.info(f"会话迁移进度: 已复制 {report['sessions_migrated']} 条")
+
+    db.execute_sql(f'DROP TABLE {LEGACY_TABLE}')
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    logger.info(f"会话表已迁移到设备维度表: {report}")
+    return report
+
+
+def ensure_registry_link():
+    """创建注册表关联触发器，并按当前注册表重新计算 devices.registry_id"""
+    with db.atomic():
+        for statement in _LINK_DDL:
+            db.execute_sql(statement)
+        # 只写入有变化的行：关联未变时启动不产生写入（数据库文件不变，启动快照仍然有效）
+        db.execute_sql("""UPDATE devices SET registry_id =
+            (SELECT id FROM device_registry WHERE ble_id = devices.device_key)
+            WHERE registry_id IS NOT (SELECT id FROM device_registry WHERE ble_id = devices.device_key)""")
+
+
+def device_id_for(player_id, player_name):
+    """返回 (player_id, player_name) 对应的 devices.id，不存在时创建"""
+    key = (player_id, player_name)
+    device_id = _device_ids.get(key)
+    if device_id is None:
+        # 多个接入进程可能同时创建同一设备：唯一索引冲突时忽略，再读出 id
+        Device.insert(device_key=player_id, name=player_name).on_conflict_ignore().execute()
+        device_id = Device.select(Device.id).where(
+            Device.device_key == player_id, Device.name == player_name).scalar()
+        _device_ids[key] = device_id
+    return device_id
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description='设备维度表迁移')
+    parser.add_argument('--migrate', action='store_true', help='把旧版会话表迁移到设备维度表')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db.connect()
+    if not args.migrate:
+        print("需要迁移" if needs_migration() else "会话表已是新结构，无需迁移")
+    else:
+        result = migrate_legacy_sessions()
+        print(json.dumps(result, ensure_ascii=False, indent=2) if result else "会话表已是新结构，无需迁移")
+        db.close()
+        init_db()
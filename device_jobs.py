@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+后台设备删除任务
+
+DELETE /api/device/<player_id> 原来在请求内用一条语句删除设备的全部会话，
+历史较长的设备会长时间占用 SQLite 写锁，阻塞 MQTT 接入，HTTP 请求也可能超时。
+现在删除改为后台任务：
+
+- 先用只读查询取出设备的全部会话 ID，再按主键分批删除，每批一个短事务，
+  批间暂停 DEVICE_DELETE_PAUSE_SECONDS，让接入进程有机会写入
+- 同时删除该设备的归档汇总（daily_usage_archive）、时长草图、活跃设备位图、设备状态和注册表记录，
+  保证统计接口不再出现已删除的设备
+- 一个任务可以包含多个设备；任务由单个后台线程依次执行，互不争抢写锁
+- 任务进度保存在内存中（最近 DEVICE_JOB_HISTORY 个），通过 GET /api/jobs/<job_id> 查询
+"""
+import logging
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import active_bitmaps
+import minute_activity
+import partitions
+from change_notify import forget_devices
+from models import db, env_number, Device, GameSession, DeviceStatus, DeviceRegistry, DailyUsageArchive, SessionLengthSketch
+
+logger = logging.getLogger(__name__)
+
+
+DELETE_BATCH_SIZE = max(1, env_number('DEVICE_DELETE_BATCH_SIZE', 500))
+DELETE_PAUSE_SECONDS = env_number('DEVICE_DELETE_PAUSE_SECONDS', 0.05, float)
+JOB_HISTORY = max(1, env_number('DEVICE_JOB_HISTORY', 50))
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class DeviceDeletionJob:
+    """一次删除任务（可包含多个设备）"""
+
+    def __init__(self, player_ids):
+        self.id = uuid.uuid4().hex[:12]
+        self.status = 'queued'  # queued / running / done / failed
+        self.created_at = _now_iso()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.devices = [{
+            'player_id': player_id,
+            'status': 'queued',
+            'sessions_total': None,
+            'sessions_deleted': 0,
+            'archive_deleted': 0,
+            'status_deleted': 0,
+            'registry_deleted': 0,
+        } for player_id in player_ids]
+
+    def to_dict(self):
+        total = sum(d['sessions_total'] or 0 for d in self.devices)
+        deleted = sum(d['sessions_deleted'] for d in self.devices)
+        counted = all(d['sessions_total'] is not None for d in self.devices)
+        return {
+            'job_id': self.id,
+            'type': 'delete_devices',
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'progress': {
+                'devices_total': len(self.devices),
+                'devices_done': len([d for d in self.devices if d['status'] == 'done']),
+                'sessions_total': total if counted else None,
+                'sessions_deleted': deleted,
+                'percent': round(deleted * 100 / total, 1) if counted and total else (100.0 if self.status == 'done' else 0.0),
+            },
+            'devices': [dict(d) for d in self.devices],
+        }
+
+
+_jobs = {}  # job_id -> DeviceDeletionJob（按提交顺序，超出 JOB_HISTORY 时淘汰最旧的已结束任务）
+_jobs_lock = threading.Lock()
+_queue = queue.Queue()
+_worker = None
+
+
+def submit_deletion(player_ids):
+    """提交删除任务，立即返回任务对象"""
+    global _worker
+    player_ids = list(dict.fromkeys(p for p in player_ids if p))
+    if not player_ids:
+        raise ValueError('player_ids 不能为空')
+    job = DeviceDeletionJob(player_ids)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        finished = [j for j in _jobs.values() if j.status in ('done', 'failed')]
+        while len(_jobs) > JOB_HISTORY and finished:
+            _jobs.pop(finished.pop(0).id, None)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name='device-jobs', daemon=True)
+            _worker.start()
+    _queue.put(job)
+    logger.info(f"已提交设备删除任务 {job.id}: {', '.join(player_ids)}")
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs():
+    with _jobs_lock:
+        return list(_jobs.values())
+
+
+def _worker_loop():
+    while True:
+        job = _queue.get()
+        try:
+            with db.connection_context():
+                _run_job(job)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            job.finished_at = _now_iso()
+            logger.error(f"设备删除任务 {job.id} 失败: {e}")
+
+
+def _run_job(job):
+    job.status = 'running'
+    job.started_at = _now_iso()
+    for device in job.devices:
+        device['status'] = 'running'
+        _delete_device(device)
+        device['status'] = 'done'
+    job.status = 'done'
+    job.finished_at = _now_iso()
+    logger.info(f"设备删除任务 {job.id} 完成: " + '；'.join(
+        f"{d['player_id']} 会话 {d['sessions_deleted']} 条、归档 {d['archive_deleted']} 条、"
+        f"状态 {d['status_deleted']} 条、注册表 {d['registry_deleted']} 条" for d in job.devices))
+
+
+def _delete_in_chunks(model, ids, on_progress):
+    """按主键分批删除，每批一个短事务"""
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        with db.atomic():
+            deleted = model.delete().where(model.id.in_(ids[i:i + DELETE_BATCH_SIZE])).execute()
+        on_progress(deleted)
+        time.sleep(DELETE_PAUSE_SECONDS)
+
+
+def _delete_device(device):
+    player_id = device['player_id']
+
+    # 只读查询取出全部 ID，删除时按主键定位，不在写事务中扫描全表
+    session_ids = [row[0] for row in GameSession.select(GameSession.id).join(Device).where(
+        Device.device_key == player_id).tuples()]
+    device['sessions_total'] = len(session_ids)
+
+    def on_sessions(n):
+        device['sessions_deleted'] += n
+    _delete_in_chunks(GameSession, session_ids, on_sessions)
+
+    # 删除期间新到的会话（设备仍在上报）一并清理
+    late_ids = [row[0] for row in GameSession.select(GameSession.id).join(Device).where(
+        Device.device_key == player_id).tuples()]
+    if late_ids:
+        device['sessions_total'] += len(late_ids)
+        _delete_in_chunks(GameSession, late_ids, on_sessions)
+
+    # 已封存到按月分区的会话（见 partitions.py）
+    device_ids = [row[0] for row in Device.select(Device.id).where(Device.device_key == player_id).tuples()]
+    sealed = partitions.delete_device_sessions(device_ids)
+    if sealed:
+        device['sessions_total'] += sealed
+        on_sessions(sealed)
+
+    archive_ids = [row[0] for row in DailyUsageArchive.select(DailyUsageArchive.id).where(
+        DailyUsageArchive.player_id == player_id).tuples()]
+
+    def on_archive(n):
+        device['archive_deleted'] += n
+    _delete_in_chunks(DailyUsageArchive, archive_ids, on_archive)
+
+    active_bitmaps.clear_devices(device_ids)
+    minute_activity.clear_devices(device_ids)
+    # 其他接入进程（INGEST_WORKERS / 单独运行的 mqtt_client.py）中的同类缓存
+    forget_devices(device_ids)
+    with db.atomic():
+        # 每天每个设备一行，行数很少，直接删除
+        SessionLengthSketch.delete().where(SessionLengthSketch.device.in_(device_ids)).execute()
+        device['status_deleted'] = DeviceStatus.delete().where(
+            DeviceStatus.player_id == player_id).execute()
+        # player_id 可能是规范化后的 BLE ID，此时同时删除注册表记录
+        if player_id.startswith('MICROBLOCKS'):
+            device['registry_deleted'] = DeviceRegistry.delete().where(
+                DeviceRegistry.ble_id == player_id).execute()
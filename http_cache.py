@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP 响应压缩与缓存
+
+- CachedBody: 已序列化的响应体 + 强 ETag，gzip 版本首次需要时压缩一次并随缓存条目保存
+- StaticAssets: 启动时读入静态文件并预压缩，计算内容哈希作为强 ETag
+- compress_response(): 对未缓存的大 JSON 响应按需 gzip
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import Response
+
+import metrics
+
+try:
+    GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+except Exception:
+    GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+
+HTTP_RESPONSE_BYTES = metrics.REGISTRY.counter(
+    'http_response_bytes_total', '响应体字节数（按编码）', ('encoding',))
+HTTP_GZIP_SAVED_BYTES = metrics.REGISTRY.counter(
+    'http_gzip_saved_bytes_total', 'gzip 压缩节省的字节数')
+
+
+def gzip_bytes(data: bytes) -> bytes:
+    # mtime=0 保证同样的输入得到同样的输出
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def accepts_gzip(request) -> bool:
+    return 'gzip' in (request.headers.get('Accept-Encoding') or '').lower()
+
+
+def etag_matches(request, etag) -> bool:
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+
+class CachedBody:
+    """缓存的响应体：原始字节 + 惰性计算的 gzip 字节"""
+    __slots__ = ('data', 'mimetype', 'etag', '_gzipped', '_lock')
+
+    def __init__(self, data: bytes, mimetype, etag=None):
+        self.data = data
+        self.mimetype = mimetype
+        self.etag = etag or '"' + hashlib.sha1(data).hexdigest() + '"'
+        self._gzipped = None
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        # 锁不能序列化；启动快照只保存原始字节，gzip 版本在需要时重新压缩
+        return CachedBody, (self.data, self.mimetype, self.etag)
+
+    @property
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            with self._lock:
+                if self._gzipped is None:
+                    self._gzipped = gzip_bytes(self.data)
+        return self._gzipped
+
+    def to_response(self, request, cache_control='no-cache'):
+        """生成响应：支持 If-None-Match（304）与 gzip 协商"""
+        headers = {'ETag': self.etag, 'Vary': 'Accept-Encoding', 'Cache-Control': cache_control}
+        if etag_matches(request, self.etag):
+            return Response(status=304, headers=headers)
+        body = self.data
+        if len(body) >= GZIP_MIN_BYTES and accepts_gzip(request):
+            body = self.gzipped
+            headers['Content-Encoding'] = 'gzip'
+            HTTP_GZIP_SAVED_BYTES.inc(amount=len(self.data) - len(body))
+        # mimetype 可能已带 charset，按完整 Content-Type 传入，避免 Werkzeug 再追加一次
+        return Response(body, content_type=self.mimetype, headers=headers)
+
+
+def compress_response(request, response):
+    """after_request 中调用：对较大的 JSON 响应进行 gzip 压缩，并统计响应字节数"""
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+        return response
+    data = response.get_data()
+    encoding = response.headers.get('Content-Encoding')
+    if encoding:
+        # 已压缩（缓存的 gzip 响应体）
+        HTTP_RESPONSE_BYTES.inc(encoding, amount=len(data))
+        return response
+    if (response.mimetype != 'application/json' or len(data) < GZIP_MIN_BYTES
+            or not accepts_gzip(request)):
+        HTTP_RESPONSE_BYTES.inc('identity', amount=len(data))
+        return response
+    compressed = gzip_bytes(data)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    HTTP_RESPONSE_BYTES.inc('gzip', amount=len(compressed))
+    HTTP_GZIP_SAVED_BYTES.inc(amount=len(data) - len(compressed))
+    return response
+
+
+class StaticAssets:
+    """预加载并预压缩的静态文件
+
+    - ETag 为内容哈希（强 ETag），浏览器可用 If-None-Match 免下载
+    - HTML 使用 no-cache（每次协商，命中时 304）；其余文件长期缓存
+    - 带 ?v=<hash> 版本参数且匹配时返回 immutable，一年内无需协商
+    """
+
+    def __init__(self, directory, max_age=None):
+        self.directory = os.path.abspath(directory)
+        try:
+            self.max_age = int(max_age if max_age is not None else os.environ.get('STATIC_MAX_AGE', '86400'))
+        except Exception:
+            self.max_age = 86400
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """读入目录下所有文件并预压缩（启动时调用）"""
+        count = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                rel = os.path.relpath(os.path.join(root, name), self.directory).replace(os.sep, '/')
+                self._load(rel)
+                count += 1
+        return count
+
+    def _load(self, filename):
+        path = os.path.join(self.directory, filename)
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/') or mimetype in ('application/javascript', 'application/json'):
+            mimetype += '; charset=utf-8'
+        with open(path, 'rb') as f:
+            body = CachedBody(f.read(), mimetype)
+        # 预先生成 gzip 版本
+        body.gzipped
+        with self._lock:
+            self._files[filename] = (os.path.getmtime(path), body)
+        return body
+
+    def get(self, filename):
+        """返回 CachedBody；文件不存在返回 None。文件修改后自动重新加载"""
+        path = os.path.abspath(os.path.join(self.directory, filename))
+        if not path.startswith(self.directory + os.sep) or not os.path.isfile(path):
+            return None
+        entry = self._files.get(filename)
+        if entry is not None and entry[0] == os.path.getmtime(path):
+            return entry[1]
+        return self._load(filename)
+
+    def response(self, request, filename):
+        body = self.get(filename)
+        if body is None:
+            return None
+        version = request.args.get('v')
+        if version and f'"{version}"' == body.etag:
+            cache_control = 'public, max-age=31536000, immutable'
+        elif body.mimetype.startswith('text/html'):
+            cache_control = 'no-cache'
+        else:
+            cache_control = f'public, max-age={self.max_age}'
+        return body.to_response(request, cache_control)
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+本地接入日志（追加写，崩溃安全）
+
+原来 on_message 同步写库：进程被杀时，已收到（QoS 1 已确认）但还没写库的消息就丢了，
+写库也只能逐条同步进行。启用日志后（INGEST_JOURNAL=1）：
+
+- on_message 去重后把原始消息连同接收时间追加到日志段文件，写入操作系统后才返回（随后确认消息）；
+  进程被杀不丢消息，JOURNAL_FSYNC=always 时每条 fsync，断电也不丢
+- 应用线程在后台按批（JOURNAL_BATCH_SIZE 条一个事务）写库，会话时间使用日志中的接收时间，
+  与同步写库的结果相同
+- 已应用位置 (段号, 偏移) 与这一批的写库在同一个事务中提交（ingest_journal_position 表），
+  重启后从该位置重放未应用的尾部：每条消息恰好应用一次
+- 段文件写满 JOURNAL_SEGMENT_BYTES 后切换到下一段，已全部应用的段删除
+
+记录格式（小端）：长度 u32 | CRC32 u32 | 接收时间 f64 | 主题长度 u16 | 主题 | 消息。
+CRC 覆盖长度之后的全部内容；进程崩溃时写了一半的尾部在启动时截掉。
+多进程接入（INGEST_WORKERS > 1）不使用日志。
+"""
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import metrics
+from models import db, env_number, IngestJournalPosition
+
+logger = logging.getLogger(__name__)
+
+
+JOURNAL_ENABLED = os.environ.get('INGEST_JOURNAL') == '1'
+JOURNAL_DIR = os.environ.get('INGEST_JOURNAL_DIR', 'ingest_journal')
+JOURNAL_SEGMENT_BYTES = max(4096, env_number('JOURNAL_SEGMENT_BYTES', 4 * 1024 * 1024))
+JOURNAL_BATCH_SIZE = max(1, env_number('JOURNAL_BATCH_SIZE', 200))
+# always：每条 fsync；interval（默认）：每条写入操作系统，应用线程至多每 JOURNAL_FSYNC_SECONDS 秒 fsync 一次
+JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', 'interval')
+JOURNAL_FSYNC_SECONDS = env_number('JOURNAL_FSYNC_SECONDS', 1.0, float)
+# 写库失败（如数据库被锁）后重试同一批的间隔
+JOURNAL_RETRY_SECONDS = 1.0
+READ_CHUNK_BYTES = 256 * 1024
+
+_PREFIX = struct.Struct('<II')  # 长度, CRC32
+_BODY_HEADER = struct.Struct('<dH')  # 接收时间, 主题长度
+
+JOURNAL_APPENDED = metrics.REGISTRY.counter(
+    'ingest_journal_appended_total', '追加到接入日志的消息数')
+JOURNAL_APPLIED = metrics.REGISTRY.counter(
+    'ingest_journal_applied_total', '从接入日志应用到数据库的消息数')
+JOURNAL_LAG = metrics.REGISTRY.gauge(
+    'ingest_journal_lag_bytes', '接入日志中尚未应用的字节数')
+JOURNAL_BATCH_SECONDS = metrics.REGISTRY.histogram(
+    'ingest_journal_batch_seconds', '应用一批日志记录的耗时（含提交）')
+
+
+def encode_record(received_at, topic, payload):
+    topic_bytes = topic.encode('utf-8') if isinstance(topic, str) else (topic or b'')
+    body = _BODY_HEADER.pack(received_at, len(topic_bytes)) + topic_bytes + payload
+    return _PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_records(data, offset=0):
+    """从 data 的 offset 处解析完整记录，返回 ([(结束偏移, 接收时间, 主题, 消息)], 有效结束偏移)。
+    遇到不完整或校验失败的记录即停止
+    """
+    records = []
+    end = len(data)
+    while offset + _PREFIX.size <= end:
+        length, crc = _PREFIX.unpack_from(data, offset)
+        start = offset + _PREFIX.size
+        if start + length > end or length < _BODY_HEADER.size:
+            break
+        body = data[start:start + length]
+        if zlib.crc32(body) != crc:
+            break
+        received_at, topic_length = _BODY_HEADER.unpack_from(body)
+        payload_start = _BODY_HEADER.size + topic_length
+        topic = body[_BODY_HEADER.size:payload_start].decode('utf-8', errors='replace')
+        offset = start + length
+        records.append((offset, received_at, topic, bytes(body[payload_start:])))
+    return records, offset
+
+
+def _segment_path(directory, number):
+    return os.path.join(directory, f'{number:012d}.log')
+
+
+def _segment_numbers(directory):
+    return sorted(int(os.path.basename(path)[:-4]) for path in glob.glob(os.path.join(directory, '*.log'))
+                  if os.path.basename(path)[:-4].isdigit())
+
+
+def ensure_journal_table():
+    db.create_tables([IngestJournalPosition], safe=True)
+
+
+class IngestJournal:
+    """追加写的接入日志：append() 由 MQTT 线程调用，应用线程在后台批量写库"""
+
+    def __init__(self, directory=None, name='default', segment_bytes=None, batch_size=None, fsync=None):
+        self.directory = directory or JOURNAL_DIR
+        self.name = name
+        self.segment_bytes = segment_bytes or JOURNAL_SEGMENT_BYTES
+        self.batch_size = batch_size or JOURNAL_BATCH_SIZE
+        self.fsync_always = (fsync or JOURNAL_FSYNC) == 'always'
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        self._fd = None
+        self._dirty = False
+        self._last_sync = time.monotonic()
+        self._thread = None
+        self._position = None  # 应用线程已提交的位置 (段号, 偏移)
+        self._open_tail()
+        JOURNAL_LAG.set_function(self.lag_bytes)
+
+    # ---- 写入 ----
+    def _open_tail(self):
+        """打开最后一个段用于追加；崩溃时写了一半的尾部截掉"""
+        numbers = _segment_numbers(self.directory)
+        self.segment = numbers[-1] if numbers else 1
+        path = _segment_path(self.directory, self.segment)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        with open(path, 'rb') as f:
+            data = f.read()
+        _, valid_end = read_records(data)
+        if valid_end < len(data):
+            logger.warning(f"接入日志段 {path} 尾部 {len(data) - valid_end} 字节不完整，已截掉")
+            os.ftruncate(self._fd, valid_end)
+        self.size = valid_end
+
+    def append(self, topic, payload, received_at=None):
+        """追加一条消息（写入操作系统后返回），返回 (段号, 结束偏移)"""
+        record = encode_record(time.time() if received_at is None else received_at, topic, payload)
+        with self._lock:
+            os.write(self._fd, record)
+            if self.fsync_always:
+                os.fsync(self._fd)
+            else:
+                self._dirty = True
+            self.size += len(record)
+            position = (self.segment, self.size)
+            if self.size >= self.segment_bytes:
+                self._rotate()
+            self._appended.notify()
+        JOURNAL_APPENDED.inc()
+        return position
+
+    def _rotate(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self.segment += 1
+        self._fd = os.open(_segment_path(self.directory, self.segment),
+                           os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = 0
+        self._dirty = False
+
+    def sync(self):
+        """把已写入操作系统的记录 fsync 到磁盘"""
+        with self._lock:
+            if self._dirty:
+                os.fsync(self._fd)
+                self._dirty = False
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+    # ---- 应用 ----
+    def applied_position(self):
+        row = IngestJournalPosition.get_or_none(IngestJournalPosition.name == self.name)
+        return (row.segment, row.byte_offset) if row else (0, 0)
+
+    def lag_bytes(self):
+        position = self._position
+        if position is None:
+            return 0
+        with self._lock:
+            segment, size = self.segment, self.size
+        applied_segment, offset = position
+        lag = size - offset if applied_segment == segment else size
+        for number in range(applied_segment, segment):
+            try:
+                lag += os.path.getsize(_segment_path(self.directory, number)) - (
+                    offset if number == applied_segment else 0)
+            except OSError:
+                pass
+        return max(0, lag)
+
+    def _read_batch(self, segment, offset):
+        """读取 (segment, offset) 之后的一批完整记录；返回 (records, 新位置)"""
+        with self._lock:
+            # 只读到写入端已完成的位置，不会读到正在写的记录
+            limit = self.size if segment == self.segment else None
+            current = self.segment
+        if segment > current:
+            return [], (segment, offset)
+        path = _segment_path(self.directory, segment)
+        available = None if limit is None else max(0, limit - offset)
+        records, data = [], b''
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                # 每次只读一块；一块内没有完整记录（超大消息）时读到可读范围的末尾
+                data = f.read(READ_CHUNK_BYTES if available is None else min(available, READ_CHUNK_BYTES))
+                records, _ = read_records(data)
+                if not records and len(data) == READ_CHUNK_BYTES:
+                    data += f.read(None if available is None else available - len(data))
+                    records, _ = read_records(data)
+        except FileNotFoundError:
+            pass
+        records = records[:self.batch_size]
+        if records:
+            end = offset + records[-1][0]
+            return [(received_at, topic, payload) for _, received_at, topic, payload in records], (segment, end)
+        if segment < current:
+            if data:
+                logger.error(f"接入日志段 {path} 偏移 {offset} 处记录损坏，跳过该段剩余部分")
+            # 段已写满且全部应用：转到下一段
+            return [], (segment + 1, 0)
+        return [], (segment, offset)
+
+    def _save_position(self, position):
+        IngestJournalPosition.insert(
+            name=self.name, segment=position[0], byte_offset=position[1]
+        ).on_conflict(
+            conflict_target=[IngestJournalPosition.name],
+            preserve=[IngestJournalPosition.segment, IngestJournalPosition.byte_offset]
+        ).execute()
+
+    def _delete_applied_segments(self, segment):
+        for number in _segment_numbers(self.directory):
+            if number >= segment:
+                break
+            try:
+                os.remove(_segment_path(self.directory, number))
+            except OSError as e:
+                logger.warning(f"删除已应用的接入日志段失败: {e}")
+
+    def apply_pending(self, apply_batch, after_commit=None, wait_seconds=0):
+        """应用一批未应用的记录，返回应用的条数（wait_seconds 内没有新记录时返回 0）"""
+        segment, offset = self._position
+        records, position = self._read_batch(segment, offset)
+        if not records:
+            if position != self._position:
+                # 只推进段号，不需要写库
+                with db.atomic():
+                    self._save_position(position)
+                self._position = position
+                self._delete_applied_segments(position[0])
+                return 0
+            with self._lock:
+                if (self.segment, self.size) == (segment, offset) and wait_seconds > 0:
+                    self._appended.wait(wait_seconds)
+            return 0
+
+        start = time.perf_counter()
+        with db.ingest_priority(), db.atomic():
+            result = apply_batch(records)
+            self._save_position(position)
+        JOURNAL_BATCH_SECONDS.observe(time.perf_counter() - start)
+        JOURNAL_APPLIED.inc(amount=len(records))
+        self._position = position
+        if after_commit is not None:
+            after_commit(result)
+        return len(records)
+
+    def start_applier(self, apply_batch, after_commit=None, before_apply=None):
+        """启动后台应用线程：先重放上次未应用的尾部，之后持续应用新记录"""
+        def run():
+            if before_apply is not None:
+                before_apply()
+            db.connect(reuse_if_open=True)
+            ensure_journal_table()
+            position = self.applied_position()
+            first = _segment_numbers(self.directory)[0]
+            if position[0] > self.segment:
+                # 日志目录被清空重建过：已保存的位置不再对应现有的段，从头应用现有的段
+                logger.warning(f"接入日志位置 {position} 超出现有的段，从第 {first} 段开头应用")
+                position = (0, 0)
+            self._position = position if position[0] else (first, 0)
+            replayed = 0
+            while True:
+                before = self._position
+                try:
+                    count = self.apply_pending(apply_batch, after_commit, wait_seconds=JOURNAL_FSYNC_SECONDS)
+                except Exception as e:
+                    # 整批回滚、位置不变，稍后重试；接入进程内的缓存可能记住了回滚掉的数据，清空
+                    logger.error(f"应用接入日志失败，{JOURNAL_RETRY_SECONDS} 秒后重试: {e}")
+                    _reset_ingest_caches()
+                    time.sleep(JOURNAL_RETRY_SECONDS)
+                    continue
+                if replayed is not None:
+                    if count or self._position != before:
+                        replayed += count
+                    else:
+                        if replayed:
+                            logger.info(f"已重放接入日志中未应用的 {replayed} 条消息")
+                        replayed = None
+                if not self.fsync_always and time.monotonic() - self._last_sync >= JOURNAL_FSYNC_SECONDS:
+                    self.sync()
+
+        self._thread = threading.Thread(target=run, name='ingest-journal', daemon=True)
+        self._thread.start()
+        return self._thread
+
+
+def _reset_ingest_caches():
+    import active_bitmaps
+    import device_dimension
+    device_dimension._device_ids.clear()
+    active_bitmaps._marked.clear()
+
+
+def journal_from_env():
+    """INGEST_JOURNAL=1 时返回接入日志，否则返回 None"""
+    if not JOURNAL_ENABLED:
+        return None
+    journal = IngestJournal()
+    logger.info(f"接入日志已启用: {os.path.abspath(journal.directory)}（fsync: {JOURNAL_FSYNC}）")
+    return journal
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+接入过载保护：有界消息队列 + 按设备限流
+
+某块板子死循环时会以极高频率向 game 主题发心跳。原来每条消息都在 MQTT 网络线程中直接写库并触发一次实时更新，
+一台设备就能拖慢整个设备群的接入。现在：
+
+- 按设备令牌桶限流（DeviceRateLimiter）：每台设备每秒补充 INGEST_DEVICE_RATE 个令牌（默认 1，0 为关闭），
+  最多积累 INGEST_DEVICE_BURST 个（默认 20）。没有令牌的心跳直接丢弃；game_start / game_end 从不丢弃，
+  但同样消耗令牌，刷开始 / 结束事件的设备其心跳会先被限流
+- 有界队列（IngestQueue，INGEST_QUEUE_SIZE，默认 0 即关闭、在 MQTT 线程中同步写库）：MQTT 线程只做解析分类后
+  连同解析结果入队，后台线程每次取至多 INGEST_QUEUE_BATCH 条（默认 100）在一个写事务中处理，整批只触发一次实时更新。
+  注意投递保证随之改变：on_message 入队即返回，QoS 1 消息在写库之前就已确认，进程被杀时队列中最多
+  INGEST_QUEUE_SIZE 条已确认的开始 / 结束事件丢失。需要不丢消息时使用接入日志（INGEST_JOURNAL=1，
+  见 ingest_journal.py），日志模式下不使用队列
+- 丢弃优先级：
+  1. 同一设备仍在排队的心跳被新心跳替换（只保留最新的接收时间，原排队位置不变）
+  2. 队列满时新到的心跳丢弃
+  3. 队列满时到达的开始 / 结束事件挤掉最早的排队心跳；队列中全是开始 / 结束事件时阻塞 MQTT 线程，
+     背压传回 Broker（与多进程接入的分发队列相同）
+- 设备在开始 / 结束事件之后的心跳不会并入之前排队的心跳，同一设备的事件顺序不变
+- 指标：ingest_shed_total{reason}（collapsed / queue_full / evicted）、ingest_rate_limited_total{event}、
+  ingest_queue_depth；被限流的设备每个日志汇总周期告警一次
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+import metrics
+from models import env_number
+
+logger = logging.getLogger(__name__)
+
+
+INGEST_QUEUE_SIZE = max(0, env_number('INGEST_QUEUE_SIZE', 0))
+INGEST_QUEUE_BATCH = max(1, env_number('INGEST_QUEUE_BATCH', 100))
+INGEST_DEVICE_RATE = max(0.0, env_number('INGEST_DEVICE_RATE', 1, float))
+INGEST_DEVICE_BURST = max(1.0, env_number('INGEST_DEVICE_BURST', 20, float))
+# 限流状态最多保留的设备数（超出时淘汰最久未出现的设备）
+RATE_LIMIT_MAX_DEVICES = max(1, env_number('INGEST_RATE_LIMIT_MAX_DEVICES', 10000))
+
+# 从不丢弃的事件
+PRIORITY_EVENTS = ('game_start', 'game_end')
+
+INGEST_SHED = metrics.REGISTRY.counter(
+    'ingest_shed_total', '过载保护丢弃的心跳数（按原因）', ('reason',))
+INGEST_RATE_LIMITED = metrics.REGISTRY.counter(
+    'ingest_rate_limited_total', '超出设备速率限制的消息数（按事件；只有心跳被丢弃）', ('event',))
+INGEST_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'ingest_queue_depth', '接入队列中等待处理的消息数')
+
+
+class DeviceRateLimiter:
+    """按设备的令牌桶"""
+
+    def __init__(self, rate=None, burst=None, max_devices=None, clock=time.monotonic):
+        self.rate = INGEST_DEVICE_RATE if rate is None else rate
+        self.burst = INGEST_DEVICE_BURST if burst is None else burst
+        self.max_devices = max_devices or RATE_LIMIT_MAX_DEVICES
+        self._clock = clock
+        self._buckets = OrderedDict()  # device_key -> [令牌数, 上次补充时间]
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def allow(self, device_key) -> bool:
+        """取一个令牌，没有令牌时返回 False（是否丢弃由调用方按事件决定）"""
+        if not self.enabled or not device_key:
+            return True
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(device_key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_devices:
+                    self._buckets.popitem(last=False)
+                bucket = self._buckets[device_key] = [self.burst, now]
+            else:
+                self._buckets.move_to_end(device_key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            return False
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class IngestQueue:
+    """有界接入队列：MQTT 线程 offer()，后台线程按批调用 handle_batch([(接收时间, 消息)])"""
+
+    def __init__(self, handle_batch, max_size=None, batch_size=None):
+        self.handle_batch = handle_batch
+        self.max_size = max(1, max_size or INGEST_QUEUE_SIZE)
+        self.batch_size = batch_size or INGEST_QUEUE_BATCH
+        # 条目为 [事件, 接收时间, 消息, 设备 key]；被挤掉的心跳把消息置为 None，出队时跳过
+        self._items = deque()
+        self._size = 0
+        # 每台设备仍在排队、可以被替换的心跳（按入队顺序，最早的先被挤掉）
+        self._heartbeats = OrderedDict()
+        self._cond = threading.Condition()
+        self._thread = None
+        INGEST_QUEUE_DEPTH.set_function(lambda: self._size)
+
+    def offer(self, payload, event=None, device_key=None, received_at=None):
+        """入队，返回 False 表示消息被丢弃（只有心跳会被丢弃）"""
+        received_at = received_at or datetime.now(timezone.utc)
+        heartbeat = event == 'heartbeat' and bool(device_key)
+        with self._cond:
+            if heartbeat:
+                queued = self._heartbeats.get(device_key)
+                if queued is not None:
+                    queued[1], queued[2] = received_at, payload
+                    INGEST_SHED.inc('collapsed')
+                    return True
+            if self._size >= self.max_size:
+                if event not in PRIORITY_EVENTS:
+                    INGEST_SHED.inc('queue_full')
+                    return False
+                if self._heartbeats:
+                    _, evicted = self._heartbeats.popitem(last=False)
+                    evicted[2] = None
+                    self._size -= 1
+                    INGEST_SHED.inc('evicted')
+                else:
+                    while self._size >= self.max_size:
+                        self._cond.wait()
+            item = [event, received_at, payload, device_key]
+            self._items.append(item)
+            self._size += 1
+            if heartbeat:
+                self._heartbeats[device_key] = item
+            elif device_key:
+                # 之后的心跳不能并入开始 / 结束事件之前的心跳
+                self._heartbeats.pop(device_key, None)
+            self._cond.notify_all()
+        return True
+
+    def _take(self):
+        with self._cond:
+            while not self._size:
+                self._cond.wait()
+            batch = []
+            while self._items and len(batch) < self.batch_size:
+                item = self._items.popleft()
+                if item[2] is None:
+                    continue
+                self._size -= 1
+                if item[0] == 'heartbeat' and self._heartbeats.get(item[3]) is item:
+                    del self._heartbeats[item[3]]
+                batch.append((item[1], item[2]))
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            try:
+                self.handle_batch(batch)
+            except Exception as e:
+                logger.error(f"处理接入队列中的 {len(batch)} 条消息失败: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ingest-queue', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+多进程 MQTT 消息接入
+
+两种模式（INGEST_MODE）：
+- dispatch（默认）：主进程持有唯一的 MQTT 连接，按设备 key 哈希分区，
+  把原始消息投递到 N 个工作进程。同一设备的消息总是进入同一个进程，
+  保证单设备事件顺序；JSON 解析、规范化和会话逻辑分散到多核。
+- shared：每个工作进程各自连接 Broker，订阅 MQTT 共享订阅 $share/<group>/game，
+  由 Broker 负载均衡。注意 Broker 默认按消息轮询分发，不保证单设备顺序，
+  需要在 Broker 侧配置按客户端/主题哈希的分发策略。
+
+写库协调：数据库使用 WAL 模式并设置 busy timeout（见 models.py），
+各进程持有独立连接；分区保证同一设备的会话行只被一个进程写入。
+工作进程通过 multiprocessing 队列把实时更新信号回传主进程，合并后转发到 API 的 update_queue。
+
+进程内状态：
+- 指标：工作进程每 METRICS_PUSH_SECONDS 秒把全部指标的当前值发给主进程，主进程汇总后由
+  /metrics 输出（INGEST_WORKERS 与 Web 服务同进程启动时）；单独运行 ingest_workers.py 时主进程
+  没有 /metrics，工作进程的指标无法抓取
+- 缓存：活跃设备置位标记与尚未写库的分钟位在每个工作进程中各有一份。API 进程删除设备 / 会话后
+  通过缓存失效通知（change_notify.py）让各工作进程丢弃；去重窗口与限流状态不清除，窗口结束后自然过期
+"""
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+import types
+import zlib
+
+import metrics
+import wire_format
+from change_notify import ChangeNotifier
+from log_utils import setup_logging
+from models import db, normalize_ble_id
+from mqtt_client import GameUsageTracker, MqttConnection
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# 从原始字节中提取分区 key，避免在分发进程中完整解析 JSON
+_BLE_ID_RE = re.compile(rb'"bleId"\s*:\s*"([^"]*)"')
+_PLAYER_ID_RE = re.compile(rb'"playerId"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+INGEST_DISPATCHED = metrics.REGISTRY.counter(
+    'ingest_dispatched_total', '分发到各工作进程的消息数', ('worker',))
+
+# 工作进程向主进程发送指标的间隔（秒）
+METRICS_PUSH_SECONDS = 5.0
+
+
+def partition_key(payload: bytes) -> str:
+    """计算消息的分区 key，与 on_message 中的 device_key 规则一致：
+    有效 bleId 优先（规范化后），否则使用 playerId
+    """
+    if wire_format.is_compact(payload):
+        return wire_format.partition_key(payload)
+    m = _BLE_ID_RE.search(payload)
+    if m:
+        norm = normalize_ble_id(m.group(1).decode('utf-8', errors='replace'))
+        if norm:
+            return norm
+    m = _PLAYER_ID_RE.search(payload)
+    if m:
+        raw = m.group(1)
+        if b'\\' in raw:
+            # 含转义字符（如 \uXXXX）时解码为真实字符串，保证与 JSON 解析结果一致
+            try:
+                return json.loads(b'"' + raw + b'"')
+            except Exception:
+                pass
+        return raw.decode('utf-8', errors='replace')
+    return ''
+
+
+def partition_for(payload: bytes, num_workers: int) -> int:
+    """稳定哈希（crc32），跨进程/重启一致"""
+    return zlib.crc32(partition_key(payload).encode('utf-8')) % num_workers
+
+
+def _push_metrics(index, notify_queue):
+    """工作进程中定期把指标发给主进程（计数器是累计值，主进程只保留每个进程最新的一份）"""
+    while True:
+        time.sleep(METRICS_PUSH_SECONDS)
+        try:
+            notify_queue.put(('metrics', index, metrics.REGISTRY.snapshot()))
+        except Exception as e:
+            logging.getLogger(__name__).debug(f"发送工作进程指标失败: {e}")
+
+
+def _worker_main(index, inbox, notify_queue, shared_group=None):
+    """工作进程入口（spawn 子进程中模块重新导入，日志与数据库连接各自独立）"""
+    worker_logger = logging.getLogger(f'{__name__}.worker{index}')
+    db.connect(reuse_if_open=True)
+    threading.Thread(target=_push_metrics, args=(index, notify_queue), name='metrics-push', daemon=True).start()
+
+    if shared_group:
+        tracker = GameUsageTracker(update_queue=notify_queue, topic=f'$share/{shared_group}/game')
+        worker_logger.info(f"工作进程 {index} 启动（共享订阅 {tracker.topic}）")
+        tracker.start()
+        return
+
+    tracker = GameUsageTracker(update_queue=notify_queue)
+    tracker.listen_for_invalidations()
+    worker_logger.info(f"工作进程 {index} 启动（分区模式）")
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        topic, payload = item
+        tracker.on_message(None, None, types.SimpleNamespace(topic=topic, payload=payload))
+    worker_logger.info(f"工作进程 {index} 退出")
+
+
+class IngestWorkerPool:
+    """管理 N 个接入工作进程，并把它们的实时更新信号转发到 update_queue"""
+
+    def __init__(self, num_workers, update_queue=None, mode=None, shared_group=None):
+        self.num_workers = max(1, int(num_workers))
+        self.mode = mode or os.environ.get('INGEST_MODE', 'dispatch')
+        self.shared_group = shared_group or os.environ.get('INGEST_SHARE_GROUP', 'usage-stats')
+        self.update_queue = update_queue
+        self._ctx = multiprocessing.get_context('spawn')
+        self.notify_queue = self._ctx.Queue()
+        self.inboxes = []
+        self.processes = []
+        # 没有进程内 update_queue 时，通过本机套接字通知 API 进程
+        self._notifier = None if update_queue is not None else ChangeNotifier()
+
+    def start(self):
+        shared = self.shared_group if self.mode == 'shared' else None
+        for i in range(self.num_workers):
+            inbox = None if shared else self._ctx.Queue(maxsize=10000)
+            proc = self._ctx.Process(
+                target=_worker_main, args=(i, inbox, self.notify_queue, shared),
+                name=f'ingest-worker-{i}', daemon=True)
+            proc.start()
+            self.inboxes.append(inbox)
+            self.processes.append(proc)
+        threading.Thread(target=self._forward_notifications, name='ingest-notify', daemon=True).start()
+        logger.info(f"已启动 {self.num_workers} 个接入工作进程（模式: {self.mode}）")
+
+    def dispatch(self, topic, payload: bytes):
+        """按设备分区投递原始消息（阻塞直到队列有空位，形成背压）"""
+        index = partition_for(payload, self.num_workers)
+        self.inboxes[index].put((topic, payload))
+        INGEST_DISPATCHED.inc(index)
+
+    def stop(self, timeout=5):
+        for inbox in self.inboxes:
+            if inbox is not None:
+                inbox.put(None)
+        for proc in self.processes:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.terminate()
+
+    def _forward_notifications(self):
+        """合并工作进程的更新信号：一批信号只转发一次；工作进程发来的指标并入本进程的注册表"""
+        while True:
+            items = [self.notify_queue.get()]
+            try:
+                while True:
+                    items.append(self.notify_queue.get_nowait())
+            except queue.Empty:
+                pass
+            data = None
+            for item in items:
+                if isinstance(item, tuple) and item[0] == 'metrics':
+                    metrics.REGISTRY.merge_remote(f'worker{item[1]}', item[2])
+                else:
+                    data = item
+            if data is None:
+                continue
+            if self.update_queue is not None:
+                self.update_queue.put(data)
+            else:
+                self._notifier.notify(data)
+
+
+class IngestDispatcher(MqttConnection):
+    """只负责接收与分发的 MQTT 客户端：只有连接与重连逻辑，去重、限流与写库都在工作进程中"""
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def on_message(self, client, userdata, msg):
+        self.pool.dispatch(msg.topic, msg.payload)
+
+    def start(self):
+        self.run()
+
+
+def run_ingest_workers(num_workers, update_queue=None):
+    """启动多进程接入（阻塞）"""
+    pool = IngestWorkerPool(num_workers, update_queue=update_queue)
+    pool.start()
+    if pool.mode == 'shared':
+        # 共享订阅模式下由各工作进程自行连接 Broker，这里只需等待
+        for proc in pool.processes:
+            proc.join()
+        return
+    try:
+        IngestDispatcher(pool).start()
+    finally:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description='多进程 MQTT 消息接入')
+    parser.add_argument('-n', '--workers', type=int,
+                        default=int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 2)))
+    args = parser.parse_args()
+
+    init_db()
+    run_ingest_workers(args.workers)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+按时间点查询设备状态（as-of）：会话区间索引
+
+“设备 X 昨天 14:05 是否在玩”“周六 19:00 有多少台机器在用”原来要对 game_sessions 写临时 SQL。
+现在每个 UTC 自然月建一棵区间树（centered interval tree），时间点查询（stabbing query）
+只沿一条根到叶的路径查找，代价 O(log n + k)，k 为命中的会话数：
+
+- 每个节点取一个中心点，保存跨过中心点的会话（分别按开始时间升序、结束时间降序排列），
+  完全在中心点左侧 / 右侧的会话放入左 / 右子树；中心点取中位会话的开始时间，树高 O(log n)
+- 某月的索引包含与该月有交集的全部会话（含从上月跨入的会话），第一次查询该月时才建立，
+  最多缓存 MAX_CACHED_MONTHS 个月
+- 数据版本变化时先读该月的指纹：session_changes 每月一行计数，game_sessions 的插入 / 修改 /
+  删除由触发器给会话开始所在月加一。与某月有交集的会话都开始于该月或更早，指纹取不晚于该月的
+  计数之和（外加已封存分区的会话数），只需读几十行的小表；指纹不变（例如只有心跳，或只有之后
+  月份的会话变化）时继续使用原索引
+- 未结束的会话在索引中的结束时间为无穷大，查询时再判断：只有设备当前会话且时间点不晚于
+  最后心跳 + 离线阈值时才算在玩（与 /api/device-status 的口径一致）；其余未结束的会话
+  （接入端在设备下次开始时补结束）不计入
+- 超过会话保留期被清理的会话只剩按日汇总，无法回答这些日期的时间点查询
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from peewee import fn
+
+import partitions
+from models import db, Device, GameSession, DeviceStatus, SessionChange, SessionPartition
+
+MAX_CACHED_MONTHS = 12
+_OPEN_END = float('inf')
+
+
+def _timestamp(value):
+    """数据库中的时间（datetime 或 ISO 字符串，naive 视为 UTC）转为 Unix 时间戳"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _iso(timestamp):
+    if timestamp is None or timestamp == _OPEN_END:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def month_range(moment):
+    """moment 所在 UTC 自然月的 [开始, 结束)"""
+    moment = moment.astimezone(timezone.utc)
+    start = datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+    end = datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start, end
+
+
+class _Node:
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+
+class IntervalTree:
+    """静态区间树：区间为半开区间 [start, end)，stab(t) 返回包含 t 的全部区间的数据"""
+
+    def __init__(self, intervals):
+        """intervals: [(start, end, data)]，end <= start 的空区间忽略"""
+        intervals = [i for i in intervals if i[1] > i[0]]
+        self.size = len(intervals)
+        self.root = self._build(intervals)
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        intervals.sort(key=lambda i: i[0])
+        node = _Node()
+        # 中位会话的开始时间：该会话一定跨过中心点，左右子树各至多一半，树高 O(log n)
+        node.center = center = intervals[len(intervals) // 2][0]
+        left, middle, right = [], [], []
+        for interval in intervals:
+            if interval[1] <= center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                middle.append(interval)
+        node.by_start = middle
+        node.by_end = sorted(middle, key=lambda i: i[1], reverse=True)
+        node.left = self._build(left)
+        node.right = self._build(right)
+        return node
+
+    def stab(self, t):
+        result = []
+        node = self.root
+        while node is not None:
+            if t < node.center:
+                # 跨过中心点的区间都满足 end > center > t，只需 start <= t
+                for start, _, data in node.by_start:
+                    if start > t:
+                        break
+                    result.append(data)
+                node = node.left
+            else:
+                # 跨过中心点的区间都满足 start <= center <= t，只需 end > t
+                for _, end, data in node.by_end:
+                    if end <= t:
+                        break
+                    result.append(data)
+                node = node.right
+        return result
+
+
+class MonthIndex:
+    """某月的区间索引：会话数据为 (会话 id, device_id, 开始, 结束或 None)"""
+
+    def __init__(self, month_start, fingerprint, rows, devices):
+        self.month_start = month_start
+        self.fingerprint = fingerprint
+        self.devices = devices  # {device_id: (player_id, player_name)}
+        self.tree = IntervalTree([
+            (start, _OPEN_END if end is None else end, (session_id, device_id, start, end))
+            for session_id, device_id, start, end in rows
+        ])
+
+
+def _month_sessions(month_start, month_end):
+    """与 [month_start, month_end) 有交集的会话"""
+    return GameSession.start_time < month_end, \
+        (GameSession.end_time.is_null() | (GameSession.end_time > month_start))
+
+
+_CHANGE_DDL = [
+    f"""CREATE TRIGGER IF NOT EXISTS game_sessions_changes_{name} AFTER {event} ON game_sessions BEGIN
+        INSERT INTO session_changes (month, version) VALUES (strftime('%Y-%m', {row}.start_time), 1)
+        ON CONFLICT (month) DO UPDATE SET version = version + 1;
+    END"""
+    for name, event, row in (('ai', 'INSERT', 'new'), ('au', 'UPDATE', 'new'), ('ad', 'DELETE', 'old'))
+] + [
+    # 修改开始时间时原来所在的月也要加一
+    """CREATE TRIGGER IF NOT EXISTS game_sessions_changes_au_old AFTER UPDATE OF start_time ON game_sessions
+    WHEN strftime('%Y-%m', old.start_time) IS NOT strftime('%Y-%m', new.start_time) BEGIN
+        INSERT INTO session_changes (month, version) VALUES (strftime('%Y-%m', old.start_time), 1)
+        ON CONFLICT (month) DO UPDATE SET version = version + 1;
+    END""",
+]
+
+
+def ensure_change_table():
+    """创建会话按月变更计数表与触发器"""
+    with db.atomic():
+        db.create_tables([SessionChange], safe=True)
+        for sql in _CHANGE_DDL:
+            db.execute_sql(sql)
+
+
+def _fingerprint(month_start, month_end):
+    """该月索引的指纹：不晚于该月的会话变更计数之和，以及已封存分区的会话数（分区删除会让它减少）"""
+    changes = SessionChange.select(fn.TOTAL(SessionChange.version)).where(
+        SessionChange.month <= f'{month_start:%Y-%m}').scalar()
+    sealed = None
+    if partitions.enabled():
+        sealed = SessionPartition.select(fn.COUNT(SessionPartition.id), fn.TOTAL(SessionPartition.session_count)) \
+            .where(SessionPartition.month < month_end.date()).tuples().get()
+    return changes, sealed
+
+
+def _build_month(month_start, month_end, fingerprint):
+    rows = []
+    devices = {}
+    for session_id, device_id, player_id, player_name, start, end in GameSession.select(
+            GameSession.id, GameSession.device, Device.device_key, Device.name,
+            GameSession.start_time, GameSession.end_time
+    ).join(Device).where(*_month_sessions(month_start, month_end)).tuples().iterator():
+        rows.append((session_id, device_id, _timestamp(start), _timestamp(end)))
+        devices[device_id] = (player_id, player_name)
+    return MonthIndex(month_start, fingerprint, rows, devices)
+
+
+class AsOfIndex:
+    """按月缓存的会话区间索引（进程内，多线程共享）"""
+
+    def __init__(self, version_source, max_months=MAX_CACHED_MONTHS):
+        self.version_source = version_source
+        self.max_months = max_months
+        self._months = OrderedDict()  # 月初 -> (数据版本, MonthIndex)
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def month(self, moment):
+        """moment 所在月的索引（数据版本变化且该月会话有变化时重建）"""
+        month_start, month_end = month_range(moment)
+        version = self.version_source.current()
+        with self._lock:
+            entry = self._months.get(month_start)
+            if entry is not None:
+                self._months.move_to_end(month_start)
+                if entry[0] == version:
+                    return entry[1]
+        # 跨月的会话开始于上个月，一并挂上上个月的分区
+        previous_start = month_range(month_start - timedelta(days=1))[0]
+        with partitions.attached(previous_start, month_end):
+            fingerprint = _fingerprint(month_start, month_end)
+            if entry is not None and entry[1].fingerprint == fingerprint:
+                index = entry[1]
+            else:
+                index = _build_month(month_start, month_end, fingerprint)
+                self.builds += 1
+        with self._lock:
+            self._months[month_start] = (version, index)
+            self._months.move_to_end(month_start)
+            while len(self._months) > self.max_months:
+                self._months.popitem(last=False)
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._months.clear()
+
+    def state_at(self, moment, offline_window, now=None, player_id=None, playing_only=False):
+        """moment 时刻各设备的状态（/api/as-of）"""
+        now = now or datetime.now(timezone.utc)
+        if moment > now:
+            raise ValueError('时间点不能晚于当前时间')
+        index = self.month(moment)
+        t = moment.timestamp()
+
+        hits = index.tree.stab(t)
+        open_hits = [hit for hit in hits if hit[3] is None]
+        if open_hits:
+            # 未结束的会话：只有设备当前会话且 t 不晚于最后心跳 + 离线阈值时才算在玩
+            keys = {index.devices[hit[1]][0] for hit in open_hits}
+            current = {row.current_session_id: _timestamp(row.last_seen) for row in DeviceStatus.select(
+                DeviceStatus.current_session_id, DeviceStatus.last_seen
+            ).where(DeviceStatus.player_id.in_(list(keys)), DeviceStatus.current_session_id.is_null(False))}
+            hits = [hit for hit in hits if hit[3] is not None or (
+                current.get(hit[0]) is not None and t <= current[hit[0]] + offline_window)]
+
+        # 同一设备有多个会话命中（数据异常）时取开始最晚的
+        playing = {}
+        for hit in hits:
+            if hit[1] not in playing or hit[2] > playing[hit[1]][2]:
+                playing[hit[1]] = hit
+
+        devices = []
+        for device_id, (key, name) in index.devices.items():
+            if player_id is not None and key != player_id:
+                continue
+            hit = playing.get(device_id)
+            if hit is None and playing_only:
+                continue
+            devices.append({
+                'player_id': key,
+                'player_name': name,
+                'status': 'playing' if hit else 'idle',
+                'session_id': hit[0] if hit else None,
+                'start_time': _iso(hit[2]) if hit else None,
+                'end_time': _iso(hit[3]) if hit else None,
+                'elapsed_seconds': int(t - hit[2]) if hit else None,
+            })
+        devices.sort(key=lambda d: (d['status'] != 'playing', d['player_id'], d['player_name']))
+        return {
+            'at': _iso(t),
+            'month': index.month_start.date().isoformat(),
+            'playing_count': sum(1 for d in devices if d['status'] == 'playing'),
+            'device_count': len(devices),
+            'devices': devices,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import time
+
+    parser = argparse.ArgumentParser(description='区间树自检与基准（随机会话，与线性扫描比较）')
+    parser.add_argument('-n', type=int, default=100000, help='会话数')
+    parser.add_argument('--queries', type=int, default=2000, help='查询次数')
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    base = datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp()
+    span = 31 * 86400
+    rows = []
+    for i in range(args.n):
+        start = base + rnd.random() * span
+        rows.append((i, rnd.randrange(500), start, None if rnd.random() < 0.01 else start + rnd.expovariate(1 / 900)))
+    started = time.perf_counter()
+    tree = IntervalTree([(s, _OPEN_END if e is None else e, (i, d, s, e)) for i, d, s, e in rows])
+    build = time.perf_counter() - started
+    points = [base + rnd.random() * span for _ in range(args.queries)]
+    started = time.perf_counter()
+    results = [sorted(hit[0] for hit in tree.stab(t)) for t in points]
+    indexed = time.perf_counter() - started
+    started = time.perf_counter()
+    for t, result in zip(points[:200], results):
+        assert result == sorted(i for i, _, s, e in rows if s <= t and (e is None or t < e)), t
+    scan = (time.perf_counter() - started) / min(200, len(points))
+    print(f"{args.n} 个会话：建树 {build * 1000:.0f} ms，索引查询 {indexed / len(points) * 1e6:.1f} µs/次，"
+          f"线性扫描 {scan * 1e6:.0f} µs/次，结果一致")
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+排行榜：按设备 / 项目 / 校区统计任意日期范围内的使用时长或完成次数，返回前 K 名
+
+- 数据来自按 (日期, 设备) 的预聚合，不扫描原始会话：session_length_sketches 每行带完成次数与总秒数，
+  接入端在 end_session 中与会话同一事务更新，当天的会话结束后立即计入；草图表建立前就已清理的日期
+  取自按日汇总表（daily_usage_archive）。SQL 按设备求和后，Python 端只处理每个设备一行
+- 设备按 devices.registry_id 归入注册表中的校区 / 项目（显示名称为“校区-项目”的设备同样归入），
+  未注册的设备只出现在设备排行中，其合计见 unassigned
+- 前 K 名用大小为 K 的堆选出（heapq.nlargest），不对全部实体排序；与第 K 名并列的实体一并返回，
+  名次按“1, 2, 2, 4”方式计算
+- 同时统计紧邻的上一个等长周期，给出上期数值、上期名次与变化
+"""
+import bisect
+import heapq
+from datetime import timedelta
+
+from peewee import fn
+
+from models import Device, DeviceRegistry, DailyUsageArchive, SessionLengthSketch
+
+GROUPS = ('device', 'project', 'campus')
+METRICS = ('time', 'sessions')
+MAX_LIMIT = 100
+
+
+class RegistryPlaces:
+    """有效注册记录：registry_id / ble_id / “校区-项目”显示名称 -> (校区, 项目)"""
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_ble_id = {}
+        self.by_name = {}
+        for reg in DeviceRegistry.select(
+                DeviceRegistry.id, DeviceRegistry.ble_id, DeviceRegistry.campus_name,
+                DeviceRegistry.project_name).where(DeviceRegistry.status == 'active'):
+            place = (reg.campus_name, reg.project_name)
+            self.by_id[reg.id] = place
+            self.by_ble_id[reg.ble_id] = place
+            self.by_name[f"{reg.campus_name}-{reg.project_name}"] = place
+
+    def place(self, player_id, player_name, registry_id=None):
+        if registry_id is not None and registry_id in self.by_id:
+            return self.by_id[registry_id]
+        return self.by_ble_id.get(player_id) or self.by_name.get(player_name)
+
+
+def group_key(group, player_id, place):
+    """实体的分组 key：设备为 player_id，校区 / 项目取自注册表；无法归入时返回 None"""
+    if group == 'device':
+        return player_id
+    if place is None:
+        return None
+    return place[0] if group == 'campus' else place[1]
+
+
+def aggregate(group, start_date, end_date, registry=None):
+    """日期闭区间内各实体的合计，返回 ({key: [总秒数, 完成次数, {名称: 秒数}]}, 未归入的 [秒数, 次数])"""
+    registry = registry or RegistryPlaces()
+    totals = {}
+    unassigned = [0, 0]
+
+    def add(player_id, player_name, place, seconds, count):
+        key = group_key(group, player_id, place)
+        if key is None:
+            unassigned[0] += seconds
+            unassigned[1] += count
+            return
+        entry = totals.get(key)
+        if entry is None:
+            entry = totals[key] = [0, 0, {}]
+        entry[0] += seconds
+        entry[1] += count
+        entry[2][player_name] = entry[2].get(player_name, 0) + seconds
+
+    for player_id, player_name, registry_id, seconds, count in SessionLengthSketch.select(
+            Device.device_key, Device.name, Device.registry_id,
+            fn.SUM(SessionLengthSketch.total_seconds), fn.SUM(SessionLengthSketch.count)
+    ).join(Device).where(SessionLengthSketch.day.between(start_date, end_date)).group_by(
+            SessionLengthSketch.device).tuples():
+        if count:
+            add(player_id, player_name, registry.place(player_id, player_name, registry_id), seconds or 0, count)
+
+    # 清理后草图仍保留，汇总表只补草图中没有的 (日期, 设备)
+    in_sketches = SessionLengthSketch.select(SessionLengthSketch.id).join(Device).where(
+        SessionLengthSketch.day == DailyUsageArchive.day,
+        Device.device_key == DailyUsageArchive.player_id,
+        Device.name == DailyUsageArchive.player_name)
+    for player_id, player_name, seconds, count in DailyUsageArchive.select(
+            DailyUsageArchive.player_id, DailyUsageArchive.player_name,
+            fn.SUM(DailyUsageArchive.total_seconds), fn.SUM(DailyUsageArchive.completed_sessions)
+    ).where(DailyUsageArchive.day.between(start_date, end_date), ~fn.EXISTS(in_sketches)).group_by(
+            DailyUsageArchive.player_id, DailyUsageArchive.player_name).tuples():
+        if count:
+            add(player_id, player_name, registry.place(player_id, player_name), seconds or 0, count)
+    return totals, unassigned
+
+
+def top_k(values, k):
+    """values 为 {key: 数值}，返回 [(名次, key, 数值)]：前 k 名及与第 k 名并列的实体"""
+    if k <= 0 or not values:
+        return []
+    top = heapq.nlargest(k, values.items(), key=lambda item: item[1])
+    threshold = top[-1][1]
+    chosen = {key for key, _ in top}
+    top.extend((key, value) for key, value in values.items() if value == threshold and key not in chosen)
+    top.sort(key=lambda item: (-item[1], str(item[0])))
+
+    ranked = []
+    for position, (key, value) in enumerate(top, start=1):
+        rank = ranked[-1][0] if ranked and ranked[-1][2] == value else position
+        ranked.append((rank, key, value))
+    return ranked
+
+
+def _metric_values(totals, metric):
+    index = 0 if metric == 'time' else 1
+    return {key: entry[index] for key, entry in totals.items() if entry[index] > 0}
+
+
+def compute_leaderboard(group, metric, start_date, end_date, limit=10):
+    """排行榜数据（/api/leaderboard）"""
+    if group not in GROUPS:
+        raise ValueError(f"group 必须是 {'/'.join(GROUPS)}")
+    if metric not in METRICS:
+        raise ValueError(f"metric 必须是 {'/'.join(METRICS)}")
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    days = (end_date - start_date).days + 1
+    if days <= 0:
+        raise ValueError('end_date 不能早于 start_date')
+    previous_end = start_date - timedelta(days=1)
+    previous_start = previous_end - timedelta(days=days - 1)
+
+    registry = RegistryPlaces()
+    totals, unassigned = aggregate(group, start_date, end_date, registry)
+    previous_totals, _ = aggregate(group, previous_start, previous_end, registry)
+    values = _metric_values(totals, metric)
+    previous_values = _metric_values(previous_totals, metric)
+    # 上期名次 = 1 + 上期数值更大的实体数（对上期数值排序一次，二分查找）
+    previous_sorted = sorted(previous_values.values())
+
+    items = []
+    for rank, key, value in top_k(values, limit):
+        seconds, count, names = totals[key]
+        previous = previous_values.get(key)
+        previous_rank = None
+        if previous is not None:
+            previous_rank = 1 + len(previous_sorted) - bisect.bisect_right(previous_sorted, previous)
+        items.append({
+            'rank': rank,
+            'key': key,
+            'name': max(names.items(), key=lambda kv: kv[1])[0] if group == 'device' else key,
+            'total_time_seconds': seconds,
+            'total_time_hours': round(seconds / 3600, 2),
+            'session_count': count,
+            'value': value,
+            'previous_value': previous,
+            'previous_rank': previous_rank,
+            'change': value - (previous or 0),
+            'change_percent': round((value - previous) * 100 / previous, 1) if previous else None,
+        })
+
+    return {
+        'group': group,
+        'metric': metric,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'days': days,
+        'previous_period': {
+            'start_date': previous_start.isoformat(),
+            'end_date': previous_end.isoformat(),
+        },
+        'limit': limit,
+        'total_entities': len(values),
+        'items': items,
+        'unassigned': {
+            'total_time_seconds': unassigned[0],
+            'session_count': unassigned[1],
+        } if group != 'device' else None,
+    }
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+日志工具
+
+- setup_logging(): 日志记录通过队列交给后台线程格式化并写出，业务线程不做同步 IO
+- IngestLogSampler: 消息热路径的逐条日志改为周期汇总 + 告警限流，
+  并支持运行时按设备开启完整逐条追踪
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+LOG_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+# 运行时追踪列表的共享文件：API 进程写入，独立运行的接入进程 / 工作进程定时读取
+TRACE_DEVICES_FILE = os.environ.get('TRACE_DEVICES_FILE', '/tmp/usage-stats-trace.json')
+TRACE_POLL_SECONDS = 2.0
+
+LOG_RECORDS_DROPPED = metrics.REGISTRY.counter(
+    'log_records_dropped_total', '日志队列已满而丢弃的日志条数')
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """不阻塞的队列 Handler：队列满时直接丢弃并计数；格式化留给后台线程"""
+
+    def prepare(self, record):
+        # 只合并 msg/args，避免在业务线程里调用 Formatter
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def setup_logging(level=None):
+    """配置根日志：QueueHandler -> 后台线程 -> stdout。可重复调用，仅首次生效"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        level = level or os.environ.get('LOG_LEVEL', 'INFO')
+        try:
+            queue_size = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+        except Exception:
+            queue_size = 10000
+
+        log_queue = queue.Queue(maxsize=queue_size)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_NonBlockingQueueHandler(log_queue))
+        root.setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def _parse_trace_devices(value):
+    return {item.strip() for item in (value or '').split(',') if item.strip()}
+
+
+class IngestLogSampler:
+    """消息热路径日志采样器
+
+    - count(): 每条消息只做计数，后台线程每隔 interval 秒输出一行汇总
+      （如 "最近 60 秒: heartbeat 12,340 条/412 台设备"），流量停止后最后一个周期的汇总照样输出
+    - warning(): 同一类告警每个周期只输出一次，其余计入抑制数
+    - is_traced(): 被追踪的设备逐条输出完整日志（可运行时开关）。开关写入 trace_file，
+      其他进程（单独运行的 mqtt_client.py、INGEST_WORKERS 工作进程）的后台线程每 TRACE_POLL_SECONDS 秒读取一次
+    """
+
+    def __init__(self, logger, interval=60.0, trace_devices=None, trace_file=None):
+        self.logger = logger
+        self.interval = interval
+        self.trace_file = trace_file
+        self._lock = threading.Lock()
+        self._trace_devices = frozenset(trace_devices or ())
+        self._trace_mtime = None
+        self._timer_pid = None
+        self._load_trace_file()
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self._window_start = now
+        self._event_counts = {}
+        self._event_devices = {}
+        self._warned = set()
+        self._suppressed = {}
+
+    # ---- 逐设备追踪 ----
+    def is_traced(self, device_key) -> bool:
+        return device_key in self._trace_devices
+
+    def enable_trace(self, device_key):
+        with self._lock:
+            self._trace_devices = self._trace_devices | {device_key}
+            self._save_trace_file()
+
+    def disable_trace(self, device_key):
+        with self._lock:
+            self._trace_devices = self._trace_devices - {device_key}
+            self._save_trace_file()
+
+    def traced_devices(self):
+        return sorted(self._trace_devices)
+
+    def _save_trace_file(self):
+        if not self.trace_file:
+            return
+        try:
+            tmp = f'{self.trace_file}.{os.getpid()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(sorted(self._trace_devices), f, ensure_ascii=False)
+            os.replace(tmp, self.trace_file)
+            self._trace_mtime = os.stat(self.trace_file).st_mtime_ns
+        except OSError as e:
+            self.logger.warning(f"写入追踪设备列表失败: {e}")
+
+    def _load_trace_file(self):
+        """追踪列表文件有变化时重新读取（文件内容即完整列表）"""
+        if not self.trace_file:
+            return
+        try:
+            mtime = os.stat(self.trace_file).st_mtime_ns
+            if mtime == self._trace_mtime:
+                return
+            with open(self.trace_file, encoding='utf-8') as f:
+                devices = frozenset(str(item) for item in json.load(f))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.debug(f"读取追踪设备列表失败: {e}")
+            return
+        with self._lock:
+            # 首次读取与 TRACE_DEVICES 合并，之后以文件为准
+            self._trace_devices = devices if self._trace_mtime is not None else self._trace_devices | devices
+            self._trace_mtime = mtime
+
+    # ---- 后台线程：定时汇总 + 读取追踪列表 ----
+    def _ensure_timer(self):
+        # 按进程启动（fork 出的子进程没有父进程的线程）
+        pid = os.getpid()
+        if self._timer_pid == pid:
+            return
+        with self._lock:
+            if self._timer_pid == pid:
+                return
+            self._timer_pid = pid
+        threading.Thread(target=self._run_timer, name='ingest-log-summary', daemon=True).start()
+
+    def _run_timer(self):
+        while True:
+            wait = TRACE_POLL_SECONDS
+            if self.interval > 0:
+                wait = min(wait, self._window_start + self.interval - time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self._load_trace_file()
+                if self.interval > 0 and time.monotonic() - self._window_start >= self.interval:
+                    self.flush()
+            except Exception as e:
+                self.logger.debug(f"输出日志汇总失败: {e}")
+
+    # ---- 计数与汇总 ----
+    def count(self, event, device_key=None):
+        self._ensure_timer()
+        now = time.monotonic()
+        with self._lock:
+            self._event_counts[event] = self._event_counts.get(event, 0) + 1
+            if device_key is not None:
+                devices = self._event_devices.get(event)
+                if devices is None:
+                    devices = self._event_devices[event] = set()
+                devices.add(device_key)
+            if now - self._window_start < self.interval:
+                return
+            summary = self._build_summary(now)
+            self._reset(now)
+        self.logger.info(summary)
+
+    def warning(self, key, message):
+        """限流告警：同一 key 每个汇总周期只输出一次"""
+        with self._lock:
+            if key in self._warned:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            self._warned.add(key)
+        self.logger.warning(message)
+
+    def flush(self):
+        """立即输出当前周期汇总并开始新周期（后台线程每个周期调用一次；退出前也可调用）"""
+        now = time.monotonic()
+        with self._lock:
+            summary = self._build_summary(now) if self._event_counts or self._suppressed else None
+            self._reset(now)
+        if summary:
+            self.logger.info(summary)
+
+    def _build_summary(self, now):
+        elapsed = max(int(now - self._window_start), 1)
+        parts = []
+        for event, cnt in sorted(self._event_counts.items(), key=lambda x: -x[1]):
+            devices = self._event_devices.get(event)
+            if devices:
+                parts.append(f"{event} {cnt:,} 条/{len(devices):,} 台设备")
+            else:
+                parts.append(f"{event} {cnt:,} 条")
+        summary = f"📊 最近 {elapsed} 秒: " + "，".join(parts)
+        suppressed = sum(self._suppressed.values())
+        if suppressed:
+            detail = "，".join(f"{k} {v:,}" for k, v in sorted(self._suppressed.items()))
+            summary += f"；已抑制告警 {suppressed:,} 条（{detail}）"
+        return summary
+
+
+def _load_interval():
+    try:
+        return float(os.environ.get('INGEST_LOG_SUMMARY_SECONDS', '60'))
+    except Exception:
+        return 60.0
+
+
+# 全局采样器（MQTT 客户端与 API 同进程时共享；API 开关追踪后经 TRACE_DEVICES_FILE 同步到其他接入进程）
+ingest_log = IngestLogSampler(
+    logging.getLogger('ingest'),
+    interval=_load_interval(),
+    trace_devices=_parse_trace_devices(os.environ.get('TRACE_DEVICES')),
+    trace_file=TRACE_DEVICES_FILE,
+)
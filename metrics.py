@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+轻量级指标采集，输出 Prometheus 文本格式（/metrics）
+
+- Counter / Gauge / Histogram 三种类型，支持标签
+- 热路径上只有一次字典查找 + 加锁累加，开销在微秒级以内
+- Gauge 支持回调函数，在抓取时才计算（如队列长度）
+- 多进程接入时工作进程定期发送 snapshot()，主进程 merge_remote() 后输出时与本进程的值相加
+"""
+import bisect
+import threading
+import time
+
+# 默认直方图桶（秒），覆盖 0.5ms ~ 10s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = [f'{n}="{_escape_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际收到 {labels}")
+        return tuple(str(v) for v in labels)
+
+    def snapshot(self):
+        """当前取值的副本（可 pickle，用于跨进程汇总）"""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def _add_remote(items, remote):
+        for values in remote:
+            for key, value in values.items():
+                items[key] = items.get(key, 0) + value
+        return items
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    metric_type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self, remote=()):
+        lines = self._header()
+        with self._lock:
+            items = dict(self._values)
+        items = self._add_remote(items, remote)
+        if not items and not self.labelnames:
+            items = {(): 0}
+        for key, value in items.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值；也可以通过 set_function 在抓取时计算"""
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, func, *labels):
+        """注册回调，抓取时调用 func() 取值"""
+        self._functions[self._key(labels)] = func
+
+    def get(self, *labels):
+        key = self._key(labels)
+        func = self._functions.get(key)
+        if func is not None:
+            return func()
+        return self._values.get(key, 0)
+
+    def snapshot(self):
+        items = super().snapshot()
+        for key, func in list(self._functions.items()):
+            try:
+                items[key] = func()
+            except Exception:
+                continue
+        return items
+
+    def render(self, remote=()):
+        lines = self._header()
+        items = self._add_remote(self.snapshot(), remote)
+        if not items and not self.labelnames:
+            items = {(): 0}
+        for key, value in items.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram(_Metric):
+    """固定桶直方图（累计桶在输出时计算，观测时只累加单个桶）"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各桶计数..., +Inf 桶], 总和
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][idx] += 1
+            state[1] += value
+
+    def time(self, *labels):
+        """上下文管理器：统计代码块耗时"""
+        return _Timer(self, labels)
+
+    def get_count(self, *labels):
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) if state else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {k: (list(v[0]), v[1]) for k, v in self._values.items()}
+
+    def render(self, remote=()):
+        lines = self._header()
+        items = self.snapshot()
+        for values in remote:
+            for key, (counts, total) in values.items():
+                if key in items:
+                    mine = items[key]
+                    items[key] = ([a + b for a, b in zip(mine[0], counts)], mine[1] + total)
+                else:
+                    items[key] = (list(counts), total)
+        for key, (counts, total) in items.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_labels', '_start')
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        # 其他进程最近一次发来的取值 {来源: {指标名: 取值}}
+        self._remote = {}
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> dict:
+        """全部指标的定义与当前取值（发送给主进程汇总）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: (metric.metric_type, metric.documentation, metric.labelnames,
+                              getattr(metric, 'buckets', None), metric.snapshot())
+                for metric in metrics}
+
+    def merge_remote(self, source, snapshot):
+        """记录来源 source（如工作进程编号）的最新取值，替换该来源上一次的取值；
+        计数器与直方图在来源进程内是累计值，因此只需保留最新一份"""
+        values = {}
+        for name, (metric_type, documentation, labelnames, buckets, items) in snapshot.items():
+            if name not in self._metrics:
+                # 只在来源进程中注册的指标（如接入队列），按来源的定义补注册
+                if metric_type == 'histogram':
+                    self.histogram(name, documentation, labelnames, buckets)
+                elif metric_type == 'gauge':
+                    self.gauge(name, documentation, labelnames)
+                else:
+                    self.counter(name, documentation, labelnames)
+            values[name] = items
+        with self._lock:
+            self._remote[source] = values
+
+    def render(self) -> str:
+        """生成 Prometheus 文本格式（含其他进程汇总来的取值）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            remote = list(self._remote.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render([values[metric.name] for values in remote if metric.name in values]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# ---- MQTT 接入指标 ----
+INGEST_MESSAGE_SECONDS = REGISTRY.histogram(
+    'ingest_message_seconds', 'on_message 处理单条消息耗时（按事件类型）', ('event',))
+INGEST_DB_SECONDS = REGISTRY.histogram(
+    'ingest_db_seconds', '单条消息的数据库耗时（按事件类型）', ('event',))
+INGEST_MESSAGES = REGISTRY.counter(
+    'ingest_messages_total', '收到的 MQTT 消息数（按事件类型）', ('event',))
+INGEST_REJECTED = REGISTRY.counter(
+    'ingest_messages_rejected_total', '被拒绝的消息数（按原因）', ('reason',))
+INGEST_DUPLICATES = REGISTRY.counter(
+    'ingest_duplicates_total', '被去重丢弃的重复消息数（按事件）', ('event',))
+INGEST_INVALID_BLE = REGISTRY.counter(
+    'ingest_invalid_ble_id_total', 'BLE ID 格式不正确的消息数（含使用 playerId 后备的消息）')
+MQTT_CONNECTS = REGISTRY.counter(
+    'mqtt_connects_total', 'MQTT 连接结果次数', ('result',))
+MQTT_RECONNECTS = REGISTRY.counter(
+    'mqtt_reconnects_total', 'MQTT 重新连接成功次数（不含首次连接）')
+MQTT_DISCONNECTS = REGISTRY.counter(
+    'mqtt_disconnects_total', 'MQTT 断开次数', ('kind',))
+
+# ---- API 指标 ----
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'HTTP 请求耗时（按端点）', ('endpoint', 'method', 'status'))
+UPDATE_QUEUE_DEPTH = REGISTRY.gauge(
+    'update_queue_depth', '实时更新队列长度')
+SSE_SUBSCRIBERS = REGISTRY.gauge(
+    'sse_subscribers', '当前 SSE 订阅连接数')
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+设备每分钟活跃位图
+
+会话时长只是结束时间减开始时间，中途设备断线 20 分钟也照样计入；心跳除了更新 last_seen 之外没有留下记录。
+现在每个设备每天保存一个 1440 位的位图（device_minute_activity，固定 180 字节）：
+第 i 位表示当天 UTC 第 i 分钟收到过该设备的消息（心跳 / 开始 / 结束）。
+
+- 接入端只在内存中置位，每 MINUTE_ACTIVITY_FLUSH_SECONDS 秒（默认 60）合并写库一次，
+  每个设备每天一行，无论心跳多频繁，写入量与存储都不随心跳数增长
+- 写库是按位或合并，重复写入没有影响，多个接入进程各自刷写也不会互相覆盖；
+  接入日志模式下每批消息在同一事务中刷写
+- 进程被杀时最多丢失最近一个刷写周期的位；同一进程内的 API 读取会合并尚未刷写的位
+- “活跃分钟数”为位图中 1 的个数：会话取开始到结束（未结束时到当前时间）所在分钟范围内的位，
+  按日汇总取设备当天全部的位
+- 与原始会话一样受 RETENTION_SESSION_DAYS 保留期清理（默认永久保留）
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from models import db, env_number, Device, DeviceMinuteActivity
+
+logger = logging.getLogger(__name__)
+
+
+MINUTES_PER_DAY = 1440
+BITMAP_BYTES = MINUTES_PER_DAY // 8
+FLUSH_SECONDS = max(0.0, env_number('MINUTE_ACTIVITY_FLUSH_SECONDS', 60, float))
+
+# 尚未写库的位 {(device_id, day): 位图}
+_pending = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def to_bytes(bitmap):
+    return bitmap.to_bytes(BITMAP_BYTES, 'little')
+
+
+def from_bytes(data):
+    return int.from_bytes(data, 'little') if data else 0
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value
+
+
+def _utc(moment):
+    return moment.astimezone(timezone.utc) if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def record(device_id, moment):
+    """设备在 moment 所在分钟活跃（只写内存）"""
+    moment = _utc(moment)
+    key = (device_id, moment.date())
+    with _lock:
+        _pending[key] = _pending.get(key, 0) | (1 << (moment.hour * 60 + moment.minute))
+
+
+def flush_if_due():
+    if time.monotonic() - _last_flush >= FLUSH_SECONDS:
+        flush()
+
+
+def flush():
+    """把内存中的位合并写库，返回写入的行数。在外层事务中调用时随外层提交"""
+    global _last_flush
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return 0
+    try:
+        with db.atomic():
+            rows = [{'day': day, 'device': device_id, 'minutes': 0, 'bitmap': to_bytes(0)}
+                    for device_id, day in pending]
+            # 先插入缺少的行拿到写锁，再读改写：多个接入进程同时刷写时不会丢位
+            for i in range(0, len(rows), 100):
+                DeviceMinuteActivity.insert_many(rows[i:i + 100]).on_conflict_ignore().execute()
+            written = 0
+            for row in _select(pending):
+                key = (row.device_id, _to_date(row.day))
+                bitmap = from_bytes(bytes(row.bitmap))
+                updated = bitmap | pending[key]
+                if updated != bitmap:
+                    DeviceMinuteActivity.update(minutes=updated.bit_count(), bitmap=to_bytes(updated)).where(
+                        DeviceMinuteActivity.id == row.id).execute()
+                    written += 1
+        return written
+    except Exception:
+        # 写库失败时把位放回，下次再刷
+        with _lock:
+            for key, bitmap in pending.items():
+                _pending[key] = _pending.get(key, 0) | bitmap
+        raise
+
+
+def _select(keys):
+    """keys 涉及的行（按日期与设备筛选后在内存中精确匹配）"""
+    days = {day for _, day in keys}
+    device_ids = {device_id for device_id, _ in keys}
+    query = DeviceMinuteActivity.select(
+        DeviceMinuteActivity.id, DeviceMinuteActivity.device, DeviceMinuteActivity.day,
+        DeviceMinuteActivity.bitmap
+    ).where(DeviceMinuteActivity.day.in_(list(days)), DeviceMinuteActivity.device.in_(list(device_ids)))
+    return [row for row in query if (row.device_id, _to_date(row.day)) in keys]
+
+
+def load(keys):
+    """{(device_id, day): 位图}，合并本进程尚未写库的位"""
+    keys = set(keys)
+    if not keys:
+        return {}
+    bitmaps = {(row.device_id, _to_date(row.day)): from_bytes(bytes(row.bitmap)) for row in _select(keys)}
+    with _lock:
+        for key in keys:
+            if key in _pending:
+                bitmaps[key] = bitmaps.get(key, 0) | _pending[key]
+    return bitmaps
+
+
+def _minute_keys(device_id, start, end):
+    day = start.date()
+    while day <= end.date():
+        yield device_id, day
+        day += timedelta(days=1)
+
+
+def session_minutes(sessions, now=None):
+    """每个会话开始到结束所在分钟范围内的活跃分钟数 {session_id: 分钟数}。
+    sessions 为 (id, device_id, start_time, end_time)，时间为 UTC datetime
+    """
+    now = now or datetime.now(timezone.utc)
+    spans = [(session_id, device_id, _utc(start), _utc(end or now))
+             for session_id, device_id, start, end in sessions]
+    bitmaps = load(key for _, device_id, start, end in spans for key in _minute_keys(device_id, start, end))
+    result = {}
+    for session_id, device_id, start, end in spans:
+        total = 0
+        for key in _minute_keys(device_id, start, end):
+            first = start.hour * 60 + start.minute if key[1] == start.date() else 0
+            last = end.hour * 60 + end.minute if key[1] == end.date() else MINUTES_PER_DAY - 1
+            if last >= first:
+                total += (bitmaps.get(key, 0) >> first & ((1 << (last - first + 1)) - 1)).bit_count()
+        result[session_id] = total
+    return result
+
+
+def daily_minutes(start_date, end_date):
+    """日期闭区间内各设备每天的活跃分钟数 {(day, player_id): 分钟数}（同一 player_id 的多个名称按位或）"""
+    merged = {}
+    for day, player_id, blob in DeviceMinuteActivity.select(
+            DeviceMinuteActivity.day, Device.device_key, DeviceMinuteActivity.bitmap
+    ).join(Device).where(DeviceMinuteActivity.day.between(start_date, end_date)).tuples():
+        key = (_to_date(day), player_id)
+        merged[key] = merged.get(key, 0) | from_bytes(bytes(blob))
+    with _lock:
+        pending = [(device_id, day, bitmap) for (device_id, day), bitmap in _pending.items()
+                   if start_date <= day <= end_date]
+    if pending:
+        keys = dict(Device.select(Device.id, Device.device_key).where(
+            Device.id.in_({device_id for device_id, _, _ in pending})).tuples())
+        for device_id, day, bitmap in pending:
+            if device_id in keys:
+                key = (day, keys[device_id])
+                merged[key] = merged.get(key, 0) | bitmap
+    return {key: bitmap.bit_count() for key, bitmap in merged.items()}
+
+
+def forget(device_ids):
+    """丢弃本进程中这些设备尚未写库的位（其他进程删除设备后通过缓存失效通知调用）"""
+    device_ids = set(device_ids)
+    with _lock:
+        for key in [key for key in _pending if key[0] in device_ids]:
+            del _pending[key]
+
+
+def clear_devices(device_ids):
+    """删除设备时同时删除其位图（含尚未写库的位）"""
+    device_ids = set(device_ids)
+    forget(device_ids)
+    if device_ids:
+        DeviceMinuteActivity.delete().where(DeviceMinuteActivity.device.in_(list(device_ids))).execute()
+
+
+def ensure_minute_table():
+    db.create_tables([DeviceMinuteActivity], safe=True)
+
+
+def _flush_at_exit():
+    try:
+        if _pending:
+            db.connect(reuse_if_open=True)
+            flush()
+    except Exception as e:
+        logger.warning(f"退出时写入分钟活跃位图失败: {e}")
+
+
+atexit.register(_flush_at_exit)
@@ -1,19 +1,150 @@
 # -*- coding: utf-8 -*-
 from peewee import *
+from contextlib import contextmanager
 from datetime import datetime, timezone
+import os
 import re
+import threading
+import time
+
+def env_number(name, default, cast=int):
+    """读取数值型环境变量，未设置或无法解析时返回默认值"""
+    try:
+        return cast(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+# 只读连接每执行这么多条虚拟机指令检查一次是否有接入写入在进行（0 为不让出）
+READ_YIELD_OPCODES = env_number('READ_YIELD_OPCODES', 1000)
+# 让出时每次休眠的秒数，以及每次让出最多等待的秒数（接入持续满负荷时读请求仍能推进）
+READ_YIELD_SLEEP_SECONDS = 0.001
+READ_YIELD_MAX_SECONDS = env_number('READ_YIELD_MAX_SECONDS', 0.05, float)
+
+class TimedSqliteDatabase(SqliteDatabase):
+    """按线程累计 SQL 执行耗时的 SqliteDatabase（用于指标统计）
+
+    读写分离：API 的 GET 请求用 connect_reader() 打开只读连接（PRAGMA query_only，WAL 下读取
+    一致的快照，不持有写锁，误写会直接报错）；写入只发生在接入线程与少数管理操作的普通连接上。
+    只读连接注册 SQLite 进度回调，查询执行与逐行读取期间定期检查：接入正在写入（ingest_priority()）
+    时短暂休眠让出 CPU 与 GIL，单核机器上并发的重统计查询不会把接入延迟拖长（见 bench_read_write.py）
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sql_timing = threading.local()
+        self._reader = threading.local()
+        self._writers = 0
+        self._writers_lock = threading.Lock()
+        # 每条 SQL 执行后调用 query_hook(sql, params, 耗时秒数)（SQL 剖析，见 sql_profiler.py）
+        self.query_hook = None
+
+    def execute_sql(self, sql, params=None, commit=None):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            elapsed = time.perf_counter() - start
+            local = self._sql_timing
+            local.total = getattr(local, 'total', 0.0) + elapsed
+            hook = self.query_hook
+            if hook is not None:
+                hook(sql, params, elapsed)
+
+    def _set_pragmas(self, conn):
+        # PRAGMA auto_vacuum 即使取值不变也会写入一页（每次连接都是一次写事务，数据版本随之变化、
+        # 响应缓存全部失效），因此只在还没有任何页的新数据库上设置
+        if conn.execute('PRAGMA page_count').fetchone()[0] == 0:
+            conn.execute('PRAGMA auto_vacuum = incremental')
+        super()._set_pragmas(conn)
+
+    def sql_time(self) -> float:
+        """当前线程累计的 SQL 耗时（秒），调用方通过前后差值计算单次耗时"""
+        return getattr(self._sql_timing, 'total', 0.0)
+
+    def _connect(self):
+        conn = super()._connect()
+        if self.is_reader():
+            conn.execute('PRAGMA query_only = 1')
+            if READ_YIELD_OPCODES > 0:
+                conn.set_progress_handler(self._yield_to_writers, READ_YIELD_OPCODES)
+        return conn
+
+    def connect_reader(self, reuse_if_open=False):
+        """为当前线程打开只读连接（当前线程已有连接且 reuse_if_open 时沿用原连接）"""
+        previous = self.is_reader()
+        self._reader.active = True
+        try:
+            opened = self.connect(reuse_if_open)
+        except Exception:
+            self._reader.active = previous
+            raise
+        if not opened:
+            self._reader.active = previous
+        return opened
+
+    def is_reader(self) -> bool:
+        """当前线程的连接是否为只读连接"""
+        return getattr(self._reader, 'active', False)
+
+    def close(self):
+        try:
+            return super().close()
+        finally:
+            self._reader.active = False
+
+    @contextmanager
+    def ingest_priority(self):
+        """接入处理一条消息（或一批日志记录）期间，让只读连接在 SQLite 内部让出 CPU"""
+        with self._writers_lock:
+            self._writers += 1
+        try:
+            yield
+        finally:
+            with self._writers_lock:
+                self._writers -= 1
+
+    def _yield_to_writers(self):
+        # 进度回调（只读连接）：有接入写入在进行时短暂休眠，返回 0 表示继续执行查询
+        if self._writers:
+            deadline = time.monotonic() + READ_YIELD_MAX_SECONDS
+            while self._writers and time.monotonic() < deadline:
+                time.sleep(READ_YIELD_SLEEP_SECONDS)
+        return 0
 
 # SQLite 数据库配置
-db = SqliteDatabase('game_usage.db')
+# WAL 模式允许读写并发；多个接入进程同时写入时依靠 busy timeout 排队等待而不是直接报错
+# auto_vacuum=incremental 必须在建表前（且在切换 WAL 前）设置，才对新数据库生效（见 _set_pragmas）；
+# 已有数据库需执行一次 `python retention.py --enable-incremental-vacuum` 转换
+try:
+    DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', '10'))
+except Exception:
+    DB_BUSY_TIMEOUT = 10.0
+db = TimedSqliteDatabase('game_usage.db', timeout=DB_BUSY_TIMEOUT,
+                         pragmas=[('journal_mode', 'wal')])
 
 class BaseModel(Model):
     class Meta:
         database = db
 
+class Device(BaseModel):
+    """设备维度表：每个 (player_id, player_name) 组合一行，会话按整数 id 引用
+
+    registry_id 指向 device_registry.id（player_id 为已注册的 BLE ID 时），
+    由触发器维护（见 device_dimension.py）；维度行只增不删，接入进程可放心缓存 id
+    """
+    device_key = CharField(max_length=100)  # 原 player_id
+    name = CharField(max_length=100)  # 原 player_name
+    registry_id = IntegerField(null=True, index=True)
+
+    class Meta:
+        table_name = 'devices'
+        indexes = (
+            (('device_key', 'name'), True),
+        )
+
 class GameSession(BaseModel):
     """游戏会话记录"""
-    player_id = CharField(max_length=100)
-    player_name = CharField(max_length=100)
+    device = ForeignKeyField(Device, backref='sessions', index=False)
     start_time = DateTimeField()
     end_time = DateTimeField(null=True)
     duration_seconds = IntegerField(null=True)
@@ -21,6 +152,10 @@ class GameSession(BaseModel):
     
     class Meta:
         table_name = 'game_sessions'
+        indexes = (
+            # 按设备查找未结束 / 最近的会话
+            (('device', 'start_time'), False),
+        )
 
 class DeviceStatus(BaseModel):
     """设备状态与最近心跳"""
@@ -45,6 +180,95 @@ class DeviceRegistry(BaseModel):
 
     class Meta:
         table_name = 'device_registry'
+        indexes = (
+            # 列表按更新时间倒序的 keyset 分页
+            (('updated_at', 'id'), False),
+        )
+
+class DailyUsageArchive(BaseModel):
+    """已清理会话的按日汇总（永久保留，见 retention.py）
+
+    原始会话超过保留期删除前先累加到这里；统计接口把它与剩余的原始会话合并，
+    因此同一会话只会被计入一次。
+    """
+    day = DateField()
+    player_id = CharField(max_length=100)
+    player_name = CharField(max_length=100)
+    session_count = IntegerField(default=0)
+    completed_sessions = IntegerField(default=0)
+    total_seconds = IntegerField(default=0)
+    last_activity = DateTimeField(null=True)
+
+    class Meta:
+        table_name = 'daily_usage_archive'
+        indexes = (
+            (('day', 'player_id', 'player_name'), True),
+        )
+
+class SessionLengthSketch(BaseModel):
+    """每天每个设备的会话时长分位数草图（DDSketch，见 quantile_sketch.py）"""
+    day = DateField()
+    device = ForeignKeyField(Device, index=False)
+    count = IntegerField(default=0)
+    # 当天该设备已完成会话的总秒数（排行榜按日汇总直接求和，不必解析草图）
+    total_seconds = IntegerField(default=0)
+    sketch = BlobField()
+
+    class Meta:
+        table_name = 'session_length_sketches'
+        indexes = (
+            (('day', 'device'), True),
+        )
+
+class DailyActiveDevices(BaseModel):
+    """每天活跃设备的位图（第 i 位对应 devices.id = i，见 active_bitmaps.py）"""
+    day = DateField(unique=True)
+    device_count = IntegerField(default=0)
+    bitmap = BlobField()
+
+    class Meta:
+        table_name = 'daily_active_devices'
+
+class DeviceMinuteActivity(BaseModel):
+    """每个设备每天的分钟活跃位图（1440 位，第 i 位对应当天 UTC 第 i 分钟，见 minute_activity.py）"""
+    day = DateField()
+    device = ForeignKeyField(Device, index=False)
+    minutes = IntegerField(default=0)  # 位图中 1 的个数
+    bitmap = BlobField()  # 固定 180 字节
+
+    class Meta:
+        table_name = 'device_minute_activity'
+        indexes = (
+            (('day', 'device'), True),
+        )
+
+class IngestJournalPosition(BaseModel):
+    """接入日志的已应用位置，与应用的那批写库在同一事务中更新（见 ingest_journal.py）"""
+    name = CharField(unique=True)
+    segment = IntegerField()
+    byte_offset = IntegerField()
+
+    class Meta:
+        table_name = 'ingest_journal_position'
+
+class SessionPartition(BaseModel):
+    """已封存的按月会话分区（每月一个数据库文件，见 partitions.py）"""
+    month = DateField(unique=True)  # 月初（UTC）
+    session_count = IntegerField(default=0)
+    min_id = IntegerField(null=True)
+    max_id = IntegerField(null=True)
+    sealed_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+
+    class Meta:
+        table_name = 'session_partitions'
+
+class SessionChange(BaseModel):
+    """会话变更计数：每个 UTC 月一行，该月开始的会话插入 / 修改 / 删除时由触发器加一（见 interval_index.py）"""
+    month = CharField(max_length=7, primary_key=True)  # YYYY-MM
+    version = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'session_changes'
 
 def normalize_ble_id(ble_id: str) -> str:
     """
@@ -85,7 +309,29 @@ def normalize_ble_id(ble_id: str) -> str:
 def init_db():
     """初始化数据库"""
     db.connect()
-    db.create_tables([GameSession, DeviceStatus, DeviceRegistry], safe=True)
+    # 旧版会话表（字符串 player_id / player_name 列）先迁移到设备维度表
+    from device_dimension import migrate_legacy_sessions, ensure_registry_link
+    migrate_legacy_sessions()
+    db.create_tables([Device, GameSession, DeviceStatus, DeviceRegistry, DailyUsageArchive], safe=True)
+    ensure_registry_link()
+    # 按月分区存储（SESSION_PARTITION_DIR 非空时启用）
+    from partitions import ensure_partition_table
+    ensure_partition_table()
+    # 会话时长分位数草图（首次建表时从现有会话重建）
+    from quantile_sketch import ensure_sketch_table
+    ensure_sketch_table()
+    # 每日活跃设备位图（首次建表时从会话与归档汇总重建）
+    from active_bitmaps import ensure_bitmap_table
+    ensure_bitmap_table()
+    # 会话按月变更计数（时间点查询索引据此判断是否需要重建）
+    from interval_index import ensure_change_table
+    ensure_change_table()
+    # 设备分钟活跃位图（心跳）
+    from minute_activity import ensure_minute_table
+    ensure_minute_table()
+    # 注册表全文搜索索引（FTS5 trigram，触发器同步）
+    from registry_search import ensure_search_index
+    ensure_search_index()
     print("数据库初始化完成")
 
 if __name__ == "__main__":
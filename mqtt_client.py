@@ -1,36 +1,143 @@
 # -*- coding: utf-8 -*-
+import abc
 import json
 import os
 import paho.mqtt.client as mqtt
-from datetime import datetime, timezone, timedelta
-from models import GameSession, DeviceStatus, DeviceRegistry, normalize_ble_id, db
+from datetime import date, datetime, timezone, timedelta
+from models import Device, GameSession, DeviceStatus, DeviceRegistry, normalize_ble_id, db
+from device_dimension import device_id_for
 import logging
-import requests
 import queue
 import threading
+import time
+import metrics
+from change_notify import ChangeNotifier, CacheInvalidationListener
+from dedup import IngestDeduplicator
+from ingest_queue import IngestQueue, DeviceRateLimiter, INGEST_QUEUE_SIZE, INGEST_RATE_LIMITED, PRIORITY_EVENTS
+import wire_format
+import quantile_sketch
+import active_bitmaps
+import minute_activity
+import sql_profiler
+from log_utils import setup_logging, ingest_log
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 配置日志（后台线程写出，逐条消息日志由 ingest_log 汇总/限流）
+setup_logging()
 logger = logging.getLogger(__name__)
 
-class GameUsageTracker:
-    def __init__(self, update_queue=None):
+class MqttConnection(abc.ABC):
+    """MQTT 连接：Broker 配置、连接 / 断开回调与自动重连循环。子类实现 on_message"""
+
+    def __init__(self, topic=None):
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         
-        # MQTT 连接配置
-        self.broker_host = "mqtt.aimaker.space"
-        self.broker_port = 1883  # 使用标准 TCP 端口
-        self.username = "guest"
-        self.password = "test"
-        self.topic = "game"
+        # MQTT 连接配置（可由 MQTT_HOST / MQTT_PORT / MQTT_USERNAME / MQTT_PASSWORD 覆盖）
+        self.broker_host = os.environ.get('MQTT_HOST', "mqtt.aimaker.space")
+        try:
+            self.broker_port = int(os.environ.get('MQTT_PORT', '1883'))  # 使用标准 TCP 端口
+        except Exception:
+            self.broker_port = 1883
+        self.username = os.environ.get('MQTT_USERNAME', "guest")
+        self.password = os.environ.get('MQTT_PASSWORD', "test")
+        self.topic = topic or "game"
         self.reconnect_delay = 5
         self.max_reconnect_delay = 60
+        # 是否已成功连接过（用于区分首次连接与重连）
+        self._has_connected = False
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            metrics.MQTT_CONNECTS.inc('success')
+            if self._has_connected:
+                metrics.MQTT_RECONNECTS.inc()
+            self._has_connected = True
+            logger.info("✅ 成功连接到 MQTT Broker")
+            result = client.subscribe(self.topic)
+            logger.info(f"✅ 订阅主题: {self.topic}, 结果: {result}")
+            # 重置重连延迟
+            self.reconnect_delay = 5
+        else:
+            error_messages = {
+                1: "协议版本不正确",
+                2: "客户端标识符无效", 
+                3: "服务器不可用",
+                4: "用户名或密码错误",
+                5: "未授权"
+            }
+            metrics.MQTT_CONNECTS.inc('refused')
+            logger.error(f"❌ 连接失败，错误代码: {rc} - {error_messages.get(rc, '未知错误')}")
+    
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            metrics.MQTT_DISCONNECTS.inc('unexpected')
+            logger.warning(f"意外断开连接，错误代码: {rc}")
+            logger.info(f"{self.reconnect_delay}秒后尝试重新连接...")
+        else:
+            metrics.MQTT_DISCONNECTS.inc('normal')
+            logger.info("正常断开连接")
+    
+    @abc.abstractmethod
+    def on_message(self, client, userdata, msg):
+        """处理一条 MQTT 消息（paho 网络线程中调用）"""
+
+    def run(self, before_loop=None):
+        """连接 Broker 并处理消息，断线后按指数退避重连（阻塞）"""
+        while True:
+            try:
+                # 设置用户名和密码
+                self.client.username_pw_set(self.username, self.password)
+                
+                logger.info(f"正在连接到 MQTT Broker: {self.broker_host}:{self.broker_port}")
+                self.client.connect(self.broker_host, self.broker_port, 60)
+                if before_loop is not None:
+                    before_loop()
+                    before_loop = None
+                
+                logger.info("开始监听 MQTT 消息...")
+                self.client.loop_forever()
+                
+            except KeyboardInterrupt:
+                logger.info("收到中断信号，正在退出...")
+                break
+            except Exception as e:
+                metrics.MQTT_CONNECTS.inc('error')
+                logger.error(f"MQTT 客户端出错: {e}")
+                logger.info(f"{self.reconnect_delay}秒后尝试重新连接...")
+                
+                import time
+                time.sleep(self.reconnect_delay)
+                
+                # 增加重连延迟，但不超过最大值
+                self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
         
-        # 实时更新队列
+        # 清理连接
+        try:
+            self.client.disconnect()
+        except:
+            pass
+
+
+class GameUsageTracker(MqttConnection):
+    def __init__(self, update_queue=None, topic=None, journal=None):
+        super().__init__(topic)
+
+        # 实时更新队列；没有进程内队列时通过本机套接字通知 API 进程
         self.update_queue = update_queue
+        self.change_notifier = None if update_queue is not None else ChangeNotifier()
+        # 重复消息过滤（重连/重投/设备重试），在任何数据库操作之前执行
+        self.dedup = IngestDeduplicator()
+        # 本地接入日志（见 ingest_journal.py）：设置后 on_message 只追加日志，写库由日志的应用线程批量完成
+        self.journal = journal
+        # 批量应用期间推迟实时更新，事务提交后只发一次
+        self._notify_deferred = None
+        # 过载保护（见 ingest_queue.py）：按设备限流；设置 INGEST_QUEUE_SIZE 时 start() 启用有界队列，MQTT 线程只入队
+        self.limiter = DeviceRateLimiter()
+        self.ingest_queue = None
+        # 缓存失效通知（start() 或多进程接入的工作进程中启动）
+        self._invalidation_listener = None
         # 离线阈值（秒）可配置，默认 300
         try:
             self.offline_window_seconds = int(os.environ.get('OFFLINE_WINDOW_SECONDS', '300'))
@@ -61,55 +168,164 @@ class GameUsageTracker:
             return dt.replace(tzinfo=timezone.utc)
         return dt.astimezone(timezone.utc)
         
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            logger.info("✅ 成功连接到 MQTT Broker")
-            result = client.subscribe(self.topic)
-            logger.info(f"✅ 订阅主题: {self.topic}, 结果: {result}")
-            # 重置重连延迟
-            self.reconnect_delay = 5
+    def on_message(self, client, userdata, msg):
+        """MQTT 消息回调：处理消息并记录耗时指标。消息只解析一次，解析结果随消息入队 / 处理"""
+        parsed = self._try_parse(msg.payload)
+        event, device_key = self._classify(parsed)
+        if not self._within_rate_limit(event, device_key):
+            return
+        if self.journal is not None:
+            # 去重后追加到本地日志即返回（回调返回后 QoS 1 消息才被确认）
+            if self._is_duplicate_payload(msg.payload, parsed):
+                metrics.INGEST_MESSAGES.inc('duplicate')
+            else:
+                self.journal.append(msg.topic, msg.payload)
+            return
+        if self.ingest_queue is not None:
+            self.ingest_queue.offer((msg.payload, parsed), event, device_key)
+            return
+        self.handle_payload(msg.payload, parsed=parsed)
+
+    def _try_parse(self, payload):
+        """解析消息，无法解析时返回 None（处理时重新解析以拒绝并计数）"""
+        try:
+            return self._parse_payload(payload)
+        except Exception:
+            return None
+
+    @staticmethod
+    def _classify(parsed):
+        """不访问数据库的消息分类，返回 (事件, 设备 key)；无法解析时返回 (None, None)"""
+        if parsed is None:
+            return None, None
+        message, _, norm_ble = parsed
+        return message.get("event"), norm_ble or message.get("playerId")
+
+    def _within_rate_limit(self, event, device_key):
+        """按设备令牌桶限流：超限的心跳丢弃，开始 / 结束事件只计数不丢弃"""
+        if self.limiter.allow(device_key):
+            return True
+        label = event if event in ('game_start', 'game_end', 'heartbeat') else 'unknown'
+        INGEST_RATE_LIMITED.inc(label)
+        ingest_log.count('rate_limited', device_key)
+        ingest_log.warning(f'rate_limited:{device_key}',
+                           f"🚦 设备 {device_key} 超出速率限制（{self.limiter.rate:g} 条/秒，突发 {self.limiter.burst:g} 条），心跳被丢弃")
+        return event in PRIORITY_EVENTS
+
+    def handle_batch(self, records):
+        """接入队列的处理线程回调：一批 (接收时间, (消息, 解析结果)) 在一个写事务中处理，实时更新只发一次"""
+        self._notify_deferred = False
+        try:
+            with db.ingest_priority(), db.atomic():
+                for received_at, (payload, parsed) in records:
+                    self.handle_payload(payload, received_at, parsed=parsed)
+                self._flush_minute_activity(minute_activity.flush_if_due)
+        finally:
+            pending, self._notify_deferred = self._notify_deferred, None
+        if pending:
+            self.trigger_realtime_update()
+
+    def handle_payload(self, payload, received_at=None, check_duplicates=True, parsed=None):
+        """处理一条消息（received_at 为接收时间，重放日志时使用；parsed 为 on_message 中已解析的结果）"""
+        start = time.perf_counter()
+        db_start = db.sql_time()
+        # 写入期间 API 的只读连接让出 CPU（见 models.TimedSqliteDatabase）
+        with db.ingest_priority(), sql_profiler.profile('mqtt') as profile:
+            label = self._process_message(payload, received_at, check_duplicates, parsed)
+            if profile is not None:
+                profile.unit = f'mqtt {label}'
+            if self._notify_deferred is None:
+                self._flush_minute_activity(minute_activity.flush_if_due)
+        metrics.INGEST_MESSAGES.inc(label)
+        metrics.INGEST_MESSAGE_SECONDS.observe(time.perf_counter() - start, label)
+        metrics.INGEST_DB_SECONDS.observe(db.sql_time() - db_start, label)
+
+    def apply_journal_batch(self, records):
+        """日志应用线程回调：在同一个写事务中应用一批 (接收时间, 主题, 消息)。
+        去重已在追加日志前完成，这里不再去重（重放时结果与首次应用一致）
+        """
+        self._notify_deferred = False
+        try:
+            for received_at, _, payload in records:
+                self.handle_payload(payload, datetime.fromtimestamp(received_at, timezone.utc),
+                                    check_duplicates=False)
+            # 与这批消息在同一事务中写入分钟活跃位图
+            self._flush_minute_activity(minute_activity.flush)
+        finally:
+            pending, self._notify_deferred = self._notify_deferred, None
+        return pending
+
+    def _flush_minute_activity(self, flush):
+        try:
+            flush()
+        except Exception as e:
+            logger.warning(f"写入分钟活跃位图失败: {e}")
+
+    def _after_journal_commit(self, pending_update):
+        if pending_update:
+            self.trigger_realtime_update()
+
+    def _parse_payload(self, payload):
+        """解析 MQTT 消息（紧凑格式按首字节识别，设备 ID 已是规范形式），返回 (message, compact, 规范化 BLE ID)"""
+        compact = wire_format.is_compact(payload)
+        if compact:
+            message = wire_format.parse_compact(payload)
         else:
-            error_messages = {
-                1: "协议版本不正确",
-                2: "客户端标识符无效", 
-                3: "服务器不可用",
-                4: "用户名或密码错误",
-                5: "未授权"
-            }
-            logger.error(f"❌ 连接失败，错误代码: {rc} - {error_messages.get(rc, '未知错误')}")
-    
-    def on_disconnect(self, client, userdata, rc):
-        if rc != 0:
-            logger.warning(f"意外断开连接，错误代码: {rc}")
-            logger.info(f"{self.reconnect_delay}秒后尝试重新连接...")
+            message = json.loads(payload.decode())
+        ble_id_raw = message.get("bleId")
+        if compact:
+            norm_ble = ble_id_raw
         else:
-            logger.info("正常断开连接")
-    
-    def on_message(self, client, userdata, msg):
+            norm_ble = normalize_ble_id(ble_id_raw) if ble_id_raw else None
+        return message, compact, norm_ble
+
+    def _drop_duplicate(self, message, event, label, norm_ble, payload):
+        """重复消息返回 True 并计数。去重 key 与 device_key 规则一致（有效 bleId 优先），不依赖注册表查询"""
+        dedup_key = norm_ble or message.get("playerId")
+        if dedup_key and self.dedup.is_duplicate(dedup_key, event, message):
+            metrics.INGEST_DUPLICATES.inc(label)
+            ingest_log.count('duplicate', dedup_key)
+            if ingest_log.is_traced(dedup_key):
+                logger.info(f"♻️ [追踪 {dedup_key}] 丢弃重复消息: {payload.decode(errors='replace')}")
+            return True
+        return False
+
+    def _is_duplicate_payload(self, payload, parsed):
+        """写日志前的去重；无法解析的消息照常写入日志，由应用线程拒绝并计数"""
+        if parsed is None:
+            return False
+        message, _, norm_ble = parsed
+        event = message.get("event")
+        if not event:
+            return False
+        label = event if event in ('game_start', 'game_end', 'heartbeat') else 'unknown'
+        return self._drop_duplicate(message, event, label, norm_ble, payload)
+
+    def _process_message(self, payload, received_at=None, check_duplicates=True, parsed=None):
+        """处理单条消息，返回用于指标统计的事件类型标签"""
+        label = 'invalid'
+        now = received_at or datetime.now(timezone.utc)
         try:
-            # 解析 MQTT 消息
-            raw_message = msg.payload.decode()
-            logger.info(f"📨 收到原始消息: {raw_message}")
-            
-            message = json.loads(raw_message)
-            logger.info(f"📋 解析后消息: {message}")
+            message, compact, norm_ble = parsed or self._parse_payload(payload)
             
             event = message.get("event")
             player_id = message.get("playerId")
             player_name = message.get("playerName")
             ble_id_raw = message.get("bleId")
-            norm_ble = normalize_ble_id(ble_id_raw) if ble_id_raw else None
-            if ble_id_raw:
-                if norm_ble:
-                    logger.info(f"🔷 BLE ID 规范化: {ble_id_raw} -> {norm_ble}")
-                else:
-                    logger.warning(f"⚠️ BLE ID 格式不正确: {ble_id_raw}，期望格式：MicroBlocks ABC")
+            if ble_id_raw and not compact:
+                if not norm_ble:
+                    metrics.INGEST_INVALID_BLE.inc()
+                    ingest_log.warning('invalid_ble_id', f"⚠️ BLE ID 格式不正确: {ble_id_raw}，期望格式：MicroBlocks ABC")
             
             # 验证消息格式
             # 必须有 event
             if not event:
-                logger.warning("⚠️ 消息格式不完整：缺少 event 字段")
-                return
+                self._reject('missing_event', "⚠️ 消息格式不完整：缺少 event 字段")
+                return label
+            label = event if event in ('game_start', 'game_end', 'heartbeat') else 'unknown'
+
+            if check_duplicates and self._drop_duplicate(message, event, label, norm_ble, payload):
+                return 'duplicate'
             
             # 验证设备标识：必须有 bleId（且在注册表中）或 playerId+playerName
             if norm_ble:
@@ -119,26 +335,32 @@ class GameUsageTracker:
                     # 找到了注册表映射，使用 bleId 作为 device_key，映射名称作为 display_name
                     device_key = norm_ble
                     display_name = f"{reg.campus_name}-{reg.project_name}"
-                    logger.info(f"✅ 使用注册表映射: {norm_ble} -> {display_name}")
                 except DeviceRegistry.DoesNotExist:
                     # 有 bleId 但未在注册表中，需要 fallback
                     if not player_id or not player_name:
-                        logger.warning(f"⚠️ 消息格式不完整：BLE ID {norm_ble} 未在注册表中，请提供 playerId 和 playerName 作为后备，或在后台注册表中添加该 BLE ID")
-                        return
+                        self._reject('unregistered_ble_id', f"⚠️ 消息格式不完整：BLE ID {norm_ble} 未在注册表中，请提供 playerId 和 playerName 作为后备，或在后台注册表中添加该 BLE ID")
+                        return label
                     device_key = norm_ble
                     display_name = player_name or norm_ble
-                    logger.info(f"ℹ️ BLE ID {norm_ble} 未在注册表中，使用提供的 playerName: {display_name}")
             else:
                 # 没有 bleId 或 bleId 格式不正确，必须提供 playerId 和 playerName
+                reason = 'invalid_ble_id' if ble_id_raw else 'missing_player'
                 if not player_id:
-                    logger.warning("⚠️ 消息格式不完整：缺少 playerId，且没有提供有效的 bleId")
-                    return
+                    self._reject(reason, "⚠️ 消息格式不完整：缺少 playerId，且没有提供有效的 bleId")
+                    return label
                 if not player_name:
-                    logger.warning("⚠️ 消息格式不完整：缺少 playerName，且没有提供有效的 bleId")
-                    return
+                    self._reject(reason, "⚠️ 消息格式不完整：缺少 playerName，且没有提供有效的 bleId")
+                    return label
                 device_key = player_id
                 display_name = player_name
 
+            ingest_log.count(label, device_key)
+            trace = ingest_log.is_traced(device_key)
+            if trace:
+                logger.info(f"📨 [追踪 {device_key}] 原始消息: {payload.decode(errors='replace')}")
+                if norm_ble and not compact:
+                    logger.info(f"🔷 [追踪 {device_key}] BLE ID 规范化: {ble_id_raw} -> {norm_ble}，显示名称: {display_name}")
+
             # 先获取旧的设备状态（用于计算异常断线的真实时长）
             old_last_seen = None
             try:
@@ -149,49 +371,66 @@ class GameUsageTracker:
                 pass
 
             # 任何消息先更新设备 last_seen（用映射后的 key/name）
-            self.update_device_last_seen(device_key, display_name)
+            self.update_device_last_seen(device_key, display_name, now)
+            # 分钟活跃位图只在内存中置位，按周期合并写库（见 minute_activity.py）
+            minute_activity.record(device_id_for(device_key, display_name), now)
             
             if event == "game_start":
-                logger.info(f"🎮 处理游戏开始事件: {display_name}")
-                self.handle_game_start(device_key, display_name, old_last_seen)
+                if trace:
+                    logger.info(f"🎮 [追踪 {device_key}] 处理游戏开始事件: {display_name}")
+                self.handle_game_start(device_key, display_name, old_last_seen, now)
             elif event == "game_end":
-                logger.info(f"🏁 处理游戏结束事件: {display_name}")
-                self.handle_game_end(device_key, display_name)
+                if trace:
+                    logger.info(f"🏁 [追踪 {device_key}] 处理游戏结束事件: {display_name}")
+                self.handle_game_end(device_key, display_name, now)
             elif event == "heartbeat":
-                logger.info(f"💓 心跳: {display_name}")
+                if trace:
+                    logger.info(f"💓 [追踪 {device_key}] 心跳: {display_name}")
                 # last_seen 已在上面统一更新
                 self.trigger_realtime_update()
             else:
-                logger.warning(f"❓ 未知事件类型: {event}")
+                ingest_log.warning('unknown_event', f"❓ 未知事件类型: {event}")
                 
+        except wire_format.CompactFormatError as e:
+            self._reject('bad_compact', f"❌ 紧凑格式解析错误: {e}, 原始消息: {payload.decode(errors='replace')}")
         except json.JSONDecodeError as e:
-            logger.error(f"❌ JSON 解析错误: {e}, 原始消息: {msg.payload.decode()}")
+            self._reject('bad_json', f"❌ JSON 解析错误: {e}, 原始消息: {payload.decode(errors='replace')}")
         except Exception as e:
+            metrics.INGEST_REJECTED.inc('error')
             logger.error(f"❌ 处理消息时出错: {e}")
+        return label
+
+    def _reject(self, reason, message):
+        """记录被拒绝的消息（计数 + 限流告警）"""
+        metrics.INGEST_REJECTED.inc(reason)
+        ingest_log.count(f'rejected:{reason}')
+        ingest_log.warning(reason, message)
     
-    def handle_game_start(self, player_id, player_name, old_last_seen=None):
+    def handle_game_start(self, player_id, player_name, old_last_seen=None, now=None):
         """处理游戏开始事件"""
+        now = now or datetime.now(timezone.utc)
         try:
             # 检查是否有未结束的会话
-            existing_session = GameSession.select().where(
-                (GameSession.player_id == player_id) & 
+            existing_session = GameSession.select().join(Device).where(
+                (Device.device_key == player_id) &
                 (GameSession.end_time.is_null())
             ).first()
             
             if existing_session:
                 logger.warning(f"玩家 {player_name} 有未结束的会话，先结束之前的会话")
-                self.end_session(existing_session, is_forced=True, forced_end_time=old_last_seen)
+                self.end_session(existing_session, is_forced=True, forced_end_time=old_last_seen, now=now)
             
             # 创建新的游戏会话
-            session = GameSession.create(
-                player_id=player_id,
-                player_name=player_name,
-                start_time=datetime.now(timezone.utc)
-            )
+            with db.atomic():
+                session = GameSession.create(
+                    device=device_id_for(player_id, player_name),
+                    start_time=now
+                )
+                active_bitmaps.mark_active(session.device_id, session.start_time)
             logger.info(f"玩家 {player_name} 开始游戏，会话ID: {session.id}")
 
             # 更新设备当前会话
-            self.set_device_current_session(player_id, player_name, session.id)
+            self.set_device_current_session(player_id, player_name, session.id, now)
             
             # 触发实时更新
             self.trigger_realtime_update()
@@ -199,20 +438,21 @@ class GameUsageTracker:
         except Exception as e:
             logger.error(f"处理游戏开始事件时出错: {e}")
     
-    def handle_game_end(self, player_id, player_name):
+    def handle_game_end(self, player_id, player_name, now=None):
         """处理游戏结束事件"""
+        now = now or datetime.now(timezone.utc)
         try:
             # 查找最近的未结束会话
-            session = GameSession.select().where(
-                (GameSession.player_id == player_id) & 
+            session = GameSession.select().join(Device).where(
+                (Device.device_key == player_id) &
                 (GameSession.end_time.is_null())
             ).order_by(GameSession.start_time.desc()).first()
             
             if session:
-                self.end_session(session)
+                self.end_session(session, now=now)
                 logger.info(f"玩家 {player_name} 结束游戏，游戏时长: {session.duration_seconds}秒")
                 # 清空设备当前会话
-                self.set_device_current_session(player_id, player_name, None)
+                self.set_device_current_session(player_id, player_name, None, now)
             else:
                 logger.warning(f"未找到玩家 {player_name} 的活跃会话")
             
@@ -222,9 +462,9 @@ class GameUsageTracker:
         except Exception as e:
             logger.error(f"处理游戏结束事件时出错: {e}")
     
-    def end_session(self, session, is_forced=False, forced_end_time=None):
+    def end_session(self, session, is_forced=False, forced_end_time=None, now=None):
         """结束游戏会话"""
-        now = datetime.now(timezone.utc)
+        now = now or datetime.now(timezone.utc)
         start_time_utc = self._to_utc(session.start_time)
         
         # 默认使用当前时间作为结束时间
@@ -257,11 +497,14 @@ class GameUsageTracker:
             
         session.end_time = end_time
         session.duration_seconds = duration
-        session.save()
+        # 会话更新先拿到写锁，再读改写时长草图，多个接入进程不会互相覆盖
+        with db.atomic():
+            session.save()
+            quantile_sketch.record_duration(session.device_id, start_time_utc, duration)
 
-    def update_device_last_seen(self, player_id: str, player_name: str):
+    def update_device_last_seen(self, player_id: str, player_name: str, now=None):
         """更新设备最后心跳时间"""
-        now_utc = datetime.now(timezone.utc)
+        now_utc = now or datetime.now(timezone.utc)
         try:
             device, _ = DeviceStatus.get_or_create(player_id=player_id, defaults={
                 'player_name': player_name,
@@ -275,9 +518,9 @@ class GameUsageTracker:
         except Exception as e:
             logger.warning(f"更新设备心跳失败: {e}")
 
-    def set_device_current_session(self, player_id: str, player_name: str, session_id):
+    def set_device_current_session(self, player_id: str, player_name: str, session_id, now=None):
         """设置设备当前会话ID（开始/结束时调用）"""
-        now_utc = datetime.now(timezone.utc)
+        now_utc = now or datetime.now(timezone.utc)
         try:
             device, _ = DeviceStatus.get_or_create(player_id=player_id, defaults={
                 'player_name': player_name,
@@ -292,64 +535,67 @@ class GameUsageTracker:
     
     def trigger_realtime_update(self):
         """触发前端实时更新"""
+        if self._notify_deferred is not None:
+            # 批量应用日志期间：事务提交后再统一通知（见 apply_journal_batch）
+            self._notify_deferred = True
+            return
         try:
-            if self.update_queue:
+            update_data = {
+                'type': 'mqtt_update',
+                'timestamp': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+            }
+            if self.update_queue is not None:
                 # 直接通过队列发送更新信号
-                update_data = {
-                    'type': 'mqtt_update',
-                    'timestamp': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
-                }
                 self.update_queue.put(update_data)
-                logger.info("✅ 成功触发实时更新（队列）")
-            else:
-                # 备用方案：HTTP 请求
-                import requests
-                try:
-                    response = requests.post('https://devicetime.aimaker.space/api/trigger-update', timeout=1)
-                    if response.status_code == 200:
-                        logger.info("✅ 成功触发实时更新（HTTP）")
-                except:
-                    logger.debug("HTTP 触发失败，使用队列方式")
+                logger.debug("✅ 成功触发实时更新（队列）")
+            elif self.change_notifier.notify(update_data):
+                # 独立运行时：本机套接字通知 API 进程
+                logger.debug("✅ 成功触发实时更新（本机通知）")
                 
         except Exception as e:
             logger.warning(f"⚠️ 触发实时更新失败: {e}")
     
-    def start(self):
-        """启动 MQTT 客户端"""
-        while True:
-            try:
-                # 设置用户名和密码
-                self.client.username_pw_set(self.username, self.password)
-                
-                logger.info(f"正在连接到 MQTT Broker: {self.broker_host}:{self.broker_port}")
-                self.client.connect(self.broker_host, self.broker_port, 60)
-                
-                logger.info("开始监听 MQTT 消息...")
-                self.client.loop_forever()
-                
-            except KeyboardInterrupt:
-                logger.info("收到中断信号，正在退出...")
-                break
-            except Exception as e:
-                logger.error(f"MQTT 客户端出错: {e}")
-                logger.info(f"{self.reconnect_delay}秒后尝试重新连接...")
-                
-                import time
-                time.sleep(self.reconnect_delay)
-                
-                # 增加重连延迟，但不超过最大值
-                self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
-        
-        # 清理连接
+    def listen_for_invalidations(self):
+        """接收 API 进程删除设备 / 会话后的缓存失效通知（见 change_notify.py）"""
+        if self._invalidation_listener is not None:
+            return
         try:
-            self.client.disconnect()
-        except:
-            pass
+            self._invalidation_listener = CacheInvalidationListener(self.forget_cached_devices).start()
+        except OSError as e:
+            logger.warning(f"⚠️ 缓存失效通知监听启动失败，删除设备后本进程的缓存要到次日才会刷新: {e}")
+
+    @staticmethod
+    def forget_cached_devices(data):
+        """丢弃本进程缓存的设备状态：活跃设备置位标记，以及（删除设备时）尚未写库的分钟位。
+        去重窗口与限流状态不在此清除，它们在窗口结束后自然过期"""
+        day = date.fromisoformat(data['day']) if data.get('day') else None
+        active_bitmaps.forget(data['device_ids'], day)
+        if day is None:
+            minute_activity.forget(data['device_ids'])
+
+    def start(self, before_loop=None):
+        """启动 MQTT 客户端
+
+        before_loop: 首次连接建立后、开始处理消息前调用一次（快速启动时在这里等待数据库初始化完成，
+        TCP 连接与数据库初始化因此可以并行）
+        """
+        self.listen_for_invalidations()
+        if self.journal is not None:
+            # 消息只追加到日志、不直接写库：连接建立后无需等待；应用线程等 before_loop 返回后再开始写库
+            self.journal.start_applier(self.apply_journal_batch, self._after_journal_commit, before_apply=before_loop)
+            before_loop = None
+        elif INGEST_QUEUE_SIZE > 0 and self.ingest_queue is None:
+            logger.warning(f"⚠️ 接入队列已启用（INGEST_QUEUE_SIZE={INGEST_QUEUE_SIZE}）：消息入队即确认，"
+                           f"进程被杀时最多丢失 {INGEST_QUEUE_SIZE} 条已确认的消息；需要不丢消息请使用 INGEST_JOURNAL=1")
+            self.ingest_queue = IngestQueue(self.handle_batch)
+            self.ingest_queue.start()
+        self.run(before_loop)
 
 if __name__ == "__main__":
     # 初始化数据库
     db.connect()
     
-    # 启动游戏使用时长追踪器
-    tracker = GameUsageTracker()
+    # 启动游戏使用时长追踪器（INGEST_JOURNAL=1 时先写本地接入日志）
+    from ingest_journal import journal_from_env
+    tracker = GameUsageTracker(journal=journal_from_env())
     tracker.start()
\ No newline at end of file
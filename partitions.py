@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+按月分区的会话存储（SESSION_PARTITION_DIR 非空时启用）
+
+全部历史都在 game_usage.db 一个文件里时，每次范围查询、索引维护和 vacuum 都面对全部数据。
+分区模式下主库只保存近期会话，已结束的月份封存到各自的数据库文件
+（SESSION_PARTITION_DIR/sessions-YYYY-MM.db，表结构与 game_sessions 相同，会话 ID 不变）：
+
+- 封存：月份结束 PARTITION_SEAL_DAYS 天后（随保留任务执行），把该月开始的已结束会话分批复制到
+  分区文件并从主库删除；每批先提交分区文件、再在主库删除并更新分区目录（session_partitions），
+  中途崩溃时最多两边各有一份，重新封存时覆盖。设备当前会话与未结束的会话留在主库
+- 路由：attached(start, end) 在当前连接上只 ATTACH 时间范围涉及的分区，并创建同名临时视图
+  game_sessions（主库 UNION ALL 各分区）。SQLite 先在 temp 中解析不带库名的表名，
+  所以范围内现有的 GameSession 查询无需修改即可跨分区读取；across() 在分区数超过
+  SQLite 可同时 ATTACH 的上限时按时间分段执行
+- 删除：超过会话保留期的整月分区先把按日汇总写入 daily_usage_archive（一条聚合查询），
+  再直接删除文件，不再逐行删除与 vacuum
+- 删除单个会话 / 设备时，分区中的会话直接打开分区文件删除（可以在主库事务内调用）
+
+会话列表接口（/api/sessions）只列出主库中的会话。
+"""
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+
+from peewee import fn
+
+from models import db, env_number, Device, GameSession, DeviceStatus, SessionPartition
+
+logger = logging.getLogger(__name__)
+
+
+PARTITION_DIR = os.environ.get('SESSION_PARTITION_DIR', '')
+# 月份结束多少天后封存（给迟到的结束事件留出时间）
+PARTITION_SEAL_DAYS = max(0, env_number('PARTITION_SEAL_DAYS', 3))
+SEAL_BATCH_SIZE = max(1, env_number('PARTITION_SEAL_BATCH_SIZE', 2000))
+SEAL_PAUSE_SECONDS = 0.05
+
+_COLUMNS = 'id, device_id, start_time, end_time, duration_seconds, created_at'
+_TABLE_SQL = ('CREATE TABLE IF NOT EXISTS {schema}game_sessions ('
+              'id INTEGER NOT NULL PRIMARY KEY, device_id INTEGER NOT NULL, start_time DATETIME NOT NULL, '
+              'end_time DATETIME, duration_seconds INTEGER, created_at DATETIME NOT NULL)')
+_INDEX_SQL = ('CREATE INDEX IF NOT EXISTS {schema}game_sessions_device_id_start_time '
+              'ON game_sessions (device_id, start_time)',
+              'CREATE INDEX IF NOT EXISTS {schema}game_sessions_start_time ON game_sessions (start_time)')
+
+# 当前线程的连接上已 ATTACH 的分区（attached() 不可嵌套）
+_local = threading.local()
+
+
+def enabled():
+    return bool(PARTITION_DIR)
+
+
+def ensure_partition_table():
+    if enabled():
+        os.makedirs(PARTITION_DIR, exist_ok=True)
+        db.create_tables([SessionPartition], safe=True)
+
+
+def month_of(value):
+    """日期 / 时间所在 UTC 月的月初（date）"""
+    if isinstance(value, datetime):
+        value = value.astimezone(timezone.utc) if value.tzinfo else value
+    return date(value.year, value.month, 1)
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _month_start(month):
+    return datetime.combine(month, datetime.min.time(), tzinfo=timezone.utc)
+
+
+def partition_path(month):
+    return os.path.join(PARTITION_DIR, f'sessions-{month:%Y-%m}.db')
+
+
+def _schema(month):
+    return f'p{month:%Y%m}'
+
+
+def _to_month(value):
+    return datetime.strptime(value[:10], '%Y-%m-%d').date() if isinstance(value, str) else value
+
+
+def sealed_months(start=None, end=None):
+    """开始时间落在 [start, end) 内的会话可能所在的已封存月份（升序）"""
+    if not enabled():
+        return []
+    query = SessionPartition.select(SessionPartition.month).order_by(SessionPartition.month)
+    if start is not None:
+        query = query.where(SessionPartition.month >= month_of(start))
+    if end is not None:
+        query = query.where(SessionPartition.month < end.date() if isinstance(end, datetime) else end)
+    return [_to_month(month) for month, in query.tuples()]
+
+
+def max_attached():
+    return db.connection().getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+
+
+def _temp_ddl(conn, sql):
+    # 只读连接（PRAGMA query_only）不允许创建临时视图，临时切换（不影响主库与分区文件）
+    reader = db.is_reader()
+    if reader:
+        conn.execute('PRAGMA query_only = 0')
+    try:
+        conn.execute(sql)
+    finally:
+        if reader:
+            conn.execute('PRAGMA query_only = 1')
+
+
+@contextmanager
+def attached(start=None, end=None):
+    """在当前连接上 ATTACH [start, end) 涉及的分区，期间不带库名的 game_sessions 为主库与分区的合并视图。
+    不能在事务中使用；分区数超过 max_attached() 时抛出 ValueError（请用 across()）
+    """
+    months = sealed_months(start, end)
+    if not months:
+        yield months
+        return
+    if getattr(_local, 'months', None):
+        raise RuntimeError('attached() 不能嵌套使用')
+    if len(months) > max_attached():
+        raise ValueError(f'时间范围涉及 {len(months)} 个分区，超过可同时 ATTACH 的 {max_attached()} 个')
+    conn = db.connection()
+    schemas = []
+    try:
+        for month in months:
+            conn.execute(f'ATTACH DATABASE ? AS {_schema(month)}', (partition_path(month),))
+            schemas.append(_schema(month))
+        selects = [f'SELECT {_COLUMNS} FROM main.game_sessions'] + [
+            f'SELECT {_COLUMNS} FROM {schema}.game_sessions' for schema in schemas]
+        _temp_ddl(conn, 'CREATE TEMP VIEW game_sessions AS ' + ' UNION ALL '.join(selects))
+        _local.months = months
+        yield months
+    finally:
+        _local.months = None
+        _temp_ddl(conn, 'DROP VIEW IF EXISTS temp.game_sessions')
+        for schema in schemas:
+            conn.execute(f'DETACH DATABASE {schema}')
+
+
+def windows(start=None, end=None):
+    """把 [start, end) 切分为若干段，每段涉及的分区数不超过可同时 ATTACH 的上限"""
+    months = sealed_months(start, end)
+    limit = max_attached() if months else 1
+    if len(months) <= limit:
+        return [(start, end)]
+    chunks = [months[i:i + limit] for i in range(0, len(months), limit)]
+    result = []
+    for i, chunk in enumerate(chunks):
+        window_start = start if i == 0 else _month_start(chunk[0])
+        window_end = end if i == len(chunks) - 1 else _month_start(next_month(chunk[-1]))
+        result.append((window_start, window_end))
+    return result
+
+
+def across(start, end, run):
+    """统一的跨分区读取：对 [start, end) 的每一段执行 run(段开始, 段结束)（可能为 None），
+    期间 game_sessions 包含该段涉及的分区；返回各段结果（按时间升序）。
+    run 必须自己按段范围筛选会话开始时间（range_conditions()），否则分段时会重复计数
+    """
+    if not enabled():
+        return [run(start, end)]
+    results = []
+    for window_start, window_end in windows(start, end):
+        with attached(window_start, window_end):
+            results.append(run(window_start, window_end))
+    return results
+
+
+def range_conditions(start, end):
+    """会话开始时间在 [start, end) 内的条件（None 表示不限）"""
+    conditions = []
+    if start is not None:
+        conditions.append(GameSession.start_time >= start)
+    if end is not None:
+        conditions.append(GameSession.start_time < end)
+    # start_time 非空，恒为真；保证 where(*conditions) 至少有一个条件
+    return conditions or [GameSession.start_time.is_null(False)]
+
+
+# ---- 封存 ----
+def _catalog_add(month, ids):
+    entry = SessionPartition.get_or_none(SessionPartition.month == month)
+    if entry is None:
+        SessionPartition.create(month=month, session_count=len(ids), min_id=min(ids), max_id=max(ids))
+        return
+    entry.session_count += len(ids)
+    entry.min_id = min(ids + [entry.min_id])
+    entry.max_id = max(ids + [entry.max_id])
+    entry.save()
+
+
+def seal_month(month, report=None):
+    """把主库中该月开始的已结束会话移到分区文件，返回移动的条数"""
+    start, end = _month_start(month), _month_start(next_month(month))
+    in_use = DeviceStatus.select(DeviceStatus.current_session_id).where(
+        DeviceStatus.current_session_id.is_null(False))
+    conn = db.connection()
+    conn.execute('ATTACH DATABASE ? AS seal', (partition_path(month),))
+    moved = 0
+    try:
+        conn.execute(_TABLE_SQL.format(schema='seal.'))
+        for sql in _INDEX_SQL:
+            conn.execute(sql.format(schema='seal.'))
+        last_id = 0
+        while True:
+            ids = [row[0] for row in GameSession.select(GameSession.id).where(
+                GameSession.id > last_id, GameSession.start_time >= start, GameSession.start_time < end,
+                GameSession.end_time.is_null(False), GameSession.id.not_in(in_use)
+            ).order_by(GameSession.id).limit(SEAL_BATCH_SIZE).tuples()]
+            if not ids:
+                break
+            placeholders = ', '.join('?' * len(ids))
+            # 先提交分区文件，再在主库删除：崩溃时最多两边各有一份，重新封存时覆盖
+            with db.atomic():
+                db.execute_sql(f'INSERT OR REPLACE INTO seal.game_sessions ({_COLUMNS}) '
+                               f'SELECT {_COLUMNS} FROM main.game_sessions WHERE id IN ({placeholders})', ids)
+            with db.atomic():
+                db.execute_sql(f'DELETE FROM main.game_sessions WHERE id IN ({placeholders})', ids)
+                _catalog_add(month, ids)
+            moved += len(ids)
+            last_id = ids[-1]
+            time.sleep(SEAL_PAUSE_SECONDS)
+    finally:
+        conn.execute('DETACH DATABASE seal')
+    if report is not None:
+        report['sessions_sealed'] = report.get('sessions_sealed', 0) + moved
+    if moved:
+        logger.info(f"已封存 {month:%Y-%m} 的 {moved} 条会话到 {partition_path(month)}")
+    return moved
+
+
+def seal_due(now=None, report=None):
+    """封存已结束超过 PARTITION_SEAL_DAYS 天的月份，返回移动的会话数"""
+    if not enabled():
+        return 0
+    now = now or datetime.now(timezone.utc)
+    # 该月之前的月份都已到期
+    limit_month = month_of(now - timedelta(days=PARTITION_SEAL_DAYS))
+    first = GameSession.select(fn.MIN(GameSession.start_time)).where(
+        GameSession.end_time.is_null(False), GameSession.start_time < _month_start(limit_month)).scalar()
+    if first is None:
+        return 0
+    moved = 0
+    month = month_of(datetime.fromisoformat(first) if isinstance(first, str) else first)
+    while month < limit_month:
+        moved += seal_month(month, report)
+        month = next_month(month)
+    return moved
+
+
+# ---- 直接访问分区文件（不需要 ATTACH，可在主库事务中使用） ----
+def _open(month):
+    return sqlite3.connect(partition_path(month), timeout=db._timeout, isolation_level=None)
+
+
+def _month_containing(day):
+    if not enabled():
+        return None
+    month = month_of(day)
+    return month if SessionPartition.select().where(SessionPartition.month == month).exists() else None
+
+
+def device_has_sessions(device_id, day):
+    """该设备当天在已封存分区中是否有会话"""
+    month = _month_containing(day)
+    if month is None:
+        return False
+    day_start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    conn = _open(month)
+    try:
+        return conn.execute(
+            'SELECT 1 FROM game_sessions WHERE device_id = ? AND start_time >= ? AND start_time < ? LIMIT 1',
+            (device_id, str(day_start), str(day_start + timedelta(days=1)))).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def delete_session(session_id):
+    """从已封存分区中删除会话，返回 (device_id, start_time, duration_seconds)；不在分区中时返回 None"""
+    if not enabled():
+        return None
+    for entry in SessionPartition.select().where(
+            SessionPartition.min_id <= session_id, SessionPartition.max_id >= session_id):
+        month = _to_month(entry.month)
+        conn = _open(month)
+        try:
+            row = conn.execute('SELECT device_id, start_time, duration_seconds FROM game_sessions WHERE id = ?',
+                               (session_id,)).fetchone()
+            if row is None:
+                continue
+            conn.execute('DELETE FROM game_sessions WHERE id = ?', (session_id,))
+        finally:
+            conn.close()
+        SessionPartition.update(session_count=SessionPartition.session_count - 1).where(
+            SessionPartition.month == month).execute()
+        return row
+    return None
+
+
+def delete_device_sessions(device_ids):
+    """从全部已封存分区中删除这些设备的会话，返回删除的条数"""
+    if not enabled() or not device_ids:
+        return 0
+    placeholders = ', '.join('?' * len(device_ids))
+    total = 0
+    for month in sealed_months():
+        conn = _open(month)
+        try:
+            deleted = conn.execute(f'DELETE FROM game_sessions WHERE device_id IN ({placeholders})',
+                                   list(device_ids)).rowcount
+        finally:
+            conn.close()
+        if deleted:
+            SessionPartition.update(session_count=SessionPartition.session_count - deleted).where(
+                SessionPartition.month == month).execute()
+            total += deleted
+    return total
+
+
+# ---- 到期删除 ----
+def _remove_files(month):
+    for path in glob.glob(partition_path(month) + '*'):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"删除分区文件 {path} 失败: {e}")
+
+
+def drop_month(month, report=None):
+    """整月删除：先把按日汇总累加到 daily_usage_archive（与删除分区目录同一事务），再删除文件"""
+    from retention import merge_archive_groups, _to_utc
+    conn = _open(month)
+    try:
+        # 分区中只有已结束的会话
+        rows = conn.execute(
+            'SELECT date(start_time), device_id, COUNT(*), COUNT(duration_seconds), TOTAL(duration_seconds), '
+            'MAX(MAX(start_time, end_time)) FROM game_sessions GROUP BY 1, 2').fetchall()
+    finally:
+        conn.close()
+    names = dict((device_id, (key, name)) for device_id, key, name in Device.select(
+        Device.id, Device.device_key, Device.name).where(Device.id.in_({row[1] for row in rows})).tuples()) \
+        if rows else {}
+    groups = {}
+    for day, device_id, count, completed, seconds, last_activity in rows:
+        if device_id not in names:
+            continue
+        key = (datetime.strptime(day, '%Y-%m-%d').date(),) + names[device_id]
+        group = groups.setdefault(key, [0, 0, 0, _to_utc(last_activity)])
+        group[0] += count
+        group[1] += completed
+        group[2] += int(seconds)
+    with db.atomic():
+        upserts = merge_archive_groups(groups) if groups else 0
+        SessionPartition.delete().where(SessionPartition.month == month).execute()
+    _remove_files(month)
+    if report is not None:
+        report['partitions_dropped'] = report.get('partitions_dropped', []) + [f'{month:%Y-%m}']
+        report['archive_upserts'] = report.get('archive_upserts', 0) + upserts
+    logger.info(f"已删除过期分区 {month:%Y-%m}（{sum(row[2] for row in rows)} 条会话，归档汇总 {upserts} 行）")
+
+
+def drop_expired(cutoff_day, report=None):
+    """删除整月早于 cutoff_day 的分区，返回删除的月份数"""
+    if not enabled():
+        return 0
+    dropped = 0
+    for month in sealed_months():
+        if next_month(month) > cutoff_day:
+            break
+        drop_month(month, report)
+        dropped += 1
+    # 封存第一批时中断留下的文件（会话仍在主库中）
+    known = set(sealed_months())
+    for path in glob.glob(os.path.join(PARTITION_DIR, 'sessions-*.db')):
+        try:
+            month = datetime.strptime(os.path.basename(path)[9:16], '%Y-%m').date()
+        except ValueError:
+            continue
+        if month not in known and next_month(month) <= cutoff_day:
+            _remove_files(month)
+    return dropped
+
+
+def describe():
+    """各分区概况（GET /api/retention）"""
+    result = []
+    for entry in SessionPartition.select().order_by(SessionPartition.month):
+        month = _to_month(entry.month)
+        path = partition_path(month)
+        result.append({
+            'month': f'{month:%Y-%m}',
+            'sessions': entry.session_count,
+            'file_bytes': os.path.getsize(path) if os.path.exists(path) else None,
+        })
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description='按月分区的会话存储')
+    parser.add_argument('--seal', action='store_true', help='立即封存已到期的月份')
+    args = parser.parse_args()
+
+    if not enabled():
+        raise SystemExit('未设置 SESSION_PARTITION_DIR')
+    init_db()
+    if args.seal:
+        print(f"已封存 {seal_due()} 条会话")
+    print(json.dumps(describe(), ensure_ascii=False, indent=2))
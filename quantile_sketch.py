@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+会话时长分位数草图（DDSketch）
+
+统计接口原来只有总和与次数。为了给出每个设备 / 项目 / 校区的中位数、p90、p99 会话时长
+（发现异常设备、被滥用的设备），而又不在每次请求时对原始 duration_seconds 排序，
+每天每个设备维护一个 DDSketch：
+
+- 时长按对数分桶：桶 i 覆盖 (γ^(i-1), γ^i]，γ = (1+α)/(1-α)，α = RELATIVE_ACCURACY（1%）。
+  任意分位数的估计值与真实值的相对误差不超过 α；时长为 0 的会话单独计数
+- 草图只是“桶 -> 计数”，合并即逐桶相加，因此可以跨任意日期范围、任意分组合并；
+  删除会话时对应桶减一即可
+- 每天每个设备一行（session_length_sketches），草图序列化为 BLOB，通常几十字节；
+  同一行另存完成次数与总秒数，也是排行榜的按日预聚合（见 leaderboard.py）
+- 接入端在 end_session 中与会话更新同一事务写入；查询代价与 天数 × 设备数 成正比，
+  与会话条数无关
+- 草图与按日汇总一样不受会话保留期影响；首次建表时从现有会话重建，
+  也可以手动执行 `python quantile_sketch.py --rebuild`（只重建原始会话完整保留的日期）
+"""
+import math
+import struct
+from datetime import datetime, timedelta, timezone
+
+from peewee import fn
+
+import partitions
+from leaderboard import GROUPS, RegistryPlaces, group_key
+from models import db, Device, GameSession, DailyUsageArchive, SessionLengthSketch
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+# 版本, 零值计数, 总和, 最小值, 最大值；之后每个桶 (桶号, 计数)
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<BIdII')
+_BUCKET = struct.Struct('<hI')
+
+
+class DDSketch:
+    """可合并的相对误差分位数草图"""
+
+    __slots__ = ('buckets', 'zero_count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.zero_count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    @staticmethod
+    def _index(value):
+        return math.ceil(math.log(value) / _LOG_GAMMA)
+
+    @staticmethod
+    def _value(index):
+        # 桶内相对误差最小的代表值
+        return 2 * GAMMA ** index / (GAMMA + 1)
+
+    def add(self, value, count=1):
+        value = max(0, int(value))
+        if value == 0:
+            self.zero_count += count
+        else:
+            index = self._index(value)
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def remove(self, value):
+        """删除一个值（min / max 保持不变，只作为范围参考）"""
+        value = max(0, int(value))
+        if value == 0:
+            if self.zero_count:
+                self.zero_count -= 1
+                self.total -= value
+            return
+        index = self._index(value)
+        remaining = self.buckets.get(index, 0) - 1
+        if remaining < 0:
+            return
+        if remaining:
+            self.buckets[index] = remaining
+        else:
+            del self.buckets[index]
+        self.total -= value
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        count = self.count
+        if count == 0:
+            return None
+        rank = q * (count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = self._value(index)
+                # 估计值不超出实际观测到的范围
+                if self.min is not None:
+                    value = min(max(value, self.min), self.max)
+                return value
+        return self.max
+
+    def to_bytes(self):
+        parts = [_HEADER.pack(_FORMAT_VERSION, self.zero_count, self.total,
+                              self.min or 0, self.max or 0)]
+        parts.extend(_BUCKET.pack(index, count) for index, count in sorted(self.buckets.items()))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls()
+        version, sketch.zero_count, sketch.total, minimum, maximum = _HEADER.unpack_from(data)
+        if version != _FORMAT_VERSION:
+            raise ValueError(f"不支持的草图版本: {version}")
+        for offset in range(_HEADER.size, len(data), _BUCKET.size):
+            index, count = _BUCKET.unpack_from(data, offset)
+            sketch.buckets[index] = count
+        if sketch.count:
+            sketch.min, sketch.max = minimum, maximum
+        return sketch
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).date() if value.tzinfo else value.date()
+    return value
+
+
+def _update(device_id, day, change):
+    """读出 (day, device) 的草图，change(sketch) 修改后写回（调用方负责事务）"""
+    row = SessionLengthSketch.get_or_none(
+        (SessionLengthSketch.day == day) & (SessionLengthSketch.device == device_id))
+    sketch = DDSketch.from_bytes(bytes(row.sketch)) if row else DDSketch()
+    change(sketch)
+    SessionLengthSketch.insert(
+        day=day, device=device_id, count=sketch.count, total_seconds=round(sketch.total), sketch=sketch.to_bytes()
+    ).on_conflict(
+        conflict_target=[SessionLengthSketch.day, SessionLengthSketch.device],
+        preserve=[SessionLengthSketch.count, SessionLengthSketch.total_seconds, SessionLengthSketch.sketch]
+    ).execute()
+
+
+def record_duration(device_id, start_time, duration_seconds):
+    """会话结束时记录时长（按会话开始时间的 UTC 日期归档）。
+    应在更新会话的同一写事务中调用，保证多个接入进程读改写草图不会互相覆盖
+    """
+    _update(device_id, _to_date(start_time), lambda sketch: sketch.add(duration_seconds))
+
+
+def remove_duration(device_id, start_time, duration_seconds):
+    """删除已完成的会话时同步草图"""
+    _update(device_id, _to_date(start_time), lambda sketch: sketch.remove(duration_seconds))
+
+
+def _first_complete_day():
+    """原始会话完整保留的第一天：早于它的日期已被保留任务部分或全部清理，草图不能重建"""
+    firsts = [first for first in partitions.across(
+        None, None, lambda start, end: GameSession.select(fn.MIN(GameSession.start_time)).where(
+            *partitions.range_conditions(start, end)).scalar()) if first is not None]
+    if not firsts:
+        return None
+    first_day = min(_to_date(first) for first in firsts)
+    archived = DailyUsageArchive.select(fn.MAX(DailyUsageArchive.day)).scalar()
+    if archived is not None and _to_date(archived) >= first_day:
+        return _to_date(archived) + timedelta(days=1)
+    return first_day
+
+
+def rebuild(start_date=None, end_date=None):
+    """从原始会话重建草图（日期闭区间），返回写入的行数。
+    默认从原始会话完整保留的第一天开始，已清理日期的草图保持不变
+    """
+    start_date = start_date or _first_complete_day()
+    if start_date is None:
+        return 0
+    range_start = datetime.combine(start_date, datetime.min.time(), tzinfo=timezone.utc)
+    range_end = datetime.combine(
+        end_date + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc) if end_date else None
+
+    sketches = {}
+
+    def collect(start, end):
+        for device_id, start_time, duration in GameSession.select(
+                GameSession.device, GameSession.start_time, GameSession.duration_seconds
+        ).where(GameSession.duration_seconds.is_null(False),
+                *partitions.range_conditions(start, end)).tuples().iterator():
+            key = (_to_date(start_time), device_id)
+            sketch = sketches.get(key)
+            if sketch is None:
+                sketch = sketches[key] = DDSketch()
+            sketch.add(duration)
+    partitions.across(range_start, range_end, collect)
+
+    with db.atomic():
+        delete = SessionLengthSketch.delete().where(SessionLengthSketch.day >= start_date)
+        if end_date:
+            delete = delete.where(SessionLengthSketch.day <= end_date)
+        delete.execute()
+        rows = [{'day': day, 'device': device_id, 'count': sketch.count,
+                 'total_seconds': round(sketch.total), 'sketch': sketch.to_bytes()}
+                for (day, device_id), sketch in sketches.items()]
+        for i in range(0, len(rows), 100):
+            SessionLengthSketch.insert_many(rows[i:i + 100]).execute()
+    return len(rows)
+
+
+def _add_total_column():
+    """旧版草图表增加 total_seconds 列，并从草图中的总和回填"""
+    with db.atomic():
+        db.execute_sql('ALTER TABLE session_length_sketches ADD COLUMN total_seconds INTEGER NOT NULL DEFAULT 0')
+        rows = list(SessionLengthSketch.select(SessionLengthSketch.id, SessionLengthSketch.sketch).tuples())
+        for row_id, blob in rows:
+            SessionLengthSketch.update(total_seconds=round(DDSketch.from_bytes(bytes(blob)).total)).where(
+                SessionLengthSketch.id == row_id).execute()
+    return len(rows)
+
+
+def ensure_sketch_table():
+    """创建草图表；首次创建时从现有会话重建"""
+    exists = SessionLengthSketch.table_exists()
+    db.create_tables([SessionLengthSketch], safe=True)
+    if not exists:
+        rebuild()
+    elif 'total_seconds' not in {column.name for column in db.get_columns('session_length_sketches')}:
+        _add_total_column()
+
+
+def compute_percentiles(group, start_date, end_date, quantiles=DEFAULT_QUANTILES, key=None):
+    """合并日期闭区间内的草图，返回各实体及全部会话的时长分位数（/api/percentiles）"""
+    if group not in GROUPS:
+        raise ValueError(f"group 必须是 {'/'.join(GROUPS)}")
+    for q in quantiles:
+        if not 0 <= q <= 1:
+            raise ValueError('分位数必须在 0 到 1 之间')
+    if end_date < start_date:
+        raise ValueError('end_date 不能早于 start_date')
+
+    registry = RegistryPlaces()
+    devices = {device_id: (device_key, name, registry_id) for device_id, device_key, name, registry_id
+               in Device.select(Device.id, Device.device_key, Device.name, Device.registry_id).tuples()}
+
+    merged = {}
+    names = {}
+    overall = DDSketch()
+    for device_id, blob in SessionLengthSketch.select(
+            SessionLengthSketch.device, SessionLengthSketch.sketch
+    ).where(SessionLengthSketch.day.between(start_date, end_date)).tuples():
+        device = devices.get(device_id)
+        if device is None:
+            continue
+        sketch = DDSketch.from_bytes(bytes(blob))
+        overall.merge(sketch)
+        player_id, player_name, registry_id = device
+        entity = group_key(group, player_id, registry.place(player_id, player_name, registry_id))
+        if entity is None or (key is not None and entity != key):
+            continue
+        if entity in merged:
+            merged[entity].merge(sketch)
+        else:
+            merged[entity] = sketch
+        if group == 'device':
+            names[entity] = player_name
+
+    def describe(sketch):
+        count = sketch.count
+        return {
+            'count': count,
+            'mean_seconds': round(sketch.total / count, 1) if count else None,
+            'min_seconds': sketch.min,
+            'max_seconds': sketch.max,
+            'percentiles': {
+                f"p{round(q * 100, 1):g}": (round(value, 1) if value is not None else None)
+                for q, value in ((q, sketch.quantile(q)) for q in quantiles)
+            },
+        }
+
+    items = []
+    for entity, sketch in merged.items():
+        item = {'key': entity, 'name': names.get(entity, entity)}
+        item.update(describe(sketch))
+        items.append(item)
+    items.sort(key=lambda item: (-item['count'], str(item['key'])))
+
+    return {
+        'group': group,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'relative_accuracy': RELATIVE_ACCURACY,
+        'overall': describe(overall),
+        'items': items,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description='会话时长分位数草图')
+    parser.add_argument('--rebuild', action='store_true', help='从原始会话重建全部草图')
+    args = parser.parse_args()
+
+    init_db()
+    if args.rebuild:
+        print(f"已重建 {rebuild()} 个草图")
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+设备注册表批量导入 / 导出
+
+- 导入：CSV 或 JSON 列表，每行 ble_id / campus_name / project_name（必填）与 status / remark（可选）。
+  BLE ID 统一经 normalize_ble_id 规范化；整批在一个事务内 upsert（已存在则更新，否则插入），
+  逐行报告错误。默认跳过错误行、写入其余行；all_or_nothing=True 时有任何错误则整批不写入
+- 导出：按 ble_id 顺序用游标逐行读取，边读边输出 CSV 或 JSON，导出结果可直接再导入
+
+CSV 表头支持英文字段名，也支持“BLE ID / 校区 / 项目 / 状态 / 备注”。
+
+命令行：
+    python registry_io.py import devices.csv [--dry-run] [--all-or-nothing]
+    python registry_io.py export [--format csv|json] [-o devices.csv]
+"""
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+from models import db, DeviceRegistry, normalize_ble_id
+
+FIELDS = ('ble_id', 'campus_name', 'project_name', 'status', 'remark')
+STATUSES = ('active', 'disabled')
+
+# CSV 表头别名（后台导出给运营同事用 Excel 编辑时常用中文表头）
+HEADER_ALIASES = {
+    'ble id': 'ble_id', 'bleid': 'ble_id', 'ble': 'ble_id', '蓝牙id': 'ble_id',
+    '校区': 'campus_name', 'campus': 'campus_name',
+    '项目': 'project_name', 'project': 'project_name',
+    '状态': 'status',
+    '备注': 'remark',
+}
+
+# SQLite 单条语句的参数个数有上限，IN 查询与批量插入分块执行
+_CHUNK = 500
+_INSERT_CHUNK = 100
+_EXPORT_FLUSH_ROWS = 200
+
+
+class RegistryImportError(ValueError):
+    """导入数据整体无法解析（如不是 CSV/JSON 列表、缺少必填列）"""
+
+
+def _normalize_header(name):
+    key = (name or '').strip().lower()
+    return HEADER_ALIASES.get(key, key)
+
+
+def parse_csv(text):
+    """解析 CSV 文本，返回 [(行号, dict)]，行号与表格软件中看到的一致（表头为第 1 行）"""
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    reader = csv.reader(io.StringIO(text))
+    try:
+        header = [_normalize_header(h) for h in next(reader)]
+    except StopIteration:
+        return []
+    missing = [f for f in ('ble_id', 'campus_name', 'project_name') if f not in header]
+    if missing:
+        raise RegistryImportError(f"CSV 缺少必填列: {', '.join(missing)}")
+    rows = []
+    for line_no, values in enumerate(reader, start=2):
+        if not any(v.strip() for v in values):
+            continue
+        rows.append((line_no, {
+            name: value for name, value in zip(header, values) if name in FIELDS
+        }))
+    return rows
+
+
+def parse_records(records):
+    """解析 JSON 列表（或 {"items": [...]}），返回 [(序号, dict)]，序号从 1 开始"""
+    if isinstance(records, dict):
+        records = records.get('items')
+    if not isinstance(records, list):
+        raise RegistryImportError("JSON 数据必须是列表或 {\"items\": [...]}")
+    return [(index, record if isinstance(record, dict) else {'_invalid': record})
+            for index, record in enumerate(records, start=1)]
+
+
+def _clean(value):
+    if value is None:
+        return None
+    return str(value).strip()
+
+
+def _validate(record):
+    """校验并规范化一行，返回 (规范化后的值, 错误信息)"""
+    if '_invalid' in record:
+        return None, '每一项必须是对象'
+    ble_id = normalize_ble_id(_clean(record.get('ble_id')) or '')
+    campus_name = _clean(record.get('campus_name'))
+    project_name = _clean(record.get('project_name'))
+    if not ble_id:
+        return None, 'ble_id 为空或无法规范化'
+    if not campus_name or not project_name:
+        return None, 'campus_name/project_name 不能为空'
+    values = {'ble_id': ble_id, 'campus_name': campus_name, 'project_name': project_name}
+    status = _clean(record.get('status'))
+    if status:
+        if status not in STATUSES:
+            return None, f"status 必须是 {'/'.join(STATUSES)}"
+        values['status'] = status
+    if 'remark' in record:
+        values['remark'] = _clean(record.get('remark')) or None
+    return values, None
+
+
+def import_registry(rows, dry_run=False, all_or_nothing=False):
+    """批量 upsert，rows 为 parse_csv / parse_records 的结果，返回导入报告"""
+    report = {
+        'total': len(rows),
+        'inserted': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'failed': 0,
+        'errors': [],
+        'dry_run': dry_run,
+        'committed': False,
+    }
+
+    valid = {}
+    for row_no, record in rows:
+        values, error = _validate(record)
+        if error is None and values['ble_id'] in valid:
+            error = f"与第 {valid[values['ble_id']][0]} 行的 BLE ID 重复"
+        if error:
+            report['failed'] += 1
+            report['errors'].append({'row': row_no, 'ble_id': record.get('ble_id'), 'error': error})
+            continue
+        valid[values['ble_id']] = (row_no, values)
+
+    if dry_run or (all_or_nothing and report['errors']):
+        # 只校验不写入：仍然统计将会插入/更新的行数
+        existing = _load_existing(list(valid))
+        for ble_id, (_, values) in valid.items():
+            item = existing.get(ble_id)
+            if item is None:
+                report['inserted'] += 1
+            elif _apply(item, values):
+                report['updated'] += 1
+            else:
+                report['unchanged'] += 1
+        return report
+
+    now_utc = datetime.now(timezone.utc)
+    with db.atomic():
+        existing = _load_existing(list(valid))
+        new_rows = []
+        for ble_id, (_, values) in valid.items():
+            item = existing.get(ble_id)
+            if item is None:
+                new_rows.append({
+                    'ble_id': ble_id,
+                    'campus_name': values['campus_name'],
+                    'project_name': values['project_name'],
+                    'status': values.get('status', 'active'),
+                    'remark': values.get('remark'),
+                    'created_at': now_utc,
+                    'updated_at': now_utc,
+                })
+                continue
+            if _apply(item, values):
+                item.updated_at = now_utc
+                item.save()
+                report['updated'] += 1
+            else:
+                report['unchanged'] += 1
+        for i in range(0, len(new_rows), _INSERT_CHUNK):
+            DeviceRegistry.insert_many(new_rows[i:i + _INSERT_CHUNK]).execute()
+        report['inserted'] = len(new_rows)
+    report['committed'] = True
+    return report
+
+
+def _load_existing(ble_ids):
+    existing = {}
+    for i in range(0, len(ble_ids), _CHUNK):
+        for item in DeviceRegistry.select().where(DeviceRegistry.ble_id.in_(ble_ids[i:i + _CHUNK])):
+            existing[item.ble_id] = item
+    return existing
+
+
+def _apply(item, values):
+    """把导入值写到已有记录上，返回是否有变化（只在内存中修改）"""
+    changed = False
+    for field in ('campus_name', 'project_name', 'status', 'remark'):
+        if field in values and getattr(item, field) != values[field]:
+            setattr(item, field, values[field])
+            changed = True
+    return changed
+
+
+def _export_rows():
+    query = DeviceRegistry.select(
+        DeviceRegistry.ble_id, DeviceRegistry.campus_name, DeviceRegistry.project_name,
+        DeviceRegistry.status, DeviceRegistry.remark
+    ).order_by(DeviceRegistry.ble_id).tuples()
+    # iterator() 不缓存结果集，内存占用与注册表大小无关
+    return query.iterator()
+
+
+def iter_export(fmt='csv'):
+    """逐块生成导出内容（str），使用独立连接，适合流式响应"""
+    with db.connection_context():
+        if fmt == 'json':
+            yield '['
+            first = True
+            for row in _export_rows():
+                item = json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False)
+                yield item if first else ',\n' + item
+                first = False
+            yield ']\n'
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # 带 BOM，Excel 打开中文不乱码
+        buffer.write('\ufeff')
+        writer.writerow(FIELDS)
+        for count, row in enumerate(_export_rows(), start=1):
+            writer.writerow(['' if value is None else value for value in row])
+            if count % _EXPORT_FLUSH_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description='设备注册表批量导入 / 导出')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_import = sub.add_parser('import', help='从 CSV / JSON 文件导入')
+    p_import.add_argument('file')
+    p_import.add_argument('--dry-run', action='store_true', help='只校验，不写入')
+    p_import.add_argument('--all-or-nothing', action='store_true', help='有任何错误行时整批不写入')
+    p_export = sub.add_parser('export', help='导出到文件或标准输出')
+    p_export.add_argument('--format', choices=('csv', 'json'), default='csv')
+    p_export.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        init_db()
+        with open(args.file, encoding='utf-8-sig') as f:
+            content = f.read()
+        try:
+            if args.file.lower().endswith('.json'):
+                rows = parse_records(json.loads(content))
+            else:
+                rows = parse_csv(content)
+        except (RegistryImportError, json.JSONDecodeError) as e:
+            print(f"❌ 无法解析 {args.file}: {e}")
+            sys.exit(1)
+        result = import_registry(rows, dry_run=args.dry_run, all_or_nothing=args.all_or_nothing)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        sys.exit(1 if result['errors'] else 0)
+    else:
+        # 导出可能写到标准输出，不调用会打印提示的 init_db()
+        db.create_tables([DeviceRegistry], safe=True)
+        out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+        try:
+            for chunk in iter_export(args.format):
+                out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
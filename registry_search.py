@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+设备注册表搜索索引
+
+- device_registry_fts：FTS5 trigram 外部内容表，索引 ble_id / campus_name / project_name / remark，
+  由触发器与 device_registry 保持同步（ORM、批量导入、其他进程的写入都会覆盖到）
+- 关键词不少于 3 个字符时走 trigram 索引（子串 / 前缀匹配，大小写不敏感，支持中文）；
+  trigram 无法索引更短的关键词（如“娃娃”），此时回退到 LIKE（注册表规模很小，代价可接受）
+- 列表按 (updated_at DESC, id DESC) 排序，配合索引做 keyset 分页，翻页不再 OFFSET 扫描
+- SQLite 未编译 FTS5 / trigram（低于 3.34）时自动回退到 LIKE
+"""
+import base64
+import json
+import logging
+
+from peewee import SQL
+
+from models import db, DeviceRegistry, normalize_ble_id
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'device_registry_fts'
+MIN_TRIGRAM_LENGTH = 3
+
+_fts_available = None
+
+_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        ble_id, campus_name, project_name, remark,
+        content='device_registry', content_rowid='id', tokenize='trigram')""",
+    f"""CREATE TRIGGER IF NOT EXISTS device_registry_fts_ai AFTER INSERT ON device_registry BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, ble_id, campus_name, project_name, remark)
+        VALUES (new.id, new.ble_id, new.campus_name, new.project_name, new.remark);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS device_registry_fts_ad AFTER DELETE ON device_registry BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, ble_id, campus_name, project_name, remark)
+        VALUES ('delete', old.id, old.ble_id, old.campus_name, old.project_name, old.remark);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS device_registry_fts_au AFTER UPDATE ON device_registry BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, ble_id, campus_name, project_name, remark)
+        VALUES ('delete', old.id, old.ble_id, old.campus_name, old.project_name, old.remark);
+        INSERT INTO {FTS_TABLE}(rowid, ble_id, campus_name, project_name, remark)
+        VALUES (new.id, new.ble_id, new.campus_name, new.project_name, new.remark);
+    END""",
+]
+
+
+def ensure_search_index():
+    """创建 FTS 表与同步触发器（首次创建时从 device_registry 重建索引）"""
+    global _fts_available
+    try:
+        exists = db.execute_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)).fetchone()
+        with db.atomic():
+            for statement in _DDL:
+                db.execute_sql(statement)
+            if not exists:
+                db.execute_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        _fts_available = True
+    except Exception as e:
+        # 没有 FTS5 或 trigram 分词器：搜索回退到 LIKE
+        _fts_available = False
+        logger.warning(f"注册表全文索引不可用，搜索回退到 LIKE: {e}")
+    return _fts_available
+
+
+def fts_available():
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = db.execute_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)).fetchone() is not None
+    return _fts_available
+
+
+def _phrase(keyword):
+    # FTS5 短语：整体作为子串匹配，避免关键词中的运算符被解析
+    return '"' + keyword.replace('"', '""') + '"'
+
+
+def search_condition(keyword):
+    """返回关键词搜索的 where 条件；关键词为空返回 None"""
+    keyword = (keyword or '').strip()
+    if not keyword:
+        return None
+    # 输入 "MicroBlocks ABC" 时同时按规范化后的 BLE ID 匹配
+    terms = [keyword]
+    if keyword.lower().startswith('microblocks'):
+        norm = normalize_ble_id(keyword)
+        if norm and norm != keyword:
+            terms.append(norm)
+
+    condition = None
+    for term in terms:
+        if fts_available() and len(term) >= MIN_TRIGRAM_LENGTH:
+            matched = DeviceRegistry.id.in_(_fts_rowids(term))
+        else:
+            matched = (DeviceRegistry.ble_id.contains(term) |
+                       DeviceRegistry.campus_name.contains(term) |
+                       DeviceRegistry.project_name.contains(term) |
+                       DeviceRegistry.remark.contains(term))
+        condition = matched if condition is None else (condition | matched)
+    return condition
+
+
+def _fts_rowids(term):
+    return SQL(f"(SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ?)", [_phrase(term)])
+
+
+def encode_cursor(item):
+    updated_at = item.updated_at
+    if not isinstance(updated_at, str):
+        # 与 sqlite3 写入 datetime 时的格式一致，保证字符串比较顺序正确
+        updated_at = updated_at.isoformat(' ')
+    raw = json.dumps([updated_at, item.id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    updated_at, item_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    return updated_at, int(item_id)
+
+
+def search_registry(keyword=None, status=None, cursor=None, per_page=20, page=None):
+    """搜索注册表，返回 (items, total, next_cursor)
+
+    cursor 为上一页返回的 next_cursor（keyset 分页）；兼容旧参数 page（OFFSET 分页）
+    """
+    conditions = []
+    condition = search_condition(keyword)
+    if condition is not None:
+        conditions.append(condition)
+    if status:
+        conditions.append(DeviceRegistry.status == status)
+
+    base = DeviceRegistry.select()
+    if conditions:
+        base = base.where(*conditions)
+    total = base.count()
+
+    query = base.order_by(DeviceRegistry.updated_at.desc(), DeviceRegistry.id.desc())
+    if cursor:
+        updated_at, item_id = decode_cursor(cursor)
+        query = query.where(
+            (DeviceRegistry.updated_at < updated_at) |
+            ((DeviceRegistry.updated_at == updated_at) & (DeviceRegistry.id < item_id)))
+    elif page and page > 1:
+        query = query.offset((page - 1) * per_page)
+
+    # 多取一条判断是否还有下一页
+    items = list(query.limit(per_page + 1))
+    next_cursor = encode_cursor(items[per_page - 1]) if len(items) > per_page else None
+    return items[:per_page], total, next_cursor
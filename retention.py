@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+数据保留与压缩
+
+策略（环境变量）：
+删除是永久的，默认不删除任何数据，需要显式配置才会清理：
+- RETENTION_SESSION_DAYS：原始会话保留天数，默认 0（永久保留）。
+  超期会话删除前按 (日期, 设备) 累加到 daily_usage_archive，汇总数据永久保留；
+  分钟活跃位图（device_minute_activity）同期删除。被删除日期的会话列表与时间点查询（/api/as-of）不再可用
+- RETENTION_DEVICE_STATUS_DAYS：device_status 中超过该天数没有心跳的设备行被清理，默认 0（不清理）
+- RETENTION_BATCH_SIZE：每个事务处理的行数，默认 500。每批一个短事务，批间暂停
+  RETENTION_PAUSE_SECONDS（默认 0.05 秒），写锁不会被长时间占用，接入进程只需短暂等待
+- RETENTION_VACUUM_STEP_PAGES：每次 incremental_vacuum 归还的页数，默认 256
+- RETENTION_INTERVAL_SECONDS：后台定时执行间隔，默认 86400；0 表示不自动执行。
+  以上清理都未配置且未启用分区时不启动定时任务
+
+启用按月分区（SESSION_PARTITION_DIR，见 partitions.py）时，每次执行还会封存到期的月份，
+并把整月超期的分区归档后直接删除文件（分区按整月到期，主库中的会话仍按天清理）。
+
+每次执行生成一份报告（删除行数、归还页数与字节数、文件大小变化），
+写入日志并可通过 GET /api/retention 查看。
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import metrics
+import partitions
+from models import db, env_number, Device, GameSession, DeviceStatus, DailyUsageArchive, DeviceMinuteActivity
+
+logger = logging.getLogger(__name__)
+
+
+SESSION_RETENTION_DAYS = env_number('RETENTION_SESSION_DAYS', 0)
+DEVICE_STATUS_RETENTION_DAYS = env_number('RETENTION_DEVICE_STATUS_DAYS', 0)
+BATCH_SIZE = max(1, env_number('RETENTION_BATCH_SIZE', 500))
+PAUSE_SECONDS = env_number('RETENTION_PAUSE_SECONDS', 0.05, float)
+VACUUM_STEP_PAGES = max(1, env_number('RETENTION_VACUUM_STEP_PAGES', 256))
+INTERVAL_SECONDS = env_number('RETENTION_INTERVAL_SECONDS', 86400)
+# fly.io 机器空闲时会自动停止，首次执行不等满一个周期
+INITIAL_DELAY_SECONDS = env_number('RETENTION_INITIAL_DELAY_SECONDS', 120)
+
+RETENTION_ROWS_DELETED = metrics.REGISTRY.counter(
+    'retention_rows_deleted_total', '保留策略删除的行数', ('table',))
+RETENTION_BYTES_RECLAIMED = metrics.REGISTRY.counter(
+    'retention_bytes_reclaimed_total', 'incremental_vacuum 归还的字节数')
+RETENTION_RUN_SECONDS = metrics.REGISTRY.histogram(
+    'retention_run_seconds', '保留任务单次执行耗时（秒）',
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+
+_run_lock = threading.Lock()
+last_report = None
+
+
+def current_policy():
+    return {
+        'session_days': SESSION_RETENTION_DAYS,
+        'device_status_days': DEVICE_STATUS_RETENTION_DAYS,
+        'batch_size': BATCH_SIZE,
+        'pause_seconds': PAUSE_SECONDS,
+        'vacuum_step_pages': VACUUM_STEP_PAGES,
+        'interval_seconds': INTERVAL_SECONDS,
+    }
+
+
+def configured():
+    """是否配置了需要定时执行的工作（清理或分区封存）"""
+    return SESSION_RETENTION_DAYS > 0 or DEVICE_STATUS_RETENTION_DAYS > 0 or partitions.enabled()
+
+
+def is_running():
+    return _run_lock.locked()
+
+
+def _to_utc(value):
+    """数据库取出的时间（datetime 或 ISO 字符串）规范为 UTC datetime"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value
+
+
+def _pragma(name):
+    return db.execute_sql(f'PRAGMA {name}').fetchone()[0]
+
+
+def _db_file_bytes():
+    total = 0
+    for suffix in ('', '-wal'):
+        try:
+            total += os.path.getsize(db.database + suffix)
+        except OSError:
+            pass
+    return total
+
+
+def _archive_sessions(rows):
+    """把一批会话累加到按日汇总表（调用方负责事务）"""
+    groups = {}
+    for session_id, player_id, player_name, start_time, end_time, duration in rows:
+        start_time = _to_utc(start_time)
+        end_time = _to_utc(end_time)
+        last_activity = max(start_time, end_time) if end_time else start_time
+        key = (start_time.date(), player_id, player_name)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0, 0, last_activity]
+        group[0] += 1
+        if duration is not None:
+            group[1] += 1
+            group[2] += duration
+        if last_activity > group[3]:
+            group[3] = last_activity
+    return merge_archive_groups(groups)
+
+
+def merge_archive_groups(groups):
+    """把 {(日期, player_id, player_name): [会话数, 完成数, 总秒数, 最后活动时间]} 累加到按日汇总表
+    （调用方负责事务），返回更新的汇总行数
+    """
+    # 一次查出本批涉及的已有汇总行，新行批量插入
+    days = {key[0] for key in groups}
+    player_ids = {key[1] for key in groups}
+    existing = {
+        (_to_date(row.day), row.player_id, row.player_name): row
+        for row in DailyUsageArchive.select().where(
+            DailyUsageArchive.day.in_(list(days)),
+            DailyUsageArchive.player_id.in_(list(player_ids)))
+    }
+    new_rows = []
+    for key, (count, completed, seconds, last_activity) in groups.items():
+        archive = existing.get(key)
+        if archive is None:
+            new_rows.append({
+                'day': key[0], 'player_id': key[1], 'player_name': key[2],
+                'session_count': count, 'completed_sessions': completed,
+                'total_seconds': seconds, 'last_activity': last_activity})
+            continue
+        archive.session_count += count
+        archive.completed_sessions += completed
+        archive.total_seconds += seconds
+        previous = _to_utc(archive.last_activity)
+        if previous is None or last_activity > previous:
+            archive.last_activity = last_activity
+        archive.save()
+    for i in range(0, len(new_rows), 100):
+        DailyUsageArchive.insert_many(new_rows[i:i + 100]).execute()
+    return len(groups)
+
+
+def prune_sessions(cutoff, report):
+    """分批归档并删除 start_time 早于 cutoff 的会话。
+    设备当前会话（device_status.current_session_id）不删除
+    """
+    in_use = DeviceStatus.select(DeviceStatus.current_session_id).where(
+        DeviceStatus.current_session_id.is_null(False))
+    last_id = 0
+    while True:
+        with db.atomic():
+            rows = list(GameSession.select(
+                GameSession.id, Device.device_key, Device.name,
+                GameSession.start_time, GameSession.end_time, GameSession.duration_seconds
+            ).join(Device).where(
+                GameSession.id > last_id,
+                GameSession.start_time < cutoff,
+                GameSession.id.not_in(in_use)
+            ).order_by(GameSession.id).limit(BATCH_SIZE).tuples())
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            report['archive_upserts'] += _archive_sessions(rows)
+            deleted = GameSession.delete().where(GameSession.id.in_(ids)).execute()
+        last_id = ids[-1]
+        report['sessions_deleted'] += deleted
+        report['chunks'] += 1
+        RETENTION_ROWS_DELETED.inc('game_sessions', amount=deleted)
+        time.sleep(PAUSE_SECONDS)
+
+
+def prune_minute_activity(cutoff_day, report):
+    """分批删除早于 cutoff_day 的分钟活跃位图（与原始会话同一保留期）"""
+    while True:
+        with db.atomic():
+            ids = [row[0] for row in DeviceMinuteActivity.select(DeviceMinuteActivity.id).where(
+                DeviceMinuteActivity.day < cutoff_day).order_by(DeviceMinuteActivity.id).limit(BATCH_SIZE).tuples()]
+            if not ids:
+                break
+            deleted = DeviceMinuteActivity.delete().where(DeviceMinuteActivity.id.in_(ids)).execute()
+        report['minute_activity_deleted'] += deleted
+        report['chunks'] += 1
+        RETENTION_ROWS_DELETED.inc('device_minute_activity', amount=deleted)
+        time.sleep(PAUSE_SECONDS)
+
+
+def prune_device_status(cutoff, report):
+    """分批删除长时间没有心跳的设备状态行"""
+    stale = (DeviceStatus.last_seen < cutoff) | (
+        DeviceStatus.last_seen.is_null() & (DeviceStatus.updated_at < cutoff))
+    while True:
+        with db.atomic():
+            ids = [row[0] for row in DeviceStatus.select(DeviceStatus.id).where(stale)
+                   .order_by(DeviceStatus.id).limit(BATCH_SIZE).tuples()]
+            if not ids:
+                break
+            deleted = DeviceStatus.delete().where(DeviceStatus.id.in_(ids)).execute()
+        report['device_status_deleted'] += deleted
+        report['chunks'] += 1
+        RETENTION_ROWS_DELETED.inc('device_status', amount=deleted)
+        time.sleep(PAUSE_SECONDS)
+
+
+def incremental_vacuum(report):
+    """分步把空闲页归还给文件系统（需要 auto_vacuum=incremental）"""
+    if _pragma('auto_vacuum') != 2:
+        report['vacuum'] = 'skipped: auto_vacuum 未开启（执行 python retention.py --enable-incremental-vacuum）'
+        return
+    page_size = _pragma('page_size')
+    conn = db.connection()
+    while _pragma('freelist_count') > 0:
+        before = _pragma('page_count')
+        # executescript 会把 PRAGMA 执行到底；普通 execute 只归还一页
+        conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})')
+        freed = before - _pragma('page_count')
+        if freed <= 0:
+            break
+        report['pages_freed'] += freed
+        RETENTION_BYTES_RECLAIMED.inc(amount=freed * page_size)
+        time.sleep(PAUSE_SECONDS)
+    report['bytes_reclaimed'] = report['pages_freed'] * page_size
+    report['vacuum'] = 'incremental'
+    try:
+        # 把 WAL 中的页写回并截断，文件大小才会真正变小；有读者时失败也无妨
+        db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    except Exception as e:
+        logger.debug(f"WAL checkpoint 失败: {e}")
+
+
+def run_retention(now=None):
+    """执行一次保留任务，返回报告；已有任务在运行时返回 None"""
+    global last_report
+    if not _run_lock.acquire(blocking=False):
+        return None
+    try:
+        now = now or datetime.now(timezone.utc)
+        started = time.perf_counter()
+        report = {
+            'started_at': now.isoformat().replace('+00:00', 'Z'),
+            'policy': current_policy(),
+            'sessions_deleted': 0,
+            'archive_upserts': 0,
+            'device_status_deleted': 0,
+            'minute_activity_deleted': 0,
+            'chunks': 0,
+            'pages_freed': 0,
+            'bytes_reclaimed': 0,
+            'file_bytes_before': _db_file_bytes(),
+        }
+        with db.connection_context():
+            if SESSION_RETENTION_DAYS > 0:
+                # 按整天截断，保证被归档的日期不会同时残留在原始表中
+                cutoff_day = now.date() - timedelta(days=SESSION_RETENTION_DAYS)
+                cutoff = datetime.combine(cutoff_day, datetime.min.time(), tzinfo=timezone.utc)
+                report['session_cutoff'] = cutoff.isoformat().replace('+00:00', 'Z')
+                prune_sessions(cutoff, report)
+                prune_minute_activity(cutoff_day, report)
+                # 已封存的整月分区直接归档并删除文件
+                partitions.drop_expired(cutoff_day, report)
+            partitions.seal_due(now, report)
+            if DEVICE_STATUS_RETENTION_DAYS > 0:
+                prune_device_status(now - timedelta(days=DEVICE_STATUS_RETENTION_DAYS), report)
+            incremental_vacuum(report)
+        report['file_bytes_after'] = _db_file_bytes()
+        report['duration_seconds'] = round(time.perf_counter() - started, 3)
+        RETENTION_RUN_SECONDS.observe(report['duration_seconds'])
+        logger.info(
+            f"🧹 数据保留任务完成: 删除会话 {report['sessions_deleted']} 行"
+            f"（归档汇总 {report['archive_upserts']} 次），删除设备状态 {report['device_status_deleted']} 行，"
+            f"归还 {report['bytes_reclaimed']} 字节，文件 {report['file_bytes_before']} -> {report['file_bytes_after']} 字节，"
+            f"耗时 {report['duration_seconds']} 秒")
+        last_report = report
+        return report
+    finally:
+        _run_lock.release()
+
+
+def enable_incremental_vacuum():
+    """把已有数据库转换为 auto_vacuum=incremental（执行一次完整 VACUUM，期间独占数据库）"""
+    with db.connection_context():
+        if _pragma('auto_vacuum') == 2:
+            return False
+        db.execute_sql('PRAGMA auto_vacuum = incremental')
+        db.execute_sql('VACUUM')
+        return _pragma('auto_vacuum') == 2
+
+
+def start_retention_scheduler():
+    """后台定时执行保留任务"""
+    if INTERVAL_SECONDS <= 0:
+        logger.info("数据保留任务未启用（RETENTION_INTERVAL_SECONDS=0）")
+        return None
+    if not configured():
+        logger.info("数据保留任务未启用（未设置 RETENTION_SESSION_DAYS / RETENTION_DEVICE_STATUS_DAYS，数据永久保留）")
+        return None
+
+    def loop():
+        time.sleep(INITIAL_DELAY_SECONDS)
+        while True:
+            try:
+                run_retention()
+            except Exception as e:
+                logger.error(f"数据保留任务失败: {e}")
+            time.sleep(INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=loop, name='retention', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from log_utils import setup_logging
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description='数据保留与压缩')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='转换已有数据库为 auto_vacuum=incremental（完整 VACUUM，需停机执行）')
+    args = parser.parse_args()
+
+    setup_logging()
+    init_db()
+    if args.enable_incremental_vacuum:
+        print('已转换' if enable_incremental_vacuum() else '无需转换（已是 incremental）')
+    else:
+        print(json.dumps(run_retention(), ensure_ascii=False, indent=2))
@@ -2,52 +2,167 @@
 # -*- coding: utf-8 -*-
 """
 游戏设备使用时长统计系统启动脚本
+
+快速启动（FAST_START=1 或 --fast-start，仅生产模式）：fly.io 上机器空闲即停止，
+每次唤醒都是冷启动。快速启动时先监听端口（/healthz 立即可用，其他请求排队等待就绪），
+再在后台依次初始化数据库、载入启动快照（见 warm_snapshot.py）、导入 Flask 应用；
+MQTT 连接与这些步骤并行建立，数据库就绪后才开始处理消息。
 """
 
+import os
+import sys
 import threading
 import time
-from models import init_db
-from mqtt_client import GameUsageTracker
-from api import app, update_queue
 
-def start_mqtt_client():
-    """启动 MQTT 客户端"""
+
+def start_mqtt_client(update_queue=None, before_loop=None):
+    """启动 MQTT 客户端（INGEST_WORKERS > 1 时使用多进程接入）
+
+    before_loop: 开始处理消息前调用一次；返回值不为 None 时作为实时更新队列
+    （快速启动时 API 在这之后才加载完成，由等待数据库就绪的同一个回调交回它的队列）
+    """
+    workers = int(os.environ.get('INGEST_WORKERS', 1))
+    if workers > 1:
+        from ingest_workers import run_ingest_workers
+        if before_loop is not None:
+            queue = before_loop()
+            if queue is not None:
+                update_queue = queue
+        print(f"启动多进程 MQTT 接入，工作进程数: {workers}")
+        run_ingest_workers(workers, update_queue=update_queue)
+        return
+    from ingest_journal import journal_from_env
+    from mqtt_client import GameUsageTracker
     print("启动 MQTT 客户端...")
-    tracker = GameUsageTracker(update_queue=update_queue)
-    tracker.start()
+    # INGEST_JOURNAL=1：消息先追加到本地日志，后台批量写库（见 ingest_journal.py）
+    tracker = GameUsageTracker(update_queue=update_queue, journal=journal_from_env())
+
+    def ready():
+        queue = before_loop()
+        if queue is not None:
+            tracker.update_queue = queue
+
+    tracker.start(before_loop=ready if before_loop is not None else None)
 
 def start_web_server():
-    """启动 Web 服务器"""
-    import os
+    """启动 Web 服务器（Flask 开发服务器）"""
+    from api import app
     port = int(os.environ.get('PORT', 5001))
     print(f"启动 Web 服务器，端口: {port}")
     app.run(debug=False, host='0.0.0.0', port=port, use_reloader=False)
 
+def start_production_server():
+    """以生产模式启动 Web 服务器（阻塞，需在主线程调用以接收退出信号）"""
+    from api import app, update_queue
+    from server import serve
+    port = int(os.environ.get('PORT', 5001))
+    print(f"启动 Web 服务器（生产模式），端口: {port}")
+    serve(app, host='0.0.0.0', port=port, update_queue=update_queue)
+
+def start_background_services():
+    """数据库就绪后启动的后台服务"""
+    from api import start_change_listener, static_assets
+    from retention import start_retention_scheduler
+    # 同时接收单独运行的接入进程（如 ingest_workers.py）发来的变更通知
+    start_change_listener()
+    # 预加载并预压缩静态文件
+    static_assets.preload()
+    # 定时清理超期数据（只在配置了保留期或分区时启动，见 retention.py）
+    start_retention_scheduler()
+
+def run_fast_start():
+    """快速启动：先监听端口，应用在后台加载，MQTT 并行连接（阻塞直到收到退出信号）"""
+    from server import ProductionServer
+    port = int(os.environ.get('PORT', 5001))
+    server = ProductionServer(host='0.0.0.0', port=port)
+    db_ready = threading.Event()
+
+    def load_app():
+        try:
+            from models import init_db
+            init_db()
+            server.mark_phase('database')
+            import api
+            server.mark_phase('import_api')
+            from warm_snapshot import load_snapshot
+            load_snapshot()
+            server.mark_phase('snapshot')
+            db_ready.set()
+            server.set_app(api.app, api.update_queue)
+            start_background_services()
+            server.mark_phase('background')
+            print(f"系统启动完成，各阶段耗时（秒）: {server.startup_phases}")
+        except Exception as e:
+            print(f"应用加载失败: {e}")
+            server.set_startup_error(e)
+
+    def wait_db_ready():
+        """在接入线程中等待数据库就绪，返回进程内更新队列（api 已在 db_ready 之前导入）"""
+        db_ready.wait()
+        server.mark_phase('mqtt_loop')
+        import api
+        return api.update_queue
+
+    print(f"启动 Web 服务器（快速启动），端口: {port}")
+    threading.Thread(target=load_app, name='app-loader', daemon=True).start()
+    threading.Thread(target=start_mqtt_client, name='mqtt', daemon=True,
+                     kwargs={'before_loop': wait_db_ready}).start()
+    server.serve()
+    return server.ready
+
+def save_snapshot():
+    from warm_snapshot import save_snapshot as save
+    save()
+
 if __name__ == "__main__":
+    # SERVER_MODE=production 或 --production：asyncio SSE + 线程池 WSGI，支持优雅关闭
+    production = '--production' in sys.argv or os.environ.get('SERVER_MODE') == 'production'
+    fast_start = '--fast-start' in sys.argv or os.environ.get('FAST_START') == '1'
+
     print("=== 游戏设备使用时长统计系统 ===")
-    
+
+    if production and fast_start:
+        if run_fast_start():
+            save_snapshot()
+        print("系统已关闭")
+        sys.exit(0)
+
+    from models import init_db
+    from warm_snapshot import load_snapshot
+    import api
+
     # 初始化数据库
     print("初始化数据库...")
     init_db()
-    
+    load_snapshot()
+    start_background_services()
+
     # 创建线程
-    mqtt_thread = threading.Thread(target=start_mqtt_client, daemon=True)
-    web_thread = threading.Thread(target=start_web_server, daemon=True)
-    
+    mqtt_thread = threading.Thread(target=start_mqtt_client, kwargs={'update_queue': api.update_queue},
+                                   daemon=True)
+
     # 启动线程
     mqtt_thread.start()
-    time.sleep(2)  # 等待 MQTT 客户端启动
+
+    if production:
+        start_production_server()
+        save_snapshot()
+        print("系统已关闭")
+        sys.exit(0)
+
+    web_thread = threading.Thread(target=start_web_server, daemon=True)
     web_thread.start()
-    
+
     print("系统启动完成!")
     print("Web 界面: http://localhost:5001/static/index.html")
     print("API 接口: http://localhost:5001/api/")
     print("按 Ctrl+C 退出")
-    
+
     try:
         # 保持主线程运行
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         print("\n正在关闭系统...")
-        print("系统已关闭")
\ No newline at end of file
+        save_snapshot()
+        print("系统已关闭")
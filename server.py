@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+"""
+生产模式 HTTP 服务器（仅依赖标准库）
+
+- 基于 asyncio 事件循环接收连接并解析 HTTP/1.1 请求（支持 keep-alive）
+- 普通请求交给固定大小的线程池执行 Flask（WSGI）应用，线程数由 WEB_THREADS 控制。
+  响应不超过 STREAM_BUFFER_BYTES 时整体写出（带 Content-Length）；更大的响应（如注册表导出）
+  由工作线程逐块交给事件循环写出，每块 drain 之后才取下一块，内存占用与响应大小无关。
+  没有 Content-Length 时使用 Transfer-Encoding: chunked（HTTP/1.0 写完后关闭连接）。
+  请求体支持 Content-Length 与 chunked 两种方式
+- /api/events（SSE）完全在事件循环上处理：空闲连接只占用一个套接字和一个
+  asyncio 队列，不占线程；更新信号只计算一次再广播给所有订阅者
+- 收到 SIGTERM/SIGINT 时优雅关闭：停止接受新连接，关闭 SSE 与空闲连接，
+  等待进行中的请求完成（最长 SHUTDOWN_TIMEOUT 秒）
+- 快速启动：可以先不传应用启动监听，应用在后台加载完成后再调用 set_app()。
+  /healthz（存活）与 /readyz（就绪，未就绪时 503）直接在事件循环上应答；
+  其他请求最多等待 STARTUP_WAIT_SECONDS 秒，仍未就绪时返回 503 + Retry-After
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import unquote_to_bytes, urlsplit
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 10 * 1024 * 1024
+# 超过该大小的响应改为边生成边写出
+STREAM_BUFFER_BYTES = 64 * 1024
+KEEPALIVE_TIMEOUT = 75
+SSE_CLIENT_BUFFER = 32
+HEALTH_PATHS = ('/healthz', '/readyz')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except Exception:
+        return default
+
+
+class BadRequest(Exception):
+    def __init__(self, status, message=''):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseAborted(Exception):
+    """响应头已经发出后出错：无法再返回错误页，只能关闭连接"""
+
+
+class _Request:
+    __slots__ = ('method', 'target', 'path', 'query', 'version', 'headers', 'body')
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    @property
+    def keep_alive(self):
+        connection = (self.header('connection') or '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+
+def _parse_head(head: bytes) -> _Request:
+    try:
+        text = head.decode('latin-1')
+        lines = text.split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise BadRequest(HTTPStatus.BAD_REQUEST, '请求行格式错误')
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise BadRequest(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        if ':' not in line:
+            raise BadRequest(HTTPStatus.BAD_REQUEST, '请求头格式错误')
+        key, value = line.split(':', 1)
+        headers.append((key.strip(), value.strip()))
+    req = _Request()
+    req.method = method.upper()
+    req.target = target
+    if not target.startswith('/'):
+        # absolute-form：只取路径部分
+        parts = urlsplit(target)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+    req.path, _, req.query = target.partition('?')
+    req.version = version
+    req.headers = headers
+    req.body = b''
+    return req
+
+
+class SSEHub:
+    """SSE 广播中心：每个订阅者一个有界 asyncio 队列；慢客户端丢弃最旧的消息"""
+
+    def __init__(self, loop, executor, build_messages, format_message):
+        self.loop = loop
+        self.executor = executor
+        self.build_messages = build_messages
+        self.format_message = format_message
+        self.subscribers = set()
+        self._building = False
+        self._pending = None
+
+    def subscribe(self):
+        q = asyncio.Queue(maxsize=SSE_CLIENT_BUFFER)
+        self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        self.subscribers.discard(q)
+
+    def publish(self, chunk):
+        for q in list(self.subscribers):
+            if q.full():
+                try:
+                    q.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            q.put_nowait(chunk)
+
+    def on_signal(self, data):
+        """事件循环线程中调用。构建消息期间到达的信号合并为一次重新构建"""
+        if self._building:
+            self._pending = data
+            return
+        self._building = True
+        self.loop.create_task(self._build_and_publish(data))
+
+    async def _build_and_publish(self, data):
+        try:
+            while data is not None:
+                if self.subscribers:
+                    messages = await self.loop.run_in_executor(self.executor, self.build_messages, data)
+                    for message in messages:
+                        self.publish(self.format_message(message).encode('utf-8'))
+                data, self._pending = self._pending, None
+        except Exception as e:
+            logger.error(f"构建 SSE 推送失败: {e}")
+        finally:
+            self._building = False
+
+    def close(self):
+        for q in list(self.subscribers):
+            if q.full():
+                q.get_nowait()
+            q.put_nowait(None)
+
+
+class ProductionServer:
+    """asyncio 接入 + 线程池执行 WSGI 的 HTTP 服务器"""
+
+    def __init__(self, app=None, host='0.0.0.0', port=5001, threads=None, update_queue=None,
+                 shutdown_timeout=None, startup_wait=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.threads = threads or _env_int('WEB_THREADS', 8)
+        self.update_queue = update_queue
+        self.shutdown_timeout = shutdown_timeout or _env_int('SHUTDOWN_TIMEOUT', 30)
+        self.startup_wait = startup_wait or _env_int('STARTUP_WAIT_SECONDS', 30)
+        self._connections = {}  # task -> 是否正在处理请求
+        self._inflight = 0
+        self._idle_event = None
+        self._stopping = False
+        self.loop = None
+        self.hub = None
+        self._ready_event = None
+        self._stop_event = None
+        # 启动各阶段完成的时间点（秒，从构造服务器时算起），由 /healthz、/readyz 返回
+        self._started = time.monotonic()
+        self.startup_phases = {}
+        self.startup_error = None
+        self._listening = threading.Event()
+
+    @property
+    def ready(self):
+        return self.app is not None and self._ready_event is not None and self._ready_event.is_set()
+
+    def mark_phase(self, name):
+        """记录启动阶段完成的时间点（任意线程调用）"""
+        self.startup_phases[name] = round(time.monotonic() - self._started, 3)
+
+    def wait_listening(self, timeout=None):
+        """等待端口开始监听（供后台加载线程使用）"""
+        return self._listening.wait(timeout)
+
+    def set_app(self, app, update_queue=None):
+        """应用加载完成后调用（任意线程）：开始处理普通请求与 SSE"""
+        if update_queue is not None:
+            self.update_queue = update_queue
+        self.app = app
+        self.wait_listening()
+        self.loop.call_soon_threadsafe(self._on_ready)
+
+    def set_startup_error(self, error):
+        """应用加载失败：/readyz 返回错误信息，等待中的请求立即得到 503"""
+        self.startup_error = str(error)
+        self.wait_listening()
+        self.loop.call_soon_threadsafe(self._ready_event.set)
+
+    def _on_ready(self):
+        from api import build_sse_messages, format_sse
+
+        self.hub = SSEHub(self.loop, self.executor, build_sse_messages, format_sse)
+        if self.update_queue is not None and not self._stopping:
+            threading.Thread(target=self._bridge_updates, name='sse-bridge', daemon=True).start()
+        self._ready_event.set()
+        self.mark_phase('ready')
+
+    # ---- 启动与关闭 ----
+    def serve(self):
+        """阻塞运行直到收到 SIGTERM/SIGINT（或调用 stop()）"""
+        asyncio.run(self._main())
+
+    def stop(self):
+        """从其他线程请求优雅关闭（与收到 SIGTERM 相同）"""
+        self.wait_listening()
+        self.loop.call_soon_threadsafe(self._stop_event.set)
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='wsgi')
+        self._idle_event = asyncio.Event()
+        self._idle_event.set()
+        self._ready_event = asyncio.Event()
+        self._stop_event = stop_event = asyncio.Event()
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self.loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows 或非主线程：依赖 KeyboardInterrupt
+                pass
+
+        if self.app is not None:
+            self._on_ready()
+
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                            limit=MAX_HEADER_BYTES, backlog=1024)
+        # port=0 时由系统分配端口
+        self.port = server.sockets[0].getsockname()[1]
+        self.mark_phase('listening')
+        self._listening.set()
+        logger.info(f"生产模式服务器已启动: http://{self.host}:{self.port}（工作线程 {self.threads}）")
+        try:
+            await stop_event.wait()
+        finally:
+            await self._shutdown(server)
+
+    async def _shutdown(self, server):
+        logger.info("正在优雅关闭：停止接受新连接，等待进行中的请求完成...")
+        self._stopping = True
+        server.close()
+        if self.hub is not None:
+            self.hub.close()
+        # 关闭空闲的 keep-alive 连接，进行中的请求继续执行
+        for task, busy in list(self._connections.items()):
+            if not busy:
+                task.cancel()
+        try:
+            await asyncio.wait_for(self._idle_event.wait(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"等待 {self.shutdown_timeout} 秒后仍有 {self._inflight} 个请求未完成，强制关闭")
+        for task in list(self._connections):
+            task.cancel()
+        await server.wait_closed()
+        self.executor.shutdown(wait=False)
+        logger.info("服务器已关闭")
+
+    def _bridge_updates(self):
+        """后台线程：把 update_queue 中的信号转交给事件循环"""
+        while not self._stopping:
+            data = self.update_queue.get()
+            try:
+                self.loop.call_soon_threadsafe(self.hub.on_signal, data)
+            except RuntimeError:
+                # 事件循环已关闭
+                return
+
+    # ---- 连接处理 ----
+    def _set_busy(self, busy):
+        task = asyncio.current_task()
+        if task in self._connections:
+            self._connections[task] = busy
+        if busy:
+            self._inflight += 1
+            self._idle_event.clear()
+        else:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._idle_event.set()
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = False
+        peer = writer.get_extra_info('peername') or ('', 0)
+        try:
+            while not self._stopping:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._write_error(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+                    break
+
+                try:
+                    req = _parse_head(head)
+                    await self._read_body(reader, req)
+                except BadRequest as e:
+                    await self._write_error(writer, e.status)
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                if req.path in HEALTH_PATHS:
+                    await self._write_health(writer, req)
+                    if not req.keep_alive:
+                        break
+                    continue
+
+                if not self._ready_event.is_set():
+                    try:
+                        await asyncio.wait_for(self._ready_event.wait(), timeout=self.startup_wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    if not self.ready:
+                        await self._write_error(writer, HTTPStatus.SERVICE_UNAVAILABLE,
+                                                {'Retry-After': '5'})
+                        break
+
+                if req.path == '/api/events' and req.method == 'GET':
+                    await self._serve_sse(writer)
+                    break
+
+                self._set_busy(True)
+                try:
+                    keep_alive = await self.loop.run_in_executor(
+                        self.executor, self._call_wsgi, req, peer, writer,
+                        req.keep_alive and not self._stopping)
+                except ResponseAborted as e:
+                    logger.error(f"写出 {req.method} {req.path} 的响应时出错: {e}")
+                    break
+                except Exception as e:
+                    if isinstance(e, ConnectionError):
+                        raise
+                    logger.error(f"处理请求 {req.method} {req.path} 时出错: {e}")
+                    await self._write_error(writer, HTTPStatus.INTERNAL_SERVER_ERROR)
+                    break
+                finally:
+                    self._set_busy(False)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def _read_body(self, reader, req):
+        if 'chunked' in (req.header('transfer-encoding') or '').lower():
+            await self._read_chunked_body(reader, req)
+            return
+        length = req.header('content-length')
+        if not length:
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            raise BadRequest(HTTPStatus.BAD_REQUEST)
+        if length < 0:
+            raise BadRequest(HTTPStatus.BAD_REQUEST)
+        if length > MAX_BODY_BYTES:
+            raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        req.body = await reader.readexactly(length)
+
+    async def _read_chunked_body(self, reader, req):
+        """读取 chunked 请求体，解码后改写为 Content-Length 交给 WSGI 应用"""
+        chunks = []
+        size = 0
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            try:
+                length = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise BadRequest(HTTPStatus.BAD_REQUEST, 'chunk 长度格式错误')
+            if length < 0:
+                raise BadRequest(HTTPStatus.BAD_REQUEST)
+            if length == 0:
+                break
+            size += length
+            if size > MAX_BODY_BYTES:
+                raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            chunks.append(await reader.readexactly(length))
+            if await reader.readexactly(2) != b'\r\n':
+                raise BadRequest(HTTPStatus.BAD_REQUEST, 'chunk 结尾格式错误')
+        # 跳过 trailer，直到空行
+        while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass
+        req.body = b''.join(chunks)
+        req.headers = [(key, value) for key, value in req.headers
+                       if key.lower() not in ('transfer-encoding', 'content-length')]
+        req.headers.append(('Content-Length', str(len(req.body))))
+
+    def _call_wsgi(self, req, peer, writer, keep_alive):
+        """在线程池中执行 WSGI 应用并写出响应，返回连接是否可以继续使用。
+        小响应整体写出；超过 STREAM_BUFFER_BYTES 的响应在本线程中逐块生成，经事件循环写出
+        """
+        environ = {
+            'REQUEST_METHOD': req.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(req.path).decode('latin-1'),
+            'QUERY_STRING': req.query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': req.version,
+            'REMOTE_ADDR': str(peer[0]),
+            'REMOTE_PORT': str(peer[1]) if len(peer) > 1 else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(req.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for key, value in req.headers:
+            if '_' in key:
+                continue
+            name = key.upper().replace('-', '_')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'CONTENT_LENGTH':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                name = 'HTTP_' + name
+                environ[name] = f"{environ[name]},{value}" if name in environ else value
+
+        response = []
+        buffered = []
+        stream = None
+
+        def write(data):
+            if stream is None:
+                buffered.append(data)
+            else:
+                stream.send(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+            return write
+
+        result = self.app(environ, start_response)
+        try:
+            size = sum(len(chunk) for chunk in buffered)
+            for chunk in result:
+                if not chunk:
+                    continue
+                if stream is not None:
+                    stream.send(chunk)
+                    continue
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_BUFFER_BYTES and req.method != 'HEAD':
+                    status, headers = response
+                    stream = _StreamWriter(self, writer, status, headers, req.version, keep_alive)
+                    stream.send(b''.join(buffered))
+                    buffered = None
+            if stream is None:
+                status, headers = response
+                self._run_on_loop(self._write_response(
+                    writer, req, status, headers, b''.join(buffered), keep_alive))
+                return keep_alive
+            stream.finish()
+            return stream.keep_alive
+        except Exception as e:
+            if stream is None or isinstance(e, ConnectionError):
+                raise
+            raise ResponseAborted(str(e)) from e
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def _run_on_loop(self, coro):
+        """工作线程中调用：在事件循环上执行 coro 并等待完成（写出 + drain，慢客户端的背压传回工作线程）"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    @staticmethod
+    def _response_head(status, headers, keep_alive, length=None, chunked=False):
+        lines = [f'HTTP/1.1 {status}']
+        for key, value in headers:
+            if key.lower() in ('connection', 'transfer-encoding'):
+                continue
+            lines.append(f'{key}: {value}')
+        if chunked:
+            lines.append('Transfer-Encoding: chunked')
+        elif length is not None:
+            lines.append(f'Content-Length: {length}')
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _write_response(self, writer, req, status, headers, body, keep_alive):
+        has_length = any(key.lower() == 'content-length' for key, _ in headers)
+        writer.write(self._response_head(status, headers, keep_alive, None if has_length else len(body)))
+        if req.method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
+    @staticmethod
+    async def _write_chunk(writer, data):
+        writer.write(data)
+        await writer.drain()
+
+    async def _write_health(self, writer, req):
+        """/healthz：进程存活即 200；/readyz：应用加载完成才 200。均附带启动阶段耗时"""
+        ready = self.ready
+        status = HTTPStatus.OK if ready or req.path == '/healthz' else HTTPStatus.SERVICE_UNAVAILABLE
+        payload = {
+            'status': 'ready' if ready else ('error' if self.startup_error else 'starting'),
+            'uptime_seconds': round(time.monotonic() - self._started, 3),
+            'phases': dict(self.startup_phases),
+        }
+        if self.startup_error:
+            payload['error'] = self.startup_error
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        headers = [('Content-Type', 'application/json'), ('Cache-Control', 'no-store')]
+        await self._write_response(writer, req, f'{status.value} {status.phrase}', headers, body,
+                                   req.keep_alive and not self._stopping)
+
+    async def _write_error(self, writer, status, extra_headers=None):
+        status = HTTPStatus(status)
+        body = status.phrase.encode('utf-8')
+        extra = ''.join(f'{key}: {value}\r\n' for key, value in (extra_headers or {}).items())
+        writer.write((f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                      f'Content-Type: text/plain; charset=utf-8\r\n{extra}'
+                      f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _serve_sse(self, writer):
+        from api import SSE_HEADERS, SSE_HEARTBEAT_SECONDS, format_sse
+
+        lines = ['HTTP/1.1 200 OK', 'Content-Type: text/event-stream; charset=utf-8']
+        lines.extend(f'{k}: {v}' for k, v in SSE_HEADERS.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        heartbeat = format_sse({'type': 'heartbeat'}).encode('utf-8')
+
+        q = self.hub.subscribe()
+        metrics.SSE_SUBSCRIBERS.inc()
+        try:
+            await writer.drain()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(q.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    chunk = heartbeat
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.hub.unsubscribe(q)
+            metrics.SSE_SUBSCRIBERS.dec()
+
+
+class _StreamWriter:
+    """工作线程中逐块写出大响应：有 Content-Length 时原样写出，否则 chunked（HTTP/1.0 以关闭连接结束）"""
+
+    def __init__(self, server, writer, status, headers, version, keep_alive):
+        self.server = server
+        self.writer = writer
+        has_length = any(key.lower() == 'content-length' for key, _ in headers)
+        self.chunked = not has_length and version == 'HTTP/1.1'
+        self.keep_alive = keep_alive and (has_length or self.chunked)
+        server._run_on_loop(server._write_chunk(
+            writer, server._response_head(status, headers, self.keep_alive, chunked=self.chunked)))
+
+    def send(self, data):
+        if not data:
+            return
+        if self.chunked:
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        self.server._run_on_loop(self.server._write_chunk(self.writer, data))
+
+    def finish(self):
+        if self.chunked:
+            self.server._run_on_loop(self.server._write_chunk(self.writer, b'0\r\n\r\n'))
+
+
+def serve(app, host='0.0.0.0', port=5001, update_queue=None, threads=None):
+    """以生产模式运行 Flask 应用（阻塞）"""
+    ProductionServer(app, host, port, threads=threads, update_queue=update_queue).serve()
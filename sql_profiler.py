@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+按请求 / 按消息的 SQL 剖析（SQL_PROFILE 非空时启用）
+
+get_players、get_device_status 中的 N+1 查询以及图表、汇总接口的逐天循环一直没人发现，因为没有任何地方统计查询次数。
+启用后 TimedSqliteDatabase 每执行一条 SQL 都回调这里（models.TimedSqliteDatabase.query_hook）：
+
+- 每个 HTTP 请求与每条 MQTT 消息各是一个剖析单元，记录查询次数、SQL 总耗时和最慢的 SQL_PROFILE_TOP 条语句
+  （耗时为 execute 的耗时，逐行读取结果的时间不计入）
+- 同一单元内同一形状（IN 列表长度不同视为相同）的语句出现 SQL_PROFILE_REPEAT 次（默认 5）及以上视为疑似 N+1，
+  同一单元同一形状每 10 分钟最多告警一次
+- 超过 SQL_SLOW_QUERY_MS（默认 100）毫秒的语句连同 EXPLAIN QUERY PLAN 写入日志，设置 SQL_SLOW_LOG 时另外按行
+  追加 JSON 到该文件
+- SQL_PROFILE=debug（或 Flask 调试模式）时响应带 X-SQL-Profile 头；GET /api/debug/sql-profile 查看最近的
+  慢查询与疑似 N+1
+- 指标：sql_profile_queries{unit}（每个单元的查询次数分布）
+
+未启用时不注册回调，没有额外开销。
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import metrics
+from models import db, env_number
+
+logger = logging.getLogger(__name__)
+
+
+SQL_PROFILE = os.environ.get('SQL_PROFILE', '').strip().lower()
+SQL_PROFILE_TOP = max(1, env_number('SQL_PROFILE_TOP', 5))
+SQL_PROFILE_REPEAT = max(2, env_number('SQL_PROFILE_REPEAT', 5))
+SQL_SLOW_QUERY_MS = env_number('SQL_SLOW_QUERY_MS', 100, float)
+SQL_SLOW_LOG = os.environ.get('SQL_SLOW_LOG', '')
+REPEAT_REPORT_SECONDS = 600
+RECENT_ENTRIES = 50
+
+SQL_PROFILE_QUERIES = metrics.REGISTRY.histogram(
+    'sql_profile_queries', '每个请求 / 消息执行的 SQL 条数', ('unit',),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+# IN (?, ?, ?) 等占位符列表折叠为一个，长度不同的同一查询视为同一形状
+_PLACEHOLDERS = re.compile(r'\?(?:\s*,\s*\?)+')
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+_local = threading.local()
+_lock = threading.Lock()
+_reported = {}  # (单元, 形状) -> 上次告警时间
+recent_slow = deque(maxlen=RECENT_ENTRIES)
+recent_repeats = deque(maxlen=RECENT_ENTRIES)
+
+
+def enabled():
+    return bool(SQL_PROFILE)
+
+
+def header_enabled(debug=False):
+    return enabled() and (debug or SQL_PROFILE == 'debug')
+
+
+def query_shape(sql):
+    return _PLACEHOLDERS.sub('?, ...', ' '.join(sql.split()))
+
+
+class QueryProfile:
+    """一个剖析单元（一次请求或一条消息）内的 SQL 统计"""
+
+    def __init__(self, unit):
+        self.unit = unit
+        self.count = 0
+        self.total = 0.0
+        self.shapes = {}  # 形状 -> [次数, 总耗时]
+        self.slowest = []  # [(耗时, sql)]，按耗时倒序，最多 SQL_PROFILE_TOP 条
+
+    def add(self, sql, elapsed):
+        self.count += 1
+        self.total += elapsed
+        entry = self.shapes.setdefault(query_shape(sql), [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        if len(self.slowest) < SQL_PROFILE_TOP or elapsed > self.slowest[-1][0]:
+            self.slowest.append((elapsed, sql))
+            self.slowest.sort(key=lambda item: -item[0])
+            del self.slowest[SQL_PROFILE_TOP:]
+
+    def repeated(self):
+        """疑似 N+1：[(形状, 次数, 总耗时)]，次数多的在前"""
+        return sorted(((shape, count, total) for shape, (count, total) in self.shapes.items()
+                       if count >= SQL_PROFILE_REPEAT), key=lambda item: -item[1])
+
+    def header(self):
+        """X-SQL-Profile 响应头（只含 ASCII）"""
+        parts = [f'queries={self.count}', f'sql_ms={self.total * 1000:.2f}']
+        if self.slowest:
+            parts.append(f'slowest_ms={self.slowest[0][0] * 1000:.2f}')
+        repeated = self.repeated()
+        if repeated:
+            # 形状中含双引号（标识符），放在最后且不加引号
+            shape, count, _ = repeated[0]
+            parts.append(f'repeated={len(repeated)}')
+            parts.append(f'top_repeat={count}x {shape[:120]}')
+        return '; '.join(parts).encode('ascii', 'replace').decode('ascii')
+
+
+def begin(unit):
+    """开始当前线程的剖析单元（未启用时返回 None）"""
+    if not enabled():
+        return None
+    profile = _local.profile = QueryProfile(unit)
+    return profile
+
+
+def end():
+    """结束当前线程的剖析单元：记录指标、报告疑似 N+1，返回 QueryProfile（没有进行中的单元时返回 None）"""
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    if profile is None:
+        return None
+    SQL_PROFILE_QUERIES.observe(profile.count, profile.unit)
+    repeated = profile.repeated()
+    if repeated:
+        now = time.monotonic()
+        for shape, count, total in repeated:
+            key = (profile.unit, shape)
+            with _lock:
+                if now - _reported.get(key, -REPEAT_REPORT_SECONDS) < REPEAT_REPORT_SECONDS:
+                    continue
+                _reported[key] = now
+            recent_repeats.append({'at': _now_iso(), 'unit': profile.unit, 'count': count,
+                                   'ms': round(total * 1000, 3), 'shape': shape})
+            logger.warning(f"🔁 疑似 N+1：{profile.unit} 中同一查询执行了 {count} 次"
+                           f"（共 {total * 1000:.1f} ms，本单元 {profile.count} 条）: {shape[:300]}")
+    return profile
+
+
+@contextmanager
+def profile(unit):
+    """剖析一段代码；单元名称可在执行中修改（profile.unit）"""
+    current = begin(unit)
+    try:
+        yield current
+    finally:
+        if current is not None:
+            end()
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def _explain(sql, params):
+    if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return []
+    try:
+        # 直接用底层连接执行，不再经过 execute_sql（避免递归回调）
+        return [row[-1] for row in db.connection().execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()]
+    except Exception as e:
+        return [f'EXPLAIN 失败: {e}']
+
+
+def _log_slow(sql, params, elapsed, unit):
+    entry = {
+        'at': _now_iso(),
+        'unit': unit,
+        'ms': round(elapsed * 1000, 3),
+        'sql': sql,
+        'params': [repr(param)[:100] for param in (params or ())][:20],
+        'plan': _explain(sql, params),
+    }
+    recent_slow.append(entry)
+    logger.warning(f"🐢 慢查询 {entry['ms']} ms（{unit or '后台'}）: {' '.join(sql.split())[:300]}"
+                   f" | 计划: {' / '.join(entry['plan'])}")
+    if SQL_SLOW_LOG:
+        try:
+            with _lock, open(SQL_SLOW_LOG, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logger.warning(f"写入慢查询日志失败: {e}")
+
+
+def _record(sql, params, elapsed):
+    current = getattr(_local, 'profile', None)
+    if current is not None:
+        current.add(sql, elapsed)
+    if elapsed * 1000 >= SQL_SLOW_QUERY_MS:
+        _log_slow(sql, params, elapsed, current.unit if current is not None else None)
+
+
+def snapshot():
+    """最近的慢查询与疑似 N+1（GET /api/debug/sql-profile）"""
+    return {
+        'enabled': enabled(),
+        'slow_query_ms': SQL_SLOW_QUERY_MS,
+        'repeat_threshold': SQL_PROFILE_REPEAT,
+        'slow_queries': list(recent_slow),
+        'repeated_queries': list(recent_repeats),
+    }
+
+
+if enabled():
+    db.query_hook = _record
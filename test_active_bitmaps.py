@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+每日活跃设备位图测试（active_bitmaps.py）
+"""
+import random
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import active_bitmaps
+import api
+import change_notify
+from conftest import play
+from models import Device, GameSession, DeviceRegistry, DailyActiveDevices
+
+FIRST_DAY = datetime(2024, 6, 1, 8, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def activity(tracker, tmp_path, monkeypatch):
+    monkeypatch.setattr(change_notify, 'CACHE_INVALIDATE_DIR', str(tmp_path / 'invalidate'))
+    rng = random.Random(5)
+    for _ in range(30):
+        device = rng.randrange(12)
+        start = FIRST_DAY + timedelta(days=rng.randrange(10), hours=rng.randrange(10))
+        play(tracker, f'MICROBLOCKSA{chr(65 + device)}A', f'程序 {device % 3}', start, 5)
+    DeviceRegistry.create(ble_id='MICROBLOCKSAAA', campus_name='一校区', project_name='娃娃机')
+    DeviceRegistry.create(ble_id='MICROBLOCKSABA', campus_name='一校区', project_name='赛车')
+    DeviceRegistry.create(ble_id='MICROBLOCKSACA', campus_name='二校区', project_name='娃娃机')
+    return tracker
+
+
+def _distinct_by_scan(start_date, end_date, campus=None, project=None):
+    start = datetime.combine(start_date, datetime.min.time(), tzinfo=timezone.utc)
+    query = GameSession.select(GameSession.device).join(Device).where(
+        GameSession.start_time >= start, GameSession.start_time < start + timedelta(days=(end_date - start_date).days + 1))
+    if campus or project:
+        query = query.join(DeviceRegistry, on=(Device.registry_id == DeviceRegistry.id)).where(
+            DeviceRegistry.campus_name == campus if campus else DeviceRegistry.project_name == project)
+    return len({row[0] for row in query.tuples()})
+
+
+@pytest.mark.parametrize('start, end', [(1, 1), (1, 3), (2, 9), (1, 30)])
+def test_distinct_count_matches_session_scan(activity, start, end):
+    start_date, end_date = date(2024, 6, start), date(2024, 6, end)
+    data = active_bitmaps.compute_distinct_devices(start_date, end_date)
+    assert data['distinct_devices'] == _distinct_by_scan(start_date, end_date)
+    assert sum(day['active_devices'] for day in data['daily']) >= data['distinct_devices']
+    filtered = active_bitmaps.compute_distinct_devices(start_date, end_date, campus_name='一校区')
+    assert filtered['distinct_devices'] == _distinct_by_scan(start_date, end_date, '一校区')
+
+
+def test_groups_match_session_scan(activity):
+    start_date, end_date = date(2024, 6, 1), date(2024, 6, 30)
+    data = active_bitmaps.compute_distinct_devices(start_date, end_date, group='project')
+    assert {g['key']: g['distinct_devices'] for g in data['groups']} == {
+        project: _distinct_by_scan(start_date, end_date, project=project)
+        for project in ('娃娃机', '赛车') if _distinct_by_scan(start_date, end_date, project=project)}
+
+
+def test_rebuild_matches_incremental_bitmaps(activity):
+    before = {row.day: bytes(row.bitmap) for row in DailyActiveDevices.select()}
+    assert active_bitmaps.rebuild() == len(before)
+    assert {row.day: bytes(row.bitmap) for row in DailyActiveDevices.select()} == before
+
+
+def test_deleting_last_session_of_the_day_clears_the_bit(activity):
+    client = api.app.test_client()
+    session = GameSession.select().order_by(GameSession.id).first()
+    day = api.to_utc_datetime(session.start_time).date()
+    same_day = GameSession.select().where(
+        GameSession.device == session.device_id,
+        GameSession.start_time >= datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc),
+        GameSession.start_time < datetime.combine(day + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc))
+    for other in list(same_day):
+        assert client.delete(f'/api/session/{other.id}').status_code == 200
+    bitmap = active_bitmaps.from_bytes(bytes(DailyActiveDevices.get(DailyActiveDevices.day == day).bitmap))
+    assert not bitmap >> session.device_id & 1
+    # 本进程的置位标记已丢弃：同一设备当天再次开始会话时重新置位
+    play(activity, session.device.device_key, session.device.name,
+         datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc) + timedelta(hours=20), 5)
+    bitmap = active_bitmaps.from_bytes(bytes(DailyActiveDevices.get(DailyActiveDevices.day == day).bitmap))
+    assert bitmap >> session.device_id & 1
+
+
+def test_bitmap_bytes_round_trip():
+    for bitmap in (0, 1, 1 << 4000 | 1 << 7):
+        assert active_bitmaps.from_bytes(active_bitmaps.to_bytes(bitmap)) == bitmap
+    assert active_bitmaps.to_bytes(0) == b''
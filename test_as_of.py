@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+时间点查询测试（api.parse_as_of / interval_index.py）
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import api
+from interval_index import AsOfIndex, IntervalTree
+from models import Device, GameSession, DeviceStatus
+
+
+class _Version:
+    """测试用数据版本：每次调用 bump() 模拟一次写入"""
+
+    def __init__(self):
+        self.value = 0
+
+    def current(self):
+        return self.value
+
+    def bump(self):
+        self.value += 1
+
+
+def _utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('value', [
+    '2024-06-01T11:00:00Z',
+    '2024-06-01T19:00:00+08:00',
+    # 查询串中未编码的 + 解码后是空格
+    '2024-06-01T19:00:00 08:00',
+    '2024-06-01 19:00:00+08:00',
+    '2024-06-01 19:00:00 08:00',
+    '2024-06-01 11:00:00',
+    ' 2024-06-01T11:00 ',
+])
+def test_parse_as_of_formats(value):
+    assert api.parse_as_of(value) == _utc(2024, 6, 1, 11)
+
+
+@pytest.mark.parametrize('value', ['', None, 'yesterday', '2024-06-01T25:00:00'])
+def test_parse_as_of_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        api.parse_as_of(value)
+
+
+def test_as_of_endpoint_accepts_unencoded_offset(temp_db):
+    # README 中的示例：+ 未编码时不能变成第二个 T
+    response = api.app.test_client().get('/api/as-of?at=2024-06-01T19:00:00+08:00')
+    assert response.status_code == 200
+    assert response.get_json()['data']['at'].startswith('2024-06-01T11:00:00')
+
+
+def test_interval_tree_matches_linear_scan():
+    rng = random.Random(7)
+    intervals = []
+    for i in range(500):
+        start = rng.uniform(0, 1000)
+        intervals.append((start, start + rng.uniform(0, 50), i))
+    tree = IntervalTree(list(intervals))
+    for _ in range(200):
+        t = rng.uniform(-10, 1060)
+        expected = sorted(data for start, end, data in intervals if start <= t < end)
+        assert sorted(tree.stab(t)) == expected
+
+
+def _session(device, start, end=None):
+    return GameSession.create(device=device, start_time=start, end_time=end,
+                              duration_seconds=int((end - start).total_seconds()) if end else None)
+
+
+def test_as_of_index_rebuilds_only_when_sessions_change(temp_db):
+    device = Device.create(device_key='DEV1', name='机器 1')
+    session = _session(device, _utc(2024, 6, 1, 10), _utc(2024, 6, 1, 12))
+    version = _Version()
+    index = AsOfIndex(version)
+    now = _utc(2024, 7, 15)
+
+    state = index.state_at(_utc(2024, 6, 1, 11), 30, now=now)
+    assert [d['status'] for d in state['devices']] == ['playing']
+    assert index.builds == 1
+
+    # 只有心跳：数据版本变化，但会话没有变化，不重建
+    DeviceStatus.create(player_id='DEV1', player_name='机器 1', last_seen=now)
+    version.bump()
+    index.state_at(_utc(2024, 6, 1, 11), 30, now=now)
+    assert index.builds == 1
+
+    # 之后月份的会话变化不影响六月的索引
+    _session(device, _utc(2024, 7, 2, 10), _utc(2024, 7, 2, 11))
+    version.bump()
+    index.state_at(_utc(2024, 6, 1, 11), 30, now=now)
+    assert index.builds == 1
+
+    # 六月的会话被修改：重建，并反映新的结束时间
+    session.end_time = _utc(2024, 6, 1, 10, 30)
+    session.save()
+    version.bump()
+    state = index.state_at(_utc(2024, 6, 1, 11), 30, now=now)
+    assert index.builds == 2
+    assert [d['status'] for d in state['devices']] == ['idle']
+
+    # 删除会话同样触发重建
+    session.delete_instance()
+    version.bump()
+    state = index.state_at(_utc(2024, 6, 1, 10, 15), 30, now=now)
+    assert index.builds == 3
+    assert state['devices'] == []
+
+
+def test_as_of_index_sees_sessions_from_previous_month(temp_db):
+    device = Device.create(device_key='DEV1', name='机器 1')
+    version = _Version()
+    index = AsOfIndex(version)
+    now = _utc(2024, 7, 15)
+    index.state_at(_utc(2024, 6, 1, 0, 30), 30, now=now)
+
+    # 跨月会话开始于五月：五月的变更计数也计入六月索引的指纹
+    _session(device, _utc(2024, 5, 31, 23), _utc(2024, 6, 1, 1))
+    version.bump()
+    state = index.state_at(_utc(2024, 6, 1, 0, 30), 30, now=now)
+    assert [d['status'] for d in state['devices']] == ['playing']
+    assert state['devices'][0]['elapsed_seconds'] == timedelta(minutes=90).total_seconds()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+跨进程变更通知测试（change_notify.py）
+"""
+import queue
+import socket
+
+import pytest
+
+import change_notify
+from change_notify import ChangeListener, ChangeNotifier
+
+
+@pytest.mark.parametrize('data', [
+    {'type': 'mqtt_update'},
+    {'type': 'mqtt_update', 'timestamp': '2024-06-01T11:00:00.123456Z'},
+])
+def test_listener_accepts_update_signals(data):
+    assert ChangeListener(None).accept(data)
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    ['mqtt_update'],
+    {},
+    {'type': 'device_update', 'data': {'devices': []}},
+    {'type': 'mqtt_update', 'data': '<script>alert(1)</script>'},
+    {'type': 'mqtt_update', 'timestamp': 12345},
+    {'type': 'mqtt_update', 'timestamp': 'x' * 1000},
+])
+def test_listener_rejects_unknown_payloads(data):
+    assert not ChangeListener(None).accept(data)
+
+
+@pytest.fixture
+def notify_socket(tmp_path, monkeypatch):
+    if not hasattr(socket, 'AF_UNIX'):
+        pytest.skip('需要 Unix 域套接字')
+    monkeypatch.setattr(change_notify, 'NOTIFY_SOCKET_PATH', str(tmp_path / 'notify.sock'))
+
+
+def test_listener_forwards_only_valid_datagrams(notify_socket):
+    received = queue.Queue()
+    listener = ChangeListener(received.put).start()
+    notifier = ChangeNotifier()
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sender.sendto(b'{"type": "device_update", "data": {"devices": ["forged"]}}', listener.address)
+        sender.sendto(b'\xff\xfe not json', listener.address)
+        with pytest.raises(queue.Empty):
+            received.get(timeout=0.3)
+
+        assert notifier.notify({'type': 'mqtt_update', 'timestamp': '2024-06-01T11:00:00Z'})
+        assert received.get(timeout=2) == {'type': 'mqtt_update', 'timestamp': '2024-06-01T11:00:00Z'}
+    finally:
+        sender.close()
+        notifier.close()
+        listener.stop()
+
+
+def test_notifier_without_listener_does_not_raise(notify_socket):
+    notifier = ChangeNotifier()
+    try:
+        assert notifier.notify({'type': 'mqtt_update'}) is False
+    finally:
+        notifier.close()
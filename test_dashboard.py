@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+仪表盘合并接口测试（/api/dashboard 与 DashboardContext）
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import api
+from models import Device, GameSession, DeviceStatus
+
+
+@pytest.fixture
+def seeded(temp_db):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    for i, key in enumerate(('DEV1', 'DEV2')):
+        device = Device.create(device_key=key, name=f'机器 {i + 1}')
+        for days_ago in range(3):
+            start = now - timedelta(days=days_ago, hours=i + 1)
+            GameSession.create(device=device, start_time=start, end_time=start + timedelta(minutes=20),
+                               duration_seconds=1200)
+        DeviceStatus.create(player_id=key, player_name=f'机器 {i + 1}', last_seen=now)
+    return api.app.test_client()
+
+
+@pytest.mark.parametrize('panel, path, params', [
+    ('stats', '/api/stats', ''),
+    ('players', '/api/players', ''),
+    ('campus_projects', '/api/campus-projects', ''),
+    ('daily_chart', '/api/daily-chart?days=7', '&days=7'),
+    ('daily_summary', '/api/daily-summary?days=3', '&summary_days=3'),
+])
+def test_dashboard_panels_match_individual_endpoints(seeded, panel, path, params):
+    combined = seeded.get(f'/api/dashboard?include={panel}{params}').get_json()
+    single = seeded.get(path).get_json()
+    assert combined['success'] and single['success']
+    assert list(combined['data']) == [panel]
+    assert combined['data'][panel] == single['data']
+
+
+def test_dashboard_defaults_to_all_panels(seeded):
+    body = seeded.get('/api/dashboard').get_json()
+    assert set(body['data']) == set(api.DASHBOARD_PANELS)
+    assert isinstance(body['data_version'], int)
+    status = body['data']['device_status']
+    assert {d['player_id'] for d in status['devices']} == {'DEV1', 'DEV2'}
+    assert status['status_count']['online'] == 2
+
+
+def test_dashboard_rejects_unknown_panels(seeded):
+    response = seeded.get('/api/dashboard?include=nope')
+    assert response.status_code == 400
+    assert not response.get_json()['success']
+
+
+def test_context_merges_session_range_queries(seeded):
+    ctx = api.DashboardContext()
+    today = datetime.combine(ctx.today, datetime.min.time(), tzinfo=timezone.utc)
+    week = ctx.sessions_between(today - timedelta(days=6), today + timedelta(days=1))
+    window = ctx._window
+    # 更小的范围直接从已加载的窗口中过滤，不再查询
+    day = ctx.sessions_between(today, today + timedelta(days=1))
+    assert ctx._window is window
+    assert day == [s for s in week if s.start_time >= today]
+    assert [s.start_time for s in week] == sorted((s.start_time for s in week), reverse=True)
+    assert ctx.device_pairs() is ctx.device_pairs()
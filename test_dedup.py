@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+接入端重复消息过滤测试（dedup.py）
+"""
+from conftest import deliver
+from dedup import DedupWindow, IngestDeduplicator
+from models import GameSession
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_window_expires_entries():
+    clock = _Clock()
+    window = DedupWindow(5, 100, clock=clock)
+    assert not window.seen('a')
+    clock.now = 4.9
+    assert window.seen('a')
+    clock.now = 5.0
+    assert not window.seen('a')
+    assert window.hits == 1
+    assert len(window) == 1
+
+
+def test_window_evicts_oldest_when_full():
+    window = DedupWindow(60, 3, clock=_Clock())
+    for key in 'abcd':
+        assert not window.seen(key)
+    assert len(window) == 3
+    assert window.evictions == 1
+    # 最旧的 a 已被淘汰：宁可漏判重复
+    assert not window.seen('a')
+    assert window.seen('d')
+
+
+def test_window_disabled_with_zero_seconds():
+    window = DedupWindow(0, 10)
+    assert not window.seen('a')
+    assert not window.seen('a')
+
+
+def test_start_end_start_is_not_duplicate():
+    dedup = IngestDeduplicator(id_window_seconds=600, window_seconds=5, max_entries=100)
+    start = {'event': 'game_start', 'playerName': '程序 A'}
+    end = {'event': 'game_end', 'playerName': '程序 A'}
+    assert not dedup.is_duplicate('DEV1', 'game_start', start)
+    assert dedup.is_duplicate('DEV1', 'game_start', start)
+    assert not dedup.is_duplicate('DEV1', 'game_end', end)
+    assert not dedup.is_duplicate('DEV1', 'game_start', start)
+    # 同一块板子切换到另一个程序不是重复
+    assert not dedup.is_duplicate('DEV1', 'game_start', {'event': 'game_start', 'playerName': '程序 B'})
+    # 心跳没有序号时不按时间窗口去重
+    assert not dedup.is_duplicate('DEV1', 'heartbeat', {'event': 'heartbeat'})
+    assert not dedup.is_duplicate('DEV1', 'heartbeat', {'event': 'heartbeat'})
+
+
+def test_sequence_numbers_dedup_redeliveries():
+    dedup = IngestDeduplicator(id_window_seconds=600, window_seconds=0, max_entries=100)
+    beat = {'event': 'heartbeat', 'seq': 7}
+    assert not dedup.is_duplicate('DEV1', 'heartbeat', beat)
+    assert dedup.is_duplicate('DEV1', 'heartbeat', dict(beat))
+    assert not dedup.is_duplicate('DEV1', 'heartbeat', {'event': 'heartbeat', 'seq': 8})
+    assert not dedup.is_duplicate('DEV2', 'heartbeat', beat)
+
+
+def test_redelivered_start_creates_one_session(tracker):
+    message = {'event': 'game_start', 'playerId': 'DEV1', 'playerName': '程序 A'}
+    deliver(tracker, message)
+    deliver(tracker, message)
+    assert GameSession.select().count() == 1
+    assert GameSession.get().end_time is None
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+设备维度表测试（device_dimension.py）：旧版会话表迁移、注册表关联触发器、device_id 缓存
+"""
+import sqlite3
+
+import pytest
+
+import device_dimension
+from conftest import _clear_process_caches, _use_database
+from models import db, init_db, Device, GameSession, DeviceRegistry
+
+LEGACY_ROWS = [
+    (3, 'MICROBLOCKSABC', '娃娃机', '2024-06-01 08:00:00+00:00', '2024-06-01 08:10:00+00:00', 600),
+    (5, 'MICROBLOCKSABC', '娃娃机', '2024-06-01 09:00:00+00:00', None, None),
+    (8, 'MICROBLOCKSABC', '赛车', '2024-06-01 10:00:00+00:00', '2024-06-01 10:05:00+00:00', 300),
+    (9, 'p1', '一楼', '2024-06-02 10:00:00+00:00', '2024-06-02 10:01:00+00:00', 60),
+    (12, 'p1', '一楼', '2024-06-03 10:00:00+00:00', '2024-06-03 10:02:00+00:00', 120),
+]
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """旧版结构的数据库：game_sessions 直接保存 player_id / player_name"""
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / 'game_usage.db'
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE game_sessions (id INTEGER PRIMARY KEY, player_id VARCHAR(100) NOT NULL,
+        player_name VARCHAR(100) NOT NULL, start_time DATETIME NOT NULL, end_time DATETIME,
+        duration_seconds INTEGER, created_at DATETIME NOT NULL)""")
+    conn.executemany('INSERT INTO game_sessions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [row + (row[3],) for row in LEGACY_ROWS])
+    conn.commit()
+    conn.close()
+    _use_database(str(path))
+    _clear_process_caches()
+    yield db
+    _use_database('game_usage.db')
+    _clear_process_caches()
+
+
+def test_init_db_migrates_legacy_sessions(legacy_db, monkeypatch):
+    monkeypatch.setattr(device_dimension, 'MIGRATE_BATCH_SIZE', 2)
+    init_db()
+
+    assert not device_dimension.needs_migration()
+    assert [(d.device_key, d.name) for d in Device.select().order_by(Device.id)] == [
+        ('MICROBLOCKSABC', '娃娃机'), ('MICROBLOCKSABC', '赛车'), ('p1', '一楼')]
+    migrated = [(s.id, s.device.device_key, s.device.name, s.duration_seconds)
+                for s in GameSession.select().order_by(GameSession.id)]
+    # 保留原会话 id
+    assert migrated == [(row[0], row[1], row[2], row[5]) for row in LEGACY_ROWS]
+    # 已迁移的数据库再次初始化不做任何事
+    assert device_dimension.migrate_legacy_sessions() is None
+
+
+def test_interrupted_migration_resumes(legacy_db):
+    db.connect()
+    # 模拟上次迁移在复制过程中中断：旧表已改名，新表只复制了一部分
+    with db.atomic():
+        db.execute_sql(f'ALTER TABLE game_sessions RENAME TO {device_dimension.LEGACY_TABLE}')
+    db.create_tables([Device, GameSession, DeviceRegistry])
+    Device.create(device_key='MICROBLOCKSABC', name='娃娃机')
+    GameSession.create(id=3, device=1, start_time=LEGACY_ROWS[0][3])
+    assert device_dimension.needs_migration()
+
+    report = device_dimension.migrate_legacy_sessions(batch_size=2)
+    assert report['sessions_migrated'] == len(LEGACY_ROWS) - 1
+    assert [s.id for s in GameSession.select().order_by(GameSession.id)] == [row[0] for row in LEGACY_ROWS]
+
+
+def test_registry_link_follows_registry_changes(temp_db):
+    device = Device.create(device_key='MICROBLOCKSABC', name='娃娃机')
+    assert Device.get_by_id(device.id).registry_id is None
+    registry = DeviceRegistry.create(ble_id='MICROBLOCKSABC', campus_name='一校区', project_name='娃娃机')
+    assert Device.get_by_id(device.id).registry_id == registry.id
+
+    # 新出现的设备行插入时自动关联
+    renamed = Device.create(device_key='MICROBLOCKSABC', name='新程序')
+    assert Device.get_by_id(renamed.id).registry_id == registry.id
+
+    registry.ble_id = 'MICROBLOCKSXYZ'
+    registry.save()
+    assert Device.get_by_id(device.id).registry_id is None
+    registry.delete_instance()
+    assert Device.select().where(Device.registry_id.is_null(False)).count() == 0
+
+
+def test_device_id_for_creates_once_and_caches(temp_db):
+    first = device_dimension.device_id_for('p1', '一楼')
+    assert device_dimension.device_id_for('p1', '一楼') == first
+    assert device_dimension.device_id_for('p1', '二楼') != first
+    # 其他进程已创建同一设备：唯一索引冲突时读出已有 id
+    device_dimension._device_ids.clear()
+    assert device_dimension.device_id_for('p1', '一楼') == first
+    assert Device.select().count() == 2
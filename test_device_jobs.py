@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+后台设备删除任务测试（device_jobs.py）
+"""
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import api
+import change_notify
+import device_jobs
+from models import Device, GameSession, DeviceStatus, DeviceRegistry, DailyUsageArchive
+
+
+@pytest.fixture
+def fleet(temp_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(device_jobs, 'DELETE_BATCH_SIZE', 2)
+    monkeypatch.setattr(device_jobs, 'DELETE_PAUSE_SECONDS', 0)
+    monkeypatch.setattr(change_notify, 'CACHE_INVALIDATE_DIR', str(tmp_path / 'invalidate'))
+    start = datetime(2024, 6, 1, 8, tzinfo=timezone.utc)
+    for key in ('MICROBLOCKSABC', 'DEV2'):
+        device = Device.create(device_key=key, name='机器')
+        for i in range(5):
+            begin = start + timedelta(hours=i)
+            GameSession.create(device=device, start_time=begin, end_time=begin + timedelta(minutes=5),
+                               duration_seconds=300)
+        DeviceStatus.create(player_id=key, player_name='机器', last_seen=start)
+        DailyUsageArchive.create(day=start.date() - timedelta(days=60), player_id=key, player_name='机器',
+                                 session_count=1, completed_sessions=1, total_seconds=60)
+    DeviceRegistry.create(ble_id='MICROBLOCKSABC', campus_name='一校区', project_name='娃娃机')
+
+
+def _sessions_of(key):
+    return GameSession.select().join(Device).where(Device.device_key == key).count()
+
+
+def test_job_deletes_device_data_in_chunks(fleet):
+    job = device_jobs.DeviceDeletionJob(['MICROBLOCKSABC'])
+    device_jobs._run_job(job)
+
+    result = job.to_dict()
+    assert result['status'] == 'done'
+    assert result['progress']['sessions_total'] == result['progress']['sessions_deleted'] == 5
+    assert result['progress']['percent'] == 100.0
+    assert result['devices'][0]['archive_deleted'] == 1
+    assert result['devices'][0]['registry_deleted'] == 1
+    assert _sessions_of('MICROBLOCKSABC') == 0
+    assert not DeviceStatus.select().where(DeviceStatus.player_id == 'MICROBLOCKSABC').exists()
+    # 其他设备不受影响
+    assert _sessions_of('DEV2') == 5
+    assert DailyUsageArchive.select().count() == 1
+
+
+def test_deletion_endpoint_runs_in_background(fleet):
+    client = api.app.test_client()
+    assert client.post('/api/device-deletions', json={'player_ids': []}).status_code == 400
+
+    response = client.post('/api/device-deletions', json={'player_ids': ['DEV2', 'DEV2', 'MICROBLOCKSABC']})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        data = client.get(f'/api/jobs/{job_id}').get_json()['data']
+        if data['status'] in ('done', 'failed'):
+            break
+        time.sleep(0.05)
+    assert data['status'] == 'done', data['error']
+    # 重复的设备只删除一次
+    assert [d['player_id'] for d in data['devices']] == ['DEV2', 'MICROBLOCKSABC']
+    assert GameSession.select().count() == 0
+    assert client.get('/api/jobs/missing').status_code == 404
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+静态文件与缓存响应测试（http_cache.py / api.static_files）
+"""
+import gzip
+import hashlib
+import os
+
+import api
+from http_cache import CachedBody
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+def _index_bytes():
+    with open(os.path.join(STATIC_DIR, 'index.html'), 'rb') as f:
+        return f.read()
+
+
+def test_static_route_is_served_by_static_assets():
+    # Flask 内置的 static 端点不能抢先匹配 /static/<path>
+    endpoints = [rule.endpoint for rule in api.app.url_map.iter_rules()
+                 if rule.rule.startswith('/static/')]
+    assert endpoints == ['static_files']
+
+
+def test_static_index_is_precompressed_with_content_etag():
+    raw = _index_bytes()
+    client = api.app.test_client()
+    response = client.get('/static/index.html', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == '"' + hashlib.sha1(raw).hexdigest() + '"'
+    assert gzip.decompress(response.get_data()) == raw
+
+
+def test_static_etag_revalidation_returns_304():
+    client = api.app.test_client()
+    etag = client.get('/static/index.html').headers['ETag']
+    response = client.get('/static/index.html', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_static_content_type_has_single_charset():
+    client = api.app.test_client()
+    for path in ('/', '/static/index.html'):
+        assert client.get(path).headers['Content-Type'] == 'text/html; charset=utf-8'
+
+
+def test_cached_body_keeps_json_content_type():
+    body = CachedBody(b'{"success": true}', 'application/json')
+    with api.app.test_request_context('/'):
+        response = body.to_response(api.request)
+    assert response.headers['Content-Type'] == 'application/json'
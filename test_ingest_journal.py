@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+本地接入日志测试（ingest_journal.py）：记录格式、崩溃尾部、恰好一次的重放
+"""
+import json
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+import ingest_journal
+from conftest import deliver
+from ingest_journal import IngestJournal, encode_record, read_records
+from models import GameSession
+
+START = datetime(2024, 6, 1, 8, tzinfo=timezone.utc).timestamp()
+
+
+def _message(event, player_id):
+    return json.dumps({'event': event, 'playerId': player_id, 'playerName': f'{player_id} 程序'}).encode()
+
+
+def test_records_round_trip_and_stop_at_damage():
+    data = encode_record(1.5, 'game', b'{"a": 1}') + encode_record(2.5, '游戏', b'H|ABC')
+    records, end = read_records(data)
+    assert [(r[1], r[2], r[3]) for r in records] == [(1.5, 'game', b'{"a": 1}'), (2.5, '游戏', b'H|ABC')]
+    assert end == len(data)
+    # 写了一半的尾部与校验失败的记录都不返回
+    assert len(read_records(data[:-1])[0]) == 1
+    damaged = bytearray(data)
+    damaged[-1] ^= 0xFF
+    assert read_records(bytes(damaged))[1] == records[0][0]
+
+
+def test_torn_tail_is_truncated_on_open(tmp_path):
+    journal = IngestJournal(str(tmp_path), segment_bytes=1 << 20)
+    journal.append('game', b'one', received_at=START)
+    journal.close()
+    path = ingest_journal._segment_path(str(tmp_path), 1)
+    with open(path, 'ab') as f:
+        f.write(encode_record(START, 'game', b'two')[:-3])
+
+    reopened = IngestJournal(str(tmp_path), segment_bytes=1 << 20)
+    assert os.path.getsize(path) == reopened.size
+    reopened.append('game', b'three', received_at=START)
+    with open(path, 'rb') as f:
+        assert [r[3] for r in read_records(f.read())[0]] == [b'one', b'three']
+    reopened.close()
+
+
+def _open(directory):
+    """与 start_applier 相同：从已提交的位置（没有时从第一段开头）继续应用"""
+    ingest_journal.ensure_journal_table()
+    journal = IngestJournal(directory, segment_bytes=120, batch_size=2)
+    position = journal.applied_position()
+    journal._position = position if position[0] else (ingest_journal._segment_numbers(directory)[0], 0)
+    return journal
+
+
+def _apply_all(journal, apply_batch):
+    applied = 0
+    for _ in range(100):
+        before = journal._position
+        applied += journal.apply_pending(apply_batch)
+        if journal._position == before:
+            return applied
+    raise AssertionError('日志没有应用完')
+
+
+def test_replay_after_crash_applies_each_message_once(tracker, tmp_path):
+    directory = str(tmp_path / 'journal')
+    tracker.journal = _open(directory)
+    for player_id in ('DEV1', 'DEV2', 'DEV3'):
+        deliver(tracker, _message('game_start', player_id))
+    deliver(tracker, _message('game_start', 'DEV1'))  # 重复消息在追加前过滤
+    for player_id in ('DEV1', 'DEV2', 'DEV3'):
+        deliver(tracker, _message('game_end', player_id))
+    # 消息只追加到日志，尚未写库
+    assert GameSession.select().count() == 0
+    assert len(ingest_journal._segment_numbers(directory)) > 1
+
+    # 一批在写库时失败：整批回滚，位置不变
+    journal = tracker.journal
+    position = journal._position
+
+    def failing(records):
+        tracker.apply_journal_batch(records)
+        raise RuntimeError('数据库被锁')
+    with pytest.raises(RuntimeError):
+        journal.apply_pending(failing)
+    assert journal._position == position
+    assert GameSession.select().count() == 0
+    # 与应用线程相同：回滚后清空进程内缓存
+    ingest_journal._reset_ingest_caches()
+
+    # 应用第一批后进程崩溃
+    assert journal.apply_pending(tracker.apply_journal_batch) == 2
+    journal.close()
+
+    restarted = _open(directory)
+    assert _apply_all(restarted, tracker.apply_journal_batch) == 4
+    sessions = list(GameSession.select())
+    assert len(sessions) == 3
+    assert all(s.end_time is not None for s in sessions)
+    # 全部应用后只保留当前段
+    assert ingest_journal._segment_numbers(directory) == [restarted.segment]
+    assert restarted.lag_bytes() == 0
+    restarted.close()
+
+
+def test_sessions_use_journal_receive_time(tracker, tmp_path):
+    journal = _open(str(tmp_path / 'journal'))
+    journal.append('game', _message('game_start', 'DEV1'), received_at=START)
+    journal.append('game', _message('game_end', 'DEV1'), received_at=START + 90)
+    _apply_all(journal, tracker.apply_journal_batch)
+    assert GameSession.get().duration_seconds == 90
+    journal.close()
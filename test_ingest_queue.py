@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+接入过载保护测试（ingest_queue.py）：令牌桶、队列丢弃顺序、背压
+"""
+import threading
+import time
+
+from conftest import deliver
+from ingest_queue import DeviceRateLimiter, IngestQueue, INGEST_RATE_LIMITED, INGEST_SHED
+from models import DeviceStatus, GameSession
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_burst_and_refill():
+    clock = _Clock()
+    limiter = DeviceRateLimiter(rate=2, burst=3, clock=clock)
+    assert [limiter.allow('DEV1') for _ in range(4)] == [True, True, True, False]
+    # 其他设备有自己的桶
+    assert limiter.allow('DEV2')
+    clock.now += 0.5
+    assert limiter.allow('DEV1')
+    assert not limiter.allow('DEV1')
+    # 补充不超过 burst
+    clock.now += 60
+    assert [limiter.allow('DEV1') for _ in range(4)] == [True, True, True, False]
+
+
+def test_limiter_disabled_and_bounded():
+    assert all(DeviceRateLimiter(rate=0, burst=1).allow('DEV1') for _ in range(10))
+    assert DeviceRateLimiter(rate=1, burst=1).allow(None)
+    limiter = DeviceRateLimiter(rate=1, burst=1, max_devices=2, clock=_Clock())
+    for key in ('a', 'b', 'c'):
+        limiter.allow(key)
+    assert len(limiter) == 2
+    # 最久未出现的 a 已被淘汰，重新获得满桶
+    assert limiter.allow('a')
+
+
+def _drain(queue):
+    return [payload for _, payload in queue._take()] if len(queue) else []
+
+
+def test_queue_shedding_order():
+    queue = IngestQueue(lambda batch: None, max_size=3, batch_size=10)
+    shed = {reason: INGEST_SHED.get(reason) for reason in ('collapsed', 'queue_full', 'evicted')}
+
+    assert queue.offer('hb1-a', 'heartbeat', 'DEV1')
+    assert queue.offer('hb2', 'heartbeat', 'DEV2')
+    # 1. 同一设备排队中的心跳被替换，位置不变
+    assert queue.offer('hb1-b', 'heartbeat', 'DEV1')
+    assert queue.offer('start3', 'game_start', 'DEV3')
+    assert len(queue) == 3
+    # 2. 队列满时新设备的心跳丢弃
+    assert not queue.offer('hb4', 'heartbeat', 'DEV4')
+    # 3. 开始 / 结束事件挤掉最早的排队心跳
+    assert queue.offer('end3', 'game_end', 'DEV3')
+    assert _drain(queue) == ['hb2', 'start3', 'end3']
+
+    assert INGEST_SHED.get('collapsed') == shed['collapsed'] + 1
+    assert INGEST_SHED.get('queue_full') == shed['queue_full'] + 1
+    assert INGEST_SHED.get('evicted') == shed['evicted'] + 1
+
+
+def test_heartbeat_after_event_is_not_merged():
+    queue = IngestQueue(lambda batch: None, max_size=10, batch_size=10)
+    queue.offer('hb-a', 'heartbeat', 'DEV1')
+    queue.offer('start', 'game_start', 'DEV1')
+    queue.offer('hb-b', 'heartbeat', 'DEV1')
+    queue.offer('hb-c', 'heartbeat', 'DEV1')
+    assert _drain(queue) == ['hb-a', 'start', 'hb-c']
+
+
+def test_queue_full_of_events_blocks_producer():
+    queue = IngestQueue(lambda batch: None, max_size=2, batch_size=1)
+    queue.offer('start1', 'game_start', 'DEV1')
+    queue.offer('start2', 'game_start', 'DEV2')
+    offered = threading.Event()
+    producer = threading.Thread(target=lambda: (queue.offer('end1', 'game_end', 'DEV1'), offered.set()))
+    producer.start()
+    assert not offered.wait(0.2)
+    assert _drain(queue) == ['start1']
+    assert offered.wait(2)
+    producer.join(2)
+    assert [_drain(queue), _drain(queue)] == [['start2'], ['end1']]
+
+
+def test_batches_are_handled_in_background():
+    batches = []
+    done = threading.Event()
+
+    def handle(batch):
+        batches.append([payload for _, payload in batch])
+        if sum(map(len, batches)) == 3:
+            done.set()
+    queue = IngestQueue(handle, max_size=10, batch_size=2)
+    for i in range(3):
+        queue.offer(f'start{i}', 'game_start', f'DEV{i}')
+    queue.start()
+    assert done.wait(2)
+    assert [p for batch in batches for p in batch] == ['start0', 'start1', 'start2']
+    assert all(len(batch) <= 2 for batch in batches)
+
+
+def test_rate_limited_device_keeps_session_events(tracker):
+    clock = _Clock()
+    tracker.limiter = DeviceRateLimiter(rate=1, burst=2, clock=clock)
+    limited = INGEST_RATE_LIMITED.get('heartbeat')
+    heartbeat = {'event': 'heartbeat', 'playerId': 'DEV1', 'playerName': '机器 1'}
+    deliver(tracker, {'event': 'game_start', 'playerId': 'DEV1', 'playerName': '机器 1'})
+    deliver(tracker, heartbeat)
+    last_seen = DeviceStatus.get().last_seen
+    time.sleep(0.01)
+    for _ in range(5):
+        deliver(tracker, heartbeat)
+    # 超限的心跳丢弃，开始 / 结束事件照常处理
+    assert INGEST_RATE_LIMITED.get('heartbeat') == limited + 5
+    assert DeviceStatus.get().last_seen == last_seen
+    deliver(tracker, {'event': 'game_end', 'playerId': 'DEV1', 'playerName': '机器 1'})
+    assert GameSession.get().end_time is not None
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+多进程接入测试（ingest_workers.py / mqtt_client.MqttConnection / 缓存失效通知）
+"""
+import json
+import socket
+import threading
+from datetime import date
+
+import pytest
+
+import active_bitmaps
+import change_notify
+import minute_activity
+import wire_format
+from ingest_workers import partition_for, partition_key
+from mqtt_client import GameUsageTracker, MqttConnection
+
+needs_unix = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='需要 Unix 域套接字')
+
+
+def test_mqtt_connection_is_abstract():
+    with pytest.raises(TypeError):
+        MqttConnection()
+
+
+def test_partition_key_matches_between_formats():
+    as_json = json.dumps({'event': 'heartbeat', 'bleId': 'MicroBlocks ABC', 'playerId': 'p1'}).encode()
+    compact = wire_format.encode_compact('heartbeat', 'ABC')
+    assert partition_key(as_json) == partition_key(compact) == 'MICROBLOCKSABC'
+    assert partition_for(as_json, 4) == partition_for(compact, 4)
+
+
+def test_partition_key_falls_back_to_player_id():
+    payload = json.dumps({'event': 'game_start', 'playerId': '一楼\\"机器', 'playerName': 'x'}).encode()
+    assert partition_key(payload) == '一楼\\"机器'
+
+
+def test_forget_cached_devices_drops_marks_and_pending():
+    day = date(2024, 6, 1)
+    active_bitmaps._marked.update({(day, 1), (date(2024, 6, 2), 1), (day, 2)})
+    minute_activity._pending.update({(1, day): 1, (2, day): 1})
+    try:
+        GameUsageTracker.forget_cached_devices({'type': 'forget_devices', 'device_ids': [1], 'day': '2024-06-01'})
+        assert active_bitmaps._marked == {(date(2024, 6, 2), 1), (day, 2)}
+        assert set(minute_activity._pending) == {(1, day), (2, day)}
+
+        GameUsageTracker.forget_cached_devices({'type': 'forget_devices', 'device_ids': [1], 'day': None})
+        assert active_bitmaps._marked == {(day, 2)}
+        assert set(minute_activity._pending) == {(2, day)}
+    finally:
+        active_bitmaps._marked.clear()
+        minute_activity._pending.clear()
+
+
+@needs_unix
+def test_invalidation_broadcast_reaches_other_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(change_notify, 'CACHE_INVALIDATE_DIR', str(tmp_path))
+    other = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    other.bind(str(tmp_path / '999999.sock'))
+    # 已退出进程遗留的套接字文件
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(str(tmp_path / '999998.sock'))
+    stale.close()
+    try:
+        assert change_notify.forget_devices([3, 4], date(2024, 6, 1)) == 1
+        assert json.loads(other.recv(4096)) == {'type': 'forget_devices', 'device_ids': [3, 4], 'day': '2024-06-01'}
+        assert not (tmp_path / '999998.sock').exists()
+    finally:
+        other.close()
+
+
+@needs_unix
+def test_invalidation_listener_delivers_every_valid_message(tmp_path, monkeypatch):
+    monkeypatch.setattr(change_notify, 'CACHE_INVALIDATE_DIR', str(tmp_path))
+    received = []
+    done = threading.Event()
+
+    def callback(data):
+        received.append(data)
+        if len(received) == 2:
+            done.set()
+
+    listener = change_notify.CacheInvalidationListener(callback).start()
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        for payload in (b'{"type":"forget_devices","device_ids":[1],"day":null}',
+                        b'not json',
+                        b'{"type":"forget_devices","device_ids":["1; DROP"]}',
+                        b'{"type":"forget_devices","device_ids":[2],"day":"2024-06-01"}'):
+            sender.sendto(payload, listener.address)
+        assert done.wait(2)
+        # 不合并：两条有效通知都回调，格式不正确的被忽略
+        assert [data['device_ids'] for data in received] == [[1], [2]]
+    finally:
+        sender.close()
+        listener.stop()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+排行榜测试（leaderboard.py）：前 K 名与并列名次、按注册表分组、上期对比
+"""
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import api
+from conftest import play
+from leaderboard import compute_leaderboard, top_k
+from models import DeviceRegistry
+
+
+def test_top_k_includes_ties_with_competition_ranks():
+    values = {'a': 30, 'b': 20, 'c': 20, 'd': 10, 'e': 20}
+    assert top_k(values, 2) == [(1, 'a', 30), (2, 'b', 20), (2, 'c', 20), (2, 'e', 20)]
+    assert top_k(values, 5) == [(1, 'a', 30), (2, 'b', 20), (2, 'c', 20), (2, 'e', 20), (5, 'd', 10)]
+    assert top_k({'x': 1, 'y': 1}, 1) == [(1, 'x', 1), (1, 'y', 1)]
+    assert top_k(values, 0) == [] and top_k({}, 3) == []
+
+
+@pytest.fixture
+def games(tracker):
+    day = datetime(2024, 6, 10, 8, tzinfo=timezone.utc)
+    for player_id, minutes in (('MICROBLOCKSAAA', 30), ('MICROBLOCKSBBB', 20), ('MICROBLOCKSCCC', 20),
+                               ('p-free', 10)):
+        play(tracker, player_id, f'{player_id} 程序', day, minutes)
+    # 上一个等长周期
+    play(tracker, 'p-free', 'p-free 程序', day - timedelta(days=1), 60)
+    play(tracker, 'MICROBLOCKSAAA', 'MICROBLOCKSAAA 程序', day - timedelta(days=1), 1)
+    for ble_id, campus, project in (('MICROBLOCKSAAA', '一校区', '娃娃机'), ('MICROBLOCKSBBB', '一校区', '赛车'),
+                                    ('MICROBLOCKSCCC', '二校区', '娃娃机')):
+        DeviceRegistry.create(ble_id=ble_id, campus_name=campus, project_name=project)
+
+
+def _ranks(data):
+    return [(item['rank'], item['key'], item['value']) for item in data['items']]
+
+
+def test_device_leaderboard_with_ties_and_previous_period(games):
+    data = compute_leaderboard('device', 'time', date(2024, 6, 10), date(2024, 6, 10), limit=2)
+    assert _ranks(data) == [(1, 'MICROBLOCKSAAA', 1800), (2, 'MICROBLOCKSBBB', 1200), (2, 'MICROBLOCKSCCC', 1200)]
+    assert data['total_entities'] == 4
+    assert data['previous_period'] == {'start_date': '2024-06-09', 'end_date': '2024-06-09'}
+    first = data['items'][0]
+    assert (first['previous_value'], first['previous_rank'], first['change']) == (60, 2, 1740)
+    assert first['name'] == 'MICROBLOCKSAAA 程序'
+    assert data['items'][1]['previous_rank'] is None
+
+    sessions = compute_leaderboard('device', 'sessions', date(2024, 6, 10), date(2024, 6, 10), limit=1)
+    assert [item['rank'] for item in sessions['items']] == [1, 1, 1, 1]
+
+
+@pytest.mark.parametrize('group, expected', [
+    ('project', [(1, '娃娃机', 3000), (2, '赛车', 1200)]),
+    ('campus', [(1, '一校区', 3000), (2, '二校区', 1200)]),
+])
+def test_grouped_leaderboard_uses_registry(games, group, expected):
+    data = compute_leaderboard(group, 'time', date(2024, 6, 10), date(2024, 6, 10))
+    assert _ranks(data) == expected
+    # 未注册的设备只计入 unassigned
+    assert data['unassigned'] == {'total_time_seconds': 600, 'session_count': 1}
+
+
+def test_leaderboard_endpoint_validates_parameters(games):
+    client = api.app.test_client()
+    ok = client.get('/api/leaderboard?group=project&start_date=2024-06-10&end_date=2024-06-10')
+    assert ok.status_code == 200
+    assert ok.get_json()['data']['items'][0]['key'] == '娃娃机'
+    assert client.get('/api/leaderboard?group=planet').status_code == 400
+    assert client.get('/api/leaderboard?metric=speed').status_code == 400
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+日志工具测试（log_utils.py）：汇总、告警限流、追踪列表同步、非阻塞队列
+"""
+import logging
+import queue
+
+import log_utils
+from log_utils import IngestLogSampler, LOG_RECORDS_DROPPED
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _logger(name):
+    logger = logging.getLogger(f'test.{name}')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = _ListHandler()
+    logger.handlers = [handler]
+    return logger, handler
+
+
+def test_sampler_summarises_counts_per_event():
+    logger, handler = _logger('summary')
+    sampler = IngestLogSampler(logger, interval=3600)
+    for i in range(5):
+        sampler.count('heartbeat', f'DEV{i % 2}')
+    sampler.count('game_start')
+    assert handler.records == []
+
+    sampler.flush()
+    [record] = handler.records
+    message = record.getMessage()
+    assert 'heartbeat 5 条/2 台设备' in message
+    assert 'game_start 1 条' in message
+    assert message.index('heartbeat') < message.index('game_start')
+
+    # 新周期没有计数时不输出空汇总
+    sampler.flush()
+    assert len(handler.records) == 1
+
+
+def test_sampler_warns_once_per_window_and_reports_suppressed():
+    logger, handler = _logger('warning')
+    sampler = IngestLogSampler(logger, interval=3600)
+    for _ in range(4):
+        sampler.warning('bad_json', '无效 JSON')
+    sampler.warning('missing_event', '缺少 event')
+    assert [r.getMessage() for r in handler.records] == ['无效 JSON', '缺少 event']
+
+    sampler.flush()
+    assert '已抑制告警 3 条（bad_json 3）' in handler.records[-1].getMessage()
+    # 新周期重新允许输出一次
+    sampler.warning('bad_json', '无效 JSON')
+    assert handler.records[-1].getMessage() == '无效 JSON'
+
+
+def test_trace_list_is_shared_through_file(tmp_path):
+    logger, _ = _logger('trace')
+    trace_file = str(tmp_path / 'trace.json')
+    api_side = IngestLogSampler(logger, interval=3600, trace_file=trace_file)
+    ingest_side = IngestLogSampler(logger, interval=3600, trace_devices={'ENV1'}, trace_file=trace_file)
+
+    api_side.enable_trace('DEV1')
+    ingest_side._load_trace_file()
+    # 首次读取与 TRACE_DEVICES 合并
+    assert ingest_side.traced_devices() == ['DEV1', 'ENV1']
+
+    api_side.disable_trace('DEV1')
+    # 两次写入可能落在同一个 mtime 刻度内，强制重新读取
+    ingest_side._trace_mtime = -1
+    ingest_side._load_trace_file()
+    # 之后以文件为准
+    assert not ingest_side.is_traced('DEV1')
+    assert ingest_side.traced_devices() == []
+
+
+def test_queue_handler_drops_instead_of_blocking():
+    handler = log_utils._NonBlockingQueueHandler(queue.Queue(maxsize=1))
+    logger = logging.getLogger('test.queue')
+    before = LOG_RECORDS_DROPPED.get()
+    record = logger.makeRecord('test.queue', logging.INFO, __file__, 1, '设备 %s', ('DEV1',), None)
+    handler.handle(record)
+    handler.handle(record)
+    assert LOG_RECORDS_DROPPED.get() == before + 1
+    queued = handler.queue.get_nowait()
+    # 业务线程只合并参数，不做格式化
+    assert queued.msg == '设备 DEV1' and queued.args is None
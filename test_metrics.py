@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+指标注册表测试（metrics.py）：Prometheus 文本输出与跨进程汇总
+"""
+import pytest
+
+import metrics
+from conftest import deliver
+from metrics import Registry
+
+
+def _lines(registry, prefix):
+    return [line for line in registry.render().splitlines() if line.startswith(prefix)]
+
+
+def test_counter_render_and_remote_sum():
+    local = Registry()
+    counter = local.counter('ingest_messages_total', '消息数', ('event',))
+    counter.inc('game_start', amount=3)
+
+    worker = Registry()
+    worker.counter('ingest_messages_total', '消息数', ('event',)).inc('game_start', amount=2)
+    worker.counter('ingest_messages_total', '消息数', ('event',)).inc('heartbeat')
+
+    local.merge_remote('worker0', worker.snapshot())
+    assert _lines(local, 'ingest_messages_total{') == [
+        'ingest_messages_total{event="game_start"} 5',
+        'ingest_messages_total{event="heartbeat"} 1',
+    ]
+    # 同一来源再次发送时替换上一次的累计值，而不是再加一次
+    worker.counter('ingest_messages_total', '消息数', ('event',)).inc('heartbeat')
+    local.merge_remote('worker0', worker.snapshot())
+    assert 'ingest_messages_total{event="heartbeat"} 2' in _lines(local, 'ingest_messages_total{')
+    # 本进程的取值不受汇总影响
+    assert counter.get('game_start') == 3
+
+
+def test_histogram_remote_sum_and_lazy_registration():
+    local = Registry()
+    worker = Registry()
+    histogram = worker.histogram('ingest_db_seconds', '耗时', ('event',), buckets=(0.01, 0.1))
+    histogram.observe(0.005, 'game_end')
+    histogram.observe(0.05, 'game_end')
+
+    # 主进程没有注册过的指标按来源的定义补注册
+    local.merge_remote('worker1', worker.snapshot())
+    local.merge_remote('worker2', worker.snapshot())
+    assert _lines(local, 'ingest_db_seconds_') == [
+        'ingest_db_seconds_bucket{event="game_end",le="0.01"} 2',
+        'ingest_db_seconds_bucket{event="game_end",le="0.1"} 4',
+        'ingest_db_seconds_bucket{event="game_end",le="+Inf"} 4',
+        'ingest_db_seconds_sum{event="game_end"} 0.11',
+        'ingest_db_seconds_count{event="game_end"} 4',
+    ]
+
+
+def test_gauge_function_is_included_in_snapshot():
+    registry = Registry()
+    gauge = registry.gauge('ingest_queue_depth', '队列长度')
+    gauge.set_function(lambda: 7)
+    assert registry.snapshot()['ingest_queue_depth'][4] == {(): 7}
+    assert _lines(registry, 'ingest_queue_depth ') == ['ingest_queue_depth 7']
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('latency_seconds', '耗时', buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    assert _lines(registry, 'latency_seconds_') == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 3.65',
+        'latency_seconds_count 4',
+    ]
+    assert histogram.get_count() == 4
+
+
+def test_labels_are_validated_and_escaped():
+    registry = Registry()
+    counter = registry.counter('rejected_total', '拒绝数', ('reason',))
+    with pytest.raises(ValueError):
+        counter.inc()
+    counter.inc('bad "json"\n')
+    assert _lines(registry, 'rejected_total{') == ['rejected_total{reason="bad \\"json\\"\\n"} 1']
+    # 同名指标重复注册返回已有的实例
+    assert registry.counter('rejected_total', '拒绝数', ('reason',)) is counter
+
+
+def test_ingest_records_message_and_rejection_metrics(tracker):
+    messages = metrics.INGEST_MESSAGES.get('game_start')
+    db_count = metrics.INGEST_DB_SECONDS.get_count('game_start')
+    rejected = metrics.INGEST_REJECTED.get('bad_json')
+
+    deliver(tracker, {'event': 'game_start', 'playerId': 'p-metrics', 'playerName': '一号机'})
+    deliver(tracker, b'{not json')
+
+    assert metrics.INGEST_MESSAGES.get('game_start') == messages + 1
+    assert metrics.INGEST_DB_SECONDS.get_count('game_start') == db_count + 1
+    assert metrics.INGEST_REJECTED.get('bad_json') == rejected + 1
+
+
+def test_metrics_endpoint_reports_request_latency(temp_db):
+    import api
+    client = api.app.test_client()
+    client.get('/metrics')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    assert 'http_request_seconds_count{endpoint="get_metrics",method="GET",status="200"}' in text
+    assert '# TYPE ingest_message_seconds histogram' in text
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+分钟活跃位图测试（minute_activity.py）
+"""
+import json
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import minute_activity
+from models import Device, DeviceMinuteActivity
+
+DAY = date(2024, 6, 1)
+
+
+def _at(hour, minute, day=DAY):
+    return datetime(day.year, day.month, day.day, hour, minute, 30, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def device_id(temp_db):
+    return Device.create(device_key='DEV1', name='机器 1').id
+
+
+def test_flush_merges_bits_with_stored_rows(device_id):
+    for minute in (0, 1, 1, 5):
+        minute_activity.record(device_id, _at(10, minute))
+    # 尚未写库的位在读取时合并
+    assert minute_activity.load([(device_id, DAY)])[(device_id, DAY)].bit_count() == 3
+    assert minute_activity.flush() == 1
+    assert minute_activity.flush() == 0
+
+    minute_activity.record(device_id, _at(10, 5))
+    minute_activity.record(device_id, _at(23, 59))
+    minute_activity.flush()
+    row = DeviceMinuteActivity.get()
+    assert row.minutes == 4
+    assert len(bytes(row.bitmap)) == minute_activity.BITMAP_BYTES
+    assert minute_activity.from_bytes(bytes(row.bitmap)) >> (23 * 60 + 59) & 1
+
+
+def test_failed_flush_keeps_pending_bits(device_id, monkeypatch):
+    minute_activity.record(device_id, _at(8, 0))
+
+    def broken(keys):
+        raise RuntimeError('数据库被锁')
+    monkeypatch.setattr(minute_activity, '_select', broken)
+    with pytest.raises(RuntimeError):
+        minute_activity.flush()
+    assert minute_activity._pending == {(device_id, DAY): 1 << 480}
+    assert DeviceMinuteActivity.select().count() == 0
+
+
+def test_session_minutes_cross_midnight(device_id):
+    for minute in range(0, 60, 2):
+        minute_activity.record(device_id, _at(23, minute))
+    for minute in range(10):
+        minute_activity.record(device_id, _at(0, minute, DAY + timedelta(days=1)))
+    minute_activity.flush()
+    minutes = minute_activity.session_minutes([
+        (1, device_id, _at(23, 30), _at(0, 4, DAY + timedelta(days=1))),
+        (2, device_id, _at(23, 0), _at(23, 9)),
+        (3, device_id, _at(12, 0), None),
+    ], now=_at(12, 30))
+    assert minutes == {1: 15 + 5, 2: 5, 3: 0}
+
+
+def test_daily_minutes_merge_names_and_pending(device_id):
+    other_name = Device.create(device_key='DEV1', name='新程序').id
+    minute_activity.record(device_id, _at(9, 0))
+    minute_activity.record(other_name, _at(9, 0))
+    minute_activity.record(other_name, _at(9, 1))
+    minute_activity.flush()
+    minute_activity.record(device_id, _at(9, 2))
+    assert minute_activity.daily_minutes(DAY, DAY) == {(DAY, 'DEV1'): 3}
+
+    minute_activity.clear_devices([device_id, other_name])
+    assert minute_activity.daily_minutes(DAY, DAY) == {}
+
+
+def test_heartbeats_set_minute_bits(tracker):
+    for minute in (0, 0, 3):
+        tracker.handle_payload(json.dumps({'event': 'heartbeat', 'playerId': 'DEV1', 'playerName': '机器 1'}).encode(),
+                               received_at=_at(7, minute))
+    minute_activity.flush()
+    assert minute_activity.daily_minutes(DAY, DAY) == {(DAY, 'DEV1'): 2}
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+按月分区测试（partitions.py）：封存、跨分区路由、分区内删除、整月到期删除
+"""
+import os
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import api
+import change_notify
+import partitions
+from conftest import play
+from models import Device, GameSession, SessionPartition, DailyUsageArchive
+
+NOW = datetime(2024, 7, 10, 12, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def partitioned(tracker, tmp_path, monkeypatch):
+    monkeypatch.setattr(partitions, 'PARTITION_DIR', str(tmp_path / 'partitions'))
+    monkeypatch.setattr(partitions, 'SEAL_BATCH_SIZE', 3)
+    monkeypatch.setattr(partitions, 'SEAL_PAUSE_SECONDS', 0)
+    monkeypatch.setattr(change_notify, 'CACHE_INVALIDATE_DIR', str(tmp_path / 'invalidate'))
+    partitions.ensure_partition_table()
+    for month in (2, 3, 4, 5, 6, 7):
+        for day in (1, 15, 28):
+            for player_id in ('DEV1', 'DEV2'):
+                play(tracker, player_id, f'{player_id} 程序', datetime(2024, month, day, 9, tzinfo=timezone.utc),
+                     month + day)
+    # 仍在进行中的会话（设备当前会话）不封存
+    tracker.handle_game_start('DEV3', 'DEV3 程序', now=datetime(2024, 5, 31, 23, tzinfo=timezone.utc))
+    return tracker
+
+
+def _players():
+    return api.compute_players(api.DashboardContext(now=NOW))
+
+
+def test_seal_moves_finished_months_and_routes_reads(partitioned):
+    before = _players()
+    total = GameSession.select().count()
+
+    moved = partitions.seal_due(NOW)
+    # 7 月之前的月份都已到期
+    assert moved == 5 * 6
+    assert partitions.sealed_months() == [date(2024, m, 1) for m in (2, 3, 4, 5, 6)]
+    assert GameSession.select().count() == total - moved
+    assert GameSession.select().where(GameSession.end_time.is_null()).count() == 1
+    assert all(os.path.exists(partitions.partition_path(m)) for m in partitions.sealed_months())
+    # 统计接口通过 ATTACH 的合并视图读取，结果不变
+    assert _players() == before
+    counts = partitions.across(None, None, lambda start, end: GameSession.select().where(
+        *partitions.range_conditions(start, end)).count())
+    assert sum(counts) == total
+    # 再次封存不重复移动
+    assert partitions.seal_due(NOW) == 0
+
+
+def test_across_splits_by_attach_limit(partitioned, monkeypatch):
+    before = _players()
+    partitions.seal_due(NOW)
+    monkeypatch.setattr(partitions, 'max_attached', lambda: 3)
+    assert len(partitions.windows()) == 2
+    with pytest.raises(ValueError):
+        with partitions.attached():
+            pass
+    starts = partitions.across(None, None, lambda start, end: [str(s.start_time)[:7] for s in GameSession.select(
+        GameSession.start_time).where(*partitions.range_conditions(start, end)).order_by(GameSession.start_time)])
+    # 每段只统计自己的时间范围：没有重复、没有遗漏
+    flat = [month for chunk in starts for month in chunk]
+    assert flat == sorted(flat) and len(flat) == GameSession.select().count() + 30
+    assert _players() == before
+
+
+def test_deleting_sealed_sessions(partitioned):
+    partitions.seal_due(NOW)
+    entry = SessionPartition.get(SessionPartition.month == date(2024, 3, 1))
+    client = api.app.test_client()
+    assert client.delete(f'/api/session/{entry.min_id}').status_code == 200
+    assert client.delete(f'/api/session/{entry.min_id}').status_code == 404
+    assert SessionPartition.get(SessionPartition.month == date(2024, 3, 1)).session_count == entry.session_count - 1
+
+    # 三月第一条会话属于 DEV1，已在上面删除
+    deleted = partitions.delete_device_sessions([Device.get(Device.device_key == 'DEV1').id])
+    assert deleted == 5 * 3 - 1
+    assert sum(row.session_count for row in SessionPartition.select()) == 5 * 3
+
+
+def test_expired_partitions_are_archived_then_dropped(partitioned):
+    partitions.seal_due(NOW)
+    before = _players()
+    report = {}
+    assert partitions.drop_expired(date(2024, 4, 15), report) == 2
+    assert report['partitions_dropped'] == ['2024-02', '2024-03']
+    assert not os.path.exists(partitions.partition_path(date(2024, 2, 1)))
+    assert partitions.sealed_months() == [date(2024, m, 1) for m in (4, 5, 6)]
+    assert DailyUsageArchive.select().count() == 2 * 3 * 2
+    # 整月删除后按日汇总接替原始会话，统计结果不变
+    assert _players() == before
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+会话时长分位数草图测试（quantile_sketch.py）
+"""
+import math
+import random
+from datetime import date, datetime, timezone
+
+import pytest
+
+import api
+import quantile_sketch
+from conftest import play
+from models import SessionLengthSketch
+from quantile_sketch import DDSketch, RELATIVE_ACCURACY
+
+
+def _exact(values, q):
+    # 与 DDSketch.quantile 相同的秩定义：第 floor(q * (n - 1)) 个（从 0 开始）
+    return sorted(values)[math.floor(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_quantiles_within_relative_accuracy(seed):
+    rng = random.Random(seed)
+    values = [int(rng.lognormvariate(6, 1.5)) + 1 for _ in range(5000)]
+    sketch = DDSketch()
+    for value in values:
+        sketch.add(value)
+    for q in (0.01, 0.25, 0.5, 0.9, 0.99, 1.0):
+        expected = _exact(values, q)
+        assert abs(sketch.quantile(q) - expected) <= RELATIVE_ACCURACY * expected + 1e-9
+
+
+def test_merge_matches_single_sketch_and_round_trips():
+    rng = random.Random(4)
+    values = [rng.randint(0, 7200) for _ in range(2000)]
+    whole, left, right = DDSketch(), DDSketch(), DDSketch()
+    for i, value in enumerate(values):
+        whole.add(value)
+        (left if i % 2 else right).add(value)
+    merged = left.merge(right)
+    assert merged.buckets == whole.buckets and merged.zero_count == whole.zero_count
+    assert (merged.min, merged.max, merged.total) == (whole.min, whole.max, whole.total)
+
+    restored = DDSketch.from_bytes(whole.to_bytes())
+    assert [restored.quantile(q) for q in (0.5, 0.9, 0.99)] == [whole.quantile(q) for q in (0.5, 0.9, 0.99)]
+    assert restored.count == len(values)
+
+
+def test_remove_and_empty_sketch():
+    sketch = DDSketch()
+    assert sketch.quantile(0.5) is None
+    for value in (0, 60, 600):
+        sketch.add(value)
+    sketch.remove(600)
+    sketch.remove(9999)  # 不存在的值忽略
+    assert sketch.count == 2
+    assert sketch.quantile(1.0) == pytest.approx(60, rel=RELATIVE_ACCURACY)
+    assert sketch.quantile(0) == 0
+    with pytest.raises(ValueError):
+        DDSketch.from_bytes(b'\x09' + sketch.to_bytes()[1:])
+
+
+def test_ingest_updates_sketches_and_rebuild_matches(tracker):
+    start = datetime(2024, 6, 10, 8, tzinfo=timezone.utc)
+    for minutes in (1, 2, 3, 10):
+        play(tracker, 'DEV1', '机器 1', start.replace(hour=8 + minutes), minutes)
+    data = quantile_sketch.compute_percentiles('device', date(2024, 6, 10), date(2024, 6, 10), (0.5, 1.0))
+    [item] = data['items']
+    assert (item['key'], item['count'], item['min_seconds'], item['max_seconds']) == ('DEV1', 4, 60, 600)
+    assert item['percentiles']['p50'] == pytest.approx(120, rel=RELATIVE_ACCURACY)
+    assert item['percentiles']['p100'] == pytest.approx(600, rel=RELATIVE_ACCURACY)
+
+    incremental = {(row.day, row.device_id): bytes(row.sketch) for row in SessionLengthSketch.select()}
+    assert quantile_sketch.rebuild() == 1
+    assert {(row.day, row.device_id): bytes(row.sketch) for row in SessionLengthSketch.select()} == incremental
+
+
+def test_percentiles_endpoint_rejects_bad_quantiles(temp_db):
+    client = api.app.test_client()
+    assert client.get('/api/percentiles?q=0.5,0.9').status_code == 200
+    assert client.get('/api/percentiles?q=1.5').status_code == 400
+    assert client.get('/api/percentiles?group=planet').status_code == 400
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+读写分离测试（models.TimedSqliteDatabase）：只读连接拒绝写入、不被写事务阻塞、读请求让出
+"""
+import threading
+import time
+
+import peewee
+import pytest
+
+import api
+import models
+import sql_profiler
+from models import db, Device
+
+
+def _in_thread(target):
+    result = {}
+
+    def run():
+        try:
+            result['value'] = target()
+        except Exception as e:
+            result['error'] = e
+        finally:
+            db.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(10)
+    return result
+
+
+def test_reader_connection_rejects_writes(temp_db):
+    def write_as_reader():
+        db.connect_reader()
+        assert db.is_reader()
+        Device.create(device_key='DEV1', name='机器 1')
+    result = _in_thread(write_as_reader)
+    assert isinstance(result.get('error'), peewee.OperationalError)
+    assert Device.select().count() == 0
+    # 关闭后同一线程的下一个连接恢复为普通连接
+    db.connect_reader(reuse_if_open=True)
+    db.close()
+    assert not db.is_reader()
+
+
+def test_reader_is_not_blocked_by_open_write_transaction(temp_db):
+    Device.create(device_key='DEV1', name='机器 1')
+    db.close()
+    in_transaction, release = threading.Event(), threading.Event()
+
+    def writer():
+        with db.atomic():
+            Device.create(device_key='DEV2', name='机器 2')
+            in_transaction.set()
+            release.wait(10)
+    thread = threading.Thread(target=lambda: (writer(), db.close()))
+    thread.start()
+    try:
+        assert in_transaction.wait(5)
+
+        def read():
+            db.connect_reader()
+            started = time.monotonic()
+            return Device.select().count(), time.monotonic() - started
+        result = _in_thread(read)
+        # 读到写事务开始前的快照，且不等待写锁
+        assert result['value'][0] == 1
+        assert result['value'][1] < 1
+    finally:
+        release.set()
+        thread.join(10)
+    assert Device.select().count() == 2
+
+
+@pytest.mark.parametrize('method, reader', [('GET', True), ('HEAD', True), ('POST', False), ('DELETE', False)])
+def test_requests_pick_connection_by_method(temp_db, method, reader):
+    db.close()
+    with api.app.test_request_context('/api/players', method=method):
+        api.before_request()
+        try:
+            assert db.is_reader() is reader
+        finally:
+            db.close()
+            sql_profiler.end()
+
+
+def test_readers_yield_while_ingest_writes(monkeypatch):
+    monkeypatch.setattr(models, 'READ_YIELD_MAX_SECONDS', 0.05)
+    started = time.monotonic()
+    db._yield_to_writers()
+    assert time.monotonic() - started < 0.01
+    with db.ingest_priority():
+        started = time.monotonic()
+        db._yield_to_writers()
+        assert time.monotonic() - started >= 0.04
+    assert db._writers == 0
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+注册表批量导入 / 导出测试（registry_io.py）
+"""
+import json
+
+import pytest
+
+import api
+import registry_io
+from models import DeviceRegistry
+from registry_io import RegistryImportError, import_registry, parse_csv, parse_records
+
+CSV_TEXT = ('\ufeffBLE ID,校区,项目,状态,备注\n'
+            'MicroBlocks abc,一校区,娃娃机,,\n'
+            'MicroBlocks ABD,一校区,赛车,disabled,维修中\n'
+            ',二校区,赛车,,\n'
+            'MICROBLOCKSABC,二校区,娃娃机,,\n'
+            'MicroBlocks ABE,二校区,赛车,broken,\n')
+
+
+def test_csv_import_reports_row_errors(temp_db):
+    report = import_registry(parse_csv(CSV_TEXT))
+    assert (report['inserted'], report['failed'], report['committed']) == (2, 3, True)
+    # 行号与表格软件一致（表头为第 1 行）
+    assert [e['row'] for e in report['errors']] == [4, 5, 6]
+    assert '第 2 行' in report['errors'][1]['error']
+    item = DeviceRegistry.get(DeviceRegistry.ble_id == 'MICROBLOCKSABD')
+    assert (item.campus_name, item.status, item.remark) == ('一校区', 'disabled', '维修中')
+
+
+def test_reimport_updates_and_reports_unchanged(temp_db):
+    import_registry(parse_csv(CSV_TEXT))
+    report = import_registry(parse_records([
+        {'ble_id': 'MicroBlocks ABC', 'campus_name': '一校区', 'project_name': '娃娃机'},
+        {'ble_id': 'MicroBlocks ABD', 'campus_name': '三校区', 'project_name': '赛车'},
+    ]))
+    assert (report['inserted'], report['updated'], report['unchanged']) == (0, 1, 1)
+    assert DeviceRegistry.get(DeviceRegistry.ble_id == 'MICROBLOCKSABD').campus_name == '三校区'
+
+
+@pytest.mark.parametrize('options', [{'dry_run': True}, {'all_or_nothing': True}])
+def test_dry_run_and_all_or_nothing_do_not_write(temp_db, options):
+    report = import_registry(parse_csv(CSV_TEXT), **options)
+    assert report['inserted'] == 2
+    assert not report['committed']
+    assert DeviceRegistry.select().count() == 0
+
+
+def test_unparseable_input_is_rejected():
+    with pytest.raises(RegistryImportError):
+        parse_csv('ble_id,remark\nABC,x\n')
+    with pytest.raises(RegistryImportError):
+        parse_records({'rows': []})
+    assert parse_records([1])[0][1] == {'_invalid': 1}
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'json'])
+def test_export_round_trips_through_import(temp_db, fmt):
+    import_registry(parse_csv(CSV_TEXT))
+    exported = ''.join(registry_io.iter_export(fmt))
+    rows = parse_records(json.loads(exported)) if fmt == 'json' else parse_csv(exported)
+    assert [record['ble_id'] for _, record in rows] == ['MICROBLOCKSABC', 'MICROBLOCKSABD']
+    report = import_registry(rows)
+    assert (report['unchanged'], report['failed']) == (2, 0)
+
+
+def test_import_endpoint_accepts_csv_body(temp_db):
+    client = api.app.test_client()
+    response = client.post('/api/device-registry/import?all_or_nothing=1', data=CSV_TEXT.encode(),
+                           content_type='text/csv')
+    assert response.status_code == 200
+    assert not response.get_json()['data']['committed']
+    response = client.post('/api/device-registry/import', data=b'not,a,registry\n', content_type='text/csv')
+    assert response.status_code == 400
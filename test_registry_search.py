@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+注册表搜索测试（registry_search.py）：trigram 索引与 LIKE 回退一致、触发器同步、keyset 分页
+"""
+from datetime import datetime, timezone
+
+import pytest
+
+import api
+import registry_search
+from models import DeviceRegistry
+
+ROWS = [
+    ('MICROBLOCKSABC', '一校区', '娃娃机', None),
+    ('MICROBLOCKSABD', '一校区', '赛车', '维修中'),
+    ('MICROBLOCKSXYZ', '二校区', '大娃娃机', 'say "hi"'),
+    ('MICROBLOCKSQRS', '三校区', '投篮', None),
+]
+
+
+@pytest.fixture
+def registry(temp_db):
+    same_time = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    for ble_id, campus, project, remark in ROWS:
+        DeviceRegistry.create(ble_id=ble_id, campus_name=campus, project_name=project, remark=remark,
+                              created_at=same_time, updated_at=same_time)
+    assert registry_search.fts_available()
+
+
+def _search(keyword, **kwargs):
+    items, total, _ = registry_search.search_registry(keyword, per_page=100, **kwargs)
+    assert total == len(items)
+    return sorted(item.ble_id for item in items)
+
+
+@pytest.mark.parametrize('keyword', ['娃娃机', '娃娃', 'abd', 'MicroBlocks abc', 'croblocksxy', '校区', '"hi"', 'zzz'])
+def test_trigram_index_matches_like_fallback(registry, monkeypatch, keyword):
+    with_index = _search(keyword)
+    monkeypatch.setattr(registry_search, '_fts_available', False)
+    assert with_index == _search(keyword)
+
+
+def test_index_follows_updates_and_deletes(registry):
+    item = DeviceRegistry.get(DeviceRegistry.ble_id == 'MICROBLOCKSQRS')
+    item.project_name = '保龄球'
+    item.save()
+    assert _search('保龄球') == ['MICROBLOCKSQRS']
+    assert _search('投篮') == []
+    item.delete_instance()
+    assert _search('保龄球') == []
+    assert _search('娃娃机', status='active') == ['MICROBLOCKSABC', 'MICROBLOCKSXYZ']
+
+
+def test_keyset_pages_cover_every_row_once(registry):
+    seen, cursor = [], None
+    while True:
+        items, total, cursor = registry_search.search_registry(None, cursor=cursor, per_page=3)
+        seen.extend(item.id for item in items)
+        if cursor is None:
+            break
+    # updated_at 相同时按 id 倒序继续翻页
+    assert seen == sorted(seen, reverse=True)
+    assert len(seen) == total == len(ROWS)
+
+
+def test_registry_endpoint_returns_next_cursor(registry):
+    client = api.app.test_client()
+    first = client.get('/api/device-registry?per_page=2').get_json()
+    second = client.get(f"/api/device-registry?per_page=2&cursor={first['next_cursor']}").get_json()
+    assert first['total'] == 4 and second['next_cursor'] is None
+    assert {d['ble_id'] for d in first['data'] + second['data']} == {row[0] for row in ROWS}
+    assert client.get('/api/device-registry?cursor=not-a-cursor').status_code == 400
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+数据保留测试（retention.py）：分批归档删除、当前会话保护、统计结果不变
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import api
+import retention
+from models import Device, GameSession, DeviceStatus, DailyUsageArchive
+
+NOW = datetime(2024, 6, 30, 12, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def policy(temp_db, monkeypatch):
+    monkeypatch.setattr(retention, 'SESSION_RETENTION_DAYS', 30)
+    monkeypatch.setattr(retention, 'DEVICE_STATUS_RETENTION_DAYS', 7)
+    monkeypatch.setattr(retention, 'BATCH_SIZE', 2)
+    monkeypatch.setattr(retention, 'PAUSE_SECONDS', 0)
+
+
+def _session(device, start, minutes=None):
+    end = start + timedelta(minutes=minutes) if minutes is not None else None
+    return GameSession.create(device=device, start_time=start, end_time=end,
+                              duration_seconds=minutes * 60 if minutes is not None else None)
+
+
+def test_old_sessions_are_archived_then_deleted(policy):
+    dev1 = Device.create(device_key='DEV1', name='机器 1')
+    dev2 = Device.create(device_key='DEV2', name='机器 2')
+    old_day = datetime(2024, 5, 1, 8, tzinfo=timezone.utc)
+    for i in range(3):
+        _session(dev1, old_day + timedelta(hours=i), 10)
+    _session(dev2, old_day, None)
+    # 设备当前会话即使超期也保留
+    current = _session(dev2, old_day + timedelta(days=1), None)
+    DeviceStatus.create(player_id='DEV2', player_name='机器 2', last_seen=NOW, current_session_id=current.id)
+    DeviceStatus.create(player_id='DEV3', player_name='机器 3', last_seen=NOW - timedelta(days=8))
+    recent = _session(dev1, NOW - timedelta(days=1), 20)
+    players_before = api.compute_players(api.DashboardContext(now=NOW))
+
+    report = retention.run_retention(NOW)
+
+    assert report['sessions_deleted'] == 4
+    assert report['chunks'] >= 2
+    assert report['device_status_deleted'] == 1
+    assert {s.id for s in GameSession.select()} == {current.id, recent.id}
+    archive = {(row.player_id, row.session_count, row.completed_sessions, row.total_seconds)
+               for row in DailyUsageArchive.select()}
+    assert archive == {('DEV1', 3, 3, 1800), ('DEV2', 1, 0, 0)}
+    # 归档后统计结果与清理前一致
+    assert api.compute_players(api.DashboardContext(now=NOW)) == players_before
+
+    # 再次执行不会重复归档
+    again = retention.run_retention(NOW)
+    assert again['sessions_deleted'] == 0
+    assert DailyUsageArchive.select().count() == 2
+
+
+def test_archive_groups_merge_into_existing_rows(temp_db):
+    day = datetime(2024, 5, 1).date()
+    first = datetime(2024, 5, 1, 8, tzinfo=timezone.utc)
+    retention.merge_archive_groups({(day, 'DEV1', '机器 1'): [2, 1, 600, first]})
+    retention.merge_archive_groups({(day, 'DEV1', '机器 1'): [1, 1, 300, first + timedelta(hours=2)],
+                                    (day, 'DEV2', '机器 2'): [1, 0, 0, first]})
+    row = DailyUsageArchive.get(DailyUsageArchive.player_id == 'DEV1')
+    assert (row.session_count, row.completed_sessions, row.total_seconds) == (3, 2, 900)
+    assert retention._to_utc(row.last_activity) == first + timedelta(hours=2)
+    assert DailyUsageArchive.select().count() == 2
+
+
+def test_nothing_is_deleted_without_policy(temp_db):
+    device = Device.create(device_key='DEV1', name='机器 1')
+    _session(device, datetime(2020, 1, 1, tzinfo=timezone.utc), 10)
+    report = retention.run_retention(NOW)
+    assert report['sessions_deleted'] == 0
+    assert GameSession.select().count() == 1
+    assert not retention.configured()
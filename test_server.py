@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+生产模式服务器测试（server.py）：chunked 请求体、keep-alive、超大请求头、流式响应与客户端断开
+"""
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import server
+from server import ProductionServer
+
+LARGE_BODY = b'0123456789abcdef' * (server.STREAM_BUFFER_BYTES // 8)
+streams_closed = []
+
+
+class _SlowStream:
+    """逐块生成的大响应，记录 close() 是否被调用"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        for _ in range(self.chunks):
+            yield b'x' * 65536
+
+    def close(self):
+        streams_closed.append(True)
+
+
+def _app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path == '/echo':
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        payload = json.dumps({'length': len(body), 'body': body.decode('utf-8'),
+                              'content_length': environ.get('CONTENT_LENGTH')}).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [payload]
+    if path == '/large':
+        start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+        return iter([LARGE_BODY[i:i + 4096] for i in range(0, len(LARGE_BODY), 4096)])
+    if path == '/large-with-length':
+        start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                  ('Content-Length', str(len(LARGE_BODY)))])
+        return iter([LARGE_BODY[i:i + 4096] for i in range(0, len(LARGE_BODY), 4096)])
+    if path == '/endless':
+        start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+        return _SlowStream(100000)
+    start_response('404 Not Found', [('Content-Type', 'text/plain')])
+    return [b'not found']
+
+
+@pytest.fixture
+def running_server():
+    srv = ProductionServer(_app, host='127.0.0.1', port=0, threads=4)
+    thread = threading.Thread(target=srv.serve, daemon=True)
+    thread.start()
+    assert srv.wait_listening(5)
+    yield srv
+    srv.stop()
+    thread.join(10)
+
+
+def _connect(srv):
+    sock = socket.create_connection(('127.0.0.1', srv.port), timeout=5)
+    return sock, sock.makefile('rb')
+
+
+def _read_response(stream):
+    """读取一个响应，返回 (状态码, 响应头 dict, 响应体)"""
+    status_line = stream.readline()
+    assert status_line, '连接已关闭'
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = stream.readline().decode('latin-1').rstrip('\r\n')
+        if not line:
+            break
+        key, value = line.split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int(stream.readline().strip(), 16)
+            if size == 0:
+                assert stream.readline() == b'\r\n'
+                break
+            body += stream.read(size)
+            assert stream.read(2) == b'\r\n'
+    elif 'content-length' in headers:
+        body = stream.read(int(headers['content-length']))
+    else:
+        body = stream.read()
+    return status, headers, body
+
+
+def test_chunked_request_body_is_decoded(running_server):
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        sock.sendall(b'POST /echo HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'
+                     b'5;ext=1\r\nhello\r\n7\r\n, world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+        status, headers, body = _read_response(stream)
+    assert status == 200
+    assert json.loads(body) == {'length': 12, 'body': 'hello, world', 'content_length': '12'}
+
+
+def test_malformed_chunk_size_is_rejected(running_server):
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        sock.sendall(b'POST /echo HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\nhello\r\n0\r\n\r\n')
+        status, headers, _ = _read_response(stream)
+    assert status == 400
+    assert headers['connection'] == 'close'
+
+
+def test_keep_alive_serves_several_requests(running_server):
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        for text in ('first', 'second'):
+            sock.sendall(b'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n%s'
+                         % (len(text), text.encode()))
+            status, headers, body = _read_response(stream)
+            assert status == 200
+            assert headers['connection'] == 'keep-alive'
+            assert json.loads(body)['body'] == text
+        # 流式响应之后连接仍可继续使用
+        sock.sendall(b'GET /large HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert _read_response(stream)[2] == LARGE_BODY
+        sock.sendall(b'GET /missing HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        status, headers, _ = _read_response(stream)
+        assert status == 404
+        assert headers['connection'] == 'close'
+        assert stream.read() == b''
+
+
+def test_http10_without_keep_alive_closes(running_server):
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        sock.sendall(b'GET /large HTTP/1.0\r\n\r\n')
+        status, headers, body = _read_response(stream)
+    # HTTP/1.0 不能使用 chunked：没有 Content-Length 时以关闭连接结束响应
+    assert status == 200
+    assert 'transfer-encoding' not in headers
+    assert body == LARGE_BODY
+
+
+def test_large_response_is_chunked_or_keeps_length(running_server):
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        sock.sendall(b'GET /large HTTP/1.1\r\nHost: x\r\n\r\n')
+        status, headers, body = _read_response(stream)
+        assert headers['transfer-encoding'] == 'chunked'
+        assert body == LARGE_BODY
+        sock.sendall(b'GET /large-with-length HTTP/1.1\r\nHost: x\r\n\r\n')
+        status, headers, body = _read_response(stream)
+        assert 'transfer-encoding' not in headers
+        assert int(headers['content-length']) == len(LARGE_BODY)
+        assert body == LARGE_BODY
+
+
+def test_oversized_headers_are_rejected(running_server):
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        try:
+            sock.sendall(b'GET /echo HTTP/1.1\r\nHost: x\r\nX-Big: ' + b'a' * (server.MAX_HEADER_BYTES + 1024)
+                         + b'\r\n\r\n')
+        except ConnectionError:
+            pass
+        status, headers, _ = _read_response(stream)
+    assert status == 431
+    assert headers['connection'] == 'close'
+
+
+def test_oversized_body_is_rejected(running_server):
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        sock.sendall(b'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n' % (server.MAX_BODY_BYTES + 1))
+        assert _read_response(stream)[0] == 413
+
+
+def test_client_disconnect_during_stream_releases_worker(running_server):
+    streams_closed.clear()
+    sock, stream = _connect(running_server)
+    sock.sendall(b'GET /endless HTTP/1.1\r\nHost: x\r\n\r\n')
+    assert stream.readline().startswith(b'HTTP/1.1 200')
+    stream.read(100000)
+    stream.close()
+    sock.close()
+
+    # 工作线程在下一次写出失败后放弃响应并关闭生成器，不会把 6 GB 的响应写完
+    deadline = time.monotonic() + 10
+    while (not streams_closed or running_server._inflight) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert streams_closed
+    assert running_server._inflight == 0
+
+    # 服务器继续正常服务
+    sock, stream = _connect(running_server)
+    with sock, stream:
+        sock.sendall(b'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: 2\r\n\r\nok')
+        assert _read_response(stream)[0] == 200
+
+
+def test_sse_disconnect_unsubscribes(running_server):
+    sock, stream = _connect(running_server)
+    sock.sendall(b'GET /api/events HTTP/1.1\r\nHost: x\r\n\r\n')
+    assert stream.readline().startswith(b'HTTP/1.1 200')
+    deadline = time.monotonic() + 5
+    while not running_server.hub.subscribers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(running_server.hub.subscribers) == 1
+    stream.close()
+    sock.close()
+
+    # 客户端断开后，下一次推送写出失败即取消订阅
+    deadline = time.monotonic() + 10
+    while running_server.hub.subscribers and time.monotonic() < deadline:
+        running_server.loop.call_soon_threadsafe(running_server.hub.publish, b'data: {}\n\n')
+        time.sleep(0.05)
+    assert not running_server.hub.subscribers
+
+
+def test_health_endpoints_before_app_is_loaded():
+    srv = ProductionServer(None, host='127.0.0.1', port=0, startup_wait=1)
+    thread = threading.Thread(target=srv.serve, daemon=True)
+    thread.start()
+    assert srv.wait_listening(5)
+    try:
+        for path, expected in (('/healthz', 200), ('/readyz', 503)):
+            sock, stream = _connect(srv)
+            with sock, stream:
+                sock.sendall(b'GET %s HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n' % path.encode())
+                status, _, body = _read_response(stream)
+            assert status == expected
+            assert json.loads(body)['status'] == 'starting'
+        sock, stream = _connect(srv)
+        with sock, stream:
+            sock.sendall(b'GET /echo HTTP/1.1\r\nHost: x\r\n\r\n')
+            status, headers, _ = _read_response(stream)
+        assert status == 503
+        assert headers['retry-after'] == '5'
+    finally:
+        srv.stop()
+        thread.join(10)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+SQL 剖析测试（sql_profiler.py）：查询形状、疑似 N+1、慢查询日志、X-SQL-Profile 响应头
+"""
+import json
+
+import pytest
+
+import api
+import sql_profiler
+from data_cache import DataVersion, VersionedCache
+from models import Device, db
+
+
+@pytest.fixture
+def profiler(temp_db, monkeypatch):
+    """启用剖析（debug 模式），清空最近记录与告警节流"""
+    monkeypatch.setattr(sql_profiler, 'SQL_PROFILE', 'debug')
+    monkeypatch.setattr(db, 'query_hook', sql_profiler._record)
+    monkeypatch.setattr(sql_profiler, '_reported', {})
+    sql_profiler.recent_slow.clear()
+    sql_profiler.recent_repeats.clear()
+    yield
+    sql_profiler._local.profile = None
+    sql_profiler.recent_slow.clear()
+    sql_profiler.recent_repeats.clear()
+
+
+def test_query_shape_folds_in_lists():
+    assert sql_profiler.query_shape('SELECT *\n  FROM t WHERE id IN (?, ?,?)') == \
+        sql_profiler.query_shape('SELECT * FROM t WHERE id IN (?, ?)') == 'SELECT * FROM t WHERE id IN (?, ...)'
+    assert sql_profiler.query_shape('SELECT * FROM t WHERE a = ? AND b = ?') == 'SELECT * FROM t WHERE a = ? AND b = ?'
+
+
+def test_disabled_profiler_does_nothing(monkeypatch):
+    monkeypatch.setattr(sql_profiler, 'SQL_PROFILE', '')
+    assert sql_profiler.begin('GET x') is None
+    assert sql_profiler.end() is None
+    assert not sql_profiler.header_enabled(debug=True)
+
+
+def test_profile_keeps_slowest_statements(monkeypatch):
+    monkeypatch.setattr(sql_profiler, 'SQL_PROFILE_TOP', 2)
+    profile = sql_profiler.QueryProfile('unit')
+    for i, elapsed in enumerate((0.003, 0.001, 0.005, 0.002)):
+        profile.add(f'SELECT {i}', elapsed)
+    assert profile.count == 4
+    assert profile.total == pytest.approx(0.011)
+    assert profile.slowest == [(0.005, 'SELECT 2'), (0.003, 'SELECT 0')]
+
+
+def test_repeated_shape_is_reported_once(profiler, caplog):
+    devices = [Device.create(device_key=f'DEV{i}', name=f'机器 {i}') for i in range(6)]
+    for _ in range(2):
+        with sql_profiler.profile('GET players') as profile:
+            Device.select().count()
+            for device in devices:
+                Device.get_by_id(device.id)
+        repeated = profile.repeated()
+        assert len(repeated) == 1 and repeated[0][1] == 6
+        assert profile.count == 7
+    # 同一单元同一形状在节流时间内只告警一次
+    assert len(sql_profiler.recent_repeats) == 1
+    assert sql_profiler.recent_repeats[0]['unit'] == 'GET players'
+    assert sum('疑似 N+1' in record.getMessage() for record in caplog.records) == 1
+
+
+def test_slow_query_is_logged_with_plan(profiler, tmp_path, monkeypatch):
+    log_path = tmp_path / 'slow.jsonl'
+    monkeypatch.setattr(sql_profiler, 'SQL_SLOW_QUERY_MS', 0)
+    monkeypatch.setattr(sql_profiler, 'SQL_SLOW_LOG', str(log_path))
+    with sql_profiler.profile('mqtt'):
+        Device.select().where(Device.device_key == 'DEV1').first()
+    entries = [json.loads(line) for line in log_path.read_text(encoding='utf-8').splitlines()]
+    select = next(entry for entry in entries if entry['sql'].startswith('SELECT'))
+    assert select['unit'] == 'mqtt'
+    assert select['params'] == ["'DEV1'", '1']
+    assert select['plan'] and not select['plan'][0].startswith('EXPLAIN 失败')
+    assert list(sql_profiler.recent_slow) == entries
+
+
+def test_response_carries_profile_header(profiler, monkeypatch):
+    # 独立的响应缓存：不能命中其他测试缓存的响应（命中时不执行 SQL）
+    version = DataVersion(db.database)
+    monkeypatch.setattr(api, 'data_version', version)
+    monkeypatch.setattr(api, 'response_cache', VersionedCache(version))
+    client = api.app.test_client()
+    response = client.get('/api/players')
+    assert response.status_code == 200
+    header = response.headers['X-SQL-Profile']
+    assert header.startswith('queries=') and int(header.split(';')[0].split('=')[1]) >= 1
+    data = client.get('/api/debug/sql-profile').get_json()['data']
+    assert data['enabled'] and data['repeat_threshold'] == sql_profiler.SQL_PROFILE_REPEAT
+
+
+def test_header_requires_debug_mode(profiler, monkeypatch):
+    monkeypatch.setattr(sql_profiler, 'SQL_PROFILE', '1')
+    assert 'X-SQL-Profile' not in api.app.test_client().get('/api/players').headers
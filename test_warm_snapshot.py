@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+启动快照测试（warm_snapshot.py）：保存 / 载入、数据库或代码变化后放弃快照
+"""
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+import api
+import device_dimension
+import warm_snapshot
+from conftest import play
+from data_cache import DataVersion, VersionedCache
+from models import db, Device
+
+
+@pytest.fixture
+def snapshot_path(tracker, tmp_path, monkeypatch):
+    # 数据版本连接与响应缓存绑定到本测试的临时数据库
+    version = DataVersion(db.database)
+    monkeypatch.setattr(api, 'data_version', version)
+    monkeypatch.setattr(api, 'response_cache', VersionedCache(version))
+    play(tracker, 'DEV1', '机器 1', datetime.now(timezone.utc).replace(microsecond=0), 0)
+    client = api.app.test_client()
+    assert client.get('/api/players').status_code == 200
+    assert client.get('/api/campus-projects').status_code == 200
+    if not db.is_closed():
+        db.close()
+    return str(tmp_path / 'warm_snapshot.pkl')
+
+
+def test_snapshot_restores_response_cache(snapshot_path):
+    assert warm_snapshot.save_snapshot(snapshot_path) == 2
+    api.response_cache.clear()
+    device_dimension._device_ids.clear()
+
+    assert warm_snapshot.load_snapshot(snapshot_path) == 2
+    assert not os.path.exists(snapshot_path)
+    assert device_dimension._device_ids == {('DEV1', '机器 1'): 1}
+    hits = api.response_cache.hits
+    assert api.app.test_client().get('/api/players').status_code == 200
+    assert api.response_cache.hits == hits + 1
+
+
+def test_snapshot_is_ignored_after_a_write(snapshot_path):
+    assert warm_snapshot.save_snapshot(snapshot_path) == 2
+    api.response_cache.clear()
+    Device.create(device_key='DEV2', name='机器 2')
+    db.close()
+    assert warm_snapshot.load_snapshot(snapshot_path) is None
+    # 放弃的快照同样删除
+    assert not os.path.exists(snapshot_path)
+    assert api.response_cache.export_current(api.data_version.current()) == []
+
+
+def test_snapshot_is_ignored_when_code_changes(snapshot_path, monkeypatch):
+    assert warm_snapshot.save_snapshot(snapshot_path) == 2
+    monkeypatch.setattr(warm_snapshot, '_code_fingerprint', lambda: 'changed')
+    assert warm_snapshot.load_snapshot(snapshot_path) is None
+    assert warm_snapshot.load_snapshot(snapshot_path) is None
+
+
+def test_empty_path_disables_snapshot(snapshot_path):
+    assert warm_snapshot.save_snapshot('') is None
+    assert warm_snapshot.load_snapshot('') is None
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+紧凑消息格式测试（wire_format.py）
+"""
+import pytest
+
+import wire_format
+from conftest import deliver
+from models import Device, GameSession
+from wire_format import CompactFormatError, encode_compact, is_compact, parse_compact
+
+
+@pytest.mark.parametrize('kwargs, expected', [
+    ({'event': 'heartbeat', 'ble_suffix': 'abc'}, {'event': 'heartbeat', 'bleId': 'MICROBLOCKSABC'}),
+    ({'event': 'game_start', 'ble_suffix': 'ABC', 'seq': 17},
+     {'event': 'game_start', 'bleId': 'MICROBLOCKSABC', 'seq': '17'}),
+    ({'event': 'game_end', 'seq': 3, 'player_id': 'p1', 'player_name': '一楼|娃娃机'},
+     {'event': 'game_end', 'seq': '3', 'playerId': 'p1', 'playerName': '一楼|娃娃机'}),
+    ({'event': 'game_start', 'player_id': 'p1', 'player_name': '机器'},
+     {'event': 'game_start', 'playerId': 'p1', 'playerName': '机器'}),
+])
+def test_round_trip(kwargs, expected):
+    payload = encode_compact(**kwargs)
+    assert is_compact(payload)
+    assert parse_compact(payload) == expected
+
+
+def test_heartbeat_is_a_few_bytes():
+    assert encode_compact('heartbeat', 'ABC') == b'H|ABC'
+
+
+@pytest.mark.parametrize('payload', [b'{"event": "heartbeat"}', b' {}', b'H', b'X|ABC', b''])
+def test_json_and_garbage_are_not_compact(payload):
+    assert not is_compact(payload)
+
+
+@pytest.mark.parametrize('payload', [b'H|AB', b'H|AB1', b'S|ABCD', b'S||1|\xff\xfe|x'])
+def test_invalid_payloads_raise(payload):
+    with pytest.raises(CompactFormatError):
+        parse_compact(payload)
+
+
+def test_partition_key_matches_parsed_device():
+    assert wire_format.partition_key(b'H|abc') == parse_compact(b'H|abc')['bleId']
+    assert wire_format.partition_key(b'E||3|p1|x') == 'p1'
+
+
+def test_compact_messages_are_ingested_like_json(tracker):
+    deliver(tracker, encode_compact('game_start', seq=1, player_id='p1', player_name='一楼娃娃机'))
+    deliver(tracker, encode_compact('game_end', seq=2, player_id='p1', player_name='一楼娃娃机'))
+    session = GameSession.get()
+    assert Device.get_by_id(session.device_id).device_key == 'p1'
+    assert session.end_time is not None
+    # 格式错误的紧凑消息被拒绝，不会写库
+    deliver(tracker, b'S|A1')
+    assert GameSession.select().count() == 1
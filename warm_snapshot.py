@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+启动快照：优雅关闭时保存内存中的热数据，下次启动直接载入，而不是重新扫描数据库
+
+fly.io 上机器空闲即停止（auto_stop_machines），每次唤醒都是冷启动：第一个打开仪表盘的人
+要等所有统计重新计算。快照保存：
+
+- 响应缓存（api.response_cache）中与当前数据版本一致、当天有效的条目
+  （按时间分桶的在线状态类接口不保存，重启后本来就已过期）
+- 设备维度缓存（device_dimension._device_ids）与当天已置位的活跃设备（active_bitmaps._marked）
+
+只有数据库与保存时完全相同才载入：保存前先做 TRUNCATE checkpoint，记录主库文件的大小与
+修改时间以及 WAL 大小（任何写入都会改变它们，打开连接、只读查询、关闭连接不会）；代码有改动（*.py 的
+大小 / 修改时间）或格式版本不同时同样放弃快照。
+
+- 路径：WARM_SNAPSHOT_PATH（默认与数据库同目录的 warm_snapshot.pkl），设为空字符串关闭
+- 快照文件只由本进程写入、读取（pickle），载入后即删除，避免下次误用过期快照
+"""
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import time
+from datetime import datetime, timezone
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+SNAPSHOT_PATH = os.environ.get(
+    'WARM_SNAPSHOT_PATH', os.path.join(os.path.dirname(db.database) or '.', 'warm_snapshot.pkl'))
+
+# cached_json 的缓存 key 为 (路径, 查询参数, 日期)，按时间分桶的接口再多一个分桶序号
+_DATED_KEY_LENGTH = 3
+
+
+def _code_fingerprint():
+    digest = hashlib.sha1()
+    base = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(base, '*.py'))):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    except FileNotFoundError:
+        return 0, 0
+
+
+def database_signature():
+    """数据库文件签名：(主库大小, 主库修改时间, WAL 大小)"""
+    return _file_stat(db.database) + (_file_stat(db.database + '-wal')[0],)
+
+
+def _consistent_state(data_version):
+    """先把 WAL 合并进主库并清空，返回 (数据版本, 签名)；期间有其他连接写入时返回 None。
+    checkpoint 必须在读取版本的连接上执行，否则 checkpoint 本身也会改变它读到的 data_version
+    """
+    version = data_version.current()
+    if not data_version.checkpoint():
+        return None
+    signature = database_signature()
+    if data_version.current() != version:
+        return None
+    return version, signature
+
+
+def _today_key(today):
+    return lambda key: len(key) == _DATED_KEY_LENGTH and key[2] == today
+
+
+def save_snapshot(path=None):
+    """保存快照（优雅关闭时调用），返回保存的缓存条目数；期间有写入或关闭快照时返回 None"""
+    path = SNAPSHOT_PATH if path is None else path
+    if not path:
+        return None
+    import active_bitmaps
+    import device_dimension
+    from api import data_version, response_cache
+
+    started = time.perf_counter()
+    try:
+        state = _consistent_state(data_version)
+        if state is not None:
+            version, signature = state
+            entries = response_cache.export_current(version, _today_key(datetime.now(timezone.utc).date()))
+            device_ids = dict(device_dimension._device_ids)
+            marked = (active_bitmaps._marked_day, set(active_bitmaps._marked))
+        if state is None or data_version.current() != version:
+            # 导出期间有其他连接写入，无法确认缓存与签名对应同一份数据
+            logger.info("保存启动快照时数据库有写入，跳过")
+            return None
+        payload = {
+            'format': FORMAT_VERSION,
+            'code': _code_fingerprint(),
+            'database': os.path.abspath(db.database),
+            'signature': signature,
+            'saved_at': time.time(),
+            'response_cache': entries,
+            'device_ids': device_ids,
+            'marked': marked,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"保存启动快照失败: {e}")
+        return None
+    logger.info(f"已保存启动快照: {len(entries)} 个缓存条目, {len(device_ids)} 个设备 "
+                f"({(time.perf_counter() - started) * 1000:.1f} ms)")
+    return len(entries)
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def load_snapshot(path=None):
+    """载入快照（init_db 之后调用），返回载入的缓存条目数；没有可用快照时返回 None"""
+    path = SNAPSHOT_PATH if path is None else path
+    if not path or not os.path.exists(path):
+        return None
+    import active_bitmaps
+    import device_dimension
+    from api import data_version, response_cache
+
+    started = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            payload = pickle.load(f)
+        if payload.get('format') != FORMAT_VERSION or payload.get('code') != _code_fingerprint() \
+                or payload.get('database') != os.path.abspath(db.database):
+            logger.info("启动快照与当前代码或数据库不匹配，忽略")
+            return None
+        state = _consistent_state(data_version)
+        if state is None or state[1] != payload['signature']:
+            logger.info("数据库在快照保存后有变化，忽略启动快照")
+            return None
+        version = state[0]
+        today = datetime.now(timezone.utc).date()
+        count = response_cache.import_entries(
+            [(key, value) for key, value in payload['response_cache'] if _today_key(today)(key)], version)
+        device_dimension._device_ids.update(payload['device_ids'])
+        marked_day, marked = payload['marked']
+        if marked_day == today and active_bitmaps._marked_day in (None, today):
+            active_bitmaps._marked_day = marked_day
+            active_bitmaps._marked.update(marked)
+    except Exception as e:
+        logger.warning(f"载入启动快照失败: {e}")
+        return None
+    finally:
+        _discard(path)
+    logger.info(f"已载入启动快照: {count} 个缓存条目, {len(payload['device_ids'])} 个设备 "
+                f"({(time.perf_counter() - started) * 1000:.1f} ms)")
+    return count
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+紧凑消息格式（供 MicroBlocks 等微控制器设备使用）
+
+与 JSON 消息共用 game 主题，按首字节自动识别：
+
+    <事件码>|<BLE 后缀>[|<seq>[|<playerId>|<playerName>]]
+
+- 事件码：S = game_start，E = game_end，H = heartbeat
+- BLE 后缀：BLE 名称 "MicroBlocks ABC" 中的 3 个字母（ABC），即已规范化的设备 ID，
+  服务端直接得到 MICROBLOCKSABC，无需正则规范化；为空时必须提供 playerId 与 playerName
+- seq：可选的设备端序号（用于去重，见 dedup.py）
+- playerId / playerName：可选的后备标识（BLE ID 未在注册表中时使用），playerName 可以包含 |
+
+示例：
+    H|ABC            心跳（约 5 字节，对应 JSON 约 90 字节）
+    S|ABC|17         游戏开始，序号 17
+    E||3|p1|一楼娃娃机  没有 BLE 的设备
+
+解析结果与 JSON 消息的字段名一致，后续处理流程不变。
+"""
+
+EVENT_CODES = {
+    'S': 'game_start',
+    'E': 'game_end',
+    'H': 'heartbeat',
+}
+EVENT_TO_CODE = {event: code for code, event in EVENT_CODES.items()}
+
+_CODE_BYTES = frozenset(ord(code) for code in EVENT_CODES)
+_SEPARATOR = ord('|')
+
+
+class CompactFormatError(ValueError):
+    """紧凑格式消息无法解析"""
+
+
+def is_compact(payload: bytes) -> bool:
+    """首字节为事件码且第二个字节为分隔符（JSON 总是以 { 或空白开头）"""
+    return len(payload) >= 2 and payload[0] in _CODE_BYTES and payload[1] == _SEPARATOR
+
+
+def parse_compact(payload: bytes) -> dict:
+    """解析紧凑格式消息，返回与 JSON 消息相同字段名的 dict（bleId 为规范化后的值）"""
+    fields = payload.split(b'|', 4)
+    message = {'event': EVENT_CODES[chr(payload[0])]}
+
+    suffix = fields[1] if len(fields) > 1 else b''
+    if suffix:
+        if len(suffix) != 3 or not suffix.isalpha():
+            raise CompactFormatError(f"BLE 后缀必须是 3 个字母: {suffix!r}")
+        message['bleId'] = 'MICROBLOCKS' + suffix.decode('ascii').upper()
+
+    if len(fields) > 2 and fields[2]:
+        message['seq'] = fields[2].decode('ascii', errors='replace')
+
+    if len(fields) > 3:
+        try:
+            if fields[3]:
+                message['playerId'] = fields[3].decode('utf-8')
+            if len(fields) > 4 and fields[4]:
+                message['playerName'] = fields[4].decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise CompactFormatError(f"playerId/playerName 不是有效的 UTF-8: {e}")
+    return message
+
+
+def encode_compact(event, ble_suffix='', seq=None, player_id=None, player_name=None) -> bytes:
+    """生成紧凑格式消息（测试与设备端参考实现）"""
+    fields = [EVENT_TO_CODE[event], ble_suffix or '']
+    if seq is not None or player_id or player_name:
+        fields.append('' if seq is None else str(seq))
+    if player_id or player_name:
+        fields.extend([player_id or '', player_name or ''])
+    return '|'.join(fields).encode('utf-8')
+
+
+def partition_key(payload: bytes) -> str:
+    """紧凑格式消息的分区 key（与 JSON 消息的 device_key 规则一致）"""
+    fields = payload.split(b'|', 4)
+    suffix = fields[1] if len(fields) > 1 else b''
+    if len(suffix) == 3 and suffix.isalpha():
+        return 'MICROBLOCKS' + suffix.decode('ascii').upper()
+    if len(fields) > 3:
+        return fields[3].decode('utf-8', errors='replace')
+    return ''